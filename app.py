@@ -1,105 +1,145 @@
 # app.py (Struttura Modulare a Fasi)
 # Gestisce l'UI Streamlit e chiama il gestore dello stato/logica.
+# Le dipendenze pesanti (google.generativeai, faiss, numpy) sono importate solo dove
+# servono; gli indici RAG sono caricati in background dopo il primo rendering.
 
-import streamlit as st
 import os
-import google.generativeai as genai
 import traceback
-# Import necessari per moduli importati (anche se non usati direttamente qui)
-import faiss
-import pickle
-import numpy
-import pandas
-import glob
-import re
-import time
+import uuid
+import json
+
+from utils import log_message, StartupProfiler
+
+# Profilo di avvio: tempo di import e di ciascuno step di inizializzazione (1. ... 5.)
+startup_profiler = StartupProfiler()
+
+with startup_profiler.stage("import streamlit"):
+    import streamlit as st
 
 # Importa funzioni e configurazioni dagli altri moduli
-from utils import log_message
-from config import (
-    EMBEDDING_MODEL_NAME, GENERATION_MODEL_NAME, SAFETY_SETTINGS_GEMINI,
-    GENERATION_CONFIG_GEMINI, INTRO_MESSAGE, INITIAL_STATE
-)
-# Importa la funzione di caricamento RAG (eseguita all'avvio)
-from rag_utils import load_rag_indexes
-# Importa il GESTORE della logica principale (che poi delegherà alle fasi)
-from state_manager import process_user_message
+with startup_profiler.stage("import config"):
+    from config import (
+        EMBEDDING_MODEL_NAME, GENERATION_MODEL_NAME, SAFETY_SETTINGS_GEMINI,
+        GENERATION_CONFIG_GEMINI, INTRO_MESSAGE, INITIAL_STATE,
+        CHAT_VISIBLE_MESSAGES, CHAT_OLDER_PAGE_SIZE, RAG_DEFAULT_NAMESPACE
+    )
+# Importa le funzioni di caricamento RAG (avviato in background all'inizializzazione)
+with startup_profiler.stage("import rag_utils"):
+    from rag_utils import start_rag_loading, get_rag_status, wait_for_rag, is_known_namespace
+# Importa lo SCHEDULER dei turni (admission control davanti a state_manager.process_user_message)
+with startup_profiler.stage("import turn_scheduler/state_manager/fasi"):
+    from turn_scheduler import schedule_turn, get_scheduler
+    from state_store import StateJournal
+    from llm_interface import get_task_report
+    from context_cache import get_context_cache
+    import client_pool
+    import speculation
+    import batching
+    import turn_events
+    import distortion_classifier
+    import turn_profiler
+    from session_memory import MessageHistory, get_session_registry
+    import metrics
 
 # --- CONFIGURAZIONE INIZIALE E CARICAMENTO RISORSE ---
-# (Identica alle versioni precedenti, eseguita una sola volta)
+# (Eseguita una sola volta per sessione)
 if 'initialized' not in st.session_state:
     st.session_state.initialized = False
 
+# Knowledge base della sessione (namespace, vedi config.RAG_NAMESPACES): parametro ?kb= dell'URL
+if 'rag_namespace' not in st.session_state:
+    requested_namespace = st.query_params.get('kb', RAG_DEFAULT_NAMESPACE)
+    if not is_known_namespace(requested_namespace):
+        log_message(f"WARN: Knowledge base '{requested_namespace}' richiesta dalla sessione non configurata, uso '{RAG_DEFAULT_NAMESPACE}'.")
+        requested_namespace = RAG_DEFAULT_NAMESPACE
+    st.session_state.rag_namespace = requested_namespace
+
 if not st.session_state.initialized:
     log_message("--- INIZIO INIZIALIZZAZIONE APPLICAZIONE (Modulare a Fasi) ---")
     init_success = True
-    rag_load_success = False
 
     # --- 1. Configurazione API Key ---
-    log_message("1. Configurazione API Key...")
-    GOOGLE_API_KEY = st.secrets.get("GOOGLE_API_KEY") # Usa Streamlit secrets
-    if not GOOGLE_API_KEY:
-        st.error("!!! ERRORE CRITICO: Secret 'GOOGLE_API_KEY' non trovato!"); log_message("ERRORE: GOOGLE_API_KEY non trovato.")
-        init_success = False; st.stop()
-    if init_success:
-        try:
-            genai.configure(api_key=GOOGLE_API_KEY)
-            log_message("   API Key Google configurata.")
-        except Exception as e:
-            st.error(f"!!! ERRORE Configurazione API Key: {e}"); log_message(f"ERRORE Config API Key: {e}"); init_success = False; st.stop()
+    with startup_profiler.stage("1. Configurazione API Key"):
+        log_message("1. Configurazione API Key...")
+        API_KEYS = client_pool.keys_from_secrets(st.secrets) # GOOGLE_API_KEYS o GOOGLE_API_KEY
+        if not API_KEYS:
+            st.error("!!! ERRORE CRITICO: Secret 'GOOGLE_API_KEY' (o 'GOOGLE_API_KEYS') non trovato!"); log_message("ERRORE: GOOGLE_API_KEY non trovato.")
+            init_success = False; st.stop()
+        if init_success:
+            try:
+                import google.generativeai as genai # Import pesante: solo quando serve davvero
+                # La prima chiave resta quella predefinita (context cache, script); le chiamate
+                # del turno sono distribuite sul pool condiviso del processo, scaldato in background
+                genai.configure(api_key=API_KEYS[0]['api_key'])
+                client_pool.configure(API_KEYS)
+                log_message(f"   API Key Google configurate: {len(API_KEYS)}.")
+            except Exception as e:
+                st.error(f"!!! ERRORE Configurazione API Key: {e}"); log_message(f"ERRORE Config API Key: {e}"); init_success = False; st.stop()
 
     # --- 2. Salvataggio Nome Modello Embedding ---
     if init_success:
-        log_message("2. Configurazione Modello Embedding...")
-        st.session_state.embedding_model_name = EMBEDDING_MODEL_NAME
-        log_message(f"   Modello Embedding impostato: {st.session_state.embedding_model_name}")
+        with startup_profiler.stage("2. Configurazione Modello Embedding"):
+            log_message("2. Configurazione Modello Embedding...")
+            st.session_state.embedding_model_name = EMBEDDING_MODEL_NAME
+            log_message(f"   Modello Embedding impostato: {st.session_state.embedding_model_name}")
 
     # --- 3. Configurazione Modello Generativo ---
     if init_success:
-        log_message("3. Configurazione Modello Generativo...")
-        log_message(f"   Modello Generativo Selezionato: {GENERATION_MODEL_NAME}")
-        try:
-            model_gemini = genai.GenerativeModel(
-                model_name=GENERATION_MODEL_NAME,
-                generation_config=GENERATION_CONFIG_GEMINI,
-                safety_settings=SAFETY_SETTINGS_GEMINI
-            )
-            st.session_state.model_gemini = model_gemini # Salva istanza in session_state
-            log_message(f"   Modello Generativo '{GENERATION_MODEL_NAME}' configurato.")
-        except Exception as e:
-            st.error(f"!!! ERRORE Configurazione Modello Generativo ({GENERATION_MODEL_NAME}): {e}"); log_message(f"ERRORE Config Modello Generativo: {e}"); init_success = False; st.stop()
+        with startup_profiler.stage("3. Configurazione Modello Generativo"):
+            log_message("3. Configurazione Modello Generativo...")
+            log_message(f"   Modello Generativo Selezionato: {GENERATION_MODEL_NAME}")
+            try:
+                model_gemini = genai.GenerativeModel(
+                    model_name=GENERATION_MODEL_NAME,
+                    generation_config=GENERATION_CONFIG_GEMINI,
+                    safety_settings=SAFETY_SETTINGS_GEMINI
+                )
+                st.session_state.model_gemini = model_gemini # Salva istanza in session_state
+                log_message(f"   Modello Generativo '{GENERATION_MODEL_NAME}' configurato.")
+            except Exception as e:
+                st.error(f"!!! ERRORE Configurazione Modello Generativo ({GENERATION_MODEL_NAME}): {e}"); log_message(f"ERRORE Config Modello Generativo: {e}"); init_success = False; st.stop()
 
     # --- 4. Salvataggio Costanti e Stato Iniziale ---
     if init_success:
-        log_message("4. Salvataggio Costanti e Stato Iniziale...")
-        st.session_state.INITIAL_STATE = INITIAL_STATE.copy()
-        st.session_state.INTRO_MESSAGE = INTRO_MESSAGE
-        log_message("   Costanti e Stato Iniziale salvati.")
+        with startup_profiler.stage("4. Salvataggio Costanti e Stato Iniziale"):
+            log_message("4. Salvataggio Costanti e Stato Iniziale...")
+            st.session_state.INITIAL_STATE = INITIAL_STATE.copy()
+            st.session_state.INTRO_MESSAGE = INTRO_MESSAGE
+            log_message("   Costanti e Stato Iniziale salvati.")
 
-    # --- 5. Caricamento Indici e Mappe RAG ---
+    # --- 5. Caricamento Indici e Mappe RAG (in background, fuori dal primo rendering) ---
     if init_success:
-        rag_load_success = load_rag_indexes() # Chiama funzione da rag_utils
-        if not rag_load_success:
-             log_message("ERRORE nel caricamento RAG rilevato in app.py.")
-             st.warning("Caricamento RAG fallito o parziale. La ricerca contesto potrebbe essere limitata.")
-             # Non blocchiamo l'app, ma RAG potrebbe non funzionare
-    else:
-        rag_load_success = False # Assicura che sia False se l'init precedente è fallito
+        with startup_profiler.stage("5. Avvio Caricamento RAG (background)"):
+            start_rag_loading(st.session_state.rag_namespace) # No-op se già avviato da un'altra sessione del processo
 
     # --- Fine Blocco Inizializzazione ---
     st.session_state.initialized = init_success
-    st.session_state.rag_enabled = rag_load_success
+    st.session_state.startup_profile = startup_profiler.report("Profilo di avvio sessione")
 
-    log_message(f"--- INIZIALIZZAZIONE COMPLETATA (Successo App: {st.session_state.initialized}, RAG Caricato: {st.session_state.rag_enabled}) ---")
+    log_message(f"--- INIZIALIZZAZIONE COMPLETATA (Successo App: {st.session_state.initialized}, Stato RAG: {get_rag_status(st.session_state.rag_namespace)}) ---")
     if not st.session_state.initialized:
          st.error("Applicazione non inizializzata correttamente a causa di errori critici.")
          st.stop()
 
 # --- GESTIONE SESSION STATE (Chat History e Stato Conversazione) ---
+# Identificativo della sessione (usato dallo scheduler per il limite di un turno per sessione)
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+# Numero di turni completati: rende idempotente il turno (un doppio invio dello stesso
+# messaggio con la stessa sequenza non esegue una seconda transizione). Non si azzera al
+# reset della chat, così un turno della chat precedente non viene mai riusato.
+if 'turn_seq' not in st.session_state:
+    st.session_state.turn_seq = 0
+
+# Journal dei delta di stato per turno (snapshot/rollback/persistenza)
+if 'state_journal' not in st.session_state:
+    st.session_state.state_journal = StateJournal()
+
 # Inizializza chat history se non esiste
 if 'messages' not in st.session_state:
     intro = st.session_state.get('INTRO_MESSAGE', "Ciao! Come posso aiutarti?")
-    st.session_state.messages = [{"role": "assistant", "content": intro}]
+    st.session_state.messages = MessageHistory(st.session_state.session_id, [{"role": "assistant", "content": intro}])
     log_message("Chat history inizializzata.")
 
 # Inizializza lo stato della conversazione se non esiste
@@ -110,6 +150,9 @@ if 'state' not in st.session_state:
         # Assicura che lo schema sia un dizionario
         if 'schema' not in st.session_state.state or not isinstance(st.session_state.state.get('schema'), dict):
              st.session_state.state['schema'] = initial.get('schema', {}).copy()
+        # Identificativo dell'utente per i dati che durano oltre la sessione (prove ERP):
+        # ?utente=... nell'URL, altrimenti la sessione corrente
+        st.session_state.state['user_id'] = st.query_params.get('utente') or st.session_state.session_id
         log_message(f"Stato conversazione inizializzato: {st.session_state.state}")
     else:
         log_message("ERRORE CRITICO: Stato iniziale (INITIAL_STATE) non trovato o non valido!")
@@ -120,49 +163,133 @@ if 'state' not in st.session_state:
 # --- INTERFACCIA STREAMLIT ---
 # st.title("Assistente Cognitivo-Comportamentale (Struttura a Fasi)")
 
-# Mostra la chat history esistente
-for message in st.session_state.messages:
+def state_signature(state):
+    """Firma compatta dello stato, usata per aggiornare la sidebar solo quando lo stato cambia."""
+    try:
+        return hash(json.dumps(state, sort_keys=True, default=str))
+    except Exception:
+        return None
+
+def render_conversation_state(placeholder):
+    """
+    Disegna lo stato della conversazione (debug) nel placeholder della sidebar. Viene
+    chiamata sia nel rerun completo sia dal fragment della chat, che aggiorna così la
+    sidebar direttamente, senza richiedere un rerun dell'intero script.
+    """
+    state = st.session_state.get('state')
+    st.session_state.sidebar_state_signature = state_signature(state)
+    with placeholder.container():
+        if isinstance(state, dict):
+            st.markdown(f"**Fase Corrente:** `{state.get('phase', 'N/D')}`")
+            st.caption("Schema Raccolto:")
+            st.json(state.get('schema', {}))
+        else:
+            st.warning("Stato non ancora inizializzato o non valido.")
+
+def render_message(message):
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
-# Input utente
-if prompt := st.chat_input("Scrivi qui il tuo messaggio..."):
-    # Aggiungi messaggio utente alla history e visualizzalo
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    with st.chat_message("user"):
-        st.markdown(prompt)
-
-    # Genera risposta del bot chiamando il state_manager
-    with st.chat_message("assistant"):
-        message_placeholder = st.empty()
-        message_placeholder.markdown("...") # Indicatore "Sto pensando..."
-
-        # Verifica stato prima di chiamare la logica
-        if 'state' in st.session_state and isinstance(st.session_state.state, dict):
-            current_state_for_logic = st.session_state.state
-            try:
-                # --- Chiamata al gestore della logica principale ---
-                response, new_state = process_user_message(prompt, current_state_for_logic)
-                # --------------------------------------------------
+def render_older_messages(messages, older_count):
+    """
+    Mostra i messaggi più vecchi solo su richiesta, una pagina alla volta
+    (anche quelli già scaricati su disco, letti tramite MessageHistory.page).
+    """
+    if older_count <= 0:
+        return
+    show_older = st.toggle(f"Mostra messaggi precedenti ({older_count})", key="show_older_messages")
+    if not show_older:
+        return
+    page_count = (older_count + CHAT_OLDER_PAGE_SIZE - 1) // CHAT_OLDER_PAGE_SIZE
+    page = st.number_input("Pagina", min_value=1, max_value=page_count, value=page_count, step=1, key="older_messages_page")
+    page_start = (int(page) - 1) * CHAT_OLDER_PAGE_SIZE
+    page_size = min(CHAT_OLDER_PAGE_SIZE, older_count - page_start)
+    if isinstance(messages, MessageHistory):
+        page_messages = messages.page(page_start, page_size)
+    else:
+        page_messages = messages[page_start:page_start + page_size]
+    for message in page_messages:
+        render_message(message)
+    st.divider()
 
-                # Aggiorna stato e visualizza/salva risposta
-                st.session_state.state = new_state # Aggiorna lo stato globale
-                log_message(f"Stato aggiornato da state_manager - Fase: {st.session_state.state.get('phase')}")
-                message_placeholder.markdown(response) # Mostra la risposta completa
-                st.session_state.messages.append({"role": "assistant", "content": response})
+@st.fragment
+def render_chat():
+    """
+    Area chat isolata in un fragment: l'invio di un messaggio riesegue solo questa
+    funzione (non l'intero script né la sidebar). Vengono renderizzati solo gli ultimi
+    CHAT_VISIBLE_MESSAGES messaggi; i precedenti sono paginati su richiesta.
+    Con il toggle "Profila i rerun" ogni esecuzione (turno compreso) viene profilata.
+    """
+    with turn_profiler.profiling('rerun', st.session_state.session_id, enabled=st.session_state.get('profile_turns', False)):
+        _render_chat()
 
-            except Exception as e:
-                log_message(f"ERRORE durante process_user_message: {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
-                st.error(f"Si è verificato un errore nell'elaborazione della risposta: {e}")
-                error_message = "Mi dispiace, si è verificato un errore interno. Per favore, prova a riformulare o riavvia la chat."
+def _render_chat():
+    # Registra l'attività della sessione (ripristina messaggi e journal se scaricati per
+    # inattività) prima di leggere o aggiungere messaggi
+    get_session_registry().touch(st.session_state.session_id, st.session_state.messages,
+                                 st.session_state.state, st.session_state.state_journal)
+    messages = st.session_state.messages
+    visible_start = max(0, len(messages) - CHAT_VISIBLE_MESSAGES)
+    render_older_messages(messages, getattr(messages, 'offloaded_count', 0) + visible_start)
+    for message in messages[visible_start:]:
+        render_message(message)
+
+    # Input utente
+    if prompt := st.chat_input("Scrivi qui il tuo messaggio..."):
+        # Aggiungi messaggio utente alla history e visualizzalo (una sola volta per turno:
+        # se la run precedente è stata interrotta a metà, il messaggio è già in history)
+        turn_seq = st.session_state.turn_seq
+        if st.session_state.get('pending_turn') != (turn_seq, prompt):
+            st.session_state.pending_turn = (turn_seq, prompt)
+            st.session_state.messages.append({"role": "user", "content": prompt})
+        render_message({"role": "user", "content": prompt})
+
+        # Genera risposta del bot chiamando il state_manager
+        with st.chat_message("assistant"):
+            message_placeholder = st.empty()
+            message_placeholder.markdown("...") # Indicatore "Sto pensando..."
+
+            # Verifica stato prima di chiamare la logica
+            if 'state' in st.session_state and isinstance(st.session_state.state, dict):
+                current_state_for_logic = st.session_state.state
+                try:
+                    # --- Chiamata al gestore della logica principale (tramite scheduler) ---
+                    response, new_state = schedule_turn(st.session_state.session_id, prompt, current_state_for_logic,
+                                                        journal=st.session_state.state_journal, turn_seq=turn_seq,
+                                                        namespace=st.session_state.rag_namespace)
+                    # --------------------------------------------------
+
+                    message_placeholder.markdown(response) # Mostra la risposta completa
+                    if st.session_state.turn_seq == turn_seq:
+                        # Aggiorna stato e salva risposta
+                        st.session_state.state = new_state # Aggiorna lo stato globale
+                        log_message(f"Stato aggiornato da state_manager - Fase: {st.session_state.state.get('phase')}")
+                        st.session_state.messages.append({"role": "assistant", "content": response})
+                        st.session_state.turn_seq = turn_seq + 1
+                        st.session_state.pending_turn = None
+                    else:
+                        log_message(f"Turno #{turn_seq} già registrato da un invio precedente, nessun aggiornamento.")
+
+                except Exception as e:
+                    log_message(f"ERRORE durante process_user_message: {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
+                    st.error(f"Si è verificato un errore nell'elaborazione della risposta: {e}")
+                    error_message = "Mi dispiace, si è verificato un errore interno. Per favore, prova a riformulare o riavvia la chat."
+                    message_placeholder.markdown(error_message)
+                    st.session_state.messages.append({"role": "assistant", "content": error_message})
+                    st.session_state.pending_turn = None
+            else:
+                st.error("Errore critico: Stato conversazione perso o non valido.")
+                log_message("ERRORE CRITICO: st.session_state.state non trovato o non valido prima di process_user_message.")
+                error_message = "Errore interno grave (stato perso). Si consiglia di riavviare la chat."
                 message_placeholder.markdown(error_message)
                 st.session_state.messages.append({"role": "assistant", "content": error_message})
-        else:
-            st.error("Errore critico: Stato conversazione perso o non valido.")
-            log_message("ERRORE CRITICO: st.session_state.state non trovato o non valido prima di process_user_message.")
-            error_message = "Errore interno grave (stato perso). Si consiglia di riavviare la chat."
-            message_placeholder.markdown(error_message)
-            st.session_state.messages.append({"role": "assistant", "content": error_message})
+
+        get_session_registry().touch(st.session_state.session_id, st.session_state.messages,
+                                     st.session_state.state, st.session_state.state_journal)
+
+        # Lo stato di debug nella sidebar viene ridisegnato (nel suo placeholder) solo se è cambiato
+        if state_signature(st.session_state.get('state')) != st.session_state.get('sidebar_state_signature'):
+            render_conversation_state(sidebar_state_placeholder)
 
 
 # --- Sidebar ---
@@ -175,9 +302,14 @@ if st.sidebar.button("Pulisci Chat e Riavvia"):
     initial = st.session_state.get('INITIAL_STATE')
 
     if intro and initial and isinstance(initial, dict):
-        st.session_state.messages = [{"role": "assistant", "content": intro}]
+        if isinstance(st.session_state.get('messages'), MessageHistory):
+            st.session_state.messages.discard_offloaded()
+        st.session_state.messages = MessageHistory(st.session_state.session_id, [{"role": "assistant", "content": intro}])
         st.session_state.state = initial.copy()
         st.session_state.state['schema'] = initial.get('schema', {}).copy()
+        st.session_state.state['user_id'] = st.query_params.get('utente') or st.session_state.session_id
+        st.session_state.state_journal = StateJournal()
+        st.session_state.pending_turn = None
         log_message("Chat e stato resettati ai valori iniziali.")
         st.rerun()
     else:
@@ -185,18 +317,122 @@ if st.sidebar.button("Pulisci Chat e Riavvia"):
          st.error("Impossibile resettare la chat correttamente.")
 
 # Mostra lo stato corrente nella sidebar per debug
+# (in un placeholder: il fragment della chat lo aggiorna quando lo stato cambia, vedi render_chat)
 st.sidebar.divider()
 st.sidebar.subheader("Stato Conversazione (Debug)")
-if 'state' in st.session_state and isinstance(st.session_state.state, dict):
-    st.sidebar.markdown(f"**Fase Corrente:** `{st.session_state.state.get('phase', 'N/D')}`")
-    st.sidebar.caption("Schema Raccolto:")
-    st.sidebar.json(st.session_state.state.get('schema', {}))
-    # with st.sidebar.expander("Mostra stato completo"):
-    #     st.sidebar.json(st.session_state.state)
-else:
-    st.sidebar.warning("Stato non ancora inizializzato o non valido.")
+sidebar_state_placeholder = st.sidebar.empty()
+render_conversation_state(sidebar_state_placeholder)
+
+render_chat()
 
 st.sidebar.divider()
-st.sidebar.caption(f"RAG Abilitato: {'Sì' if st.session_state.get('rag_enabled', False) else 'No'}")
+rag_status = get_rag_status(st.session_state.rag_namespace)
+rag_status_labels = {'ready': 'Sì', 'loading': 'Caricamento in corso...', 'failed': 'No (caricamento fallito o parziale)', 'not_started': 'No'}
+st.sidebar.caption(f"RAG Abilitato: {rag_status_labels.get(rag_status, rag_status)}")
+rag_resources = wait_for_rag(0, st.session_state.rag_namespace)
+if rag_resources:
+    st.sidebar.caption(f"Knowledge base: {st.session_state.rag_namespace} - Generazione Indici RAG: {rag_resources.get('generation', 'N/D')}")
 st.sidebar.caption(f"Modello Generativo: {GENERATION_MODEL_NAME}")
 
+# Profilatura dei rerun della chat di questa sessione (cProfile, vedi turn_profiler.py)
+st.sidebar.toggle("Profila i rerun (cProfile)", key="profile_turns")
+profile_reports = turn_profiler.recent_reports(st.session_state.session_id)
+if profile_reports:
+    last_profile = profile_reports[0]
+    with st.sidebar.expander(f"Ultimo profilo: {last_profile['label']} ({last_profile['seconds'] * 1000:.0f} ms)"):
+        st.caption(f"File: {last_profile['path'] or 'non salvato'}")
+        st.caption("Funzioni per tempo proprio:")
+        st.dataframe(last_profile['self'], hide_index=True)
+        st.caption("Funzioni per tempo cumulativo:")
+        st.dataframe(last_profile['cumulative'], hide_index=True)
+
+# Metriche dello scheduler dei turni (condivise tra tutte le sessioni del processo)
+scheduler_stats = get_scheduler().stats()
+turn_metrics = metrics.snapshot(prefix='turns.')
+queue_wait = turn_metrics['samples'].get('turns.queue_wait_seconds', {})
+st.sidebar.caption(
+    f"Turni attivi: {scheduler_stats['active']}/{scheduler_stats['max_concurrency']} - "
+    f"In coda: {scheduler_stats['queue_depth']}/{scheduler_stats['max_queue_depth']}"
+)
+if queue_wait.get('count'):
+    st.sidebar.caption(f"Attesa in coda p50/p95: {queue_wait['p50']:.2f}s / {queue_wait['p95']:.2f}s")
+degraded_counters = {name[len('turns.degraded.'):]: value for name, value in turn_metrics['counters'].items()
+                     if name.startswith('turns.degraded.')}
+if degraded_counters:
+    st.sidebar.caption("Fallback per deadline del turno: " + ", ".join(f"{name} {value}" for name, value in sorted(degraded_counters.items())))
+
+# Eventi analitici per turno (vedi turn_events.py)
+events_stats = turn_events.get_writer().stats()
+if events_stats['recorded']:
+    st.sidebar.caption(f"Eventi turno: {events_stats['written']} scritti, {events_stats['buffered']} in attesa"
+                       + (f", {events_stats['write_errors']} errori di scrittura" if events_stats['write_errors'] else ""))
+
+# Latenza e costo per task LLM (model tiering, vedi config.LLM_TASKS)
+with st.sidebar.expander("Modelli per task"):
+    for row in get_task_report():
+        latency_text = f"{row['latency_p50']:.2f}s / {row['latency_p95']:.2f}s" if row['latency_p50'] is not None else "N/D"
+        st.caption(f"**{row['task']}** ({row['model']}): {row['calls']} chiamate, p50/p95 {latency_text}, "
+                   f"token {row['input_tokens']}+{row['output_tokens']}, ~${row['cost_usd']:.4f}")
+
+    context_cache = get_context_cache()
+    if context_cache:
+        cache_stats = context_cache.stats()
+        hit_rate_text = f"{cache_stats['hit_rate']:.0%}" if cache_stats['hit_rate'] is not None else "N/D"
+        st.caption(f"Context cache ({cache_stats['backend']}): hit {cache_stats['hits']}, miss {cache_stats['misses']} "
+                   f"({hit_rate_text}), ~{cache_stats['cached_tokens']} token da cache, {cache_stats['inline']} prefissi inline")
+
+    speculation_stats = speculation.stats()
+    if speculation_stats['predictions']:
+        hit_rate_text = f"{speculation_stats['hit_rate']:.0%}" if speculation_stats['hit_rate'] is not None else "N/D"
+        st.caption(f"Precalcolo speculativo: {speculation_stats['predictions']} previsioni, hit {speculation_stats['hits']} "
+                   f"({hit_rate_text}), risorse usate {speculation_stats['assets_used']}/{speculation_stats['assets_computed']}, "
+                   f"scartate {speculation_stats['assets_wasted']}, saltate per carico {speculation_stats['skipped_busy']}")
+
+    # Micro-batching tra sessioni di embedding e ricerche FAISS (vedi batching.py)
+    for batcher_name, label in (('embed', "Embedding"), ('faiss_search', "Ricerche FAISS")):
+        batch_report = batching.report(batcher_name)
+        if batch_report['batches']:
+            queue_p95 = batch_report['queue_seconds'].get('p95') or 0.0
+            st.caption(f"{label}: {batch_report['requests']} richieste in {batch_report['batches']} batch "
+                       f"(media {batch_report['avg_batch_size']:.1f}), attesa p95 {queue_p95 * 1000:.0f} ms")
+
+    # Classificazione delle valutazioni disfunzionali: locale (kNN) o passata all'LLM
+    distortion_stats = distortion_classifier.stats()
+    if distortion_stats['local_rate'] is not None:
+        st.caption(f"Valutazioni disfunzionali: {distortion_stats['local']} classificate in locale, "
+                   f"{distortion_stats['escalated']} passate all'LLM ({distortion_stats['local_rate']:.0%} locali)")
+
+# Chiavi API del pool: quota residua stimata (token bucket), pause dopo i 429, chiamate in corso
+api_pool = client_pool.get_pool()
+if api_pool and len(api_pool.clients) > 1:
+    with st.sidebar.expander("Chiavi API"):
+        for row in api_pool.status():
+            cooling_text = f", in pausa {row['cooling_down']:.0f}s" if row['cooling_down'] else ""
+            st.caption(f"**{row['name']}**: {row['in_flight']} in corso{cooling_text} - " + ", ".join(
+                f"{kind} {quota['requests']:.0f} rich./{quota['tokens']:.0f} token" for kind, quota in row['quota'].items()))
+
+# Memoria stimata per sessione e componente (dimensionamento delle sessioni per replica)
+with st.sidebar.expander("Memoria sessioni"):
+    memory_report = get_session_registry().memory_report()
+    active_sessions = [row for row in memory_report['sessions'] if not row['evicted']]
+    avg_text = f"{memory_report['avg_session_bytes'] / 1024:.1f} KB" if memory_report['avg_session_bytes'] else "N/D"
+    st.caption(f"Sessioni in memoria: {len(active_sessions)} (scaricate: {len(memory_report['sessions']) - len(active_sessions)}) - "
+               f"totale {memory_report['sessions_total_bytes'] / 1024:.1f} KB, media {avg_text} per sessione")
+    st.caption(f"Risorse RAG condivise: {memory_report['rag']['total_bytes'] / (1024 * 1024):.1f} MB "
+               f"(indici {memory_report['rag']['index_bytes'] / (1024 * 1024):.1f} MB, mappe {memory_report['rag']['map_bytes'] / (1024 * 1024):.1f} MB)")
+    for namespace_row in memory_report['rag']['namespaces']:
+        st.caption(f"- Knowledge base '{namespace_row['namespace']}' ({namespace_row['generation']}): indici propri "
+                   f"{namespace_row['own_bytes'] / (1024 * 1024):.1f}/{namespace_row['quota_bytes'] / (1024 * 1024):.0f} MB, "
+                   f"{namespace_row['shared_indexes']} indici condivisi")
+    for row in memory_report['sessions'][:10]:
+        marker = " (questa sessione)" if row['session_id'] == st.session_state.session_id else ""
+        st.caption(f"`{row['session_id'][:8]}`{marker}: messaggi {row['messages_bytes'] / 1024:.1f} KB "
+                   f"({row['messages_in_memory']} in memoria, {row['messages_offloaded'] or 0} su disco), "
+                   f"stato {row['state_bytes'] / 1024:.1f} KB, journal {row['journal_bytes'] / 1024:.1f} KB, "
+                   f"inattiva da {row['idle_seconds']:.0f}s")
+
+# Profilo di avvio della sessione (import e step di inizializzazione)
+if st.session_state.get('startup_profile'):
+    with st.sidebar.expander("Profilo di avvio"):
+        for stage in st.session_state.startup_profile:
+            st.caption(f"{stage['fase']}: {stage['ms']} ms")
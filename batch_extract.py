@@ -0,0 +1,299 @@
+# batch_extract.py (Struttura Modulare a Fasi)
+# Elaborazione batch (senza Streamlit) delle narrazioni di esempio anonimizzate.
+# Per ogni narrazione di un corpus JSONL esegue l'estrazione della fase
+# ASSESSMENT_GET_EXAMPLE (EC, PV1, TS1 + _summarize_component_clinically), come nel
+# turno reale, e salva risultati e latenza per elemento in un file colonnare.
+#
+# Uso:
+#   GOOGLE_API_KEY=... python batch_extract.py corpus.jsonl risultati.parquet [opzioni]
+#
+# - Ogni riga del corpus è un oggetto JSON con un identificativo ('id') e il testo ('text');
+#   i nomi dei campi si cambiano con --id-field / --text-field.
+# - I risultati vengono aggiunti subito a un checkpoint JSONL (<output>.checkpoint.jsonl),
+#   indicizzato per (id, prompt_version): rilanciando lo stesso comando le narrazioni già
+#   elaborate con la versione corrente dei prompt vengono saltate (una nuova versione le
+#   rielabora tutte); con --retry-errors vengono rielaborate quelle con esito diverso da 'ok'.
+# - Il ritmo di avvio è limitato (--items-per-minute) e si dimezza automaticamente
+#   quando le estrazioni falliscono (tipicamente per i limiti di frequenza del provider).
+# - La colonna 'prompt_version' (hash dei prefissi dei prompt) permette di confrontare
+#   le esecuzioni con versioni diverse dei prompt.
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+from utils import log_message
+from config import (
+    BATCH_WORKERS, BATCH_ITEMS_PER_MINUTE, BATCH_MIN_ITEMS_PER_MINUTE,
+    BATCH_MAX_RETRIES, BATCH_RETRY_BACKOFF_SECONDS
+)
+
+RESULT_COLUMNS = [
+    'id', 'status', 'ec', 'pv1', 'ts1', 'attempts', 'latency_seconds',
+    'prompt_version', 'error', 'processed_at'
+]
+
+
+def prompt_version():
+    """Hash breve dei prefissi di estrazione e sintesi (identifica la versione dei prompt)."""
+    from phases.assessment_logic import EXTRACTION_PROMPT_PREFIX, SUMMARIZATION_PROMPT_PREFIX
+    digest = hashlib.sha256((EXTRACTION_PROMPT_PREFIX + SUMMARIZATION_PROMPT_PREFIX).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+class AdaptiveRateLimiter:
+    """
+    Limita il numero di elementi avviati al minuto. Dopo un fallimento il ritmo si
+    dimezza (fino a min_per_minute); ogni successo lo riporta gradualmente al massimo.
+    """
+
+    def __init__(self, per_minute, min_per_minute=BATCH_MIN_ITEMS_PER_MINUTE):
+        self.max_per_minute = per_minute
+        self.min_per_minute = min(min_per_minute, per_minute)
+        self.per_minute = per_minute
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Attende il prossimo slot disponibile."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 60.0 / self.per_minute
+        if slot > now:
+            time.sleep(slot - now)
+
+    def throttle(self):
+        with self._lock:
+            self.per_minute = max(self.min_per_minute, self.per_minute / 2)
+        metrics.set_gauge('batch.items_per_minute', self.per_minute)
+        log_message(f"Batch: Fallimento rilevato, ritmo ridotto a {self.per_minute:.1f} elementi/min.")
+
+    def recover(self):
+        with self._lock:
+            self.per_minute = min(self.max_per_minute, self.per_minute * 1.1)
+        metrics.set_gauge('batch.items_per_minute', self.per_minute)
+
+
+def _init_worker():
+    """Configura l'API Gemini nel processo/thread di elaborazione (chiave da GOOGLE_API_KEY)."""
+    import google.generativeai as genai
+    genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+
+
+def process_item(item_id, text, version, max_retries=BATCH_MAX_RETRIES, backoff_seconds=BATCH_RETRY_BACKOFF_SECONDS):
+    """
+    Esegue l'estrazione della prima parte dello schema su una narrazione.
+
+    Returns:
+        dict: Riga dei risultati (vedi RESULT_COLUMNS). 'status' è 'ok' se l'estrazione è
+              riuscita, 'fallback' se (come nell'app) l'intero testo viene usato come EC.
+    """
+    from phases.assessment_logic import _extract_first_part
+    from config import INITIAL_STATE
+    started = time.perf_counter()
+    components, error, attempts = None, None, 0
+    while attempts <= max_retries:
+        attempts += 1
+        try:
+            components = _extract_first_part(text, dict(INITIAL_STATE['schema']))
+            error = None if components is not None else "Estrazione non valida"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            log_message(f"Batch: ERRORE elemento '{item_id}' (tentativo {attempts}): {error}\n{traceback.format_exc()}")
+        if components is not None:
+            break
+        if attempts <= max_retries:
+            time.sleep(backoff_seconds * (2 ** (attempts - 1)))
+    if components is None:
+        components = {'ec': text, 'pv1': None, 'ts1': None}
+    return {
+        'id': item_id,
+        'status': 'ok' if error is None else 'fallback',
+        'ec': components.get('ec'),
+        'pv1': components.get('pv1'),
+        'ts1': components.get('ts1'),
+        'attempts': attempts,
+        'latency_seconds': round(time.perf_counter() - started, 3),
+        'prompt_version': version,
+        'error': error,
+        'processed_at': time.time(),
+    }
+
+
+def load_corpus(path, id_field='id', text_field='text'):
+    """Legge il corpus JSONL; restituisce una lista di (id, testo), saltando le righe non valide."""
+    items = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                log_message(f"Batch: WARN - Riga {line_number} del corpus non valida ({e}), ignorata.")
+                continue
+            text = record.get(text_field)
+            if not text:
+                log_message(f"Batch: WARN - Riga {line_number} senza campo '{text_field}', ignorata.")
+                continue
+            items.append((str(record.get(id_field, line_number)), text))
+    return items
+
+
+def load_checkpoint(path):
+    """
+    Restituisce le righe già elaborate dal checkpoint JSONL ((id, prompt_version) -> riga).
+    Se un elemento è stato rielaborato (--retry-errors) vale l'ultima riga.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Ultima riga troncata da un'interruzione: l'elemento verrà rielaborato
+            done[(row['id'], row.get('prompt_version'))] = row
+    return done
+
+
+def write_columnar(rows, output_path):
+    """
+    Scrive i risultati in formato colonnare: Parquet (pyarrow, vedi requirements.txt) se
+    l'estensione è .parquet, altrimenti CSV. Senza pyarrow ripiega su CSV, segnalandolo nel
+    log (il checkpoint JSONL resta comunque completo). Restituisce il percorso effettivamente scritto.
+    """
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+    if output_path.endswith('.parquet'):
+        try:
+            df.to_parquet(output_path, index=False)
+            return output_path
+        except ImportError as e:
+            output_path = output_path[:-len('.parquet')] + '.csv'
+            log_message(f"Batch: WARN - Parquet non disponibile ({e}). Scrivo {output_path}.")
+    df.to_csv(output_path, index=False)
+    return output_path
+
+
+def run_batch(corpus_path, output_path, workers=BATCH_WORKERS, items_per_minute=BATCH_ITEMS_PER_MINUTE,
+              use_processes=True, id_field='id', text_field='text', limit=None, retry_errors=False):
+    """
+    Elabora il corpus con un pool di processi (o thread), con ritmo limitato e checkpoint.
+    Vengono saltate le narrazioni già nel checkpoint per la versione corrente dei prompt
+    (se retry_errors è True, solo quelle con esito 'ok').
+
+    Returns:
+        dict: Riepilogo dell'esecuzione (conteggi e latenze).
+    """
+    checkpoint_path = output_path + '.checkpoint.jsonl'
+    done = load_checkpoint(checkpoint_path)
+    version = prompt_version()
+
+    def already_done(item_id):
+        row = done.get((item_id, version))
+        return row is not None and (not retry_errors or row['status'] == 'ok')
+
+    items = [item for item in load_corpus(corpus_path, id_field, text_field) if not already_done(item[0])]
+    if limit is not None:
+        items = items[:limit]
+    current_rows = sum(1 for _id, row_version in done if row_version == version)
+    log_message(f"Batch: {len(items)} narrazioni da elaborare ({current_rows} già nel checkpoint per il prompt {version}"
+                f"{', esiti non ok rielaborati' if retry_errors else ''}), "
+                f"{workers} {'processi' if use_processes else 'thread'}, {items_per_minute} elementi/min.")
+
+    if use_processes:
+        # 'spawn': il client gRPC di Gemini non è sicuro dopo un fork
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_worker)
+    else:
+        _init_worker()
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+
+    limiter = AdaptiveRateLimiter(items_per_minute)
+    max_in_flight = workers * 2 # Pochi elementi in volo: un'interruzione perde al massimo questi
+    pending = set()
+    completed = 0
+    with executor, open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        def collect(futures):
+            nonlocal completed
+            for future in futures:
+                try:
+                    row = future.result()
+                except Exception as e:
+                    log_message(f"Batch: ERRORE nel worker: {type(e).__name__}: {e}")
+                    limiter.throttle()
+                    continue
+                checkpoint.write(json.dumps(row, ensure_ascii=False) + "\n")
+                checkpoint.flush()
+                done[(row['id'], row['prompt_version'])] = row
+                completed += 1
+                metrics.observe('batch.item_latency_seconds', row['latency_seconds'])
+                metrics.increment(f"batch.items.{row['status']}")
+                if row['status'] != 'ok' or row['attempts'] > 1:
+                    limiter.throttle()
+                else:
+                    limiter.recover()
+                if completed % 50 == 0:
+                    log_message(f"Batch: {completed}/{len(items)} narrazioni elaborate.")
+
+        for item_id, text in items:
+            while len(pending) >= max_in_flight:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            limiter.acquire()
+            pending.add(executor.submit(process_item, item_id, text, version))
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+
+    written_path = write_columnar(list(done.values()), output_path)
+    current = [row for (_id, row_version), row in done.items() if row_version == version]
+    latencies = [row['latency_seconds'] for row in current]
+    summary = {
+        'output': written_path,
+        'processed_this_run': completed,
+        'total_rows': len(done),
+        'prompt_version': version,
+        'ok': sum(1 for row in current if row['status'] == 'ok'),
+        'fallback': sum(1 for row in current if row['status'] == 'fallback'),
+        'latency_seconds': metrics.summarize_samples(latencies),
+    }
+    log_message(f"Batch: Completato. {json.dumps(summary, ensure_ascii=False)}")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estrazione batch EC/PV1/TS1 su un corpus JSONL di narrazioni.")
+    parser.add_argument('corpus', help="File JSONL con le narrazioni")
+    parser.add_argument('output', help="File dei risultati (.parquet o .csv)")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--items-per-minute', type=float, default=BATCH_ITEMS_PER_MINUTE)
+    parser.add_argument('--threads', action='store_true', help="Usa un pool di thread invece che di processi")
+    parser.add_argument('--id-field', default='id')
+    parser.add_argument('--text-field', default='text')
+    parser.add_argument('--limit', type=int, default=None, help="Elabora al massimo N nuove narrazioni")
+    parser.add_argument('--retry-errors', action='store_true',
+                        help="Rielabora le narrazioni con esito diverso da 'ok' per la versione corrente dei prompt")
+    args = parser.parse_args(argv)
+    if not os.environ.get("GOOGLE_API_KEY"):
+        print("ERRORE: variabile d'ambiente GOOGLE_API_KEY non impostata.")
+        return 1
+    run_batch(args.corpus, args.output, workers=args.workers, items_per_minute=args.items_per_minute,
+              use_processes=not args.threads, id_field=args.id_field, text_field=args.text_field, limit=args.limit,
+              retry_errors=args.retry_errors)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
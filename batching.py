@@ -0,0 +1,135 @@
+# batching.py (Struttura Modulare a Fasi)
+# Micro-batching tra sessioni: le richieste piccole e frequenti (embedding di una query,
+# ricerca di un vettore in un indice FAISS) arrivate da sessioni concorrenti entro una
+# finestra di pochi millisecondi vengono raccolte ed eseguite come una sola operazione
+# (una richiesta di embedding batch, una ricerca matriciale per indice); i risultati
+# tornano poi a ciascun chiamante.
+# Le richieste sono raggruppate per gruppo (es. modello di embedding, indice): un batch
+# contiene solo richieste dello stesso gruppo. Un batch parte quando è pieno
+# (max_batch_size) o quando la richiesta più vecchia ha atteso la finestra.
+#
+# Metriche per batcher ('batching.<nome>.*'): dimensione dei batch, attesa nella finestra,
+# durata del batch e richieste servite (latenza contro throughput).
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import metrics
+from utils import log_message
+from deadline import TurnDeadline, turn_deadline, call_timeout
+
+
+class _Request:
+    __slots__ = ('item', 'future', 'enqueued_at', 'expires_at')
+
+    def __init__(self, item, timeout):
+        self.item = item
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.expires_at = self.enqueued_at + timeout
+
+
+class MicroBatcher:
+    """
+    Raccoglie le richieste di più thread ed esegue batch_func(gruppo, items) una volta per batch.
+    batch_func deve restituire una lista di risultati nello stesso ordine degli items.
+    """
+
+    def __init__(self, name, batch_func, window_seconds, max_batch_size, workers=2):
+        self.name = name
+        self.batch_func = batch_func
+        self.window_seconds = window_seconds
+        self.max_batch_size = max(1, int(max_batch_size))
+        self._cond = threading.Condition()
+        self._pending = {}  # gruppo -> lista di _Request, in ordine di arrivo
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'batch-{name}')
+        self._collector = None
+
+    def submit(self, group, item):
+        """
+        Accoda una richiesta e ne attende il risultato (al massimo il budget della chiamata).
+
+        Raises:
+            TimeoutError: Il risultato non è arrivato entro il budget del turno.
+            Le eccezioni di batch_func (propagate a tutte le richieste del batch).
+        """
+        timeout = call_timeout()
+        request = _Request(item, timeout)
+        with self._cond:
+            if self._collector is None:
+                self._collector = threading.Thread(target=self._collect_loop, name=f"batcher-{self.name}", daemon=True)
+                self._collector.start()
+            self._pending.setdefault(group, []).append(request)
+            self._cond.notify_all()
+        try:
+            return request.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            metrics.increment(f'batching.{self.name}.timeouts')
+            raise TimeoutError(f"Batch '{self.name}' non completato entro {timeout:.1f}s")
+
+    def _collect_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    ready, next_flush = [], None
+                    for group, requests in self._pending.items():
+                        flush_at = requests[0].enqueued_at + self.window_seconds
+                        if len(requests) >= self.max_batch_size or flush_at <= now:
+                            ready.append(group)
+                        elif next_flush is None or flush_at < next_flush:
+                            next_flush = flush_at
+                    if ready:
+                        break
+                    self._cond.wait(None if next_flush is None else next_flush - now)
+                batches = []
+                for group in ready:
+                    requests = self._pending.pop(group)
+                    batches.append((group, requests[:self.max_batch_size]))
+                    if len(requests) > self.max_batch_size:
+                        self._pending[group] = requests[self.max_batch_size:]
+            for group, requests in batches:
+                self._executor.submit(self._run_batch, group, requests)
+
+    def _run_batch(self, group, requests):
+        started = time.monotonic()
+        live = [request for request in requests if request.expires_at > started and not request.future.done()]
+        if not live:
+            return
+        metrics.observe(f'batching.{self.name}.batch_size', len(live))
+        for request in live:
+            metrics.observe(f'batching.{self.name}.queue_seconds', started - request.enqueued_at)
+        try:
+            # Il batch ha il budget del chiamante che può attendere più a lungo
+            with turn_deadline(TurnDeadline(max(request.expires_at for request in live) - started)):
+                results = self.batch_func(group, [request.item for request in live])
+            if len(results) != len(live):
+                raise ValueError(f"{len(results)} risultati per {len(live)} richieste")
+        except Exception as e:
+            metrics.increment(f'batching.{self.name}.errors')
+            log_message(f"Batching '{self.name}': ERRORE nel batch di {len(live)} richieste ({type(e).__name__}: {e}).")
+            for request in live:
+                request.future.set_exception(e)
+            return
+        for request, result in zip(live, results):
+            request.future.set_result(result)
+        metrics.observe(f'batching.{self.name}.batch_seconds', time.monotonic() - started)
+        metrics.increment(f'batching.{self.name}.requests', len(live))
+        metrics.increment(f'batching.{self.name}.batches')
+
+
+def report(name):
+    """Richieste, batch, dimensione media e latenze (attesa in finestra e batch) del batcher."""
+    snapshot = metrics.snapshot(prefix=f'batching.{name}.')
+    counters, samples = snapshot['counters'], snapshot['samples']
+    batches = counters.get(f'batching.{name}.batches', 0)
+    requests = counters.get(f'batching.{name}.requests', 0)
+    return {
+        'requests': requests,
+        'batches': batches,
+        'avg_batch_size': requests / batches if batches else None,
+        'queue_seconds': samples.get(f'batching.{name}.queue_seconds', {}),
+        'batch_seconds': samples.get(f'batching.{name}.batch_seconds', {}),
+        'errors': counters.get(f'batching.{name}.errors', 0),
+    }
@@ -0,0 +1,398 @@
+# client_pool.py (Struttura Modulare a Fasi)
+# Pool di client Gemini: più chiavi API (anche di progetti diversi) condivise da tutte le
+# sessioni del processo, al posto dell'unica chiave configurata con genai.configure().
+# - Ogni chiave ha il proprio GenerativeServiceClient (connessione gRPC propria), creato e
+#   "scaldato" in background all'avvio e tenuto attivo con una chiamata leggera
+#   (count_tokens) quando resta inattivo, così il primo turno non paga l'apertura della connessione.
+# - Limiti lato client con token bucket per chiave e tipo di chiamata ('generate', 'embed'):
+#   richieste al minuto e token al minuto (config.CLIENT_POOL_LIMITS, sovrascrivibili per chiave).
+# - Ogni chiamata va alla chiave con più quota residua; se nessuna ha quota si attende la
+#   ricarica entro il budget del turno (deadline.py), oltre si usa il fallback.
+# - Su 429 (quota esaurita) la chiave entra in pausa per CLIENT_POOL_COOLDOWN_SECONDS e la
+#   chiamata viene ripetuta su un'altra chiave.
+#
+# Senza pool configurato (script, batch, load test) call() usa il client predefinito
+# di genai.configure().
+#
+# Secrets (secrets.toml), in alternativa a GOOGLE_API_KEY:
+#   GOOGLE_API_KEYS = ["chiave-1", "chiave-2"]
+# oppure, con nome e limiti per chiave:
+#   [[GOOGLE_API_KEYS]]
+#   name = "progetto-b"
+#   api_key = "..."
+#   generate_rpm = 300
+
+import copy
+import threading
+import time
+
+import metrics
+from deadline import call_timeout
+from context_cache import estimate_tokens
+from utils import log_message
+from config import (
+    GENERATION_MODEL_NAME, CLIENT_POOL_LIMITS, CLIENT_POOL_COOLDOWN_SECONDS, CLIENT_POOL_KEEPALIVE_SECONDS
+)
+
+
+class RateLimitedError(RuntimeError):
+    """Nessuna chiave del pool ha quota disponibile entro il budget della chiamata."""
+
+
+class TokenBucket:
+    """Token bucket: 'capacity' unità, ricaricate a 'capacity' al minuto."""
+
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self, now):
+        self._refill(now)
+        return self.level
+
+    def wait_time(self, amount, now):
+        """Secondi prima che 'amount' unità siano disponibili (0 se lo sono già)."""
+        self._refill(now)
+        needed = min(amount, self.capacity) - self.level
+        return max(0.0, needed / self.rate)
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount  # Può andare in negativo: le chiamate successive attendono
+
+    def drain(self, now):
+        self._refill(now)
+        self.level = min(self.level, 0.0)
+
+
+def is_rate_limit_error(error):
+    """True per gli errori di quota del provider (HTTP 429 / ResourceExhausted)."""
+    return (type(error).__name__ in ('ResourceExhausted', 'TooManyRequests')
+            or getattr(error, 'code', None) == 429
+            or '429' in str(error) or 'Resource has been exhausted' in str(error))
+
+
+class PooledClient:
+    """Una chiave API del pool: client gRPC, bucket per tipo di chiamata, stato di pausa."""
+
+    def __init__(self, name, api_key=None, limits=None):
+        self.name = name
+        self.api_key = api_key
+        self.buckets = {
+            kind: (TokenBucket(kind_limits['rpm']), TokenBucket(kind_limits['tpm']))
+            for kind, kind_limits in (limits or CLIENT_POOL_LIMITS).items()
+        }
+        self.cooldown_until = 0.0
+        self.last_used = 0.0
+        self.in_flight = 0
+        self._generative_client = None
+        self._bound_models = {}
+        self._client_lock = threading.Lock()
+
+    @property
+    def generative_client(self):
+        """GenerativeServiceClient della chiave (None = client predefinito di genai.configure)."""
+        if self.api_key is None:
+            return None
+        with self._client_lock:
+            if self._generative_client is None:
+                from google.ai import generativelanguage as glm
+                self._generative_client = glm.GenerativeServiceClient(client_options={'api_key': self.api_key})
+            return self._generative_client
+
+    def bind(self, model):
+        """
+        Copia di 'model' (GenerativeModel) che invia le richieste con il client di questa
+        chiave. I modelli senza client dell'SDK (es. backend finto) sono restituiti invariati.
+        """
+        if self.api_key is None or not hasattr(model, '_client'):
+            return model
+        with self._client_lock:
+            bound = self._bound_models.get(id(model))
+            if bound is None or bound[0] is not model:
+                bound_model = copy.copy(model)
+                bound = (model, bound_model)
+                self._bound_models[id(model)] = bound
+        bound_model = bound[1]
+        bound_model._client = self.generative_client
+        return bound_model
+
+    def score(self, kind, tokens, now):
+        """Quota residua (0-1) dopo la chiamata; None se la chiave non può accettarla ora."""
+        if now < self.cooldown_until:
+            return None
+        requests, token_bucket = self.buckets[kind]
+        if requests.wait_time(1, now) > 0 or token_bucket.wait_time(tokens, now) > 0:
+            return None
+        return min((requests.level - 1) / requests.capacity, (token_bucket.level - tokens) / token_bucket.capacity)
+
+    def wait_time(self, kind, tokens, now):
+        requests, token_bucket = self.buckets[kind]
+        return max(self.cooldown_until - now, requests.wait_time(1, now), token_bucket.wait_time(tokens, now))
+
+    def warm_up(self):
+        """Apre la connessione con una chiamata leggera (count_tokens) sul modello generativo."""
+        import google.generativeai as genai
+        started = time.perf_counter()
+        self.bind(genai.GenerativeModel(GENERATION_MODEL_NAME)).count_tokens("ping")
+        self.last_used = time.monotonic()
+        metrics.observe(f'client_pool.{self.name}.warm_up_seconds', time.perf_counter() - started)
+
+
+class ClientPool:
+    """Pool di chiavi con bilanciamento sulla quota residua e failover sui 429."""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self._condition = threading.Condition()
+        self._keepalive_thread = None
+
+    def acquire(self, kind, tokens, timeout, exclude=()):
+        """
+        Riserva quota per una chiamata sulla chiave con più quota residua, attendendo la
+        ricarica dei bucket al massimo 'timeout' secondi.
+
+        Returns:
+            PooledClient: La chiave scelta.
+
+        Raises:
+            RateLimitedError: Nessuna chiave disponibile entro il timeout.
+        """
+        started = time.monotonic()
+        give_up_at = started + max(0.0, timeout)
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                candidates = [client for client in self.clients if client not in exclude] or self.clients
+                scored = [(client.score(kind, tokens, now), client) for client in candidates]
+                scored = [(score, client) for score, client in scored if score is not None]
+                if scored:
+                    # A parità di quota, la chiave con meno chiamate in corso
+                    _, client = max(scored, key=lambda item: (item[0], -item[1].in_flight))
+                    requests, token_bucket = client.buckets[kind]
+                    requests.take(1, now)
+                    token_bucket.take(tokens, now)
+                    client.in_flight += 1
+                    client.last_used = now
+                    metrics.observe('client_pool.acquire_wait_seconds', now - started)
+                    return client
+                wait = min(client.wait_time(kind, tokens, now) for client in candidates)
+                if now + wait > give_up_at:
+                    metrics.increment(f'client_pool.{kind}.rate_limited')
+                    raise RateLimitedError(f"Nessuna chiave con quota '{kind}' disponibile entro {timeout:.1f}s")
+                self._condition.wait(wait)
+
+    def release(self, client, kind, estimated_tokens, actual_tokens=None):
+        """Chiude la chiamata e corregge il bucket dei token con il consumo effettivo."""
+        with self._condition:
+            client.in_flight -= 1
+            if actual_tokens is not None:
+                client.buckets[kind][1].take(actual_tokens - estimated_tokens, time.monotonic())
+            self._condition.notify_all()
+
+    def mark_rate_limited(self, client):
+        """429 dal provider: la chiave resta in pausa e i suoi bucket vengono svuotati."""
+        with self._condition:
+            now = time.monotonic()
+            client.cooldown_until = now + CLIENT_POOL_COOLDOWN_SECONDS
+            for bucket_pair in client.buckets.values():
+                for bucket in bucket_pair:
+                    bucket.drain(now)
+        metrics.increment(f'client_pool.{client.name}.rate_limited')
+        log_message(f"Client Pool: 429 sulla chiave '{client.name}', in pausa per {CLIENT_POOL_COOLDOWN_SECONDS}s.")
+
+    def warm_up(self):
+        """Scalda in background le connessioni di tutte le chiavi e avvia il keep-alive."""
+        for client in self.clients:
+            threading.Thread(target=self._warm_up_safely, args=(client,),
+                             name=f"client-pool-warm-{client.name}", daemon=True).start()
+        if CLIENT_POOL_KEEPALIVE_SECONDS > 0 and self._keepalive_thread is None:
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name="client-pool-keepalive", daemon=True)
+            self._keepalive_thread.start()
+
+    def _warm_up_safely(self, client):
+        try:
+            client.warm_up()
+            log_message(f"Client Pool: Connessione della chiave '{client.name}' pronta.")
+        except Exception as e:
+            metrics.increment(f'client_pool.{client.name}.warm_up_errors')
+            log_message(f"Client Pool: WARN - Warm-up della chiave '{client.name}' fallito ({type(e).__name__}: {e}).")
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(CLIENT_POOL_KEEPALIVE_SECONDS)
+            idle_since = time.monotonic() - CLIENT_POOL_KEEPALIVE_SECONDS
+            for client in self.clients:
+                if client.last_used < idle_since and client.in_flight == 0:
+                    self._warm_up_safely(client)
+
+    def status(self):
+        """Stato delle chiavi (quota residua, pausa, chiamate in corso), per la sidebar/diagnostica."""
+        with self._condition:
+            now = time.monotonic()
+            return [{
+                'name': client.name,
+                'in_flight': client.in_flight,
+                'cooling_down': max(0.0, client.cooldown_until - now),
+                'quota': {kind: {'requests': requests.available(now), 'tokens': tokens.available(now)}
+                          for kind, (requests, tokens) in client.buckets.items()},
+            } for client in self.clients]
+
+
+_default_client = PooledClient('default')
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def keys_from_secrets(secrets):
+    """
+    Chiavi configurate nei secrets: GOOGLE_API_KEYS (lista di stringhe o di tabelle con
+    api_key, name e limiti opzionali) oppure la sola GOOGLE_API_KEY.
+
+    Returns:
+        list: Lista di dict {'name', 'api_key', 'limits'}; vuota se non c'è nessuna chiave.
+    """
+    entries = secrets.get("GOOGLE_API_KEYS") or ([secrets["GOOGLE_API_KEY"]] if secrets.get("GOOGLE_API_KEY") else [])
+    keys = []
+    for position, entry in enumerate(entries, start=1):
+        if isinstance(entry, str):
+            entry = {'api_key': entry}
+        limits = {kind: {'rpm': entry.get(f'{kind}_rpm', kind_limits['rpm']),
+                         'tpm': entry.get(f'{kind}_tpm', kind_limits['tpm'])}
+                  for kind, kind_limits in CLIENT_POOL_LIMITS.items()}
+        keys.append({'name': entry.get('name') or f"chiave-{position}", 'api_key': entry['api_key'], 'limits': limits})
+    return keys
+
+
+def configure(keys, warm_up=True):
+    """
+    Crea il pool condiviso del processo (una sola volta: le sessioni successive lo riusano).
+
+    Args:
+        keys (list): Chiavi come restituite da keys_from_secrets.
+        warm_up (bool): Se True, apre le connessioni in background.
+
+    Returns:
+        ClientPool | None: Il pool del processo (None senza chiavi).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None and keys:
+            _pool = ClientPool([PooledClient(key['name'], key['api_key'], key['limits']) for key in keys])
+            log_message(f"Client Pool: {len(keys)} chiavi configurate ({', '.join(key['name'] for key in keys)}).")
+            if warm_up:
+                _pool.warm_up()
+        return _pool
+
+
+def get_pool():
+    """Il pool del processo, o None se non configurato."""
+    return _pool
+
+
+def _actual_tokens(response):
+    """Token effettivi della chiamata dai metadati d'uso della risposta (None se assenti)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None and getattr(usage, 'total_token_count', None):
+        return usage.total_token_count
+    return None
+
+
+class PooledStream:
+    """
+    Risposta in streaming che tiene occupata la chiave del pool finché non è stata letta:
+    la chiave viene rilasciata (con la correzione del bucket dei token sul consumo
+    effettivo, noto solo a fine stream) quando l'iterazione termina o con close().
+    """
+
+    def __init__(self, pool, client, kind, estimated_tokens, response):
+        self.pool = pool
+        self.client = client
+        self.kind = kind
+        self.estimated_tokens = estimated_tokens
+        self.response = response
+        self._released = False
+
+    @property
+    def usage_metadata(self):
+        return getattr(self.response, 'usage_metadata', None)
+
+    def __iter__(self):
+        try:
+            yield from self.response
+        finally:
+            self.close()
+
+    def close(self):
+        """Rilascia la chiave (idempotente); da chiamare se lo stream viene abbandonato a metà."""
+        if self._released:
+            return
+        self._released = True
+        if self.pool is not None:
+            self.pool.release(self.client, self.kind, self.estimated_tokens, _actual_tokens(self.response))
+
+
+def call(func, kind='generate', estimated_tokens=0, pinned=False, stream=False):
+    """
+    Esegue func(client) con una chiave del pool, ripetendo su un'altra chiave in caso di 429.
+
+    Args:
+        func (callable): Riceve il PooledClient (usare client.bind(model) o
+                         client.generative_client) e restituisce il risultato della chiamata.
+        kind (str): Tipo di quota ('generate' o 'embed').
+        estimated_tokens (int): Token stimati della richiesta (vedi estimate_request_tokens).
+        pinned (bool): Usa solo la prima chiave (risorse legate a un progetto, es. context cache).
+        stream (bool): func restituisce una risposta in streaming: il risultato è un PooledStream
+                       che tiene la chiave fino alla fine della lettura (il failover copre solo l'avvio).
+
+    Returns:
+        Il risultato di func (avvolto in un PooledStream se stream è True).
+
+    Raises:
+        RateLimitedError: Nessuna chiave con quota entro il budget della chiamata.
+        Le eccezioni di func (l'ultimo 429 se tutte le chiavi sono in pausa).
+    """
+    pool = _pool
+    if pool is None:
+        result = func(_default_client)
+        return PooledStream(None, _default_client, kind, estimated_tokens, result) if stream else result
+    candidates = pool.clients[:1] if pinned else pool.clients
+    tried = []
+    while True:
+        client = pool.acquire(kind, estimated_tokens, call_timeout(),
+                              exclude=tuple(tried) + tuple(c for c in pool.clients if c not in candidates))
+        actual_tokens = None
+        leased = False
+        try:
+            result = func(client)
+            metrics.increment(f'client_pool.{client.name}.calls')
+            if stream:
+                leased = True  # La chiave viene rilasciata dal PooledStream a fine lettura
+                return PooledStream(pool, client, kind, estimated_tokens, result)
+            actual_tokens = _actual_tokens(result)
+            return result
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            pool.mark_rate_limited(client)
+            tried.append(client)
+            if len(tried) >= len(candidates):
+                raise
+            metrics.increment('client_pool.failovers')
+            log_message(f"Client Pool: Failover della chiamata '{kind}' dopo 429 su '{client.name}'.")
+        finally:
+            if not leased:
+                pool.release(client, kind, estimated_tokens, actual_tokens)
+
+
+def estimate_request_tokens(prompt, history=None, max_output_tokens=0):
+    """Token stimati di una richiesta (prompt, history e output massimo) per il bucket dei token."""
+    history_chars = sum(len(str(part)) for message in (history or []) if isinstance(message, dict)
+                        for part in message.get('parts', []))
+    return estimate_tokens(str(prompt)) + history_chars // 4 + (max_output_tokens or 0)
@@ -2,6 +2,9 @@
 # Contiene costanti, configurazioni modelli, prompt iniziali,
 # stato iniziale e la mappa FASE -> CHIAVE_RAG.
 
+import os
+import tempfile
+
 # --- Modelli AI ---
 EMBEDDING_MODEL_NAME = "models/text-embedding-004"
 GENERATION_MODEL_NAME = "models/gemini-1.5-flash-latest" # O "models/gemini-1.5-pro-latest"
@@ -20,6 +23,216 @@ GENERATION_CONFIG_GEMINI = {
     "candidate_count": 1
 }
 
+# --- Registro dei Task LLM (model tiering) ---
+# Ogni punto di chiamata all'LLM usa il proprio modello, la propria configurazione di
+# generazione e il proprio limite di token in output (vedi llm_interface.get_model_for_task).
+# I task molto piccoli (validazione SV2, sintesi di 10-15 parole) usano il modello più
+# veloce a temperatura 0 con limiti bassi.
+FAST_MODEL_NAME = "models/gemini-1.5-flash-8b-latest"
+
+LLM_TASKS = {
+    'extraction': {     # Estrazione JSON di EC/PV1/TS1 dal racconto dell'utente
+        'model_name': GENERATION_MODEL_NAME,
+        'generation_config': {"temperature": 0.0, "max_output_tokens": 512, "candidate_count": 1},
+    },
+    'multi_extraction': { # Estrazione JSON di più episodi (EC/PV1/TS1) da un racconto lungo
+        'model_name': GENERATION_MODEL_NAME,
+        'generation_config': {"temperature": 0.0, "max_output_tokens": 2048, "candidate_count": 1},
+    },
+    'section_summary': { # Riassunto offline di sezioni e capitoli del manuale (indice RAG gerarchico)
+        'model_name': GENERATION_MODEL_NAME,
+        'generation_config': {"temperature": 0.0, "max_output_tokens": 256, "candidate_count": 1},
+    },
+    'summarization': {  # Sintesi fedele (10-15 parole) di un componente dello schema
+        'model_name': FAST_MODEL_NAME,
+        'generation_config': {"temperature": 0.0, "max_output_tokens": 64, "candidate_count": 1},
+    },
+    'distortion_classification': { # Valutazione disfunzionale (una chiave) quando il classificatore locale è incerto
+        'model_name': FAST_MODEL_NAME,
+        'generation_config': {"temperature": 0.0, "max_output_tokens": 16, "candidate_count": 1},
+    },
+    'sv2_validation': { # Classificazione a una parola (VALIDO_SV2 / NON_VALIDO_SV2 / NEGATIVO)
+        'model_name': FAST_MODEL_NAME,
+        'generation_config': {"temperature": 0.0, "max_output_tokens": 10, "candidate_count": 1},
+    },
+    'user_reply': {     # Risposta conversazionale all'utente (task specifico della fase)
+        'model_name': GENERATION_MODEL_NAME,
+        'generation_config': GENERATION_CONFIG_GEMINI,
+    },
+    'fallback': {       # Risposta generica quando il messaggio esce dal flusso previsto
+        'model_name': GENERATION_MODEL_NAME,
+        'generation_config': GENERATION_CONFIG_GEMINI,
+    },
+}
+
+# Prezzi indicativi (USD per milione di token) per la stima dei costi per task.
+# Da aggiornare secondo il listino corrente del provider.
+LLM_PRICING_PER_MILLION_TOKENS = {
+    "models/gemini-1.5-flash-latest":    {'input': 0.075, 'output': 0.30},
+    "models/gemini-1.5-flash-8b-latest": {'input': 0.0375, 'output': 0.15},
+    "models/gemini-1.5-pro-latest":      {'input': 1.25, 'output': 5.00},
+}
+
+# --- Pool di Chiavi API Gemini (vedi client_pool.py) ---
+# Chiavi in st.secrets: GOOGLE_API_KEYS (lista) oppure GOOGLE_API_KEY.
+# Limiti lato client per chiave e tipo di chiamata (richieste e token al minuto), da
+# allineare alle quote del progetto; sovrascrivibili per chiave (es. generate_rpm = 300).
+CLIENT_POOL_LIMITS = {
+    'generate': {'rpm': 1000, 'tpm': 1_000_000},
+    'embed': {'rpm': 1500, 'tpm': 1_000_000},
+}
+CLIENT_POOL_COOLDOWN_SECONDS = 30     # Pausa di una chiave dopo un 429 (le chiamate vanno alle altre)
+CLIENT_POOL_KEEPALIVE_SECONDS = 240   # Chiamata leggera sulle chiavi inattive da così tanto (0 = disattivato)
+
+# --- Context Caching dei Prefissi Stabili dei Prompt (vedi context_cache.py) ---
+# 'gemini' = caching lato provider, 'local' = emulazione in processo (test/offline), 'off' = disattivato.
+# Nota: il provider richiede nomi modello con versione esplicita (es. "models/gemini-1.5-flash-001")
+# e un prefisso minimo di CONTEXT_CACHE_MIN_TOKENS token; sotto soglia il prefisso è inviato inline.
+# Disattivato per impostazione predefinita: i prefissi attuali (istruzioni e definizioni dello schema)
+# sono di poche centinaia di token, molto sotto la soglia, e con 'gemini' verrebbero comunque inviati
+# inline. Per attivarlo: 'gemini' con CONTEXT_CACHE_INCLUDE_CHAPTER_MATERIAL = True e capitoli oltre la soglia.
+CONTEXT_CACHE_BACKEND = 'off'
+CONTEXT_CACHE_TTL_SECONDS = 3600
+CONTEXT_CACHE_MIN_TOKENS = 32768
+CONTEXT_CACHE_RETRY_SECONDS = 300   # Dopo una registrazione fallita il prefisso va inline per questo tempo
+# Se True, il prefisso delle risposte include il materiale del capitolo della fase (chunk RAG)
+CONTEXT_CACHE_INCLUDE_CHAPTER_MATERIAL = False
+
+# --- Estrazione in Streaming (vedi streaming_json.py) ---
+# Thread che sintetizzano i campi estratti (EC, PV1, TS1) mentre la risposta JSON è ancora in arrivo.
+EXTRACTION_SUMMARY_WORKERS = 3
+
+# --- Estrazione di Più Episodi da un Racconto Lungo ---
+# Un messaggio di almeno MULTI_EXAMPLE_MIN_CHARS caratteri (es. un diario) viene analizzato
+# in una sola chiamata che restituisce tutti gli episodi; oltre MULTI_EXAMPLE_CHUNK_CHARS il
+# testo è diviso in blocchi (ai confini di paragrafo) analizzati in parallelo.
+MULTI_EXAMPLE_MIN_CHARS = 800
+MULTI_EXAMPLE_CHUNK_CHARS = 6000
+MULTI_EXAMPLE_MAX_EPISODES = 5      # Episodi proposti all'utente al massimo
+
+# --- Elaborazione Batch delle Narrazioni (vedi batch_extract.py) ---
+BATCH_WORKERS = 4                   # Processi (o thread) che elaborano le narrazioni in parallelo
+BATCH_ITEMS_PER_MINUTE = 60         # Narrazioni avviate al minuto (ognuna = 1 estrazione + fino a 3 sintesi)
+BATCH_MIN_ITEMS_PER_MINUTE = 5      # Ritmo minimo dopo i rallentamenti per limiti di frequenza
+BATCH_MAX_RETRIES = 2               # Nuovi tentativi per narrazione se l'estrazione fallisce
+BATCH_RETRY_BACKOFF_SECONDS = 2.0   # Attesa iniziale tra i tentativi (raddoppia a ogni tentativo)
+
+# --- Pool di Formulazioni per le Transizioni Scriptate (vedi phrasing_pool.py) ---
+PHRASING_POOL_ENABLED = True
+PHRASING_POOL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "phrasing_pool.json")
+PHRASING_SLOT_MAX_CHARS = 100   # Lunghezza massima dei valori dello schema inseriti nei segnaposto
+
+# --- Load Test e Backend LLM Finto (vedi loadtest.py e fake_llm.py) ---
+FAKE_LLM_LATENCY_MEDIAN_SECONDS = 0.8  # Latenza mediana simulata di una chiamata LLM
+FAKE_LLM_LATENCY_SIGMA = 0.5           # Dispersione (log-normale) della latenza simulata
+FAKE_LLM_ERROR_RATE = 0.0              # Frazione di chiamate che falliscono (errore simulato)
+LOADTEST_SLO_P99_SECONDS = 10.0        # SLO sulla latenza p99 di un turno (soglia di saturazione)
+LOADTEST_MAX_BUSY_RATE = 0.01          # Frazione massima di turni rifiutati ("occupato") accettata
+
+# --- Registro delle Esposizioni ERP (vedi exposure_log.py) ---
+ERP_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "erp_data") # Un file per utente
+ERP_SESSION_GAP_SECONDS = 3 * 3600  # Prove distanti più di così appartengono a sedute diverse
+ERP_MASTERY_SUDS = 30               # SUDS di picco sotto cui un gradino della gerarchia è "superato"
+ERP_MASTERY_TRIALS = 2              # Prove consecutive sotto soglia (e senza compulsioni) per salire di gradino
+ERP_CACHE_MAX_USERS = 256           # Serie di prove tenute in memoria (LRU) per non rileggere il file a ogni turno
+
+# --- Indice dei Cicli Passati per Utente (vedi cycle_index.py) ---
+CYCLE_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cycle_index") # File per utente
+CYCLE_RECALL_TOP_K = 3               # Cicli passati più simili restituiti per un nuovo episodio
+CYCLE_TRIGGER_SIMILARITY = 0.8       # Similarità (coseno) oltre cui due Eventi Critici sono lo stesso trigger
+CYCLE_INDEX_CACHE_MAX_USERS = 256    # Indici utente tenuti in memoria (LRU)
+
+# --- Classificatore delle Valutazioni Disfunzionali (vedi distortion_classifier.py) ---
+DISTORTION_EXEMPLARS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "distortion_exemplars.json")
+DISTORTION_VECTORS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "distortion_vectors.npz") # Generato al primo uso
+DISTORTION_KNN_K = 5                     # Esempi più vicini che votano l'etichetta
+DISTORTION_KNN_TEMPERATURE = 0.05        # Temperatura del voto (più bassa = pesa di più l'esempio più vicino)
+DISTORTION_CONFIDENCE_THRESHOLD = 0.6    # Quota di voto minima per non chiedere all'LLM
+DISTORTION_MIN_SIMILARITY = 0.35         # Similarità (coseno) minima con l'esempio più vicino
+DISTORTION_EMBED_RETRY_SECONDS = 300     # Pausa prima di riprovare l'embedding degli esempi dopo un errore
+
+# --- RAG ---
+RAG_DATA_DIR = "."                         # Cartella con indici, mappe e manifest
+RAG_MANIFEST_FILENAME = "rag_manifest.json" # Generato con: python rag_utils.py build-manifest
+RAG_RELOAD_POLL_SECONDS = 30               # Intervallo di controllo del manifest (0 = hot reload disattivato)
+# Attesa massima (secondi) di una ricerca mentre gli indici vengono ancora caricati in background
+RAG_LOAD_WAIT_SECONDS = 10.0
+# Knowledge base per namespace (multi-tenant): ogni namespace ha la propria cartella con indici,
+# mappe e manifest ed è scelto per sessione (parametro ?kb= dell'URL). Chiavi opzionali:
+# 'base' (namespace da cui prendere, condivisi in memoria, gli indici assenti dalla cartella),
+# 'memory_quota_mb' (memoria massima degli indici propri) e 'phase_chapter_map' (sostituzioni
+# di PHASE_TO_CHAPTER_KEY_MAP per il namespace).
+RAG_DEFAULT_NAMESPACE = "default"
+RAG_NAMESPACES = {
+    "default": {"data_dir": RAG_DATA_DIR},
+    # "clinica_esempio": {
+    #     "data_dir": os.path.join("knowledge_bases", "clinica_esempio"),
+    #     "base": "default",
+    #     "memory_quota_mb": 256,
+    #     "phase_chapter_map": {"RESTRUCTURING_INTRO": "step_3_ristrutturazione_edizione_2"},
+    # },
+}
+RAG_NAMESPACE_MEMORY_QUOTA_MB = 512     # Quota di default degli indici propri di un namespace
+RAG_NAMESPACES_MAX_MEMORY_MB = 2048     # Memoria RAG totale del processo; oltre si scaricano i namespace meno usati
+# Ricerca gerarchica: i riassunti di capitoli e sezioni (python rag_utils.py build-hierarchy)
+# instradano la query verso poche sezioni; la ricerca sui chunk avviene solo al loro interno.
+RAG_ROUTE_CHAPTERS = 2            # Capitoli candidati per query
+RAG_ROUTE_SECTIONS = 3            # Sezioni (dentro i capitoli candidati) in cui cercare i chunk
+RAG_CHUNK_TOP_K = 3               # Chunk restituiti
+RAG_CONTEXT_CHUNK_MAX_CHARS = 1200  # Lunghezza massima di ogni chunk inserito nel prompt
+RAG_SUMMARY_INPUT_MAX_CHARS = 20000 # Testo di una sezione passato all'LLM per il riassunto (offline)
+# Micro-batching tra sessioni (vedi batching.py): embedding e ricerche FAISS arrivati entro la
+# finestra vengono eseguiti insieme. Finestra più lunga = batch più grandi ma più latenza per query.
+RAG_BATCHING_ENABLED = True
+EMBED_BATCH_WINDOW_MS = 5         # Attesa massima di una query prima dell'invio del batch di embedding
+EMBED_BATCH_MAX_SIZE = 32         # Query per richiesta di embedding (il provider ne accetta al massimo 100)
+SEARCH_BATCH_WINDOW_MS = 2        # Attesa massima di una ricerca prima della ricerca matriciale sull'indice
+SEARCH_BATCH_MAX_SIZE = 64        # Vettori per ricerca matriciale
+
+# --- Eventi Analitici per Turno (vedi turn_events.py) ---
+# Un evento per turno (fasi, durate, chiamate LLM, fallback, campi modificati; nessun testo)
+# scritto a blocchi in file Parquet partizionati per giorno.
+TURN_EVENTS_ENABLED = True
+TURN_EVENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "turn_events")
+TURN_EVENTS_FLUSH_EVENTS = 1000     # Eventi per file (blocco di scrittura)
+TURN_EVENTS_FLUSH_SECONDS = 60      # Scrittura comunque dopo questo tempo, anche con pochi eventi
+TURN_EVENTS_MAX_BUFFERED = 50000    # Eventi tenuti in memoria se la scrittura fallisce (poi si scartano i più vecchi)
+TURN_EVENTS_CSV_FALLBACK = False    # Senza pyarrow scrive CSV (degradato: tipi non garantiti); se False gli eventi restano in buffer
+
+# --- Profilatura dei Turni (vedi turn_profiler.py) ---
+# DOCBOT_PROFILE_TURNS=N profila un turno ogni N nel processo (0 o assente = disattivata);
+# dalla sidebar si può profilare anche la sola sessione corrente.
+_profile_turns_env = os.environ.get("DOCBOT_PROFILE_TURNS", "0").strip()
+TURN_PROFILER_EVERY_N_TURNS = int(_profile_turns_env) if _profile_turns_env.isdigit() else 0
+TURN_PROFILER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+TURN_PROFILER_TOP_N = 15        # Funzioni mostrate per tempo proprio e per tempo cumulativo
+TURN_PROFILER_MAX_FILES = 50    # Profili salvati tenuti su disco (i più vecchi vengono cancellati)
+
+# --- Scheduler dei Turni (Admission Control) ---
+# Limiti condivisi da tutte le sessioni del processo (vedi turn_scheduler.py).
+TURN_MAX_CONCURRENCY = 8            # Turni (chiamate LLM) eseguiti contemporaneamente
+TURN_QUEUE_MAX_DEPTH = 32           # Turni massimi in attesa; oltre si risponde "occupato"
+TURN_QUEUE_MAX_WAIT_SECONDS = 15.0  # SLO di attesa in coda; oltre si risponde "occupato"
+# Coalescenza delle richieste identiche in corso (vedi singleflight.py): LLM e turni duplicati
+LLM_COALESCE_REQUESTS = True
+TURN_RESULT_CACHE_MAX_SESSIONS = 1024 # Sessioni di cui si ricorda l'ultimo turno completato (idempotenza)
+
+# Precalcolo speculativo del turno successivo (vedi speculation.py): solo con capacità libera
+SPECULATION_ENABLED = True
+SPECULATION_WORKERS = 2             # Thread dedicati al lavoro speculativo
+SPECULATION_MAX_PENDING = 16        # Risorse speculative in attesa o in calcolo, oltre si rinuncia
+SPECULATION_MAX_LOAD = 0.5          # Si specula solo con turni attivi sotto questa frazione di TURN_MAX_CONCURRENCY
+SPECULATION_BUDGET_SECONDS = 30.0   # Deadline di ogni risorsa speculativa (come la deadline di un turno)
+SPECULATION_MAX_SESSIONS = 1024     # Previsioni in attesa di verifica (sessioni abbandonate scartate, LRU)
+
+# Deadline per turno (vedi deadline.py): budget complessivo di un turno, coda inclusa.
+# Ogni chiamata LLM/embedding usa il budget residuo come timeout (al massimo LLM_CALL_TIMEOUT_SECONDS);
+# sotto DEADLINE_MIN_CALL_SECONDS la chiamata non viene avviata e si usa il fallback.
+TURN_DEADLINE_SECONDS = 45.0
+LLM_CALL_TIMEOUT_SECONDS = 120
+DEADLINE_MIN_CALL_SECONDS = 1.0
+BUSY_MESSAGE = "In questo momento sto ricevendo molte richieste. Per favore, riprova tra qualche secondo inviando di nuovo il tuo messaggio."
+
 # --- Costanti Chat ---
 INTRO_MESSAGE = """Ciao! Sono un assistente conversazionale per supportarti nella gestione del Disturbo Ossessivo-Compulsivo (DOC), basandomi su principi e tecniche di terapia cognitivo-comportamentale (TCC).
 
@@ -34,6 +247,20 @@ Il nostro percorso insieme si strutturerà indicativamente così:
 
 Sei pronto/a per iniziare questo percorso insieme? (Puoi rispondere 'sì', 'ok' o iniziare a raccontare un esempio)"""
 
+# Rendering della chat: messaggi sempre visibili e dimensione pagina dei messaggi precedenti
+CHAT_VISIBLE_MESSAGES = 20
+CHAT_OLDER_PAGE_SIZE = 20
+
+# --- Memoria per Sessione (vedi session_memory.py) ---
+# Messaggi della chat tenuti in memoria per sessione; i più vecchi vengono scaricati su disco
+# (restano consultabili nella paginazione). Anche la history inviata all'LLM usa solo questi.
+SESSION_HISTORY_MAX_IN_MEMORY = 100
+SESSION_IDLE_TIMEOUT_SECONDS = 1800         # Sessione inattiva oltre questo tempo: scaricata su disco
+SESSION_OFFLOAD_RETENTION_SECONDS = 86400   # File delle sessioni scaricate eliminati dopo questo tempo
+SESSION_SWEEP_INTERVAL_SECONDS = 60         # Intervallo di controllo delle sessioni inattive
+# Cartella dei file scaricati (contengono le conversazioni: va tenuta fuori dal repository)
+SESSION_OFFLOAD_DIR = os.path.join(tempfile.gettempdir(), "docbot_sessions")
+
 # Stato iniziale della conversazione
 INITIAL_STATE = {
     'phase': 'START', # La fase iniziale gestita da assessment_logic.py
@@ -41,6 +268,9 @@ INITIAL_STATE = {
     # Aggiungere qui altri campi di stato se servono globalmente o per fasi future
 }
 
+# Numero massimo di delta di stato (uno per turno) conservati nel journal di sessione
+STATE_JOURNAL_MAX_ENTRIES = 200
+
 # Liste per risposte comuni
 CONFERME = ['sì', 'si', 'ok', 'va bene', 'certo', 'yes', 'yep', 'volentieri', 'procediamo', 'iniziamo', 'sono pronto', 'pronto', 'd\'accordo', 'esatto', 'giusto', 'confermo']
 NEGAZIONI_O_DUBBI = ['no', 'non', 'non sono sicuro', 'aspetta', 'non ho capito', 'perché', 'non lo so', 'non ricordo', 'non credo', 'sbagliato', 'errato', 'diverso', 'cambia', 'modifica']
@@ -62,6 +292,7 @@ PHASE_TO_CHAPTER_KEY_MAP = {
     'START':                     'step_2_schema_funzionamento_doc',
     'ASSESSMENT_INTRO':          'step_2_schema_funzionamento_doc',
     'ASSESSMENT_GET_EXAMPLE':    'step_2_schema_funzionamento_doc',
+    'ASSESSMENT_CHOOSE_EXAMPLE': 'step_2_schema_funzionamento_doc',
     'ASSESSMENT_GET_PV1':        'step_2_schema_funzionamento_doc',
     'ASSESSMENT_GET_TS1':        'step_2_schema_funzionamento_doc',
     'ASSESSMENT_GET_SV2':        'step_2_schema_funzionamento_doc',
@@ -79,6 +310,8 @@ PHASE_TO_CHAPTER_KEY_MAP = {
     # Assicurati che questi nomi fase siano usati in restructuring_logic.py
     'RESTRUCTURING_INTRO':       'step_3_intervento_secondo_processo_ricorsivo',
     'RESTRUCTURING_IDENTIFY_HOT': 'step_3_intervento_secondo_processo_ricorsivo',
+    'RESTRUCTURING_CHALLENGE':   'step_3_intervento_secondo_processo_ricorsivo',
+    'RESTRUCTURING_ALTERNATIVE': 'step_3_intervento_secondo_processo_ricorsivo',
     # ... altre fasi di ristrutturazione ...
 
     # --- Fasi ERP (Capitolo 5) ---
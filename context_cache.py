@@ -0,0 +1,215 @@
+# context_cache.py (Struttura Modulare a Fasi)
+# Caching lato provider dei prefissi stabili dei prompt (istruzioni di sistema,
+# definizioni dello schema, materiale dei capitoli).
+# Il prefisso di ogni fase/task viene registrato una sola volta e poi referenziato
+# tramite handle, così a ogni turno si inviano solo le parti variabili del prompt.
+#
+# Backend disponibili (config.CONTEXT_CACHE_BACKEND):
+# - 'gemini': google.generativeai.caching.CachedContent (richiede google-generativeai >= 0.7
+#             e un prefisso di almeno CONTEXT_CACHE_MIN_TOKENS token, limite del provider);
+# - 'local':  emulazione in processo (il prefisso viene reinserito nel prompt), per test
+#             e sviluppo offline con la stessa contabilità di hit/miss;
+# - 'off':    nessun caching, il prefisso viene sempre inviato inline.
+#
+# Il caching è disattivato per impostazione predefinita ('off'): i prefissi attuali (istruzioni e
+# definizioni dello schema) sono di poche centinaia di token, molto sotto CONTEXT_CACHE_MIN_TOKENS,
+# e anche con 'gemini' verrebbero inviati inline (contatore 'inline' nella sidebar). Diventa
+# efficace solo con prefissi lunghi, es. CONTEXT_CACHE_INCLUDE_CHAPTER_MATERIAL = True con
+# capitoli che superano la soglia (o modelli con un minimo più basso).
+#
+# La registrazione di un prefisso (una chiamata di rete) avviene fuori dal lock del registro,
+# una sola volta per prefisso anche con più sessioni in attesa; se fallisce il prefisso viene
+# inviato inline senza riprovare per CONTEXT_CACHE_RETRY_SECONDS.
+
+import datetime
+import hashlib
+import threading
+import time
+import metrics
+from utils import log_message
+from singleflight import SingleFlight
+from config import (
+    CONTEXT_CACHE_BACKEND, CONTEXT_CACHE_TTL_SECONDS, CONTEXT_CACHE_MIN_TOKENS, CONTEXT_CACHE_RETRY_SECONDS,
+    SAFETY_SETTINGS_GEMINI
+)
+
+PREFIX_SEPARATOR = "\n\n---\n\n"
+
+
+def estimate_tokens(text):
+    """Stima grossolana del numero di token (circa 4 caratteri per token)."""
+    return len(text or "") // 4
+
+
+def compose_inline(prefix_text, prompt):
+    """Prompt completo con il prefisso inline (usato quando il caching non è disponibile)."""
+    return f"{prefix_text}{PREFIX_SEPARATOR}{prompt}"
+
+
+class LocalContextCacheBackend:
+    """Emulazione in processo del caching: conserva i prefissi e li reinserisce nel prompt."""
+
+    name = 'local'
+
+    def __init__(self):
+        self._prefixes = {}
+
+    def register(self, key, model_name, prefix_text, ttl_seconds):
+        handle = f"local/{key}/{hashlib.sha256(prefix_text.encode('utf-8')).hexdigest()[:12]}"
+        self._prefixes[handle] = prefix_text
+        return handle
+
+    def bind(self, handle, base_model, prompt, generation_config=None):
+        return base_model, compose_inline(self._prefixes[handle], prompt)
+
+
+class GeminiContextCacheBackend:
+    """Context caching del provider (CachedContent) con il prefisso come system instruction."""
+
+    name = 'gemini'
+
+    def __init__(self):
+        self._models = {}
+        self._models_lock = threading.Lock()
+
+    def register(self, key, model_name, prefix_text, ttl_seconds):
+        from google.generativeai import caching
+        cached_content = caching.CachedContent.create(
+            model=model_name,
+            display_name=key[:120],
+            system_instruction=prefix_text,
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        )
+        return cached_content.name
+
+    def bind(self, handle, base_model, prompt, generation_config=None):
+        import google.generativeai as genai
+        cache_key = (handle, id(base_model))
+        with self._models_lock:
+            model = self._models.get(cache_key)
+        if model is None:
+            # Lettura del CachedContent (chiamata di rete) fuori dal lock: con più sessioni
+            # concorrenti al più un modello duplicato, e resta il primo registrato
+            from google.generativeai import caching
+            model = genai.GenerativeModel.from_cached_content(
+                cached_content=caching.CachedContent.get(handle),
+                generation_config=generation_config,
+                safety_settings=SAFETY_SETTINGS_GEMINI,
+            )
+            with self._models_lock:
+                model = self._models.setdefault(cache_key, model)
+        return model, prompt
+
+
+class ContextCache:
+    """
+    Registro dei prefissi in cache: chiave logica (es. 'assessment.user_reply') ->
+    handle del backend, rinnovato quando il contenuto cambia o il TTL scade.
+    """
+
+    def __init__(self, backend, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS, min_tokens=CONTEXT_CACHE_MIN_TOKENS,
+                 retry_seconds=CONTEXT_CACHE_RETRY_SECONDS):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._entries = {}  # (key, model_name) -> {'hash', 'handle', 'expires_at'} o {'hash', 'failed_until'}
+        self._registrations = SingleFlight('context_cache')
+
+    def _register(self, key, model_name, prefix_text, prefix_hash):
+        """Registra il prefisso nel backend (fuori dal lock); un fallimento sospende i tentativi."""
+        try:
+            handle = self.backend.register(key, model_name, prefix_text, self.ttl_seconds)
+        except Exception:
+            with self._lock:
+                self._entries[(key, model_name)] = {'hash': prefix_hash, 'failed_until': time.time() + self.retry_seconds}
+            raise
+        with self._lock:
+            self._entries[(key, model_name)] = {
+                'hash': prefix_hash, 'handle': handle, 'expires_at': time.time() + self.ttl_seconds
+            }
+        log_message(f"Context Cache: Prefisso '{key}' registrato ({self.backend.name}, ~{estimate_tokens(prefix_text)} token) -> {handle}")
+        return handle
+
+    def _get_handle(self, key, model_name, prefix_text):
+        """Handle del prefisso in cache; None se una registrazione recente è fallita (prefisso inline)."""
+        prefix_hash = hashlib.sha256(prefix_text.encode('utf-8')).hexdigest()
+        with self._lock:
+            entry = self._entries.get((key, model_name))
+            if entry and entry['hash'] == prefix_hash:
+                if entry.get('failed_until', 0) > time.time():
+                    return None
+                # Margine di 60 s per non usare un handle che scade durante la richiesta
+                if entry.get('handle') and entry['expires_at'] > time.time() + 60:
+                    metrics.increment('context_cache.hits')
+                    metrics.increment('context_cache.cached_tokens', estimate_tokens(prefix_text))
+                    return entry['handle']
+        metrics.increment('context_cache.misses')
+        handle, _ = self._registrations.do((key, model_name, prefix_hash), self._register,
+                                           key, model_name, prefix_text, prefix_hash)
+        return handle
+
+    def prepare(self, key, base_model, prefix_text, prompt, generation_config=None):
+        """
+        Restituisce (modello, prompt) da usare per la chiamata: il modello legato al
+        prefisso in cache e il solo prompt variabile, oppure il modello di base con
+        il prefisso inline se il caching non è applicabile o fallisce.
+        generation_config è quella del task (il modello legato alla cache la riceve esplicitamente).
+        """
+        model_name = getattr(base_model, 'model_name', None)
+        if estimate_tokens(prefix_text) < self.min_tokens:
+            metrics.increment('context_cache.inline_below_min_tokens')
+            return base_model, compose_inline(prefix_text, prompt)
+        try:
+            handle = self._get_handle(key, model_name, prefix_text)
+            if handle is None:
+                metrics.increment('context_cache.inline_after_error')
+                return base_model, compose_inline(prefix_text, prompt)
+            return self.backend.bind(handle, base_model, prompt, generation_config)
+        except Exception as e:
+            metrics.increment('context_cache.errors')
+            log_message(f"WARN: Context Cache non disponibile per '{key}' ({type(e).__name__}: {e}). Prefisso inviato inline.")
+            return base_model, compose_inline(prefix_text, prompt)
+
+    def stats(self):
+        """Contatori di hit/miss e token serviti dalla cache."""
+        counters = metrics.snapshot(prefix='context_cache.')['counters']
+        hits = counters.get('context_cache.hits', 0)
+        misses = counters.get('context_cache.misses', 0)
+        return {
+            'backend': self.backend.name,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if (hits + misses) else None,
+            'cached_tokens': counters.get('context_cache.cached_tokens', 0),
+            'inline': (counters.get('context_cache.inline_below_min_tokens', 0) + counters.get('context_cache.errors', 0)
+                       + counters.get('context_cache.inline_after_error', 0)),
+        }
+
+
+def _create_default_cache():
+    if CONTEXT_CACHE_BACKEND == 'gemini':
+        return ContextCache(GeminiContextCacheBackend())
+    if CONTEXT_CACHE_BACKEND == 'local':
+        # L'emulazione non ha il limite minimo del provider
+        return ContextCache(LocalContextCacheBackend(), min_tokens=0)
+    return None
+
+
+_context_cache = _create_default_cache()
+if _context_cache is not None and _context_cache.min_tokens > 0:
+    log_message(f"Context Cache: Backend '{_context_cache.backend.name}', prefissi sotto {_context_cache.min_tokens} token "
+                "inviati inline (con i prompt attuali il caching del provider non si attiva).")
+
+
+def get_context_cache():
+    """Cache condivisa dal processo (None se CONTEXT_CACHE_BACKEND = 'off')."""
+    return _context_cache
+
+
+def prepare_call(key, base_model, prefix_text, prompt, generation_config=None):
+    """Come ContextCache.prepare, con il prefisso inline se il caching è disattivato."""
+    if _context_cache is None:
+        return base_model, compose_inline(prefix_text, prompt)
+    return _context_cache.prepare(key, base_model, prefix_text, prompt, generation_config)
@@ -0,0 +1,223 @@
+# cycle_index.py (Struttura Modulare a Fasi)
+# Indice vettoriale per utente dei cicli del DOC già confermati (EC/PV1/TS1/SV2/TS2).
+# Lo schema in stato descrive un solo ciclo e viene sovrascritto a ogni sessione: qui
+# ogni schema confermato viene conservato e indicizzato, così la Prevenzione Ricadute
+# può confrontare un nuovo episodio con la storia del paziente.
+#
+# Formato su disco (per utente, nome file derivato dall'identificativo):
+# - <utente>.cycles.jsonl: un record per ciclo confermato (data e schema), append-only.
+# - <utente>.vectors.bin: intestazione (versione, dimensione, modello di embedding) e
+#   una riga float16 per ciclo con due vettori normalizzati: il ciclo intero e il solo
+#   Evento Critico (il trigger). La riga i corrisponde al record i.
+# L'embedding di un ciclo si calcola una sola volta, in background dopo la conferma;
+# i record non ancora indicizzati (es. embedding fallito) vengono recuperati alla
+# conferma successiva. recall() calcola solo l'embedding del nuovo episodio e confronta
+# in memoria (prodotto scalare NumPy) con i vettori già salvati.
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+import rag_utils
+from utils import log_message
+from config import (
+    EMBEDDING_MODEL_NAME, CYCLE_INDEX_DIR, CYCLE_RECALL_TOP_K, CYCLE_TRIGGER_SIMILARITY,
+    CYCLE_INDEX_CACHE_MAX_USERS
+)
+
+FILE_MAGIC = b'CYCVEC01'
+_HEADER = struct.Struct('<8sI16s')  # magic, dimensione, digest del modello di embedding
+
+SCHEMA_LABELS = [
+    ('ec', 'Evento critico'), ('pv1', 'Ossessione'), ('ts1', 'Compulsione'),
+    ('sv2', 'Seconda valutazione'), ('ts2', 'Tentativo di soluzione 2'),
+]
+
+_cache = OrderedDict()  # file_utente -> {'records': list, 'vectors': array (n, 2, dim) float32, 'sizes': tuple}
+_lock = threading.Lock()
+# Un solo thread: gli embedding dei cicli confermati sono rari e non devono rallentare il turno
+_index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cycle_index')
+
+
+def _user_file(user_id, kind):
+    digest = hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(CYCLE_INDEX_DIR, f"{digest}.{kind}")
+
+
+def _model_digest(model_name=EMBEDDING_MODEL_NAME):
+    return hashlib.sha256(model_name.encode('utf-8')).digest()[:16]
+
+
+def cycle_text(schema):
+    """Testo del ciclo usato per l'embedding."""
+    return "\n".join(f"{label}: {schema.get(key)}" for key, label in SCHEMA_LABELS if schema.get(key))
+
+
+def _embed(text):
+    """Embedding normalizzato (float32) con il modello degli indici RAG."""
+    vector = np.asarray(rag_utils._embed_query(EMBEDDING_MODEL_NAME, text)['embedding'], dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _embed_cycle(schema):
+    return np.stack([_embed(cycle_text(schema)), _embed(str(schema.get('ec') or cycle_text(schema)))])
+
+
+def _file_sizes(user_id):
+    return tuple(os.path.getsize(p) if os.path.exists(p) else 0
+                 for p in (_user_file(user_id, 'cycles.jsonl'), _user_file(user_id, 'vectors.bin')))
+
+
+def _read_vectors(path):
+    """Vettori salvati (n, 2, dim) in float32; None se il file manca o è di un altro modello."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        magic, dim, model_digest = _HEADER.unpack(header)
+        if magic != FILE_MAGIC or model_digest != _model_digest():
+            log_message(f"Cycle Index: WARN - '{path}' di un altro formato o modello di embedding, verrà ricostruito.")
+            return None
+        rows = np.fromfile(f, dtype=np.float16)
+    rows = rows[:len(rows) - len(rows) % (2 * dim)]  # Riga troncata da una scrittura interrotta
+    return rows.reshape(-1, 2, dim).astype(np.float32)
+
+
+def _entry(user_id):
+    """Voce di cache dell'utente, riletta solo se i file sono cambiati (chiamare con _lock)."""
+    records_path = _user_file(user_id, 'cycles.jsonl')
+    entry = _cache.get(records_path)
+    sizes = _file_sizes(user_id)
+    if entry is None or entry['sizes'] != sizes:
+        records = []
+        if os.path.exists(records_path):
+            with open(records_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # Record troncato: i successivi non sono affidabili
+        vectors = _read_vectors(_user_file(user_id, 'vectors.bin'))
+        entry = {'records': records, 'vectors': vectors, 'sizes': sizes}
+        metrics.increment('cycle_index.loaded')
+    _cache[records_path] = entry
+    _cache.move_to_end(records_path)
+    while len(_cache) > CYCLE_INDEX_CACHE_MAX_USERS:
+        _cache.popitem(last=False)
+    return entry
+
+
+def _index_pending(user_id):
+    """Calcola e accoda i vettori dei record non ancora indicizzati."""
+    with _lock:
+        entry = _entry(user_id)
+        start = 0 if entry['vectors'] is None else len(entry['vectors'])
+        pending = entry['records'][start:]
+    if not pending:
+        return 0
+    new_rows = np.stack([_embed_cycle(record['schema']) for record in pending])  # Fuori dal lock
+    path = _user_file(user_id, 'vectors.bin')
+    with _lock:
+        entry = _entry(user_id)
+        if (0 if entry['vectors'] is None else len(entry['vectors'])) != start:
+            return 0  # Indicizzati nel frattempo da un altro processo
+        mode = 'ab' if entry['vectors'] is not None else 'wb'
+        with open(path, mode) as f:
+            if mode == 'wb':
+                f.write(_HEADER.pack(FILE_MAGIC, new_rows.shape[2], _model_digest()))
+            else:
+                # Scarta un'eventuale riga troncata prima di accodare
+                f.truncate(_HEADER.size + entry['vectors'].size * 2)
+            f.write(new_rows.astype(np.float16).tobytes())
+        stored = new_rows.astype(np.float16).astype(np.float32)
+        entry['vectors'] = stored if entry['vectors'] is None else np.concatenate([entry['vectors'], stored])
+        entry['sizes'] = _file_sizes(user_id)
+    metrics.increment('cycle_index.cycles_embedded', len(new_rows))
+    log_message(f"Cycle Index: {len(new_rows)} cicli indicizzati ({len(entry['vectors'])} in totale).")
+    return len(new_rows)
+
+
+def _index_pending_safe(user_id):
+    try:
+        return _index_pending(user_id)
+    except Exception as e:
+        metrics.increment('cycle_index.errors')
+        log_message(f"Cycle Index: ERRORE indicizzazione ({type(e).__name__}: {e}). Ritento alla prossima conferma.")
+        return 0
+
+
+def add_cycle(user_id, schema):
+    """
+    Conserva uno schema confermato e ne avvia l'indicizzazione in background.
+
+    Args:
+        user_id (str): Identificativo dell'utente.
+        schema (dict): Lo schema confermato (ec, pv1, ts1, sv2, ts2).
+
+    Returns:
+        Future: Completato quando i vettori sono salvati (numero di cicli indicizzati).
+    """
+    record = {'ts': time.time(), 'schema': {key: schema.get(key) for key, _ in SCHEMA_LABELS}}
+    os.makedirs(CYCLE_INDEX_DIR, exist_ok=True)
+    with _lock:
+        with open(_user_file(user_id, 'cycles.jsonl'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        entry = _entry(user_id)
+    metrics.increment('cycle_index.cycles_added')
+    log_message(f"Cycle Index: Ciclo confermato salvato ({len(entry['records'])} per questo utente).")
+    return _index_executor.submit(_index_pending_safe, user_id)
+
+
+def recall(user_id, schema, top_k=CYCLE_RECALL_TOP_K):
+    """
+    Cicli passati più simili a un nuovo episodio e trigger ricorrenti.
+
+    Args:
+        user_id (str): Identificativo dell'utente.
+        schema (dict): Il nuovo episodio (anche parziale, basta l'Evento Critico).
+        top_k (int): Numero di cicli simili da restituire.
+
+    Returns:
+        dict: 'nearest' (lista di {'score', 'ts', 'schema'}, dal più simile) e
+              'recurring_triggers' (cicli passati con un Evento Critico simile a quello
+              nuovo, {'score', 'ts', 'ec'}). Liste vuote se non c'è storia indicizzata.
+    """
+    with _lock:
+        entry = _entry(user_id)
+        records, vectors = entry['records'], entry['vectors']
+    if vectors is None or not len(vectors):
+        return {'nearest': [], 'recurring_triggers': []}
+    query = _embed_cycle(schema)
+    cycle_scores = vectors[:, 0, :] @ query[0]
+    trigger_scores = vectors[:, 1, :] @ query[1]
+
+    top_k = min(top_k, len(cycle_scores))
+    nearest = np.argpartition(-cycle_scores, top_k - 1)[:top_k]
+    nearest = nearest[np.argsort(-cycle_scores[nearest])]
+    triggers = np.flatnonzero(trigger_scores >= CYCLE_TRIGGER_SIMILARITY)
+    triggers = triggers[np.argsort(-trigger_scores[triggers])]
+    metrics.increment('cycle_index.recalls')
+    return {
+        'nearest': [{'score': float(cycle_scores[i]), 'ts': records[i]['ts'], 'schema': records[i]['schema']}
+                    for i in nearest],
+        'recurring_triggers': [{'score': float(trigger_scores[i]), 'ts': records[i]['ts'],
+                                'ec': records[i]['schema'].get('ec')} for i in triggers],
+    }
+
+
+def cycle_count(user_id):
+    """(cicli salvati, cicli indicizzati) dell'utente."""
+    with _lock:
+        entry = _entry(user_id)
+        return len(entry['records']), 0 if entry['vectors'] is None else len(entry['vectors'])
@@ -0,0 +1,73 @@
+# deadline.py (Struttura Modulare a Fasi)
+# Deadline per turno propagata a tutte le chiamate del turno (LLM, embedding, ricerca RAG).
+# process_user_message attiva la deadline del turno (contextvars: è visibile a tutte le
+# funzioni chiamate, anche nei thread avviati con copy_context()); ogni chiamata usa come
+# timeout il budget residuo. A budget esaurito i gestori ripiegano sui fallback esistenti
+# (testo originale invece della sintesi, niente RAG, risposta scriptata) e ogni fallback
+# attivato viene registrato con record_degradation().
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+from utils import log_message
+from config import LLM_CALL_TIMEOUT_SECONDS, DEADLINE_MIN_CALL_SECONDS
+
+_current_deadline = contextvars.ContextVar('turn_deadline', default=None)
+
+
+class TurnDeadline:
+    """Scadenza di un turno e registro dei fallback attivati per rispettarla."""
+
+    def __init__(self, budget_seconds):
+        self.budget_seconds = budget_seconds
+        self.expires_at = time.monotonic() + budget_seconds
+        self.degradations = []
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def record(self, name):
+        with self._lock:
+            self.degradations.append(name)
+
+
+@contextmanager
+def turn_deadline(deadline):
+    """Attiva 'deadline' (TurnDeadline o None) per il codice eseguito nel blocco."""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline():
+    """La deadline del turno in corso (None fuori da un turno, es. batch e script)."""
+    return _current_deadline.get()
+
+
+def call_timeout(default=LLM_CALL_TIMEOUT_SECONDS):
+    """Timeout per la prossima chiamata: il minimo tra 'default' e il budget residuo del turno."""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return default
+    return min(default, deadline.remaining())
+
+
+def budget_exhausted():
+    """True se il budget residuo non basta per avviare un'altra chiamata."""
+    deadline = _current_deadline.get()
+    return deadline is not None and deadline.remaining() < DEADLINE_MIN_CALL_SECONDS
+
+
+def record_degradation(name):
+    """Registra un fallback attivato per rispettare la deadline del turno."""
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.record(name)
+    metrics.increment(f'turns.degraded.{name}')
+    log_message(f"Deadline: Budget del turno esaurito, fallback '{name}'.")
@@ -0,0 +1,266 @@
+# distortion_classifier.py (Struttura Modulare a Fasi)
+# Classificatore locale delle valutazioni disfunzionali del DOC (responsabilità ipertrofica,
+# fusione pensiero-azione, intolleranza dell'incertezza, ...) per la Ristrutturazione Cognitiva.
+# Invece di una chiamata generativa a ogni turno, il testo dell'utente (SV2/PV1 o il pensiero
+# "caldo") viene confrontato con un insieme di esempi etichettati (distortion_exemplars.json):
+# - kNN: voto pesato (softmax delle similarità coseno) dei DISTORTION_KNN_K esempi più vicini;
+#   la confidenza è la quota di voto dell'etichetta vincente;
+# - centroidi: se l'etichetta del centroide più vicino è diversa da quella del kNN la
+#   confidenza viene dimezzata (i due criteri non concordano).
+# Sotto DISTORTION_CONFIDENCE_THRESHOLD (o se il testo è lontano da tutti gli esempi) la
+# classificazione passa all'LLM (task 'distortion_classification'), una sola parola in uscita.
+#
+# I vettori degli esempi si calcolano con una sola richiesta di embedding e sono salvati in
+# DISTORTION_VECTORS_FILE (legati al modello di embedding e al contenuto degli esempi: se
+# cambiano vengono ricalcolati). Per generarli offline: python distortion_classifier.py build
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import metrics
+import rag_utils
+from utils import log_message
+from singleflight import SingleFlight
+from deadline import budget_exhausted, record_degradation
+from config import (
+    EMBEDDING_MODEL_NAME, DISTORTION_EXEMPLARS_FILE, DISTORTION_VECTORS_FILE, DISTORTION_KNN_K,
+    DISTORTION_KNN_TEMPERATURE, DISTORTION_CONFIDENCE_THRESHOLD, DISTORTION_MIN_SIMILARITY,
+    DISTORTION_EMBED_RETRY_SECONDS
+)
+
+# Tipo di task degli embedding: lo stesso per gli esempi e per il testo da classificare
+EMBEDDING_TASK_TYPE = "CLASSIFICATION"
+
+_exemplars = None   # {'labels': {chiave: {...}}, 'texts': [...], 'label_of': array, 'digest': str}
+_vectors = None     # {'vectors': (n, dim) normalizzati, 'centroids': (n_etichette, dim)}
+_vectors_retry_at = 0.0  # Dopo un embedding fallito non si riprova prima di questo istante (monotonic)
+_lock = threading.Lock()
+_vector_flights = SingleFlight('distortion_vectors')  # Un solo calcolo dei vettori alla volta
+
+
+def _load_exemplars(path=DISTORTION_EXEMPLARS_FILE):
+    """Etichette (nome, descrizione, domande) ed esempi; vuoto se il file manca o non è valido."""
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        data = json.loads(raw.decode('utf-8'))
+    except (OSError, ValueError) as e:
+        log_message(f"Distortion Classifier: WARN - Esempi '{path}' non disponibili ({e}). Classificazione solo con l'LLM.")
+        return {'labels': {}, 'texts': [], 'label_of': np.zeros(0, dtype=np.int64), 'digest': None}
+    labels = {key: label for key, label in (data.get('labels') or {}).items() if label.get('exemplars')}
+    texts, label_of = [], []
+    for position, label in enumerate(labels.values()):
+        texts.extend(label['exemplars'])
+        label_of.extend([position] * len(label['exemplars']))
+    log_message(f"Distortion Classifier: {len(texts)} esempi per {len(labels)} valutazioni disfunzionali.")
+    return {'labels': labels, 'texts': texts, 'label_of': np.asarray(label_of, dtype=np.int64),
+            'digest': hashlib.sha256(raw + EMBEDDING_MODEL_NAME.encode('utf-8')).hexdigest()}
+
+
+def get_labels():
+    """Le valutazioni disfunzionali note: {chiave: {'name', 'description', 'challenge_questions', 'exemplars'}}."""
+    global _exemplars
+    with _lock:
+        if _exemplars is None:
+            _exemplars = _load_exemplars()
+        return _exemplars['labels']
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+
+def _centroids(vectors, label_of, n_labels):
+    return _normalize(np.stack([vectors[label_of == position].mean(axis=0) for position in range(n_labels)]))
+
+
+def build_vectors(path=DISTORTION_VECTORS_FILE):
+    """
+    Calcola (una richiesta batch) e salva i vettori degli esempi per il modello di embedding corrente.
+
+    Returns:
+        dict: {'vectors', 'centroids'}.
+    """
+    get_labels()
+    return _embed_exemplars(path)
+
+
+def _embed_exemplars(path):
+    exemplars = _exemplars
+    vectors = _normalize(np.asarray(rag_utils._embed_batch(EMBEDDING_MODEL_NAME, exemplars['texts'], EMBEDDING_TASK_TYPE),
+                                    dtype=np.float32))
+    try:
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, vectors=vectors.astype(np.float16), digest=np.array(exemplars['digest']))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log_message(f"Distortion Classifier: WARN - Vettori non salvati in '{path}' ({e}).")
+    metrics.increment('distortion.exemplars_embedded')
+    log_message(f"Distortion Classifier: Vettori di {len(exemplars['texts'])} esempi calcolati.")
+    return {'vectors': vectors, 'centroids': _centroids(vectors, exemplars['label_of'], len(exemplars['labels']))}
+
+
+def _read_vectors(path=DISTORTION_VECTORS_FILE):
+    """Vettori salvati, None se mancano o sono di altri esempi o di un altro modello."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as saved:
+            if str(saved['digest']) != _exemplars['digest'] or len(saved['vectors']) != len(_exemplars['texts']):
+                log_message(f"Distortion Classifier: Vettori in '{path}' non aggiornati (esempi o modello cambiati), li ricalcolo.")
+                return None
+            vectors = _normalize(saved['vectors'].astype(np.float32))
+    except (OSError, KeyError, ValueError) as e:
+        log_message(f"Distortion Classifier: WARN - Vettori in '{path}' non leggibili ({e}), li ricalcolo.")
+        return None
+    return {'vectors': vectors, 'centroids': _centroids(vectors, _exemplars['label_of'], len(_exemplars['labels']))}
+
+
+def _load_or_embed_vectors():
+    """Legge o calcola i vettori (fuori dal lock); se l'embedding fallisce rimanda i tentativi."""
+    global _vectors, _vectors_retry_at
+    vectors = _read_vectors()
+    if vectors is None:
+        try:
+            vectors = _embed_exemplars(DISTORTION_VECTORS_FILE)
+        except Exception as e:
+            metrics.increment('distortion.exemplars_failed')
+            log_message(f"Distortion Classifier: WARN - Embedding degli esempi fallito ({type(e).__name__}: {e}). "
+                        f"Classificazione con l'LLM, nuovo tentativo tra {DISTORTION_EMBED_RETRY_SECONDS}s.")
+            with _lock:
+                _vectors_retry_at = time.monotonic() + DISTORTION_EMBED_RETRY_SECONDS
+            return None
+    with _lock:
+        _vectors = vectors
+    return vectors
+
+
+def _get_vectors():
+    """
+    Vettori degli esempi, letti dal file o calcolati al primo uso (una volta per processo).
+    None senza esempi o durante la pausa dopo un embedding fallito.
+    """
+    get_labels()
+    with _lock:
+        if _vectors is not None or not _exemplars['texts'] or time.monotonic() < _vectors_retry_at:
+            return _vectors
+    return _vector_flights.do('vectors', _load_or_embed_vectors)[0]
+
+
+def _classify_locally(text):
+    """Etichetta, confidenza e similarità del kNN sugli esempi (None senza esempi)."""
+    vectors = _get_vectors()
+    if vectors is None:
+        return None
+    labels = list(_exemplars['labels'])
+    label_of = _exemplars['label_of']
+    query = _normalize(np.asarray(rag_utils._embed_query(EMBEDDING_MODEL_NAME, text, EMBEDDING_TASK_TYPE)['embedding'],
+                                  dtype=np.float32))
+    similarities = vectors['vectors'] @ query
+    nearest = np.argsort(-similarities)[:DISTORTION_KNN_K]
+    weights = np.exp((similarities[nearest] - similarities[nearest[0]]) / DISTORTION_KNN_TEMPERATURE)
+    votes = np.bincount(label_of[nearest], weights=weights, minlength=len(labels)) / weights.sum()
+    best = int(np.argmax(votes))
+    confidence = min(1.0, float(votes[best]))
+    if int(np.argmax(vectors['centroids'] @ query)) != best:
+        confidence /= 2  # kNN e centroidi non concordano
+    return {
+        'label': labels[best],
+        'confidence': confidence,
+        'similarity': float(similarities[nearest[0]]),
+        'scores': {labels[i]: round(float(votes[i]), 3) for i in np.flatnonzero(votes)},
+    }
+
+
+def _classify_with_llm(text, labels):
+    """Classificazione con l'LLM (una parola): la chiave di una delle etichette o None."""
+    from llm_interface import generate_response
+    categories = "\n".join(f"- {key}: {label['name']}. {label['description']}" for key, label in labels.items())
+    prompt = f"""Sei un esperto di terapia cognitivo-comportamentale del DOC. Indica quale valutazione disfunzionale
+esprime il seguente testo di un paziente.
+
+CATEGORIE:
+{categories}
+
+TESTO DEL PAZIENTE: \"\"\"{text}\"\"\"
+
+Rispondi ESATTAMENTE con la chiave di UNA categoria (es. {next(iter(labels))}), senza altro testo."""
+    answer = generate_response(prompt=prompt, history=[], task='distortion_classification').strip().strip('.').lower()
+    return answer if answer in labels else None
+
+
+def classify(text, allow_llm=True):
+    """
+    Tipo di valutazione disfunzionale espresso dal testo.
+
+    Args:
+        text (str): Testo da classificare (es. SV2 e PV1 dello schema, o il pensiero "caldo").
+        allow_llm (bool): Se False non passa mai all'LLM (resta il risultato locale, anche incerto).
+
+    Returns:
+        dict | None: {'label', 'confidence', 'similarity', 'scores', 'source'} con source 'local'
+                     (kNN sopra soglia), 'llm' (confidenza None) o 'local_uncertain'; None se il
+                     testo è vuoto o la classificazione non è stata possibile.
+    """
+    if not text or not text.strip():
+        return None
+    labels = get_labels()
+    if budget_exhausted():
+        record_degradation('distortion_skipped')
+        return None
+    try:
+        result = _classify_locally(text)
+    except Exception as e:
+        metrics.increment('distortion.errors')
+        log_message(f"Distortion Classifier: ERRORE nella classificazione locale ({type(e).__name__}: {e}).")
+        result = None
+    confident = result is not None and result['confidence'] >= DISTORTION_CONFIDENCE_THRESHOLD \
+        and result['similarity'] >= DISTORTION_MIN_SIMILARITY
+    if confident:
+        metrics.increment('distortion.local')
+        result['source'] = 'local'
+        log_message(f"Distortion Classifier: '{result['label']}' (confidenza {result['confidence']:.2f}, locale).")
+        return result
+    if allow_llm and labels and not budget_exhausted():
+        metrics.increment('distortion.escalated')
+        label = _classify_with_llm(text, labels)
+        if label:
+            log_message(f"Distortion Classifier: '{label}' (LLM, confidenza locale insufficiente).")
+            return {'label': label, 'confidence': None, 'similarity': result['similarity'] if result else None,
+                    'scores': result['scores'] if result else {}, 'source': 'llm'}
+        metrics.increment('distortion.llm_invalid')
+    if result is None:
+        return None
+    metrics.increment('distortion.uncertain')
+    result['source'] = 'local_uncertain'
+    return result
+
+
+def stats():
+    """Classificazioni locali, passate all'LLM e incerte (per la sidebar)."""
+    counters = metrics.snapshot(prefix='distortion.')['counters']
+    local = counters.get('distortion.local', 0)
+    escalated = counters.get('distortion.escalated', 0)
+    return {
+        'local': local,
+        'escalated': escalated,
+        'uncertain': counters.get('distortion.uncertain', 0),
+        'local_rate': local / (local + escalated) if (local + escalated) else None,
+    }
+
+
+if __name__ == "__main__":
+    # Uso: GOOGLE_API_KEY=... python distortion_classifier.py build
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "build":
+        import google.generativeai as genai
+        genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+        build_vectors()
+    else:
+        print("Uso: python distortion_classifier.py build")
@@ -0,0 +1,241 @@
+# exposure_log.py (Struttura Modulare a Fasi)
+# Registro delle prove di esposizione ERP, una serie temporale append-only per utente.
+# Ogni prova (gradino della gerarchia, SUDS prima/picco/fine, durata, compulsione
+# evitata, in vivo o immaginativa) è un record binario a dimensione fissa (TRIAL_DTYPE,
+# 19 byte) accodato a <ERP_DATA_DIR>/<utente>.trials.bin: caricare centinaia di prove è
+# una sola lettura (np.fromfile) e le serie lette restano in una cache LRU del processo.
+# La gerarchia dell'utente è in <utente>.hierarchy.json.
+# analyze() calcola in NumPy, senza cicli Python sulle prove: abituazione per prova,
+# calo entro la seduta e tra sedute, andamento del picco per gradino e il prossimo passo.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+from utils import log_message
+from config import (
+    ERP_DATA_DIR, ERP_SESSION_GAP_SECONDS, ERP_MASTERY_SUDS, ERP_MASTERY_TRIALS, ERP_CACHE_MAX_USERS
+)
+
+FILE_MAGIC = b'ERPTRL01'  # Intestazione (e versione del formato) dei file delle prove
+
+MODE_IN_VIVO = 0
+MODE_IMAGINAL = 1
+
+TRIAL_DTYPE = np.dtype([
+    ('ts', '<f8'),        # Inizio della prova (epoch, secondi)
+    ('duration', '<f4'),  # Durata (secondi)
+    ('item', '<u2'),      # Indice del gradino nella gerarchia
+    ('pre', 'u1'),        # SUDS prima dell'esposizione (0-100)
+    ('peak', 'u1'),       # SUDS di picco
+    ('post', 'u1'),       # SUDS alla fine
+    ('resisted', 'u1'),   # 1 = compulsione evitata
+    ('mode', 'u1'),       # MODE_IN_VIVO / MODE_IMAGINAL
+])
+
+_cache = OrderedDict()  # file_utente -> {'size': byte del file letti, 'trials': array, 'hierarchy': list}
+_lock = threading.Lock()
+
+
+def _user_file(user_id, kind):
+    # Il nome del file non contiene l'identificativo in chiaro
+    digest = hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(ERP_DATA_DIR, f"{digest}.{kind}")
+
+
+def _read_trials(path):
+    if not os.path.exists(path):
+        return 0, np.empty(0, dtype=TRIAL_DTYPE)
+    with open(path, 'rb') as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            log_message(f"Exposure Log: WARN - Intestazione non valida in '{path}', prove ignorate.")
+            return 0, np.empty(0, dtype=TRIAL_DTYPE)
+        trials = np.fromfile(f, dtype=TRIAL_DTYPE)
+    # Un record troncato (scrittura interrotta) viene semplicemente escluso
+    return len(FILE_MAGIC) + trials.nbytes, trials
+
+
+def _read_hierarchy(path):
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('items', [])
+    except (OSError, json.JSONDecodeError) as e:
+        log_message(f"Exposure Log: WARN - Gerarchia '{path}' non leggibile ({e}).")
+        return []
+
+
+def _entry(user_id):
+    """Voce di cache dell'utente, riletta solo se il file delle prove è cambiato (chiamare con _lock)."""
+    path = _user_file(user_id, 'trials.bin')
+    entry = _cache.get(path)
+    size_on_disk = os.path.getsize(path) if os.path.exists(path) else 0
+    if entry is None or entry['size'] != size_on_disk:
+        size, trials = _read_trials(path)
+        entry = {
+            'size': size,
+            'trials': trials,
+            'hierarchy': _read_hierarchy(_user_file(user_id, 'hierarchy.json')),
+        }
+        metrics.increment('erp.trials_loaded')
+    _cache[path] = entry
+    _cache.move_to_end(path)
+    while len(_cache) > ERP_CACHE_MAX_USERS:
+        _cache.popitem(last=False)
+    return entry
+
+
+def load_trials(user_id):
+    """Tutte le prove dell'utente (array strutturato TRIAL_DTYPE, in ordine di registrazione)."""
+    with _lock:
+        return _entry(user_id)['trials']
+
+
+def load_hierarchy(user_id):
+    """La gerarchia dell'utente: lista di {'text': str, 'suds': int} (l'indice è l'id del gradino)."""
+    with _lock:
+        return list(_entry(user_id)['hierarchy'])
+
+
+def save_hierarchy(user_id, items):
+    """Salva la gerarchia. I gradini già usati dalle prove non vanno riordinati né rimossi."""
+    path = _user_file(user_id, 'hierarchy.json')
+    os.makedirs(ERP_DATA_DIR, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'items': items}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    with _lock:
+        _entry(user_id)['hierarchy'] = list(items)
+
+
+def append_trial(user_id, item, pre, peak, post, duration, resisted, mode=MODE_IN_VIVO, ts=None):
+    """Accoda una prova al file dell'utente e la aggiunge alla serie in cache."""
+    record = np.zeros(1, dtype=TRIAL_DTYPE)
+    record['ts'] = time.time() if ts is None else ts
+    record['duration'] = max(0.0, float(duration))
+    record['item'] = item
+    for field, value in (('pre', pre), ('peak', peak), ('post', post)):
+        record[field] = min(100, max(0, int(value)))
+    record['resisted'] = 1 if resisted else 0
+    record['mode'] = mode
+    path = _user_file(user_id, 'trials.bin')
+    with _lock:
+        entry = _entry(user_id)
+        os.makedirs(ERP_DATA_DIR, exist_ok=True)
+        with open(path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(FILE_MAGIC)
+            elif f.tell() != entry['size']:
+                # Coda troncata da una scrittura interrotta: riallinea prima di accodare
+                f.truncate(entry['size'])
+            f.write(record.tobytes())
+        entry['trials'] = np.concatenate([entry['trials'], record])
+        entry['size'] = os.path.getsize(path)
+    metrics.increment('erp.trials_recorded')
+    return record[0]
+
+
+def analyze(trials, hierarchy):
+    """
+    Analisi di abituazione delle prove di un utente.
+
+    Args:
+        trials (np.ndarray): Prove (TRIAL_DTYPE) in ordine di registrazione.
+        hierarchy (list): Gerarchia dell'utente (vedi load_hierarchy).
+
+    Returns:
+        dict: 'habituation' (calo picco→fine per prova, 0-1), 'session' (seduta di ogni
+              prova), 'within_session' (calo medio picco→fine nelle prove di ogni seduta),
+              'per_item' (prove, ultimo picco, pendenza del picco per prova, calo del picco
+              rispetto alla seduta precedente, prove consecutive sotto soglia, superato)
+              e 'next_item' / 'next_reason'.
+    """
+    n_items = max(len(hierarchy), int(trials['item'].max()) + 1 if len(trials) else 0)
+    peak = trials['peak'].astype(np.float64)
+    post = trials['post'].astype(np.float64)
+
+    habituation = np.divide(peak - post, peak, out=np.zeros_like(peak), where=peak > 0)
+
+    # Sedute: nuova seduta quando tra due prove passa più di ERP_SESSION_GAP_SECONDS
+    session = np.concatenate([[0], np.cumsum(np.diff(trials['ts']) > ERP_SESSION_GAP_SECONDS)])[:len(trials)].astype(np.int64)
+    n_sessions = int(session[-1]) + 1 if len(trials) else 0
+    session_trials = np.bincount(session, minlength=n_sessions)
+    within_session = np.divide(np.bincount(session, weights=peak - post, minlength=n_sessions), session_trials,
+                               out=np.zeros(n_sessions), where=session_trials > 0)
+
+    # Per gradino: ordine stabile per gradino, posizione di ogni prova nel suo gradino
+    item = trials['item'].astype(np.int64)
+    order = np.argsort(item, kind='stable')
+    sorted_item = item[order]
+    count = np.bincount(item, minlength=n_items)
+    group_start = np.r_[0, np.cumsum(count)[:-1]]
+    x = np.empty(len(trials))
+    x[order] = np.arange(len(trials)) - group_start[sorted_item]
+
+    # Pendenza (minimi quadrati) del picco in funzione del numero di prova, per gradino
+    sum_x = np.bincount(item, weights=x, minlength=n_items)
+    sum_y = np.bincount(item, weights=peak, minlength=n_items)
+    sum_xy = np.bincount(item, weights=x * peak, minlength=n_items)
+    sum_xx = np.bincount(item, weights=x * x, minlength=n_items)
+    denominator = count * sum_xx - sum_x ** 2
+    slope = np.divide(count * sum_xy - sum_x * sum_y, denominator,
+                      out=np.zeros(n_items), where=denominator > 0)
+
+    last_peak = np.full(n_items, np.nan)
+    last_peak[item] = peak  # Con indici ripetuti vince l'ultima prova
+
+    # Tra sedute: picco massimo per (gradino, seduta), confronto tra le ultime due sedute del gradino
+    group_key, group_index = np.unique(item * max(n_sessions, 1) + session, return_inverse=True)
+    group_peak = np.zeros(len(group_key))
+    np.maximum.at(group_peak, group_index, peak)
+    group_item = group_key // max(n_sessions, 1)
+    between_session = np.full(n_items, np.nan)
+    if len(group_key):
+        last_group = np.searchsorted(group_item, np.arange(n_items), side='right') - 1
+        has_previous = (last_group >= 1) & (group_item[np.maximum(last_group, 0)] == np.arange(n_items)) \
+            & (group_item[np.maximum(last_group - 1, 0)] == np.arange(n_items))
+        between_session[has_previous] = group_peak[last_group[has_previous] - 1] - group_peak[last_group[has_previous]]
+
+    # Prove consecutive finali sotto soglia e senza compulsioni
+    ok = (peak <= ERP_MASTERY_SUDS) & (trials['resisted'] == 1)
+    last_bad = np.full(n_items, -1)
+    np.maximum.at(last_bad, item[~ok], x[~ok].astype(np.int64))
+    streak = count - 1 - last_bad
+    mastered = (count > 0) & (streak >= ERP_MASTERY_TRIALS)
+
+    # Prossimo passo: ripetere l'ultimo gradino finché non è superato, poi il primo non
+    # superato in ordine di SUDS iniziale
+    next_item, next_reason = None, 'done'
+    ranked = sorted(range(len(hierarchy)), key=lambda i: hierarchy[i].get('suds', 0))
+    if len(trials) and item[-1] < len(hierarchy) and not mastered[item[-1]]:
+        next_item, next_reason = int(item[-1]), 'repeat'
+    else:
+        for candidate in ranked:
+            if not mastered[candidate]:
+                next_item = candidate
+                next_reason = 'start' if not len(trials) else ('resume' if count[candidate] else 'next')
+                break
+
+    return {
+        'habituation': habituation,
+        'session': session,
+        'within_session': within_session,
+        'per_item': {
+            'count': count,
+            'last_peak': last_peak,
+            'slope': slope,
+            'between_session': between_session,
+            'streak': streak,
+            'mastered': mastered,
+        },
+        'next_item': next_item,
+        'next_reason': next_reason,
+    }
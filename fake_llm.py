@@ -0,0 +1,188 @@
+# fake_llm.py (Struttura Modulare a Fasi)
+# Backend Gemini finto, in processo, per load test e sviluppo offline.
+# Sostituisce i modelli per task di llm_interface (stessa interfaccia di GenerativeModel:
+# generate_content, anche in streaming, e start_chat().send_message) e l'embedding batch
+# di rag_utils (le query passano comunque dal micro-batching tra sessioni). Le risposte
+# sono plausibili per ogni task (JSON per l'estrazione, VALIDO_SV2 per la validazione,
+# testo breve per sintesi e risposte), con latenza log-normale ed errori simulati configurabili.
+#
+# Uso:
+#   import fake_llm
+#   fake_llm.install(fake_llm.FakeLLMProfile(latency_median_seconds=0.8, error_rate=0.01))
+
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+
+import metrics
+from config import LLM_TASKS, FAKE_LLM_LATENCY_MEDIAN_SECONDS, FAKE_LLM_LATENCY_SIGMA, FAKE_LLM_ERROR_RATE
+
+EMBEDDING_DIMENSION = 768 # Come text-embedding-004 (dimensione degli indici FAISS)
+
+
+class FakeLLMError(RuntimeError):
+    """Errore simulato del provider (es. 429 / 503)."""
+
+
+class FakeLLMProfile:
+    """Distribuzione di latenza (log-normale) e di errori del backend finto."""
+
+    def __init__(self, latency_median_seconds=FAKE_LLM_LATENCY_MEDIAN_SECONDS, latency_sigma=FAKE_LLM_LATENCY_SIGMA,
+                 error_rate=FAKE_LLM_ERROR_RATE, embedding_latency_seconds=0.05, seed=None):
+        self.latency_median_seconds = latency_median_seconds
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.embedding_latency_seconds = embedding_latency_seconds
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency(self):
+        if self.latency_median_seconds <= 0:
+            return 0.0
+        with self._lock:
+            return self.latency_median_seconds * math.exp(self._random.gauss(0, self.latency_sigma))
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+class _Obj:
+    """Contenitore di attributi (imita le strutture di risposta dell'SDK)."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _make_response(text, prompt):
+    part = _Obj(text=text)
+    candidate = _Obj(finish_reason="STOP", content=_Obj(parts=[part]), safety_ratings=[])
+    usage = _Obj(prompt_token_count=len(prompt) // 4, candidates_token_count=len(text) // 4)
+    return _Obj(text=text, candidates=[candidate], prompt_feedback=None, usage_metadata=usage)
+
+
+def _user_text(prompt):
+    """Testo dell'utente contenuto nel prompt (ultima sezione tra triple virgolette o dopo i due punti)."""
+    provided = re.search(r'TESTO FORNITO DALL\'UTENTE[^:]*: "(.*?)"\s*\n', prompt, flags=re.DOTALL)
+    if provided:
+        return provided.group(1).strip()
+    quoted = re.findall(r'"""(.*?)"""', prompt, flags=re.DOTALL)
+    if quoted:
+        return quoted[-1].strip()
+    return prompt.strip().splitlines()[-1] if prompt.strip() else ""
+
+
+def fake_reply(task, prompt):
+    """Risposta finta plausibile per il task indicato."""
+    if task == 'extraction':
+        sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+', _user_text(prompt)) if s.strip()]
+        sentences += [None] * (3 - len(sentences))
+        return "```json\n" + json.dumps({'ec': sentences[0], 'pv1': sentences[1], 'ts1': sentences[2]},
+                                        ensure_ascii=False) + "\n```"
+    if task == 'multi_extraction':
+        episodes = []
+        for paragraph in re.split(r'\n\s*\n', _user_text(prompt)):
+            sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+', paragraph) if s.strip()]
+            if sentences:
+                sentences += [None] * (3 - len(sentences))
+                episodes.append({'titolo': sentences[0][:40], 'ec': sentences[0], 'pv1': sentences[1], 'ts1': sentences[2]})
+        return "```json\n" + json.dumps({'episodes': episodes}, ensure_ascii=False) + "\n```"
+    if task == 'sv2_validation':
+        return "VALIDO_SV2"
+    if task == 'distortion_classification':
+        match = re.search(r'^- (\w+):', prompt, re.MULTILINE)
+        return match.group(1) if match else "NESSUNA"
+    if task == 'summarization':
+        words = _user_text(prompt).split()
+        return " ".join(words[:12]) or "Sintesi."
+    return "Grazie per avermelo raccontato. Puoi dirmi qualcosa in più su questo punto?"
+
+
+class FakeGenerativeModel:
+    """Sostituto di genai.GenerativeModel per un task."""
+
+    def __init__(self, task, profile):
+        self.task = task
+        self.profile = profile
+        self.model_name = f"fake/{task}"
+        self._generation_config = None
+
+    def _call(self, prompt):
+        metrics.increment(f'fake_llm.{self.task}.calls')
+        latency = self.profile.sample_latency()
+        if self.profile.should_fail():
+            time.sleep(latency / 4) # Gli errori tornano prima di una risposta completa
+            metrics.increment(f'fake_llm.{self.task}.injected_errors')
+            raise FakeLLMError("429 Resource has been exhausted (errore simulato)")
+        return latency, fake_reply(self.task, str(prompt))
+
+    def generate_content(self, prompt, stream=False, request_options=None, **kwargs):
+        latency, text = self._call(prompt)
+        if not stream:
+            time.sleep(latency)
+            return _make_response(text, str(prompt))
+        return _FakeStream(text, str(prompt), latency)
+
+    def start_chat(self, history=None):
+        return _FakeChat(self)
+
+
+class _FakeChat:
+    def __init__(self, model):
+        self.model = model
+
+    def send_message(self, prompt, request_options=None, **kwargs):
+        return self.model.generate_content(prompt)
+
+
+class _FakeStream:
+    """Risposta in streaming: il testo arriva in frammenti distribuiti sulla latenza."""
+
+    def __init__(self, text, prompt, latency):
+        self.text = text
+        self.usage_metadata = _make_response(text, prompt).usage_metadata
+        self._latency = latency
+
+    def __iter__(self):
+        chunk_size = 24
+        chunks = [self.text[i:i + chunk_size] for i in range(0, len(self.text), chunk_size)] or [""]
+        # Primo frammento dopo metà della latenza, il resto distribuito uniformemente
+        time.sleep(self._latency / 2)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(self._latency / 2 / len(chunks))
+            yield _Obj(text=chunk)
+
+
+def _fake_vector(text):
+    """Vettore deterministico derivato dal testo."""
+    generator = random.Random(int(hashlib.sha256(text.encode('utf-8')).hexdigest()[:8], 16))
+    return [generator.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSION)]
+
+
+def fake_embed_batch(profile):
+    """Funzione di embedding batch finta: una latenza per richiesta, come il provider."""
+    def embed(model_name, texts, task_type):
+        metrics.increment('fake_llm.embedding.calls')
+        time.sleep(profile.embedding_latency_seconds)
+        return [_fake_vector(text) for text in texts]
+    return embed
+
+
+def install(profile=None):
+    """
+    Sostituisce i modelli di tutti i task di config.LLM_TASKS e l'embedding batch di
+    rag_utils con il backend finto. Restituisce il profilo usato.
+    """
+    import llm_interface
+    import rag_utils
+    profile = profile or FakeLLMProfile()
+    with llm_interface._task_models_lock:
+        for task in LLM_TASKS:
+            llm_interface._task_models[task] = FakeGenerativeModel(task, profile)
+    rag_utils._embed_batch = fake_embed_batch(profile)
+    return profile
@@ -1,34 +1,199 @@
 # llm_interface.py (Struttura Modulare a Fasi)
 # Questo file rimane invariato rispetto alla versione precedente (ibrida).
 # Gestisce l'interazione con l'API Gemini.
+# Ogni task (estrazione, sintesi, validazione SV2, risposta, fallback) usa il modello e la
+# configurazione definiti in config.LLM_TASKS; latenza, token e costo sono registrati per task.
+# Le chiamate passano dal pool di chiavi API (client_pool.py): bilanciamento sulla quota
+# residua, limiti lato client e failover su un'altra chiave in caso di 429.
+# Ogni chiamata fatta durante un turno è registrata anche nell'evento del turno (turn_events.py).
 
-import streamlit as st
-import google.generativeai as genai
+import hashlib
+import json
+import threading
+import time
 import traceback
-from utils import log_message
+import metrics
+import client_pool
+import turn_events
+from singleflight import SingleFlight
+from context_cache import prepare_call
+from deadline import call_timeout, budget_exhausted, record_degradation
+from utils import log_message, get_session_value, show_ui_message
+from config import (
+    LLM_TASKS, LLM_PRICING_PER_MILLION_TOKENS, SAFETY_SETTINGS_GEMINI, LLM_COALESCE_REQUESTS, GENERATION_CONFIG_GEMINI
+)
 
-def generate_response(prompt, history=None, model=None):
+# Risposte restituite da generate_response quando la chiamata fallisce (mostrabili all'utente).
+# Chi usa il testo generato come dato (riassunti, classificazioni) le riconosce con is_failed_response.
+ERROR_NO_MODEL = "Mi dispiace, si è verificato un errore interno nel contattare il modello AI."
+ERROR_PROMPT_BLOCKED = "Non ho potuto generare una risposta completa, potrebbe essere stata bloccata per motivi di sicurezza. Prova a riformulare."
+ERROR_RESPONSE_BLOCKED = "La mia risposta è stata bloccata per motivi di sicurezza. Per favore, riformula la tua richiesta."
+ERROR_EMPTY_RESPONSE = "Ho ricevuto una risposta vuota dal modello. Potrebbe esserci un problema o un blocco implicito."
+ERROR_UNREADABLE_RESPONSE = "Mi dispiace, non ho potuto elaborare correttamente la risposta dal modello AI."
+ERROR_UNEXPECTED = "Mi dispiace, si è verificato un errore tecnico imprevisto. Riprova più tardi."
+ERROR_RESPONSES = frozenset((ERROR_NO_MODEL, ERROR_PROMPT_BLOCKED, ERROR_RESPONSE_BLOCKED, ERROR_EMPTY_RESPONSE,
+                             ERROR_UNREADABLE_RESPONSE, ERROR_UNEXPECTED))
+
+def is_failed_response(text):
+    """True se generate_response non ha prodotto un testo utile (stringa vuota o messaggio di errore)."""
+    return not (text or "").strip() or text in ERROR_RESPONSES
+
+# Richieste identiche in corso (stesso task, modello, prompt e history) condividono una sola chiamata
+_llm_flights = SingleFlight('llm')
+
+# Modelli per task, condivisi da tutte le sessioni del processo (creati al primo uso)
+_task_models = {}
+_task_models_lock = threading.Lock()
+
+def get_model_for_task(task):
     """
-    Genera una risposta usando il modello Gemini specificato o quello in session_state.
+    Restituisce l'istanza GenerativeModel configurata per il task indicato (vedi config.LLM_TASKS).
+
+    Returns:
+        genai.GenerativeModel | None: Il modello, o None se il task non è registrato.
+    """
+    task_config = LLM_TASKS.get(task)
+    if task_config is None:
+        log_message(f"WARN: Task LLM '{task}' non registrato in LLM_TASKS.")
+        return None
+    with _task_models_lock:
+        model = _task_models.get(task)
+        if model is None:
+            import google.generativeai as genai
+            model = genai.GenerativeModel(
+                model_name=task_config['model_name'],
+                generation_config=task_config['generation_config'],
+                safety_settings=SAFETY_SETTINGS_GEMINI
+            )
+            _task_models[task] = model
+            log_message(f"Modello per task '{task}' creato: {task_config['model_name']} ({task_config['generation_config']})")
+    return model
+
+def _task_generation_config(task):
+    """Configurazione di generazione del task (quella del modello di sessione se il task non è indicato)."""
+    return LLM_TASKS[task]['generation_config'] if task in LLM_TASKS else GENERATION_CONFIG_GEMINI
+
+def _record_usage(task, model_name, response, latency_seconds):
+    """Registra latenza, token e costo stimato della chiamata nelle metriche del task."""
+    metrics.increment(f'llm.{task}.calls')
+    metrics.observe(f'llm.{task}.latency_seconds', latency_seconds)
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        turn_events.record_llm_call(task, model_name, latency_seconds)
+        return
+    input_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+    output_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+    turn_events.record_llm_call(task, model_name, latency_seconds, input_tokens, output_tokens)
+    metrics.increment(f'llm.{task}.input_tokens', input_tokens)
+    metrics.increment(f'llm.{task}.output_tokens', output_tokens)
+    pricing = LLM_PRICING_PER_MILLION_TOKENS.get(model_name)
+    if pricing:
+        cost = (input_tokens * pricing['input'] + output_tokens * pricing['output']) / 1_000_000
+        metrics.increment(f'llm.{task}.cost_usd', cost)
+
+def get_task_report():
+    """
+    Riepilogo per task di chiamate, latenza, token e costo stimato.
+
+    Returns:
+        list: Lista di dict, uno per task registrato.
+    """
+    snapshot = metrics.snapshot(prefix='llm.')
+    counters, samples = snapshot['counters'], snapshot['samples']
+    report = []
+    for task, task_config in LLM_TASKS.items():
+        latency = samples.get(f'llm.{task}.latency_seconds', {})
+        report.append({
+            'task': task,
+            'model': task_config['model_name'],
+            'calls': counters.get(f'llm.{task}.calls', 0),
+            'latency_p50': latency.get('p50'),
+            'latency_p95': latency.get('p95'),
+            'input_tokens': counters.get(f'llm.{task}.input_tokens', 0),
+            'output_tokens': counters.get(f'llm.{task}.output_tokens', 0),
+            'cost_usd': counters.get(f'llm.{task}.cost_usd', 0.0),
+        })
+    return report
+
+def generate_response(prompt, history=None, model=None, task=None, cached_prefix=None):
+    """
+    Genera una risposta usando il modello Gemini del task indicato, quello specificato
+    o quello in session_state.
     Gestisce la history nel formato atteso da Gemini.
 
     Args:
         prompt (str): Il prompt completo per il turno corrente.
         history (list, optional): Lista di dizionari nel formato Gemini. Defaults to None.
         model (genai.GenerativeModel, optional): Istanza del modello da usare.
-                                                 Se None, usa st.session_state.model_gemini.
+                                                 Se None, usa il modello del task o
+                                                 st.session_state.model_gemini.
                                                  Defaults to None.
+        task (str, optional): Chiave di config.LLM_TASKS (es. 'extraction', 'summarization').
+                              Determina modello, configurazione e metriche. Defaults to None.
+        cached_prefix (tuple, optional): (chiave, testo) del prefisso stabile del prompt.
+                              Viene registrato una volta nella context cache e referenziato
+                              tramite handle; se il caching non è applicabile è anteposto
+                              al prompt. Defaults to None.
 
     Returns:
         str: La risposta testuale generata dal modello, o un messaggio di errore.
+             Stringa vuota se il budget del turno è esaurito (il chiamante usa il proprio fallback).
     """
-    model_gemini_local = model if model is not None else st.session_state.get('model_gemini')
+    if model is None and task is not None:
+        model = get_model_for_task(task)
+    model_gemini_local = model if model is not None else get_session_value('model_gemini')
+    metrics_task = task or 'untagged'
+    model_name = getattr(model_gemini_local, 'model_name', None)
+    if cached_prefix and model_gemini_local:
+        prefix_key, prefix_text = cached_prefix
+        model_gemini_local, prompt = prepare_call(prefix_key, model_gemini_local, prefix_text, prompt,
+                                                 _task_generation_config(task))
 
     if not model_gemini_local:
          log_message("ERRORE CRITICO: Modello Gemini non fornito né trovato in session_state.")
-         return "Mi dispiace, si è verificato un errore interno nel contattare il modello AI."
+         return ERROR_NO_MODEL
+
+    if budget_exhausted():
+        record_degradation(f'llm_skipped.{metrics_task}')
+        return ""
 
+    if not LLM_COALESCE_REQUESTS:
+        return _call_model(model_gemini_local, prompt, history, metrics_task, model_name)
+    request_key = _request_key(metrics_task, model_name, prompt, history, cached_prefix)
     try:
+        response_text, shared = _llm_flights.do(request_key, _call_model, model_gemini_local, prompt, history,
+                                                metrics_task, model_name, wait_timeout=call_timeout())
+    except TimeoutError:
+        record_degradation(f'llm_coalesced_wait.{metrics_task}')
+        return ""
+    if shared:
+        log_message(f"Richiesta LLM identica già in corso (task '{metrics_task}'): risultato condiviso.")
+    return response_text
+
+def _request_key(task, model_name, prompt, history, cached_prefix):
+    """Chiave di coalescenza: hash di task, modello, prompt, history e prefisso in cache."""
+    digest = hashlib.sha256()
+    for part in (task, model_name, prompt, json.dumps(history or [], sort_keys=True, default=str),
+                 cached_prefix[1] if cached_prefix else None):
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+def _estimate_tokens(model, prompt, history):
+    """Token stimati della chiamata (prompt, history e output massimo del modello) per i limiti del pool."""
+    generation_config = getattr(model, '_generation_config', None) or {}
+    max_output_tokens = generation_config.get('max_output_tokens', 0) if isinstance(generation_config, dict) \
+        else getattr(generation_config, 'max_output_tokens', 0)
+    return client_pool.estimate_request_tokens(prompt, history, max_output_tokens)
+
+def _uses_provider_cache(model):
+    """True per i modelli legati a un CachedContent: esiste solo nel progetto della chiave principale."""
+    return getattr(model, 'cached_content', None) is not None
+
+def _call_model(model_gemini_local, prompt, history, metrics_task, model_name):
+    """Esegue la chiamata Gemini e ne estrae il testo (errori e blocchi -> messaggio di fallback)."""
+    try:
+        call_started = time.perf_counter()
         cleaned_history = None
         if history and isinstance(history, list):
              cleaned_history = [
@@ -41,17 +206,24 @@ def generate_response(prompt, history=None, model=None):
                     msg["parts"][0].strip() not in ["...", "Sto pensando...", ""]
              ]
 
-        if cleaned_history:
-             log_message(f"Avvio chat Gemini con {len(cleaned_history)} elementi nella history.")
-             chat_session = model_gemini_local.start_chat(history=cleaned_history)
-             response = chat_session.send_message(prompt, request_options={'timeout': 120})
-             log_message("Prompt inviato tramite chat_session.send_message().")
-        else:
-             log_message("Invio prompt a Gemini senza history precedente (generate_content).")
-             response = model_gemini_local.generate_content(prompt, request_options={'timeout': 120})
-             log_message("Prompt inviato tramite model.generate_content().")
+        def send(client):
+            pooled_model = client.bind(model_gemini_local)
+            if cleaned_history:
+                 log_message(f"Avvio chat Gemini con {len(cleaned_history)} elementi nella history.")
+                 chat_session = pooled_model.start_chat(history=cleaned_history)
+                 pooled_response = chat_session.send_message(prompt, request_options={'timeout': call_timeout()})
+                 log_message("Prompt inviato tramite chat_session.send_message().")
+            else:
+                 log_message("Invio prompt a Gemini senza history precedente (generate_content).")
+                 pooled_response = pooled_model.generate_content(prompt, request_options={'timeout': call_timeout()})
+                 log_message("Prompt inviato tramite model.generate_content().")
+            return pooled_response
+
+        response = client_pool.call(send, 'generate', _estimate_tokens(model_gemini_local, prompt, cleaned_history),
+                                    pinned=_uses_provider_cache(model_gemini_local))
 
         log_message("Risposta API ricevuta da Gemini.")
+        _record_usage(metrics_task, model_name, response, time.perf_counter() - call_started)
 
         # --- Gestione Risposta e Filtri Sicurezza ---
         try:
@@ -63,8 +235,8 @@ def generate_response(prompt, history=None, model=None):
                       log_message(f"WARN: Risposta vuota (bloccata?). Motivo Blocco Prompt: {block_reason}, Ratings: {safety_ratings}")
                  else:
                       log_message("WARN: Risposta vuota (response.candidates è vuoto/None) senza prompt_feedback.")
-                 st.warning("La risposta potrebbe essere stata bloccata dai filtri di sicurezza o è vuota.")
-                 return "Non ho potuto generare una risposta completa, potrebbe essere stata bloccata per motivi di sicurezza. Prova a riformulare."
+                 show_ui_message('warning', "La risposta potrebbe essere stata bloccata dai filtri di sicurezza o è vuota.")
+                 return ERROR_PROMPT_BLOCKED
 
              candidate = response.candidates[0]
 
@@ -74,8 +246,8 @@ def generate_response(prompt, history=None, model=None):
              if candidate.finish_reason == "SAFETY":
                   safety_ratings_candidate = candidate.safety_ratings
                   log_message(f"WARN: Risposta bloccata per motivi di sicurezza (Candidate). Ratings: {safety_ratings_candidate}")
-                  st.warning("La risposta è stata bloccata dai filtri di sicurezza.")
-                  return "La mia risposta è stata bloccata per motivi di sicurezza. Per favore, riformula la tua richiesta."
+                  show_ui_message('warning', "La risposta è stata bloccata dai filtri di sicurezza.")
+                  return ERROR_RESPONSE_BLOCKED
 
              if candidate.content and candidate.content.parts:
                  bot_response_text = "".join(part.text for part in candidate.content.parts if hasattr(part, 'text'))
@@ -85,19 +257,97 @@ def generate_response(prompt, history=None, model=None):
 
              if not bot_response_text.strip():
                   log_message("WARN: Testo della risposta estratto è vuoto o solo spazi bianchi.")
-                  return "Ho ricevuto una risposta vuota dal modello. Potrebbe esserci un problema o un blocco implicito."
+                  return ERROR_EMPTY_RESPONSE
 
              log_message(f"Testo risposta estratto: '{bot_response_text[:80]}...'")
              return bot_response_text
 
         except (ValueError, IndexError, AttributeError) as resp_err:
              log_message(f"ERRORE nell'accedere al contenuto della risposta Gemini: {resp_err}")
-             st.warning("La struttura della risposta del modello non è come previsto.")
-             return "Mi dispiace, non ho potuto elaborare correttamente la risposta dal modello AI."
+             show_ui_message('warning', "La struttura della risposta del modello non è come previsto.")
+             return ERROR_UNREADABLE_RESPONSE
 
+    except client_pool.RateLimitedError as e:
+        record_degradation(f'llm_rate_limited.{metrics_task}')
+        log_message(f"WARN: Quota delle chiavi API esaurita per il task '{metrics_task}': {e}")
+        return ""
     except Exception as e:
         error_type = type(e).__name__
+        metrics.increment(f'llm.{metrics_task}.errors')
+        turn_events.record_llm_call(metrics_task, model_name, time.perf_counter() - call_started, ok=False)
+        if budget_exhausted():
+            record_degradation(f'llm_timeout.{metrics_task}')
         log_message(f"ERRORE Imprevisto durante Generazione Risposta Gemini: {error_type}: {e}\nTraceback: {traceback.format_exc()}")
-        st.error(f"Errore durante la comunicazione con il modello AI: {e}")
-        return "Mi dispiace, si è verificato un errore tecnico imprevisto. Riprova più tardi."
+        show_ui_message('error', f"Errore durante la comunicazione con il modello AI: {e}")
+        return ERROR_UNEXPECTED
+
+
+def generate_response_stream(prompt, task=None, cached_prefix=None):
+    """
+    Genera una risposta (senza history) in streaming, restituendo i frammenti di testo
+    man mano che arrivano dal modello. In caso di errore o blocco lo stream termina
+    (il chiamante gestisce il fallback sul testo eventualmente ricevuto); lo stesso
+    accade quando il budget del turno (deadline.py) si esaurisce.
+
+    Args:
+        prompt (str): Il prompt completo.
+        task (str, optional): Chiave di config.LLM_TASKS. Defaults to None.
+        cached_prefix (tuple, optional): (chiave, testo) del prefisso stabile. Defaults to None.
+
+    Yields:
+        str: Frammenti di testo della risposta.
+    """
+    model_gemini_local = get_model_for_task(task) if task is not None else get_session_value('model_gemini')
+    metrics_task = task or 'untagged'
+    if not model_gemini_local:
+        log_message("ERRORE CRITICO: Modello Gemini non fornito né trovato per lo streaming.")
+        return
+    if budget_exhausted():
+        record_degradation(f'llm_skipped.{metrics_task}')
+        return
+    model_name = getattr(model_gemini_local, 'model_name', None)
+    if cached_prefix:
+        prefix_key, prefix_text = cached_prefix
+        model_gemini_local, prompt = prepare_call(prefix_key, model_gemini_local, prefix_text, prompt,
+                                                 _task_generation_config(task))
 
+    call_started = time.perf_counter()
+    first_chunk_at = None
+    response = None
+    try:
+        log_message("Invio prompt a Gemini in streaming (generate_content stream=True).")
+        # Il failover sui 429 copre l'avvio dello stream, non i frammenti già ricevuti; la chiave
+        # del pool resta occupata fino alla fine della lettura (response è un PooledStream)
+        response = client_pool.call(
+            lambda client: client.bind(model_gemini_local).generate_content(
+                prompt, stream=True, request_options={'timeout': call_timeout()}),
+            'generate', _estimate_tokens(model_gemini_local, prompt, None),
+            pinned=_uses_provider_cache(model_gemini_local), stream=True)
+        for chunk in response:
+            if call_timeout() <= 0:
+                record_degradation(f'llm_stream_cut.{metrics_task}')
+                return # Budget esaurito a metà stream: il chiamante usa il testo ricevuto finora
+            try:
+                text = chunk.text
+            except (ValueError, IndexError, AttributeError) as chunk_err:
+                log_message(f"WARN: Frammento di streaming senza testo (bloccato?): {chunk_err}")
+                continue
+            if text:
+                if first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+                    metrics.observe(f'llm.{metrics_task}.first_chunk_seconds', first_chunk_at - call_started)
+                yield text
+        _record_usage(metrics_task, model_name, response, time.perf_counter() - call_started)
+    except client_pool.RateLimitedError as e:
+        record_degradation(f'llm_rate_limited.{metrics_task}')
+        log_message(f"WARN: Quota delle chiavi API esaurita per lo streaming del task '{metrics_task}': {e}")
+    except Exception as e:
+        metrics.increment(f'llm.{metrics_task}.errors')
+        turn_events.record_llm_call(metrics_task, model_name, time.perf_counter() - call_started, ok=False)
+        if budget_exhausted():
+            record_degradation(f'llm_timeout.{metrics_task}')
+        log_message(f"ERRORE durante lo streaming della risposta Gemini: {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
+    finally:
+        # Stream interrotto (budget esaurito, errore o chiamante che smette di leggere): rilascia la chiave
+        if response is not None:
+            response.close()
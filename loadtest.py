@@ -0,0 +1,277 @@
+# loadtest.py (Struttura Modulare a Fasi)
+# Load test multi-sessione: simula N sessioni concorrenti che percorrono conversazioni
+# scriptate attraverso l'intero assessment (START -> ... -> RESTRUCTURING_INTRO), con il
+# backend LLM finto di fake_llm.py (latenza ed errori configurabili).
+#
+# Modalità:
+# - 'direct':  turni inviati a turn_scheduler.schedule_turn (stesso percorso dell'app:
+#              admission control + state_manager.process_user_message), senza Streamlit;
+# - 'apptest': ogni sessione è un streamlit.testing.v1.AppTest che esegue app.py
+#              (richiede streamlit e google-generativeai installati).
+#
+# Per ogni livello di concorrenza riporta throughput, percentili di latenza dei turni,
+# turni rifiutati ("occupato"), errori LLM e memoria del processo, e individua il punto
+# di saturazione: il primo livello in cui la p99 supera LOADTEST_SLO_P99_SECONDS o i
+# rifiuti superano LOADTEST_MAX_BUSY_RATE.
+#
+# Uso:
+#   python loadtest.py --sessions 1,2,4,8,16,32 --latency-median 0.8 --error-rate 0.01
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import redirect_stdout
+
+import metrics
+import fake_llm
+from config import (
+    BUSY_MESSAGE, LOADTEST_SLO_P99_SECONDS, LOADTEST_MAX_BUSY_RATE,
+    FAKE_LLM_LATENCY_MEDIAN_SECONDS, FAKE_LLM_LATENCY_SIGMA, FAKE_LLM_ERROR_RATE
+)
+
+# Conversazioni scriptate: ognuna porta l'assessment fino alla proposta di RESTRUCTURING_INTRO
+SCRIPTS = [
+    [
+        "Ciao",
+        "sì",
+        "Ieri sera stavo uscendo di casa. Ho pensato di aver lasciato il gas acceso e che potesse esplodere tutto. Sono tornato indietro tre volte a controllare la manopola.",
+        "sì",
+        "Ho pensato che sono una persona irresponsabile e che non posso fidarmi della mia memoria.",
+        "Ho deciso di fotografare la manopola ogni volta prima di uscire.",
+        "sì",
+    ],
+    [
+        "Buongiorno",
+        "ok",
+        "Al lavoro ho stretto la mano a un collega. Mi è venuto il dubbio di essermi contaminata con qualche malattia. Sono andata in bagno a lavarmi le mani per dieci minuti.",
+        "sì",
+        "Ho pensato che se non mi lavo bene farò ammalare la mia famiglia e sarà colpa mia.",
+        "nessuna",
+        "sì",
+    ],
+    [
+        "Salve",
+        "va bene",
+        "Stavo guidando verso casa. Ho avuto l'immagine di aver investito qualcuno senza accorgermene. Ho rifatto il percorso per controllare che non ci fosse nessuno a terra.",
+        "sì",
+        "Mi sono detto che rischio di perdere il lavoro se continuo ad arrivare tardi per questi controlli.",
+        "Ho provato a resistere e a non tornare indietro la volta successiva.",
+        "sì",
+    ],
+]
+FINAL_PHASE = 'RESTRUCTURING_INTRO'
+BUSY_RETRIES = 3 # Un utente reale riprova dopo il messaggio "occupato"
+
+
+def process_rss_mb():
+    """Memoria residente del processo in MB (Linux: /proc; altrove il picco da resource)."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except Exception:
+        return None
+
+
+class DirectSession:
+    """Sessione simulata che invia i turni direttamente allo scheduler."""
+
+    def __init__(self):
+        from state_store import StateJournal, freeze_state
+        from config import INITIAL_STATE
+        self.session_id = f"loadtest-{uuid.uuid4().hex[:12]}"
+        self.state = freeze_state(INITIAL_STATE)
+        self.journal = StateJournal()
+
+    def send(self, message):
+        from turn_scheduler import schedule_turn
+        response, self.state = schedule_turn(self.session_id, message, self.state, journal=self.journal)
+        return response
+
+    @property
+    def phase(self):
+        return self.state.get('phase')
+
+
+class AppTestSession:
+    """Sessione simulata che esegue app.py tramite l'harness di test di Streamlit."""
+
+    def __init__(self, app_path):
+        from streamlit.testing.v1 import AppTest
+        self.app = AppTest.from_file(app_path, default_timeout=300)
+        self.app.secrets["GOOGLE_API_KEY"] = "loadtest"
+        self.app.run()
+
+    def send(self, message):
+        self.app.chat_input[0].set_value(message).run()
+        return self.app.session_state["messages"][-1]["content"]
+
+    @property
+    def phase(self):
+        return self.app.session_state["state"].get('phase')
+
+
+def run_session(session_factory, conversations, think_time, script_offset, turns, outcomes, lock):
+    """Esegue 'conversations' conversazioni scriptate in una sessione, registrando ogni turno."""
+    for conversation_index in range(conversations):
+        script = SCRIPTS[(script_offset + conversation_index) % len(SCRIPTS)]
+        try:
+            session = session_factory()
+        except Exception as e:
+            with lock:
+                outcomes.append({'completed': False, 'error': f"{type(e).__name__}: {e}"})
+            continue
+        for message in script:
+            for _attempt in range(BUSY_RETRIES + 1):
+                started = time.perf_counter()
+                try:
+                    response = session.send(message)
+                    error = None
+                except Exception as e:
+                    response, error = None, f"{type(e).__name__}: {e}"
+                latency = time.perf_counter() - started
+                busy = response == BUSY_MESSAGE
+                with lock:
+                    turns.append({'latency_seconds': latency, 'busy': busy, 'error': error})
+                if think_time:
+                    time.sleep(think_time)
+                if not busy:
+                    break
+        with lock:
+            outcomes.append({'completed': session.phase == FINAL_PHASE, 'error': None})
+
+
+def run_level(sessions, session_factory, conversations, think_time, slo_p99, max_busy_rate):
+    """Esegue un livello di concorrenza e restituisce il riepilogo delle misure."""
+    metrics.reset()
+    turns, outcomes, lock = [], [], threading.Lock()
+    rss_before = process_rss_mb()
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(target=run_session, name=f"loadtest-session-{i}",
+                         args=(session_factory, conversations, think_time, i, turns, outcomes, lock))
+        for i in range(sessions)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    served = [turn for turn in turns if not turn['busy'] and turn['error'] is None]
+    latency = metrics.summarize_samples([turn['latency_seconds'] for turn in served])
+    busy_rate = sum(1 for turn in turns if turn['busy']) / len(turns) if turns else 0.0
+    counters = metrics.snapshot()['counters']
+    llm_errors = sum(value for name, value in counters.items() if name.startswith('llm.') and name.endswith('.errors'))
+    result = {
+        'sessions': sessions,
+        'turns': len(turns),
+        'served_turns': len(served),
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_turns_per_second': round(len(served) / elapsed, 3) if elapsed else None,
+        'latency_seconds': latency,
+        'busy_rate': round(busy_rate, 4),
+        'turn_errors': sum(1 for turn in turns if turn['error'] is not None),
+        'llm_errors': llm_errors,
+        'conversations_completed': sum(1 for outcome in outcomes if outcome['completed']),
+        'conversations_total': len(outcomes),
+        'rss_mb_before': rss_before,
+        'rss_mb_after': process_rss_mb(),
+    }
+    p99 = latency['p99'] if latency else None
+    result['within_slo'] = p99 is not None and p99 <= slo_p99 and busy_rate <= max_busy_rate
+    return result
+
+
+def run_load_test(levels, mode='direct', conversations=1, think_time=0.0, profile=None, app_path='app.py',
+                  slo_p99=LOADTEST_SLO_P99_SECONDS, max_busy_rate=LOADTEST_MAX_BUSY_RATE, verbose=False):
+    """
+    Esegue i livelli di concorrenza in ordine crescente, fermandosi dopo il primo
+    livello fuori SLO.
+
+    Returns:
+        dict: {'levels': [...], 'max_sessions_within_slo', 'saturation_sessions'}
+    """
+    fake_llm.install(profile)
+    if mode == 'apptest':
+        session_factory = lambda: AppTestSession(app_path)
+    else:
+        session_factory = DirectSession
+
+    results = []
+    saturation = None
+    for sessions in sorted(levels):
+        if verbose:
+            result = run_level(sessions, session_factory, conversations, think_time, slo_p99, max_busy_rate)
+        else:
+            # I log dei turni (molto verbosi con molte sessioni) vengono scartati
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                result = run_level(sessions, session_factory, conversations, think_time, slo_p99, max_busy_rate)
+        results.append(result)
+        print(format_level(result), file=sys.stderr, flush=True)
+        if not result['within_slo']:
+            saturation = sessions
+            break
+    within = [result['sessions'] for result in results if result['within_slo']]
+    return {
+        'mode': mode,
+        'slo_p99_seconds': slo_p99,
+        'levels': results,
+        'max_sessions_within_slo': max(within) if within else 0,
+        'saturation_sessions': saturation,
+    }
+
+
+def format_level(result):
+    latency = result['latency_seconds'] or {}
+    def fmt(value):
+        return f"{value:.2f}s" if value is not None else "N/D"
+    return (f"[{'OK ' if result['within_slo'] else 'KO '}] sessioni {result['sessions']:>4} | "
+            f"{result['throughput_turns_per_second']} turni/s | p50 {fmt(latency.get('p50'))} "
+            f"p95 {fmt(latency.get('p95'))} p99 {fmt(latency.get('p99'))} | occupato {result['busy_rate']:.1%} | "
+            f"errori LLM {result['llm_errors']} | conversazioni {result['conversations_completed']}/{result['conversations_total']} | "
+            f"RSS {result['rss_mb_after'] or 0:.0f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test multi-sessione con backend LLM finto.")
+    parser.add_argument('--sessions', default="1,2,4,8,16,32,64", help="Livelli di concorrenza (separati da virgola)")
+    parser.add_argument('--mode', choices=['direct', 'apptest'], default='direct')
+    parser.add_argument('--conversations', type=int, default=1, help="Conversazioni scriptate per sessione")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Pausa (s) dell'utente tra i turni")
+    parser.add_argument('--latency-median', type=float, default=FAKE_LLM_LATENCY_MEDIAN_SECONDS)
+    parser.add_argument('--latency-sigma', type=float, default=FAKE_LLM_LATENCY_SIGMA)
+    parser.add_argument('--error-rate', type=float, default=FAKE_LLM_ERROR_RATE)
+    parser.add_argument('--slo-p99', type=float, default=LOADTEST_SLO_P99_SECONDS)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--app', default='app.py', help="Percorso di app.py (modalità apptest)")
+    parser.add_argument('--output', default=None, help="File JSON del report")
+    parser.add_argument('--verbose', action='store_true', help="Mostra i log dei turni")
+    args = parser.parse_args(argv)
+
+    profile = fake_llm.FakeLLMProfile(latency_median_seconds=args.latency_median, latency_sigma=args.latency_sigma,
+                                      error_rate=args.error_rate, seed=args.seed)
+    levels = [int(level) for level in args.sessions.split(',') if level.strip()]
+    report = run_load_test(levels, mode=args.mode, conversations=args.conversations, think_time=args.think_time,
+                           profile=profile, app_path=args.app, slo_p99=args.slo_p99, verbose=args.verbose)
+    print(f"Sessioni massime entro lo SLO (p99 <= {args.slo_p99}s): {report['max_sessions_within_slo']}"
+          + (f" - saturazione a {report['saturation_sessions']} sessioni" if report['saturation_sessions'] else ""),
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# metrics.py (Struttura Modulare a Fasi)
+# Registro minimale e thread-safe delle metriche operative del processo
+# (contatori, gauge e campioni di durata), condiviso tra tutte le sessioni.
+# Le metriche sono esportate tramite snapshot() (sidebar, log, script esterni).
+
+import threading
+from collections import deque
+
+# Numero massimo di campioni conservati per ciascuna serie di durate
+MAX_SAMPLES_PER_SERIES = 1000
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_samples = {}
+
+
+def increment(name, amount=1):
+    """Incrementa il contatore 'name' di 'amount'."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name, value):
+    """Imposta il valore corrente della gauge 'name'."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, value):
+    """Registra un campione (es. durata in secondi) nella serie 'name'."""
+    with _lock:
+        series = _samples.get(name)
+        if series is None:
+            series = deque(maxlen=MAX_SAMPLES_PER_SERIES)
+            _samples[name] = series
+        series.append(float(value))
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    position = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[position]
+
+
+def summarize_samples(values):
+    """
+    Calcola count/media/percentili per una lista di campioni.
+
+    Returns:
+        dict: {'count', 'mean', 'p50', 'p95', 'p99', 'max'} (None se vuota).
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': _percentile(ordered, 0.50),
+        'p95': _percentile(ordered, 0.95),
+        'p99': _percentile(ordered, 0.99),
+        'max': ordered[-1],
+    }
+
+
+def snapshot(prefix=None):
+    """
+    Restituisce una copia coerente di tutte le metriche.
+
+    Args:
+        prefix (str, optional): Se indicato, include solo le metriche il cui nome inizia così.
+
+    Returns:
+        dict: {'counters': {...}, 'gauges': {...}, 'samples': {nome: riepilogo}}
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        samples = {name: list(series) for name, series in _samples.items()}
+    if prefix:
+        counters = {k: v for k, v in counters.items() if k.startswith(prefix)}
+        gauges = {k: v for k, v in gauges.items() if k.startswith(prefix)}
+        samples = {k: v for k, v in samples.items() if k.startswith(prefix)}
+    return {
+        'counters': counters,
+        'gauges': gauges,
+        'samples': {name: summarize_samples(values) for name, values in samples.items()},
+    }
+
+
+def reset():
+    """Azzera tutte le metriche (usato da script di test/benchmark)."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _samples.clear()
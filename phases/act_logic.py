@@ -1,7 +1,6 @@
 # phases/act_logic.py (Struttura Modulare a Fasi)
 # Placeholder per la logica delle fasi ACT / Mindfulness / Valori.
 
-import streamlit as st
 from utils import log_message
 # Importa altre dipendenze necessarie
 
@@ -8,18 +8,127 @@
 # NUOVO: Implementata funzione _summarize_component_clinically.
 # AGGIORNATO: Prompt di _summarize_component_clinically modificato per maggiore fedeltà (v2).
 # AGGIORNATO: Logica di fallback in _summarize_component_clinically per usare testo originale.
+# AGGIORNATO: Estrazione EC/PV1/TS1 in streaming, con sintesi dei campi avviata appena ciascuno è completo.
+# AGGIORNATO: Transizioni scriptate servite localmente dal pool di formulazioni (phrasing_pool.py).
+# NUOVO: Racconti lunghi (più episodi) estratti in una sola chiamata; l'utente sceglie l'episodio (ASSESSMENT_CHOOSE_EXAMPLE).
+# AGGIORNATO: Ogni schema confermato viene salvato nell'indice dei cicli dell'utente (cycle_index.py).
+# AGGIORNATO: Il fallback generico include il contesto del manuale (ricerca RAG gerarchica).
+# NUOVO: Precalcolo speculativo del turno successivo (speculative_assets, vedi speculation.py).
+# AGGIORNATO: Capitolo della fase e materiale in cache risolti nella knowledge base (namespace) della sessione.
 
-import streamlit as st
 import time
 import traceback
 import json # Importato per parsing JSON
 import re   # Import per espressioni regolari
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # Importa funzioni e costanti necessarie
-from utils import log_message
-from llm_interface import generate_response # Importiamo per usare generate_response
-from rag_utils import search_global_rag, search_step_rag
-from config import CONFERME, NEGAZIONI_O_DUBBI, PHASE_TO_CHAPTER_KEY_MAP, INITIAL_STATE
+from utils import log_message, get_session_value
+from llm_interface import generate_response, generate_response_stream, is_failed_response
+from streaming_json import IncrementalJsonFieldParser
+from phrasing_pool import pick_phrasing
+from deadline import call_timeout, budget_exhausted, record_degradation
+import cycle_index
+import speculation
+from llm_interface import get_model_for_task
+from context_cache import get_context_cache, prepare_call, estimate_tokens
+from rag_utils import (
+    search_global_rag, search_step_rag, search_hierarchical_rag, format_rag_context, wait_for_rag,
+    chapter_context, chapter_search_asset, phase_chapter_key, current_namespace
+)
+from config import (
+    CONFERME, NEGAZIONI_O_DUBBI, INITIAL_STATE,
+    CONTEXT_CACHE_INCLUDE_CHAPTER_MATERIAL, EXTRACTION_SUMMARY_WORKERS,
+    MULTI_EXAMPLE_MIN_CHARS, MULTI_EXAMPLE_CHUNK_CHARS, MULTI_EXAMPLE_MAX_EPISODES, LLM_TASKS
+)
+
+# --- Prefissi Stabili dei Prompt ---
+# Parti dei prompt identiche a ogni turno: vengono registrate una volta nella context
+# cache (vedi context_cache.py) e referenziate tramite handle; a ogni chiamata si
+# inviano solo le parti variabili (fase, schema, testo dell'utente).
+SCHEMA_DEFINITIONS = {
+    'ec': "l'evento specifico (interno o esterno) che ha attivato il ciclo.",
+    'pv1': "la prima valutazione (pensiero, dubbio, immagine, paura) sorta in risposta all'EC, rappresentando l'ossessione.",
+    'ts1': "il tentativo (comportamentale o mentale) di neutralizzare o gestire la PV1 (ossessione), rappresentando la compulsione.",
+    'sv2': "la valutazione critica o il giudizio (anche sulle conseguenze o costi) che il paziente fa sul primo ciclo (EC-PV1-TS1) o su sé stesso in relazione ad esso.",
+    'ts2': "il tentativo (anche fallito) di contenere, modificare o evitare il ripetersi del primo ciclo (EC-PV1-TS1) in futuro (include tentativi di resistenza)."
+}
+_SCHEMA_DEFINITIONS_TEXT = "\n".join(f"- {key.upper()}: {definition}" for key, definition in SCHEMA_DEFINITIONS.items())
+
+SYSTEM_PROMPT_PREFIX = f"""Sei un assistente empatico per il supporto al DOC (TCC).
+ISTRUZIONI: Rispondi in ITALIANO. Tono empatico, chiaro, CONCISO. Fai UNA domanda alla volta. Non usare sigle (EC, PV1 ecc.) nella domanda diretta all'utente, usa i nomi completi (es. Evento Critico). Non chiedere informazioni già presenti nello SCHEMA UTENTE PARZIALE.
+COMPONENTI DELLO SCHEMA DI FUNZIONAMENTO DOC:
+{_SCHEMA_DEFINITIONS_TEXT}"""
+
+SUMMARIZATION_PROMPT_PREFIX = """CONTESTO: Stiamo costruendo uno schema di funzionamento DOC.
+TASK: Rielabora il TESTO FORNITO DALL'UTENTE in una sintesi **estremamente concisa** (idealmente 1 frase breve, massimo 10-15 parole se possibile) per il COMPONENTE DA SINTETIZZARE indicato.
+**REGOLE FONDAMENTALI:**
+1.  **MASSIMA FEDELTÀ:** Usa **ESATTAMENTE le stesse parole chiave** dell'utente. Non sostituire parole se non strettamente necessario per la grammatica minima.
+2.  **NO INTERPRETAZIONE:** Non aggiungere **nessuna** interpretazione psicologica, giudizio o valutazione.
+3.  **NO PAROLE ESTERNE:** Non usare **mai** parole come 'errore', 'sbaglio', 'giusto', 'sbagliato', 'negativo', 'positivo', 'consapevolezza', 'impulso', 'tentativo', 'fallimento' a meno che non siano **presenti nel testo originale dell'utente**.
+4.  **CONCISIONE ESTREMA:** Rimuovi solo le parole superflue per rendere la frase più breve possibile mantenendo il significato letterale espresso dall'utente. Se il testo è già conciso, restituiscilo così com'è.
+
+Output Atteso: Solo la sintesi estremamente concisa e letterale."""
+
+EXTRACTION_PROMPT_PREFIX = """Analizza attentamente il messaggio dell'utente riportato in fondo, che descrive un'esperienza legata al DOC.
+Il tuo compito è identificare e separare i seguenti componenti INIZIALI dello schema DOC, se sono chiaramente presenti nel testo:
+1.  **EC (Evento Critico):** La situazione specifica, l'evento esterno o interno che ha innescato il ciclo.
+2.  **PV1 (Prima Valutazione/Ossessione):** Il primo pensiero intrusivo, dubbio, immagine o paura significativa sorta in risposta all'EC.
+3.  **TS1 (Tentativo Soluzione 1/Compulsione):** La reazione comportamentale o mentale (rituale, controllo, rassicurazione, evitamento, anche differito) messa in atto *in risposta diretta* a PV1 per gestirla.
+
+Restituisci il risultato ESATTAMENTE nel seguente formato JSON:
+{
+  "ec": "Testo estratto dell'Evento Critico",
+  "pv1": "Testo estratto della Prima Valutazione",
+  "ts1": "Testo estratto della Compulsione/Tentativo Soluzione 1"
+}
+
+Se un componente NON è chiaramente identificabile nel messaggio fornito, imposta il suo valore su **null** o su una **stringa vuota**. Sii conciso. Se non identifichi nemmeno l'EC, restituisci null per EC. Non cercare SV2 o TS2 in questo passaggio."""
+
+MULTI_EXTRACTION_PROMPT_PREFIX = """Analizza attentamente il racconto dell'utente riportato in fondo: può descrivere PIÙ episodi distinti legati al DOC (ad esempio un diario di più giorni).
+Individua ogni episodio distinto e, per ciascuno, i componenti INIZIALI dello schema DOC se sono chiaramente presenti:
+1.  **EC (Evento Critico):** La situazione specifica, l'evento esterno o interno che ha innescato il ciclo.
+2.  **PV1 (Prima Valutazione/Ossessione):** Il primo pensiero intrusivo, dubbio, immagine o paura significativa sorta in risposta all'EC.
+3.  **TS1 (Tentativo Soluzione 1/Compulsione):** La reazione comportamentale o mentale messa in atto *in risposta diretta* a PV1 per gestirla.
+
+Restituisci il risultato ESATTAMENTE nel seguente formato JSON, un elemento per episodio nell'ordine del racconto:
+{
+  "episodes": [
+    {"titolo": "Breve etichetta dell'episodio (massimo 8 parole)", "ec": "Testo dell'Evento Critico", "pv1": "Testo della Prima Valutazione", "ts1": "Testo della Compulsione"}
+  ]
+}
+
+Non unire episodi diversi e non inventarne. Se un componente NON è chiaramente identificabile imposta il suo valore su **null**. Escludi gli episodi senza un EC. Sii conciso. Non cercare SV2 o TS2 in questo passaggio."""
+
+SV2_VALIDATION_PROMPT_PREFIX = """ANALISI RISPOSTA UTENTE PER SECONDA VALUTAZIONE (SV2)
+DOMANDA POSTA ALL'UTENTE: Chiedeva la Seconda Valutazione (SV2) - il PENSIERO o GIUDIZIO (anche su conseguenze) dopo PV1/TS1, non solo l'emozione.
+TASK: La risposta dell'utente descrive effettivamente una Valutazione Cognitiva Secondaria (SV2)?
+- È un pensiero, un giudizio, una valutazione (anche metacognitiva), una riflessione sulle **conseguenze** (es. "rischierò il licenziamento", "farò tardi", "ho pensato che fosse terribile", "questo pensiero è inaccettabile")? -> VALIDO_SV2
+- È SOLO un'emozione (es. "ansia", "paura")? -> NON_VALIDO_SV2
+- È un'azione, un comportamento, un tentativo (anche fallito) di fare/non fare qualcosa (es. "sono tornato indietro", "ho cercato di resistere", "ho chiesto rassicurazioni")? -> NON_VALIDO_SV2
+- È una negazione esplicita o "non lo so"? -> NEGATIVO
+- È qualcos'altro di non pertinente? -> NON_VALIDO_SV2
+Output Atteso: Rispondi ESATTAMENTE con UNA delle seguenti stringhe: VALIDO_SV2, NON_VALIDO_SV2, NEGATIVO"""
+
+def _system_prompt_prefix(phase):
+    """
+    Prefisso stabile per le risposte all'utente: istruzioni di sistema, definizioni dello
+    schema e (se abilitato) il materiale del capitolo associato alla fase.
+
+    Returns:
+        tuple: (chiave_cache, testo_prefisso)
+    """
+    chapter_key = phase_chapter_key(phase)
+    if not CONTEXT_CACHE_INCLUDE_CHAPTER_MATERIAL or not chapter_key:
+        return ('assessment.system', SYSTEM_PROMPT_PREFIX)
+    resources = wait_for_rag(0) # Non blocca il turno se gli indici non sono ancora pronti
+    chapter_map = (resources or {}).get('step_maps', {}).get(chapter_key)
+    if not chapter_map:
+        return ('assessment.system', SYSTEM_PROMPT_PREFIX)
+    chapter_text = "\n\n".join(chunk.get('content', '') for _, chunk in sorted(chapter_map.items()) if isinstance(chunk, dict))
+    # Stesso capitolo in knowledge base diverse = materiale diverso: la chiave include il namespace
+    return (f'assessment.system.{current_namespace()}.{chapter_key}', f"{SYSTEM_PROMPT_PREFIX}\n\nMATERIALE DEL CAPITOLO DI RIFERIMENTO:\n{chapter_text}")
 
 # --- Funzione Helper per Sintesi Clinica (ma MOLTO Fedele) ---
 def _summarize_component_clinically(component_key, user_text, schema_context):
@@ -31,38 +140,25 @@ def _summarize_component_clinically(component_key, user_text, schema_context):
     original_text_cleaned = user_text.strip().strip('"').strip("'")
     if not original_text_cleaned or not component_key:
         return original_text_cleaned
+    if budget_exhausted():
+        record_degradation('summary_raw_text')
+        return original_text_cleaned
 
     log_message(f"Assessment Logic: Avvio sintesi ESTREMAMENTE fedele per {component_key.upper()}...")
 
-    definitions = {
-        'ec': "l'evento specifico (interno o esterno) che ha attivato il ciclo.",
-        'pv1': "la prima valutazione (pensiero, dubbio, immagine, paura) sorta in risposta all'EC, rappresentando l'ossessione.",
-        'ts1': "il tentativo (comportamentale o mentale) di neutralizzare o gestire la PV1 (ossessione), rappresentando la compulsione.",
-        'sv2': "la valutazione critica o il giudizio (anche sulle conseguenze o costi) che il paziente fa sul primo ciclo (EC-PV1-TS1) o su sé stesso in relazione ad esso.",
-        'ts2': "il tentativo (anche fallito) di contenere, modificare o evitare il ripetersi del primo ciclo (EC-PV1-TS1) in futuro (include tentativi di resistenza)."
-    }
-    role_description = definitions.get(component_key, "un elemento dello schema DOC")
-
-    # Prompt v2: ancora più restrittivo sulla fedeltà e neutralità
-    summarization_prompt = f"""CONTESTO: Stiamo costruendo uno schema di funzionamento DOC.
-    COMPONENTE DA SINTETIZZARE: {component_key.upper()} - che rappresenta: {role_description}
+    role_description = SCHEMA_DEFINITIONS.get(component_key, "un elemento dello schema DOC")
+
+    # Prompt v2: ancora più restrittivo sulla fedeltà e neutralità (regole nel prefisso stabile)
+    summarization_prompt = f"""COMPONENTE DA SINTETIZZARE: {component_key.upper()} - che rappresenta: {role_description}
     TESTO FORNITO DALL'UTENTE per questo componente: "{original_text_cleaned}"
     SCHEMA PARZIALE ATTUALE (per contesto addizionale): {schema_context}
-
-    TASK: Rielabora il TESTO FORNITO DALL'UTENTE in una sintesi **estremamente concisa** (idealmente 1 frase breve, massimo 10-15 parole se possibile) per il componente {component_key.upper()}.
-    **REGOLE FONDAMENTALI:**
-    1.  **MASSIMA FEDELTÀ:** Usa **ESATTAMENTE le stesse parole chiave** dell'utente. Non sostituire parole se non strettamente necessario per la grammatica minima.
-    2.  **NO INTERPRETAZIONE:** Non aggiungere **nessuna** interpretazione psicologica, giudizio o valutazione.
-    3.  **NO PAROLE ESTERNE:** Non usare **mai** parole come 'errore', 'sbaglio', 'giusto', 'sbagliato', 'negativo', 'positivo', 'consapevolezza', 'impulso', 'tentativo', 'fallimento' a meno che non siano **presenti nel testo originale dell'utente**.
-    4.  **CONCISIONE ESTREMA:** Rimuovi solo le parole superflue per rendere la frase più breve possibile mantenendo il significato letterale espresso dall'utente. Se il testo è già conciso, restituiscilo così com'è.
-
-    Output Atteso: Solo la sintesi estremamente concisa e letterale.
     """
     try:
         summary = generate_response(
             prompt=summarization_prompt,
             history=[],
-            model=st.session_state.get('model_gemini')
+            task='summarization',
+            cached_prefix=('assessment.summarization', SUMMARIZATION_PROMPT_PREFIX)
         )
         summary = summary.strip()
 
@@ -157,6 +253,238 @@ def _clean_llm_json_response(llm_response_text):
         log_message(f"ERRORE in _clean_llm_json_response: {e}")
         return llm_response_text
 
+# --- Estrazione della Prima Parte (EC/PV1/TS1) in Streaming ---
+# Pool condiviso per le sintesi avviate durante lo streaming dell'estrazione
+_summary_executor = ThreadPoolExecutor(max_workers=EXTRACTION_SUMMARY_WORKERS, thread_name_prefix="summary")
+
+FIRST_PART_FIELDS = ('ec', 'pv1', 'ts1')
+
+def _extract_first_part(user_msg, schema):
+    """
+    Estrae EC, PV1 e TS1 dal messaggio dell'utente con una chiamata LLM in streaming.
+    Ogni campo viene sintetizzato (in parallelo) appena il parser incrementale lo vede
+    completo, invece di attendere la fine dell'intera risposta JSON.
+
+    Args:
+        user_msg (str): Il messaggio dell'utente.
+        schema (dict): Lo schema corrente (contesto per la sintesi).
+
+    Returns:
+        dict | None: {'ec', 'pv1', 'ts1'} sintetizzati (None se assenti), oppure None
+                     se la risposta non è un JSON valido.
+    """
+    extraction_prompt = f"""Messaggio dell'utente:
+        \"\"\"
+        {user_msg}
+        \"\"\"
+        """
+    parser = IncrementalJsonFieldParser(fields=FIRST_PART_FIELDS)
+    futures = {}
+    raw_values = {}
+    chunks = []
+
+    def submit_summary(key, value):
+        if key in futures:
+            return
+        if value and isinstance(value, str):
+            raw_values[key] = value
+            # copy_context: la sintesi nel thread del pool vede la deadline del turno
+            futures[key] = _summary_executor.submit(contextvars.copy_context().run,
+                                                    _summarize_component_clinically, key, value, dict(schema))
+        else:
+            futures[key] = None
+
+    for chunk in generate_response_stream(prompt=extraction_prompt, task='extraction',
+                                          cached_prefix=('assessment.extraction', EXTRACTION_PROMPT_PREFIX)):
+        chunks.append(chunk)
+        for key, value in parser.feed(chunk):
+            log_message(f"Assessment Logic: Campo '{key}' completo durante lo streaming, avvio sintesi.")
+            submit_summary(key, value)
+
+    llm_extraction_response = "".join(chunks)
+    log_message(f"Assessment Logic: Risposta LLM grezza per estrazione semplificata: {llm_extraction_response}")
+    if not parser.completed:
+        # Streaming non interpretabile in modo incrementale: parsing del testo completo come prima
+        if not llm_extraction_response:
+            log_message("Assessment Logic: WARN - Risposta LLM (sempl.) per estrazione è vuota.")
+            return None
+        clean_response = _clean_llm_json_response(llm_extraction_response)
+        try:
+            parsed_data = json.loads(clean_response)
+        except json.JSONDecodeError as json_err:
+            log_message(f"Assessment Logic: ERRORE parsing JSON (sempl.) da LLM: {json_err}. Risposta LLM pulita: {clean_response}")
+            return None
+        if not isinstance(parsed_data, dict):
+            log_message("Assessment Logic: WARN - Risposta LLM (sempl.) pulita non è un dizionario JSON valido.")
+            return None
+        for key in FIRST_PART_FIELDS:
+            submit_summary(key, parsed_data.get(key))
+
+    extracted_components = {}
+    for key in FIRST_PART_FIELDS:
+        future = futures.get(key)
+        if future is None:
+            extracted_components[key] = None
+            continue
+        try:
+            extracted_components[key] = future.result(timeout=call_timeout())
+        except FutureTimeoutError:
+            record_degradation('summary_raw_text')
+            extracted_components[key] = raw_values[key].strip()
+    log_message(f"Assessment Logic: Estrazione e SINTESI FEDELE completate: {extracted_components}")
+    return extracted_components
+
+def _split_narrative(text, max_chars=MULTI_EXAMPLE_CHUNK_CHARS):
+    """Divide un racconto in blocchi di al massimo max_chars caratteri, ai confini di paragrafo (o di frase)."""
+    pieces = []
+    for paragraph in (p.strip() for p in re.split(r'\n\s*\n', text)):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r'(?<=[.!?])\s+', paragraph):
+            pieces.extend(sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars))
+    chunks = []
+    current = ""
+    for piece in (p for p in pieces if p):
+        if current and len(current) + 2 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _extract_episodes_from_chunk(chunk):
+    """Estrae tutti gli episodi (EC/PV1/TS1 grezzi) da un blocco di racconto con una sola chiamata."""
+    extraction_prompt = f"""Racconto dell'utente:
+        \"\"\"
+        {chunk}
+        \"\"\"
+        """
+    llm_response = generate_response(prompt=extraction_prompt, history=[], task='multi_extraction',
+                                     cached_prefix=('assessment.multi_extraction', MULTI_EXTRACTION_PROMPT_PREFIX))
+    clean_response = _clean_llm_json_response(llm_response)
+    try:
+        parsed_data = json.loads(clean_response) if clean_response else None
+    except json.JSONDecodeError as json_err:
+        log_message(f"Assessment Logic: ERRORE parsing JSON (più episodi) da LLM: {json_err}. Risposta LLM pulita: {clean_response}")
+        return []
+    if isinstance(parsed_data, dict):
+        # Tollera anche un singolo episodio restituito senza la lista 'episodes'
+        parsed_data = parsed_data.get('episodes', [parsed_data])
+    if not isinstance(parsed_data, list):
+        return []
+    return [episode for episode in parsed_data if isinstance(episode, dict) and episode.get('ec')]
+
+def _extract_episodes(user_msg, schema):
+    """
+    Estrae tutti gli episodi di un racconto lungo: una sola chiamata strutturata per
+    blocco (i blocchi, se più di uno, in parallelo), poi la sintesi di tutti i campi di
+    tutti gli episodi in parallelo.
+
+    Args:
+        user_msg (str): Il racconto dell'utente.
+        schema (dict): Lo schema corrente (contesto per la sintesi).
+
+    Returns:
+        list: Episodi {'titolo', 'ec', 'pv1', 'ts1'} sintetizzati (al massimo
+              MULTI_EXAMPLE_MAX_EPISODES), lista vuota se l'estrazione non è riuscita.
+    """
+    chunks = _split_narrative(user_msg)
+    log_message(f"Assessment Logic: Estrazione di più episodi da {len(user_msg)} caratteri in {len(chunks)} blocchi.")
+    if len(chunks) == 1:
+        episodes = _extract_episodes_from_chunk(chunks[0])
+    else:
+        chunk_futures = [_summary_executor.submit(contextvars.copy_context().run, _extract_episodes_from_chunk, chunk)
+                         for chunk in chunks]
+        episodes = []
+        for future in chunk_futures:
+            try:
+                episodes.extend(future.result(timeout=call_timeout()))
+            except FutureTimeoutError:
+                record_degradation('multi_extraction_chunk')
+    episodes = episodes[:MULTI_EXAMPLE_MAX_EPISODES]
+
+    futures = {}
+    for index, episode in enumerate(episodes):
+        for key in FIRST_PART_FIELDS:
+            value = episode.get(key)
+            if value and isinstance(value, str):
+                futures[(index, key)] = _summary_executor.submit(contextvars.copy_context().run,
+                                                                 _summarize_component_clinically, key, value, dict(schema))
+    summarized = []
+    for index, episode in enumerate(episodes):
+        components = {'titolo': str(episode.get('titolo') or episode['ec'])[:80]}
+        for key in FIRST_PART_FIELDS:
+            future = futures.get((index, key))
+            if future is None:
+                components[key] = None
+                continue
+            try:
+                components[key] = future.result(timeout=call_timeout())
+            except FutureTimeoutError:
+                record_degradation('summary_raw_text')
+                components[key] = episode[key].strip()
+        summarized.append(components)
+    log_message(f"Assessment Logic: {len(summarized)} episodi estratti e sintetizzati.")
+    return summarized
+
+def _create_episode_choice_text(episodes):
+    episode_lines = "\n".join(f"{number}. **{episode['titolo']}**: {episode['ec']}"
+                               for number, episode in enumerate(episodes, start=1))
+    return f"""Grazie per questo racconto così dettagliato. Mi sembra che descriva {len(episodes)} episodi diversi:
+
+{episode_lines}
+
+Lavoriamo su uno alla volta: da quale vorresti partire? Scrivimi il numero."""
+
+_ORDINALS = {'primo': 1, 'prima': 1, 'secondo': 2, 'seconda': 2, 'terzo': 3, 'terza': 3,
+             'quarto': 4, 'quarta': 4, 'quinto': 5, 'quinta': 5}
+
+def _parse_episode_choice(user_msg, count):
+    """Indice (da 0) dell'episodio scelto dall'utente, o None se la risposta non è chiara."""
+    text = user_msg.strip().lower()
+    match = re.search(r'\b(\d+)\b', text)
+    number = int(match.group(1)) if match else None
+    if number is None:
+        words = re.findall(r"\w+", text)
+        if 'ultimo' in words or 'ultima' in words:
+            number = count
+        else:
+            number = next((_ORDINALS[word] for word in words if word in _ORDINALS), None)
+    if number is None or not 1 <= number <= count:
+        return None
+    return number - 1
+
+def _ask_sv2_task(schema):
+    """Transizione scriptata e task LLM della domanda sulla Seconda Valutazione (dopo la conferma della prima parte)."""
+    pv1_text = schema.get('pv1', '...')
+    ts1_text = schema.get('ts1', '...')
+    scripted_transition = ('ask_sv2', {'pv1': schema.get('pv1'), 'ts1': schema.get('ts1')})
+    llm_task_prompt = f"Perfetto, grazie. Ora esploriamo cosa succede dopo la Compulsione ('{ts1_text[:80]}...'). A volte, ci sono altri pensieri o valutazioni (Seconda Valutazione - SV2), e magari strategie per evitare il problema in futuro (Tentativo Soluzione 2 - TS2). Questi elementi non sono sempre presenti o evidenti. \n\nConcentriamoci sulla **Seconda Valutazione (SV2)**: subito **dopo** l'Ossessione ('{pv1_text[:80]}...') o la Compulsione ('{ts1_text[:80]}...'), cosa hai **PENSATO** o **GIUDICATO** riguardo a quello che stava succedendo, all'ossessione stessa, alla compulsione o alle sue conseguenze? (Non solo l'emozione)."
+    return scripted_transition, llm_task_prompt
+
+def _chat_history_for_llm(messages):
+    """History nel formato Gemini dai messaggi della chat (esclusi i segnaposto di attesa)."""
+    chat_history_for_llm = []
+    for msg in messages:
+         role = 'model' if msg.get('role') == 'assistant' else msg.get('role')
+         content = msg.get('content', '')
+         if role in ['user', 'model'] and content and content.strip() not in ["...", "Sto pensando..."]:
+             chat_history_for_llm.append({'role': role, 'parts': [content]})
+    return chat_history_for_llm
+
+def _task_reply(phase, schema, llm_task_prompt, user_msg, chat_history_for_llm):
+    """Risposta LLM per il task specifico della fase, con gli estratti pertinenti del capitolo."""
+    phase_prompt = f"""FASE CONVERSAZIONE: {phase}. SCHEMA UTENTE PARZIALE: {schema}.
+OBIETTIVO SPECIFICO: {llm_task_prompt}"""
+    chapter_text = chapter_context(phase, cycle_index.cycle_text(schema))
+    if chapter_text:
+        phase_prompt += f"\n\nMATERIALE DEL MANUALE (usalo solo se pertinente):\n{chapter_text}"
+    return generate_response(prompt=f"{phase_prompt}\n\n---\n\nUltimo Messaggio Utente (da ignorare se il prompt lo include già): {user_msg}", history=chat_history_for_llm, task='user_reply',
+                             cached_prefix=_system_prompt_prefix(phase))
+
 # --- Funzione Helper Trova Mancante ---
 # (Invariata)
 def _find_next_missing_step(schema):
@@ -182,6 +510,7 @@ def handle(user_msg, current_state):
 
     bot_response_text = ""
     llm_task_prompt = None
+    scripted_transition = None # (chiave, slot) nel pool di formulazioni: risposta locale senza LLM
 
     conferme = CONFERME
     negazioni_o_dubbi = NEGAZIONI_O_DUBBI
@@ -201,6 +530,7 @@ def handle(user_msg, current_state):
                           any(word in conferme for word in user_msg_processed.split())
         if is_confirmation:
              new_state['phase'] = 'ASSESSMENT_GET_EXAMPLE'
+             scripted_transition = ('example_invitation', {})
              llm_task_prompt = "Perfetto. Allora, prova a raccontarmi una situazione concreta e recente in cui hai provato ansia, disagio o hai avuto pensieri che ti preoccupavano legati al DOC. Descrivi semplicemente cosa è successo e cosa hai pensato o fatto."
              log_message("Assessment Logic: Transizione ASSESSMENT_INTRO -> ASSESSMENT_GET_EXAMPLE.")
         else:
@@ -208,69 +538,67 @@ def handle(user_msg, current_state):
              log_message("Assessment Logic: Input non conferma diretta, assumo sia inizio Esempio -> ASSESSMENT_GET_EXAMPLE.")
 
     elif current_phase == 'ASSESSMENT_GET_EXAMPLE':
-        # (Logica estrazione e chiamata _summarize_component_clinically invariata)
+        # Estrazione in streaming: la sintesi di ogni campo parte appena il campo è completo
         log_message(f"Assessment Logic: Ricevuto input in ASSESSMENT_GET_EXAMPLE: '{user_msg[:100]}...'")
-        log_message("Assessment Logic: Avvio analisi LLM semplificata (EC, PV1, TS1)...")
-        extraction_prompt = f"""Analizza attentamente il seguente messaggio dell'utente, che descrive un'esperienza legata al DOC:
-        \"\"\"
-        {user_msg}
-        \"\"\"
-        Il tuo compito è identificare e separare i seguenti componenti INIZIALI dello schema DOC, se sono chiaramente presenti nel testo:
-        1.  **EC (Evento Critico):** La situazione specifica, l'evento esterno o interno che ha innescato il ciclo.
-        2.  **PV1 (Prima Valutazione/Ossessione):** Il primo pensiero intrusivo, dubbio, immagine o paura significativa sorta in risposta all'EC.
-        3.  **TS1 (Tentativo Soluzione 1/Compulsione):** La reazione comportamentale o mentale (rituale, controllo, rassicurazione, evitamento, anche differito) messa in atto *in risposta diretta* a PV1 per gestirla.
-
-        Restituisci il risultato ESATTAMENTE nel seguente formato JSON:
-        {{
-          "ec": "Testo estratto dell'Evento Critico",
-          "pv1": "Testo estratto della Prima Valutazione",
-          "ts1": "Testo estratto della Compulsione/Tentativo Soluzione 1"
-        }}
-
-        Se un componente NON è chiaramente identificabile nel messaggio fornito, imposta il suo valore su **null** o su una **stringa vuota**. Sii conciso. Se non identifichi nemmeno l'EC, restituisci null per EC. Non cercare SV2 o TS2 in questo passaggio.
-        """
-        extracted_components = {'ec': None, 'pv1': None, 'ts1': None}
-        llm_extraction_response = None
-        parsing_ok = False
+        extracted_components = None
+        candidate_episodes = []
         try:
-            llm_extraction_response = generate_response(prompt=extraction_prompt, history=[], model=st.session_state.get('model_gemini'))
-            log_message(f"Assessment Logic: Risposta LLM grezza per estrazione semplificata: {llm_extraction_response}")
-            if llm_extraction_response:
-                clean_response = _clean_llm_json_response(llm_extraction_response)
-                try:
-                    parsed_data = json.loads(clean_response)
-                    if isinstance(parsed_data, dict):
-                        extracted_components['ec'] = parsed_data.get("ec") if parsed_data.get("ec") else None
-                        extracted_components['pv1'] = parsed_data.get("pv1") if parsed_data.get("pv1") else None
-                        extracted_components['ts1'] = parsed_data.get("ts1") if parsed_data.get("ts1") else None
-                        log_message(f"Assessment Logic: Estrazione JSON semplificata riuscita - Dati RAW: {extracted_components}")
-                        parsing_ok = True
-                    else: log_message("Assessment Logic: WARN - Risposta LLM (sempl.) pulita non è un dizionario JSON valido.")
-                except json.JSONDecodeError as json_err: log_message(f"Assessment Logic: ERRORE parsing JSON (sempl.) da LLM: {json_err}. Risposta LLM pulita: {clean_response}")
-            else: log_message("Assessment Logic: WARN - Risposta LLM (sempl.) per estrazione è vuota.")
+            if len(user_msg) >= MULTI_EXAMPLE_MIN_CHARS:
+                # Racconto lungo: può contenere più episodi, estratti tutti in una chiamata
+                candidate_episodes = _extract_episodes(user_msg, new_state['schema'])
+            if len(candidate_episodes) == 1:
+                extracted_components = {key: candidate_episodes[0][key] for key in FIRST_PART_FIELDS}
+            elif not candidate_episodes:
+                log_message("Assessment Logic: Avvio analisi LLM semplificata (EC, PV1, TS1) in streaming...")
+                extracted_components = _extract_first_part(user_msg, new_state['schema'])
         except Exception as e: log_message(f"Assessment Logic: ERRORE durante chiamata LLM o processing (sempl.): {e}\n{traceback.format_exc()}")
-
-        if not parsing_ok:
+        parsing_ok = extracted_components is not None
+
+        if len(candidate_episodes) > 1:
+            new_state['candidate_episodes'] = candidate_episodes
+            new_state['phase'] = 'ASSESSMENT_CHOOSE_EXAMPLE'
+            log_message(f"Assessment Logic: {len(candidate_episodes)} episodi candidati. Transizione a {new_state['phase']}.")
+            bot_response_text = _create_episode_choice_text(candidate_episodes)
+        elif not parsing_ok:
             log_message("Assessment Logic: Fallback (causa errore estrazione/parsing sempl.) - Uso l'intero user_msg come EC.")
             new_state['schema'] = INITIAL_STATE['schema'].copy()
             new_state['schema']['ec'] = user_msg # Salva testo grezzo
             new_state['phase'] = 'ASSESSMENT_GET_PV1'
             log_message(f"Assessment Logic: Transizione fallback a {new_state['phase']}.")
             ec_text = new_state['schema'].get('ec', 'la situazione descritta')
+            scripted_transition = ('ask_pv1_after_fallback', {'ec': ec_text})
             llm_task_prompt = f"Grazie per aver descritto la situazione: '{ec_text[:100]}...'. Ora vorrei capire l'**Ossessione (PV1)**. Quale è stato il primo pensiero, immagine, dubbio o paura che hai avuto in *quel momento*?"
         else:
-            # Successo: SINTETIZZA (fedelmente) e Salva EC, PV1, TS1 estratti
+            # Successo: Salva EC, PV1, TS1 estratti e già sintetizzati (fedelmente) durante lo streaming
             for key, value in extracted_components.items():
-                if value:
-                    synthesized_value = _summarize_component_clinically(key, value, new_state['schema'])
-                    new_state['schema'][key] = synthesized_value
-                else:
-                     new_state['schema'][key] = None
+                new_state['schema'][key] = value
             log_message(f"Assessment Logic: Schema aggiornato dopo estrazione e SINTESI FEDELE: {new_state['schema']}")
             new_state['phase'] = 'ASSESSMENT_CONFIRM_FIRST_PART'
             log_message(f"Assessment Logic: Transizione a {new_state['phase']}.")
             bot_response_text = _create_first_part_summary_text(new_state['schema'])
 
+    elif current_phase == 'ASSESSMENT_CHOOSE_EXAMPLE':
+        candidate_episodes = new_state.get('candidate_episodes') or []
+        choice = _parse_episode_choice(user_msg, len(candidate_episodes))
+        if not candidate_episodes:
+            log_message("Assessment Logic: WARN - Nessun episodio candidato in stato. Torno a ASSESSMENT_GET_EXAMPLE.")
+            new_state['phase'] = 'ASSESSMENT_GET_EXAMPLE'
+            scripted_transition = ('example_invitation', {})
+            llm_task_prompt = "Perfetto. Allora, prova a raccontarmi una situazione concreta e recente in cui hai provato ansia, disagio o hai avuto pensieri che ti preoccupavano legati al DOC. Descrivi semplicemente cosa è successo e cosa hai pensato o fatto."
+        elif choice is None:
+            log_message("Assessment Logic: Scelta dell'episodio non chiara. Richiedo.")
+            bot_response_text = f"Scusa, non ho capito quale episodio preferisci. Scrivimi un numero da 1 a {len(candidate_episodes)}.\n\n" + \
+                                _create_episode_choice_text(candidate_episodes).split("\n\n", 1)[1]
+        else:
+            chosen = candidate_episodes[choice]
+            new_state['schema'] = INITIAL_STATE['schema'].copy()
+            for key in FIRST_PART_FIELDS:
+                new_state['schema'][key] = chosen.get(key)
+            new_state.pop('candidate_episodes', None)
+            new_state['phase'] = 'ASSESSMENT_CONFIRM_FIRST_PART'
+            log_message(f"Assessment Logic: Scelto l'episodio {choice + 1} ('{chosen.get('titolo')}'). Transizione a {new_state['phase']}.")
+            bot_response_text = _create_first_part_summary_text(new_state['schema'])
+
     elif current_phase == 'ASSESSMENT_CONFIRM_FIRST_PART':
         # (Logica invariata)
         log_message(f"Assessment Logic: Gestione fase '{current_phase}'")
@@ -285,9 +613,15 @@ def handle(user_msg, current_state):
             log_message("Assessment Logic: Prima parte (EC/PV1/TS1) confermata.")
             new_state['phase'] = 'ASSESSMENT_GET_SV2'
             log_message(f"Assessment Logic: Transizione a {new_state['phase']}.")
-            pv1_text = new_state['schema'].get('pv1', '...')
-            ts1_text = new_state['schema'].get('ts1', '...')
-            llm_task_prompt = f"Perfetto, grazie. Ora esploriamo cosa succede dopo la Compulsione ('{ts1_text[:80]}...'). A volte, ci sono altri pensieri o valutazioni (Seconda Valutazione - SV2), e magari strategie per evitare il problema in futuro (Tentativo Soluzione 2 - TS2). Questi elementi non sono sempre presenti o evidenti. \n\nConcentriamoci sulla **Seconda Valutazione (SV2)**: subito **dopo** l'Ossessione ('{pv1_text[:80]}...') o la Compulsione ('{ts1_text[:80]}...'), cosa hai **PENSATO** o **GIUDICATO** riguardo a quello che stava succedendo, all'ossessione stessa, alla compulsione o alle sue conseguenze? (Non solo l'emozione)."
+            scripted_transition, llm_task_prompt = _ask_sv2_task(new_state['schema'])
+            if user_msg_processed in conferme:
+                # Conferma semplice: la domanda può essere stata preparata durante il turno precedente
+                prepared_question = speculation.take(_next_question_key(
+                    new_state['phase'], new_state['schema'], llm_task_prompt,
+                    _chat_history_for_llm(get_session_value('messages', [])[:-1])))
+                if prepared_question and not is_failed_response(prepared_question):
+                    bot_response_text = prepared_question
+                    scripted_transition = llm_task_prompt = None
         elif is_modification_request:
             log_message("Assessment Logic: Richiesta modifica prima parte.")
             new_state['originating_confirmation_phase'] = 'ASSESSMENT_CONFIRM_FIRST_PART'
@@ -310,6 +644,7 @@ def handle(user_msg, current_state):
              new_state['phase'] = 'ASSESSMENT_GET_TS1'
              log_message(f"Assessment Logic: PV1 sintetizzato e salvato. Prossimo mancante '{next_missing}'. Transizione a {new_state['phase']}.")
              pv1_text = new_state['schema'].get('pv1', '...')
+             scripted_transition = ('ask_ts1', {'pv1': new_state['schema'].get('pv1')})
              llm_task_prompt = f"Ok, l'Ossessione (PV1) è '{pv1_text[:100]}...'. Adesso passiamo alla **Compulsione (TS1)**. Cosa hai fatto/pensato/sentito *in risposta diretta*?"
         else:
             new_state['phase'] = 'ASSESSMENT_CONFIRM_FIRST_PART'
@@ -334,50 +669,57 @@ def handle(user_msg, current_state):
             new_state['schema']['sv2'] = None
             new_state['phase'] = 'ASSESSMENT_GET_TS2'
             log_message("Assessment Logic: Transizione a ASSESSMENT_GET_TS2.")
+            scripted_transition = ('ask_ts2_no_sv2', {})
             llm_task_prompt = f"Capito (SV2 non significativa). Ora l'ultimo punto: il **Tentativo di Soluzione 2 (TS2)**. C'è stata qualche strategia/intenzione futura per **evitare situazioni simili**, **prevenire l'ossessione**, o **gestire diversamente la compulsione**? Hai provato a resistere?"
         else:
             log_message("Assessment Logic: Avvio validazione LLM per SV2...")
             # Prompt validazione v2: più chiaro su conseguenze
-            validation_prompt = f"""ANALISI RISPOSTA UTENTE PER SECONDA VALUTAZIONE (SV2)
-            CONTESTO: Dopo Evento Critico (EC)="{new_state['schema'].get('ec', 'N/D')}", Ossessione (PV1)="{new_state['schema'].get('pv1', 'N/D')}", e Compulsione (TS1)="{new_state['schema'].get('ts1', 'N/D')}".
-            DOMANDA POSTA ALL'UTENTE: Chiedeva la Seconda Valutazione (SV2) - il PENSIERO o GIUDIZIO (anche su conseguenze) dopo PV1/TS1, non solo l'emozione.
+            validation_prompt = f"""CONTESTO: Dopo Evento Critico (EC)="{new_state['schema'].get('ec', 'N/D')}", Ossessione (PV1)="{new_state['schema'].get('pv1', 'N/D')}", e Compulsione (TS1)="{new_state['schema'].get('ts1', 'N/D')}".
             RISPOSTA UTENTE DA ANALIZZARE: "{sv2_input}"
-            TASK: La risposta dell'utente descrive effettivamente una Valutazione Cognitiva Secondaria (SV2)?
-            - È un pensiero, un giudizio, una valutazione (anche metacognitiva), una riflessione sulle **conseguenze** (es. "rischierò il licenziamento", "farò tardi", "ho pensato che fosse terribile", "questo pensiero è inaccettabile")? -> VALIDO_SV2
-            - È SOLO un'emozione (es. "ansia", "paura")? -> NON_VALIDO_SV2
-            - È un'azione, un comportamento, un tentativo (anche fallito) di fare/non fare qualcosa (es. "sono tornato indietro", "ho cercato di resistere", "ho chiesto rassicurazioni")? -> NON_VALIDO_SV2
-            - È una negazione esplicita o "non lo so"? -> NEGATIVO
-            - È qualcos'altro di non pertinente? -> NON_VALIDO_SV2
-            Output Atteso: Rispondi ESATTAMENTE con UNA delle seguenti stringhe: VALIDO_SV2, NON_VALIDO_SV2, NEGATIVO
             """
             try:
-                validation_response = generate_response(prompt=validation_prompt, history=[], model=st.session_state.get('model_gemini')).strip().upper()
-                log_message(f"Assessment Logic: Risultato validazione LLM per SV2: '{validation_response}'")
-
-                if validation_response == 'VALIDO_SV2':
-                    log_message("Assessment Logic: SV2 validato come VALIDO.")
-                    synthesized_sv2 = _summarize_component_clinically('sv2', sv2_input, new_state['schema'])
-                    new_state['schema']['sv2'] = synthesized_sv2
-                    new_state['phase'] = 'ASSESSMENT_GET_TS2'
-                    log_message("Assessment Logic: Transizione a ASSESSMENT_GET_TS2.")
-                    sv2_text = new_state['schema'].get('sv2', 'la valutazione precedente')
-                    llm_task_prompt = f"Capito (SV2: {sv2_text[:80]}...). Ora l'ultimo punto: il **Tentativo di Soluzione 2 (TS2)**. C'è stata qualche strategia/intenzione futura per **evitare situazioni simili**, **prevenire l'ossessione**, o **gestire diversamente la compulsione**? Hai provato a resistere?"
-                elif validation_response == 'NEGATIVO':
-                    log_message("Assessment Logic: SV2 validato come NEGATIVO.")
-                    new_state['schema']['sv2'] = None
-                    new_state['phase'] = 'ASSESSMENT_GET_TS2'
-                    log_message("Assessment Logic: Transizione a ASSESSMENT_GET_TS2.")
-                    llm_task_prompt = f"Capito (SV2 non significativa). Ora l'ultimo punto: il **Tentativo di Soluzione 2 (TS2)**. C'è stata qualche strategia/intenzione futura per **evitare situazioni simili**, **prevenire l'ossessione**, o **gestire diversamente la compulsione**? Hai provato a resistere?"
-                else: # NON_VALIDO_SV2 o altro
-                    log_message("Assessment Logic: SV2 validato come NON VALIDO. Richiedo.")
-                    new_state['phase'] = 'ASSESSMENT_GET_SV2'
-                    pv1_text = new_state['schema'].get('pv1', '...')
-                    ts1_text = new_state['schema'].get('ts1', '...')
-                    llm_task_prompt = f"Ok, grazie per la risposta ('{sv2_input[:80]}...'). Tuttavia, stiamo cercando specificamente la **Seconda Valutazione (SV2)**: un **pensiero**, un **giudizio** o una **valutazione** (anche sulle conseguenze, come 'rischierò il licenziamento') che hai avuto *dopo* l'ossessione ('{pv1_text[:80]}...') o la compulsione ('{ts1_text[:80]}...'). Non l'emozione o l'azione stessa. C'è stato un pensiero o giudizio specifico in quel momento? (Se non c'è stato o non ricordi, dimmi pure 'nessuno' o 'non ricordo')."
+                if budget_exhausted():
+                    record_degradation('sv2_validation_skipped')
+                    raise TimeoutError("budget del turno esaurito")
+                raw_validation = generate_response(prompt=validation_prompt, history=[], task='sv2_validation',
+                                                   cached_prefix=('assessment.sv2_validation', SV2_VALIDATION_PROMPT_PREFIX))
+                if is_failed_response(raw_validation):
+                    raise RuntimeError(f"risposta non valida del modello ('{raw_validation[:80]}')")
+                log_message(f"Assessment Logic: Risultato validazione LLM per SV2: '{raw_validation.strip()}'")
+                # NON_VALIDO_SV2 contiene VALIDO_SV2: va riconosciuto per primo
+                validation_response = next((label for label in ('NON_VALIDO_SV2', 'VALIDO_SV2', 'NEGATIVO')
+                                            if label in raw_validation.upper()), None)
+                if validation_response is None:
+                    raise ValueError(f"esito non riconosciuto ('{raw_validation.strip()[:80]}')")
             except Exception as e:
-                log_message(f"ERRORE durante validazione LLM per SV2: {e}. Richiedo.")
+                # Validazione non riuscita (errore del provider, esito non riconosciuto o budget esaurito):
+                # la risposta viene accettata come SV2 invece di chiedere all'utente di ripeterla
+                log_message(f"Assessment Logic: WARN - Validazione LLM per SV2 non riuscita ({e}). Accetto la risposta come SV2.")
+                validation_response = None
+
+            if validation_response in ('VALIDO_SV2', None):
+                log_message("Assessment Logic: SV2 validato come VALIDO." if validation_response else "Assessment Logic: SV2 accettato senza validazione.")
+                synthesized_sv2 = _summarize_component_clinically('sv2', sv2_input, new_state['schema'])
+                new_state['schema']['sv2'] = synthesized_sv2
+                new_state['phase'] = 'ASSESSMENT_GET_TS2'
+                log_message("Assessment Logic: Transizione a ASSESSMENT_GET_TS2.")
+                sv2_text = new_state['schema'].get('sv2', 'la valutazione precedente')
+                scripted_transition = ('ask_ts2_after_sv2', {'sv2': new_state['schema'].get('sv2')})
+                llm_task_prompt = f"Capito (SV2: {sv2_text[:80]}...). Ora l'ultimo punto: il **Tentativo di Soluzione 2 (TS2)**. C'è stata qualche strategia/intenzione futura per **evitare situazioni simili**, **prevenire l'ossessione**, o **gestire diversamente la compulsione**? Hai provato a resistere?"
+            elif validation_response == 'NEGATIVO':
+                log_message("Assessment Logic: SV2 validato come NEGATIVO.")
+                new_state['schema']['sv2'] = None
+                new_state['phase'] = 'ASSESSMENT_GET_TS2'
+                log_message("Assessment Logic: Transizione a ASSESSMENT_GET_TS2.")
+                scripted_transition = ('ask_ts2_no_sv2', {})
+                llm_task_prompt = f"Capito (SV2 non significativa). Ora l'ultimo punto: il **Tentativo di Soluzione 2 (TS2)**. C'è stata qualche strategia/intenzione futura per **evitare situazioni simili**, **prevenire l'ossessione**, o **gestire diversamente la compulsione**? Hai provato a resistere?"
+            else: # NON_VALIDO_SV2
+                log_message("Assessment Logic: SV2 validato come NON VALIDO. Richiedo.")
                 new_state['phase'] = 'ASSESSMENT_GET_SV2'
-                llm_task_prompt = f"Scusa, ho avuto un problema nell'analizzare la tua risposta per la Seconda Valutazione. Potresti ripeterla o riformularla? Ricorda, cerchiamo un pensiero o un giudizio avuto dopo l'ossessione o la compulsione."
+                pv1_text = new_state['schema'].get('pv1', '...')
+                ts1_text = new_state['schema'].get('ts1', '...')
+                scripted_transition = ('reask_sv2_invalid', {'sv2_input': sv2_input, 'pv1': new_state['schema'].get('pv1'), 'ts1': new_state['schema'].get('ts1')})
+                llm_task_prompt = f"Ok, grazie per la risposta ('{sv2_input[:80]}...'). Tuttavia, stiamo cercando specificamente la **Seconda Valutazione (SV2)**: un **pensiero**, un **giudizio** o una **valutazione** (anche sulle conseguenze, come 'rischierò il licenziamento') che hai avuto *dopo* l'ossessione ('{pv1_text[:80]}...') o la compulsione ('{ts1_text[:80]}...'). Non l'emozione o l'azione stessa. C'è stato un pensiero o giudizio specifico in quel momento? (Se non c'è stato o non ricordi, dimmi pure 'nessuno' o 'non ricordo')."
 
     elif current_phase == 'ASSESSMENT_GET_TS2':
         # (Logica invariata, usa _summarize_component_clinically)
@@ -406,6 +748,8 @@ def handle(user_msg, current_state):
                           and not is_modification_request
         if is_confirmation:
             new_state['phase'] = 'RESTRUCTURING_INTRO'
+            if new_state.get('user_id'):
+                cycle_index.add_cycle(new_state['user_id'], new_state['schema'])
             bot_response_text = "Ottimo, grazie per la conferma! Avere chiaro questo schema completo è un passo importante.\n\nOra che abbiamo definito un esempio del ciclo, possiamo iniziare ad approfondire le valutazioni e i pensieri che lo mantengono. Ti andrebbe di passare alla fase successiva, chiamata **Ristrutturazione Cognitiva**?"
             log_message(f"Assessment Logic: Schema COMPLETO confermato. Transizione proposta a RESTRUCTURING_INTRO.")
         elif is_modification_request:
@@ -437,6 +781,7 @@ def handle(user_msg, current_state):
              target_names = {'ec': 'Evento Critico', 'pv1': 'Ossessione', 'ts1': 'Compulsione', 'sv2': 'Seconda Valutazione', 'ts2': 'Tentativo Soluzione 2'}
              target_name = target_names.get(target_key, target_key)
              current_value = new_state.get('schema', {}).get(target_key, "Non definito")
+             scripted_transition = ('ask_edit_value', {'target_name': target_name, 'current_value': current_value or "Non definito"})
              llm_task_prompt = f"Ok, vuoi modificare '{target_name}'. Il valore attuale (sintetizzato) è: \"{current_value}\". Per favore, fornisci la nuova descrizione completa per questo punto (verrà risintetizzata)."
              log_message(f"Assessment Logic: Target modifica '{target_key}'. Transizione a {new_state['phase']}.")
          else:
@@ -484,32 +829,43 @@ def handle(user_msg, current_state):
         new_state['phase'] = 'RESTRUCTURING_INTRO'
         bot_response_text = "Abbiamo completato la valutazione dell'esempio. Ti andrebbe ora di passare alla fase successiva, la **Ristrutturazione Cognitiva**?"
 
+    # --- Transizioni Scriptate: risposta locale dal pool di formulazioni (se il contesto lo consente) ---
+    if llm_task_prompt and scripted_transition:
+        pooled_response = pick_phrasing(scripted_transition[0], scripted_transition[1], user_msg=user_msg)
+        if pooled_response:
+            bot_response_text = pooled_response
+            llm_task_prompt = None
+    if llm_task_prompt and budget_exhausted():
+        # Budget del turno esaurito: risposta scriptata (variante del pool o testo del task) senza LLM
+        record_degradation('scripted_reply')
+        pooled_response = pick_phrasing(*scripted_transition) if scripted_transition else None
+        bot_response_text = pooled_response or llm_task_prompt
+        llm_task_prompt = None
+
     # --- Gestione Chiamata LLM Specifica ---
     if llm_task_prompt:
         # (Logica invariata)
         log_message(f"Assessment Logic: Eseguo LLM per task specifico: {llm_task_prompt}")
-        chat_history_for_llm = []
-        history_source = st.session_state.get('messages', [])
-        if len(history_source) > 1:
-            for msg in history_source[:-1]:
-                 role = 'model' if msg.get('role') == 'assistant' else msg.get('role')
-                 content = msg.get('content', '')
-                 if role in ['user', 'model'] and content and content.strip() not in ["...", "Sto pensando..."]:
-                     chat_history_for_llm.append({'role': role, 'parts': [content]})
-        system_prompt = f"""Sei un assistente empatico per il supporto al DOC (TCC).
-FASE CONVERSAZIONE: {new_state['phase']}. SCHEMA UTENTE PARZIALE: {new_state.get('schema', {})}.
-ISTRUZIONI: Rispondi in ITALIANO. Tono empatico, chiaro, CONCISO. Fai UNA domanda alla volta. Non usare sigle (EC, PV1 ecc.) nella domanda diretta all'utente, usa i nomi completi (es. Evento Critico). Non chiedere informazioni già presenti nello SCHEMA UTENTE PARZIALE.
-OBIETTIVO SPECIFICO: {llm_task_prompt}"""
-        bot_response_text = generate_response(prompt=f"{system_prompt}\n\n---\n\nUltimo Messaggio Utente (da ignorare se il prompt lo include già): {user_msg}", history=chat_history_for_llm, model=st.session_state.get('model_gemini'))
+        chat_history_for_llm = _chat_history_for_llm(get_session_value('messages', [])[:-1])
+        bot_response_text = _task_reply(new_state['phase'], new_state.get('schema', {}), llm_task_prompt, user_msg, chat_history_for_llm)
+        if is_failed_response(bot_response_text):
+            # Chiamata fallita a metà turno: la domanda scriptata (variante del pool o testo del task)
+            # invece del fallback generico, così la conversazione prosegue nella fase corretta
+            log_message(f"Assessment Logic: WARN - Risposta LLM per il task non valida ('{(bot_response_text or '')[:80]}'). Uso la domanda scriptata.")
+            pooled_response = pick_phrasing(*scripted_transition) if scripted_transition else None
+            bot_response_text = pooled_response or llm_task_prompt
 
     # --- Fallback Generico ---
     elif not bot_response_text:
         # (Logica invariata)
         log_message(f"Assessment Logic: Nessuna logica specifica o task LLM per fase '{current_phase}'. Eseguo fallback generico...")
-        rag_context = ""
-        system_prompt_generic = f"""Sei un assistente empatico per il supporto al DOC (TCC). FASE CONVERSAZIONE ATTUALE: {new_state['phase']}. SCHEMA UTENTE: {new_state.get('schema', {})}.{rag_context} ISTRUZIONI: Rispondi in ITALIANO. Tono empatico, chiaro, CONCISO. L'utente ha inviato un messaggio ('{user_msg[:100]}...') che non rientra nel flusso previsto. Rispondi in modo utile e pertinente. Guida gentilmente verso l'obiettivo della fase attuale ({current_phase}). Fai UNA domanda alla volta se necessario."""
+        # Contesto dal manuale: riassunto delle sezioni pertinenti e pochi chunk (ricerca gerarchica)
+        rag_context = format_rag_context(search_hierarchical_rag(user_msg))
+        rag_context = f"\n\nCONTESTO DAL MANUALE (usalo solo se pertinente):\n{rag_context}\n\n" if rag_context else ""
+        system_prompt_generic = f"""FASE CONVERSAZIONE ATTUALE: {new_state['phase']}. SCHEMA UTENTE: {new_state.get('schema', {})}.{rag_context} L'utente ha inviato un messaggio ('{user_msg[:100]}...') che non rientra nel flusso previsto. Rispondi in modo utile e pertinente. Guida gentilmente verso l'obiettivo della fase attuale ({current_phase}). Fai UNA domanda alla volta se necessario."""
         chat_history_for_llm = []
-        bot_response_text = generate_response(prompt=f"{system_prompt_generic}", history=chat_history_for_llm, model=st.session_state.get('model_gemini'))
+        bot_response_text = generate_response(prompt=f"{system_prompt_generic}", history=chat_history_for_llm, task='fallback',
+                                              cached_prefix=_system_prompt_prefix(new_state['phase']))
         log_message("Assessment Logic: Eseguito LLM generico di fallback.")
 
     # Fallback finale
@@ -530,3 +886,57 @@ OBIETTIVO SPECIFICO: {llm_task_prompt}"""
         log_message("ERRORE CRITICO: 'schema' perso o corrotto prima del return! Ripristino parziale.")
         new_state['schema'] = current_state.get('schema', INITIAL_STATE['schema'].copy())
     return bot_response_text, new_state
+
+
+# --- Precalcolo Speculativo del Turno Successivo (vedi speculation.py) ---
+# Fase in cui porta, con ogni probabilità, la risposta dell'utente (una conferma).
+SPECULATIVE_NEXT_PHASE = {
+    'ASSESSMENT_CONFIRM_FIRST_PART': 'ASSESSMENT_GET_SV2',
+    'ASSESSMENT_CONFIRM_SCHEMA': 'RESTRUCTURING_INTRO',
+}
+PREDICTED_CONFIRMATION = "sì"
+
+def _next_question_key(phase, schema, llm_task_prompt, chat_history_for_llm):
+    return speculation.asset_key('question', phase, schema, llm_task_prompt, chat_history_for_llm)
+
+def speculative_assets(state, bot_response):
+    """
+    Risorse costose del turno successivo, da preparare mentre l'utente legge e scrive.
+
+    Args:
+        state (dict): Lo stato dopo il turno appena concluso.
+        bot_response (str): La risposta appena inviata (entra nella history del turno successivo).
+
+    Returns:
+        tuple | None: (fase_prevista, [(chiave, funzione), ...]), o None se la fase
+                      successiva non è prevedibile.
+    """
+    next_phase = SPECULATIVE_NEXT_PHASE.get(state.get('phase'))
+    if next_phase is None:
+        return None
+    schema = dict(state.get('schema') or {})
+    assets = []
+    # Estratti del capitolo della fase successiva pertinenti allo schema dell'utente
+    chapter_asset = chapter_search_asset(next_phase, cycle_index.cycle_text(schema))
+    if chapter_asset and wait_for_rag(0) is not None:
+        assets.append(chapter_asset)
+    if next_phase.startswith('ASSESSMENT_'):
+        # Registrazione del prefisso della fase nella context cache (se supera la soglia del provider)
+        context_cache = get_context_cache()
+        prefix_key, prefix_text = _system_prompt_prefix(next_phase)
+        if context_cache is not None and estimate_tokens(prefix_text) >= context_cache.min_tokens:
+            model = get_model_for_task('user_reply')
+            assets.append((speculation.asset_key('warm', prefix_key, prefix_text),
+                           lambda: prepare_call(prefix_key, model, prefix_text, "",
+                                               LLM_TASKS['user_reply']['generation_config'])))
+    if next_phase == 'ASSESSMENT_GET_SV2':
+        # Domanda successiva (variante del pool o formulazione LLM) per la risposta "sì"
+        scripted_transition, llm_task_prompt = _ask_sv2_task(schema)
+        messages = list(get_session_value('messages', []))
+        if messages: # La risposta appena data entra nella history del turno successivo (fuori da Streamlit non c'è history)
+            messages.append({'role': 'assistant', 'content': bot_response})
+        chat_history_for_llm = _chat_history_for_llm(messages)
+        assets.append((_next_question_key(next_phase, schema, llm_task_prompt, chat_history_for_llm),
+                       lambda: pick_phrasing(*scripted_transition, user_msg=PREDICTED_CONFIRMATION)
+                       or _task_reply(next_phase, schema, llm_task_prompt, PREDICTED_CONFIRMATION, chat_history_for_llm)))
+    return next_phase, assets
@@ -1,7 +1,6 @@
 # phases/disgust_logic.py (Struttura Modulare a Fasi)
 # Placeholder per la logica delle fasi relative al Disgusto.
 
-import streamlit as st
 from utils import log_message
 # Importa altre dipendenze necessarie
 
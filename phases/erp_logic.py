@@ -1,27 +1,217 @@
 # phases/erp_logic.py (Struttura Modulare a Fasi)
-# Placeholder per la logica delle fasi di Esposizione con Prevenzione della Risposta (ERP).
+# Logica delle fasi di Esposizione con Prevenzione della Risposta (ERP).
+# - ERP_INTRO: spiega l'esposizione; se l'utente ha già una gerarchia riparte da lì.
+# - ERP_BUILD_HIERARCHY: raccoglie le situazioni temute con il loro SUDS (0-100).
+# - ERP_IN_VIVO_PRE / ERP_IMAGINAL: SUDS prima della prova (in vivo o immaginativa).
+# - ERP_IN_VIVO_POST: SUDS di picco e finale, compulsione evitata o no; la prova viene
+#   registrata in exposure_log e l'analisi di abituazione propone il passo successivo.
+# Le risposte sono scriptate: nessuna chiamata LLM nel turno ERP.
+
+import re
+import time
+
+import numpy as np
 
-import streamlit as st
 from utils import log_message
-# Importa altre dipendenze necessarie
+from config import CONFERME, ERP_MASTERY_SUDS, ERP_MASTERY_TRIALS
+import exposure_log
+
+HIERARCHY_DONE_WORDS = ['fatto', 'finito', 'basta', 'ho finito', 'è tutto', 'nient\'altro']
+
+_suds_line_re = re.compile(r'^\s*[-*•\d.)\s]*?(?P<text>\S.*?)[\s:=,(–-]+(?P<suds>\d{1,3})\s*\)?\s*(?:/\s*100)?\s*$')
+_minutes_re = re.compile(r'(\d+(?:[.,]\d+)?)\s*(?:min|minuti|minuto)\b', re.IGNORECASE)
+_number_re = re.compile(r'\b(\d{1,3})\b')
+# Esito della prevenzione della risposta, in ordine di priorità (vedi _resisted):
+# 1. fallimento esplicito ("non ho resistito", "non ce l'ho fatta", "ho ceduto");
+# 2. riuscita esplicita, comprese le compulsioni negate ("non l'ho fatta", "non ho controllato");
+# 3. compulsione fatta, se non preceduta da "non" ("l'ho fatta", "ho controllato");
+# 4. un "no" isolato (risposta a "sei riuscito a non fare la compulsione?").
+_failed_re = re.compile(r"\b(non ho resistito|non sono riuscit[oa]|non ce l'ho fatta|(?<!non )ho ceduto)\b", re.IGNORECASE)
+_resisted_re = re.compile(r"\b(ho resistito|sono riuscit[oa]|(?<!non )ce l'ho fatta|non l'ho fatt[ao]|non ho (?:controllato|ceduto|fatto la compulsione)"
+                          r"|senza (?:fare )?(?:la |le )?compulsion[ei])\b", re.IGNORECASE)
+_compulsion_done_re = re.compile(r"(?<!non )(?<!ce )\b(l'ho fatt[ao]|ho controllato|ho fatto la compulsione)\b", re.IGNORECASE)
+_bare_no_re = re.compile(r"\bno\b", re.IGNORECASE)
+
+
+def _erp_state(state):
+    erp = state.setdefault('erp', {})
+    if not erp.get('user_id'):
+        # Senza identificativo (es. load test) le prove restano legate a questa conversazione
+        erp['user_id'] = state.get('user_id') or f"conv-{time.time_ns()}"
+    return erp
+
+
+def _parse_hierarchy_items(user_msg):
+    items = []
+    for line in re.split(r'[\n;]+', user_msg):
+        match = _suds_line_re.match(line)
+        if match and int(match.group('suds')) <= 100:
+            items.append({'text': match.group('text').strip(' .'), 'suds': int(match.group('suds'))})
+    return items
+
+
+def _resisted(user_msg):
+    """True se l'utente è riuscito a non fare la compulsione (in assenza di indicazioni: sì)."""
+    text = user_msg.replace('\u2019', "'")
+    if _failed_re.search(text):
+        return False
+    if _resisted_re.search(text):
+        return True
+    return not (_compulsion_done_re.search(text) or _bare_no_re.search(text))
+
+
+def _suds_values(user_msg):
+    """Valori SUDS (0-100) nel messaggio, esclusi i minuti."""
+    text = _minutes_re.sub(' ', user_msg)
+    return [int(n) for n in _number_re.findall(text) if int(n) <= 100]
+
+
+def _format_hierarchy(hierarchy):
+    ranked = sorted(range(len(hierarchy)), key=lambda i: hierarchy[i]['suds'])
+    return "\n".join(f"{position}. {hierarchy[i]['text']} (SUDS {hierarchy[i]['suds']})"
+                     for position, i in enumerate(ranked, start=1))
+
+
+def _next_step_text(hierarchy, analysis):
+    item = analysis['next_item']
+    if item is None:
+        return ("Hai superato tutti i gradini della tua gerarchia: il picco d'ansia è rimasto sotto "
+                f"{ERP_MASTERY_SUDS} senza compulsioni. È un risultato importante! Possiamo aggiungere nuove situazioni o consolidare quelle fatte.")
+    text = hierarchy[item]['text']
+    reason = analysis['next_reason']
+    if reason == 'repeat':
+        intro = f"Ti propongo di ripetere la stessa esposizione: \"{text}\"."
+    elif reason == 'next':
+        intro = f"Puoi salire di un gradino: \"{text}\" (SUDS previsto {hierarchy[item]['suds']})."
+    elif reason == 'resume':
+        intro = f"Riprendiamo dal gradino \"{text}\"."
+    else:
+        intro = f"Iniziamo dal gradino più basso: \"{text}\" (SUDS previsto {hierarchy[item]['suds']})."
+    return (f"{intro}\n\nPrima di iniziare, quanto è alto il tuo disagio adesso, da 0 a 100 (SUDS)? "
+            "Se preferisci un'esposizione immaginativa, scrivi \"immaginativa\".")
+
+
+def _trial_summary(record, hierarchy, analysis):
+    item = int(record['item'])
+    per_item = analysis['per_item']
+    peak, post = int(record['peak']), int(record['post'])
+    lines = [f"Prova registrata: picco {peak}, fine {post}"
+             f" (abituazione {analysis['habituation'][-1] * 100:.0f}%)."]
+    if per_item['count'][item] > 1:
+        slope = per_item['slope'][item]
+        trend = "sta scendendo" if slope < 0 else "non sta ancora scendendo"
+        lines.append(f"Su \"{hierarchy[item]['text']}\" hai fatto {per_item['count'][item]} prove: "
+                     f"il picco {trend} ({slope:+.1f} punti a prova).")
+    if (analysis['session'] == analysis['session'][-1]).sum() > 1:
+        lines.append(f"In questa seduta, in media, l'ansia è scesa di {analysis['within_session'][-1]:.0f} punti "
+                     "dal picco alla fine di ogni prova.")
+    between = per_item['between_session'][item]
+    if not np.isnan(between):
+        lines.append(f"Rispetto alla seduta precedente, il picco su questo gradino è "
+                     f"{'sceso' if between > 0 else 'salito'} di {abs(between):.0f} punti.")
+    if not record['resisted']:
+        lines.append("Hai detto di aver fatto la compulsione: capita, e fa parte del percorso. "
+                     "La prossima volta prova a rimandarla anche solo di qualche minuto.")
+    elif per_item['mastered'][item]:
+        lines.append(f"Il picco è rimasto sotto {ERP_MASTERY_SUDS} per {ERP_MASTERY_TRIALS} prove di fila "
+                     "senza compulsioni: questo gradino è superato!")
+    return " ".join(lines)
+
 
 def handle(user_msg, current_state):
     """
     Gestisce la logica per le fasi ERP.
-    ATTENZIONE: Logica non ancora implementata.
+
+    Args:
+        user_msg (str): Il messaggio dell'utente.
+        current_state (dict): Lo stato attuale (copia mutabile).
+
+    Returns:
+        tuple: (str, dict) -> (risposta_del_bot, nuovo_stato)
     """
     new_state = current_state.copy()
     current_phase = new_state.get('phase', 'UNKNOWN')
-    log_message(f"ERP Logic: Ricevuto messaggio per fase '{current_phase}' - LOGICA NON IMPLEMENTATA.")
+    erp = _erp_state(new_state)
+    user_id = erp['user_id']
+    msg_lower = user_msg.lower().strip()
+    log_message(f"ERP Logic: Fase '{current_phase}'.")
+
+    hierarchy = exposure_log.load_hierarchy(user_id)
+
+    if current_phase == 'ERP_INTRO':
+        if hierarchy:
+            analysis = exposure_log.analyze(exposure_log.load_trials(user_id), hierarchy)
+            new_state['phase'] = 'ERP_IN_VIVO_PRE'
+            return (f"Bentornato all'esposizione. Questa è la tua gerarchia:\n\n{_format_hierarchy(hierarchy)}\n\n"
+                    + _next_step_text(hierarchy, analysis)), new_state
+        new_state['phase'] = 'ERP_BUILD_HIERARCHY'
+        return ("Nell'Esposizione con Prevenzione della Risposta affronti gradualmente le situazioni che "
+                "attivano il DOC, senza mettere in atto la compulsione, finché l'ansia non scende da sola.\n\n"
+                "Costruiamo la tua gerarchia: scrivimi alcune situazioni che temi, una per riga, ciascuna con "
+                "quanto disagio ti darebbe da 0 a 100 (SUDS). Ad esempio:\n"
+                "toccare la maniglia di un bagno pubblico - 60\n\n"
+                "Quando hai finito scrivi \"fatto\"."), new_state
+
+    if current_phase == 'ERP_BUILD_HIERARCHY':
+        new_items = _parse_hierarchy_items(user_msg)
+        if new_items:
+            hierarchy = hierarchy + new_items
+            exposure_log.save_hierarchy(user_id, hierarchy)
+            return (f"Aggiunto. La gerarchia finora:\n\n{_format_hierarchy(hierarchy)}\n\n"
+                    "Vuoi aggiungere altre situazioni? Se è completa, scrivi \"fatto\"."), new_state
+        if hierarchy and any(word in msg_lower for word in HIERARCHY_DONE_WORDS + CONFERME):
+            analysis = exposure_log.analyze(exposure_log.load_trials(user_id), hierarchy)
+            new_state['phase'] = 'ERP_IN_VIVO_PRE'
+            return f"Ottimo, la gerarchia è pronta.\n\n{_next_step_text(hierarchy, analysis)}", new_state
+        return ("Non ho trovato situazioni con un punteggio. Scrivile una per riga con il SUDS da 0 a 100, "
+                "ad esempio: \"lasciare il gas senza ricontrollare - 70\"."), new_state
 
-    # TODO: Implementare la logica per le fasi:
-    # - ERP_INTRO
-    # - ERP_BUILD_HIERARCHY
-    # - ERP_IN_VIVO_PRE / ERP_IN_VIVO_POST
-    # - ERP_IMAGINAL
-    # - etc.
+    if current_phase in ('ERP_IN_VIVO_PRE', 'ERP_IMAGINAL'):
+        mode = exposure_log.MODE_IMAGINAL if current_phase == 'ERP_IMAGINAL' else exposure_log.MODE_IN_VIVO
+        if 'immagin' in msg_lower:
+            mode = exposure_log.MODE_IMAGINAL
+            new_state['phase'] = 'ERP_IMAGINAL'
+        values = _suds_values(user_msg)
+        analysis = exposure_log.analyze(exposure_log.load_trials(user_id), hierarchy)
+        if analysis['next_item'] is None and hierarchy:
+            return _next_step_text(hierarchy, analysis), new_state
+        if not hierarchy:
+            new_state['phase'] = 'ERP_BUILD_HIERARCHY'
+            return "Prima di iniziare serve la gerarchia: scrivimi le situazioni temute con il SUDS da 0 a 100.", new_state
+        if not values:
+            return "Dimmi quanto è alto il tuo disagio adesso, con un numero da 0 a 100.", new_state
+        item = analysis['next_item']
+        erp['pending'] = {'item': item, 'pre': values[0], 'start': time.time(), 'mode': mode}
+        new_state['phase'] = 'ERP_IN_VIVO_POST'
+        task = (f"Immagina nel dettaglio la situazione \"{hierarchy[item]['text']}\", come se stesse succedendo ora"
+                if mode == exposure_log.MODE_IMAGINAL
+                else f"Ora affronta la situazione \"{hierarchy[item]['text']}\"")
+        return (f"{task}, senza fare la compulsione. Resta nella situazione finché l'ansia non cala.\n\n"
+                "Quando hai finito scrivimi il SUDS di picco e quello finale (es. \"picco 70, fine 30\"), "
+                "quanti minuti è durata e se sei riuscito a non fare la compulsione."), new_state
 
-    # Risposta placeholder
-    bot_response = f"Siamo nella fase ERP ('{current_phase}'), ma questa parte non è ancora stata sviluppata nel dettaglio. Cosa vorresti fare?"
+    if current_phase == 'ERP_IN_VIVO_POST':
+        pending = erp.get('pending')
+        if not pending:
+            new_state['phase'] = 'ERP_IN_VIVO_PRE'
+            return "Non ho una prova in corso. Quanto è alto il tuo disagio adesso, da 0 a 100?", new_state
+        values = _suds_values(user_msg)
+        if len(values) < 2:
+            return ("Mi servono due numeri da 0 a 100: il SUDS di picco e quello alla fine "
+                    "(es. \"picco 70, fine 30\")."), new_state
+        peak, post = max(values[0], pending['pre']), values[1]
+        minutes = _minutes_re.search(user_msg)
+        duration = (float(minutes.group(1).replace(',', '.')) * 60 if minutes
+                    else time.time() - pending['start'])
+        resisted = _resisted(user_msg)
+        record = exposure_log.append_trial(user_id, pending['item'], pending['pre'], peak, post,
+                                           duration, resisted, pending['mode'], ts=pending['start'])
+        erp.pop('pending', None)
+        analysis = exposure_log.analyze(exposure_log.load_trials(user_id), hierarchy)
+        new_state['phase'] = 'ERP_IN_VIVO_PRE'
+        log_message(f"ERP Logic: Prova registrata (gradino {pending['item']}, picco {peak}, fine {post}, resistito {resisted}).")
+        return f"{_trial_summary(record, hierarchy, analysis)}\n\n{_next_step_text(hierarchy, analysis)}", new_state
 
-    return bot_response, new_state
+    log_message(f"ERP Logic: WARN - Fase '{current_phase}' non gestita, ritorno a ERP_INTRO.")
+    new_state['phase'] = 'ERP_INTRO'
+    return "Riprendiamo il lavoro sull'esposizione. Scrivimi quando sei pronto.", new_state
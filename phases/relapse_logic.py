@@ -1,7 +1,6 @@
 # phases/relapse_logic.py (Struttura Modulare a Fasi)
 # Placeholder per la logica delle fasi di Prevenzione Ricadute.
 
-import streamlit as st
 from utils import log_message
 # Importa altre dipendenze necessarie
 
@@ -19,6 +18,8 @@ def handle(user_msg, current_state):
     # - RELAPSE_TRIGGERS
     # - RELAPSE_PLAN
     # - etc.
+    # Per confrontare un nuovo episodio con i cicli passati dell'utente:
+    # cycle_index.recall(new_state['user_id'], schema) -> cicli simili e trigger ricorrenti.
 
     # Risposta placeholder
     bot_response = f"Siamo nella fase di Prevenzione Ricadute ('{current_phase}'), ma questa parte non è ancora stata sviluppata nel dettaglio. Cosa vorresti fare?"
@@ -1,30 +1,150 @@
 # phases/restructuring_logic.py (Struttura Modulare a Fasi)
-# Placeholder per la logica delle fasi di Ristrutturazione Cognitiva.
+# Logica delle fasi di Ristrutturazione Cognitiva (secondo processo ricorsivo).
+# - RESTRUCTURING_INTRO: spiega la ristrutturazione e propone come pensiero "caldo" la
+#   Seconda Valutazione (SV2) dello schema confermato.
+# - RESTRUCTURING_IDENTIFY_HOT: l'utente conferma la SV2 o scrive il pensiero con parole sue;
+#   il classificatore locale (distortion_classifier.py) ne riconosce la valutazione
+#   disfunzionale, passando all'LLM solo se incerto.
+# - RESTRUCTURING_CHALLENGE: domande di messa in discussione specifiche della valutazione.
+# - RESTRUCTURING_ALTERNATIVE: l'utente riformula la valutazione; si propone poi l'ERP.
+# Le risposte sono scriptate: al più una chiamata LLM (classificazione incerta) per ciclo.
 
-import streamlit as st
 from utils import log_message
-# Importa altre dipendenze necessarie (llm_interface, rag_utils, config, etc.)
+from config import CONFERME, NEGAZIONI_O_DUBBI
+import distortion_classifier
+import speculation
+
+# Domande generiche quando la valutazione non è stata riconosciuta
+GENERIC_CHALLENGE_QUESTIONS = [
+    "Quali prove hai che questo pensiero sia vero? E quali prove vanno nella direzione opposta?",
+    "Cosa diresti a un amico che avesse lo stesso pensiero nella tua situazione?",
+    "Se guardassi la situazione tra qualche mese, che peso daresti a questo pensiero?",
+]
+
+
+def _is_confirmation(msg_lower):
+    """
+    True solo se l'intero messaggio è una conferma breve ("sì", "va bene", "sì, certo"): un pensiero
+    scritto con parole proprie può contenere "si" o "giusto" senza essere una conferma.
+    """
+    words = msg_lower.replace(',', ' ').replace('.', ' ').replace('!', ' ').split()
+    if not words or any(word in NEGAZIONI_O_DUBBI for word in words):
+        return False
+    cleaned = " ".join(words)
+    return cleaned in CONFERME or (len(words) <= 3 and all(word in CONFERME for word in words))
+
+
+def _default_hot_thought(schema):
+    """Pensiero proposto come "caldo": la Seconda Valutazione, o l'ossessione se manca."""
+    return schema.get('sv2') or schema.get('pv1')
+
+
+def _classification_key(text):
+    return speculation.asset_key('distortion', text)
+
+
+def _challenge_questions(restructuring):
+    label = distortion_classifier.get_labels().get(restructuring.get('distortion'))
+    return label['challenge_questions'] if label else GENERIC_CHALLENGE_QUESTIONS
+
 
 def handle(user_msg, current_state):
     """
     Gestisce la logica per le fasi di Ristrutturazione Cognitiva.
-    ATTENZIONE: Logica non ancora implementata.
+
+    Args:
+        user_msg (str): Il messaggio dell'utente.
+        current_state (dict): Lo stato attuale (copia mutabile).
+
+    Returns:
+        tuple: (str, dict) -> (risposta_del_bot, nuovo_stato)
     """
     new_state = current_state.copy()
     current_phase = new_state.get('phase', 'UNKNOWN')
-    log_message(f"Restructuring Logic: Ricevuto messaggio per fase '{current_phase}' - LOGICA NON IMPLEMENTATA.")
+    schema = new_state.get('schema') or {}
+    restructuring = dict(new_state.get('restructuring') or {})
+    msg_lower = user_msg.lower().strip()
+    log_message(f"Restructuring Logic: Fase '{current_phase}'.")
+
+    if current_phase == 'RESTRUCTURING_INTRO':
+        hot_thought = _default_hot_thought(schema)
+        if not _is_confirmation(msg_lower):
+            return ("Va bene, prenditi il tempo che ti serve. Quando vuoi iniziare la Ristrutturazione "
+                    "Cognitiva scrivimi \"sì\"."), new_state
+        new_state['phase'] = 'RESTRUCTURING_IDENTIFY_HOT'
+        intro = ("Nella Ristrutturazione Cognitiva non cerchiamo di scacciare l'ossessione, ma di guardare "
+                 "da vicino il significato che le dai: è questa valutazione a rendere il pensiero così "
+                 "angosciante e a spingerti verso la compulsione.")
+        if hot_thought:
+            return (f"{intro}\n\nNel tuo schema hai descritto questa valutazione:\n\n\"{hot_thought}\"\n\n"
+                    "È questo il pensiero che ti pesa di più? Rispondi \"sì\", oppure scrivilo con parole tue."), new_state
+        return f"{intro}\n\nQual è il pensiero che ti pesa di più quando arriva l'ossessione?", new_state
 
-    # TODO: Implementare la logica per le fasi:
-    # - RESTRUCTURING_INTRO
-    # - RESTRUCTURING_IDENTIFY_HOT
-    # - RESTRUCTURING_CHALLENGE
-    # - etc.
+    if current_phase == 'RESTRUCTURING_IDENTIFY_HOT':
+        default_thought = _default_hot_thought(schema)
+        hot_thought = default_thought if default_thought and _is_confirmation(msg_lower) else user_msg.strip()
+        result = speculation.take(_classification_key(hot_thought))
+        if result is None:
+            result = distortion_classifier.classify(hot_thought)
+        label = distortion_classifier.get_labels().get(result['label']) if result else None
+        new_state['restructuring'] = restructuring = {
+            'hot_thought': hot_thought,
+            'distortion': result['label'] if label else None,
+            'confidence': result['confidence'] if label else None,
+            'source': result['source'] if label else None,
+            'q_index': 0,
+            'answers': [],
+        }
+        new_state['phase'] = 'RESTRUCTURING_CHALLENGE'
+        log_message(f"Restructuring Logic: Pensiero caldo classificato come '{restructuring['distortion']}' ({restructuring['source']}).")
+        questions = _challenge_questions(restructuring)
+        if label:
+            return (f"In questo pensiero riconosco una valutazione tipica del DOC: **{label['name']}**. "
+                    f"{label['description']}\n\nProviamo a metterla in discussione insieme. {questions[0]}"), new_state
+        return f"Proviamo a mettere in discussione questo pensiero insieme. {questions[0]}", new_state
 
-    # Risposta placeholder
-    bot_response = f"Siamo nella fase di Ristrutturazione Cognitiva ('{current_phase}'), ma questa parte non è ancora stata sviluppata nel dettaglio. Cosa vorresti fare?"
+    if current_phase == 'RESTRUCTURING_CHALLENGE':
+        questions = _challenge_questions(restructuring)
+        restructuring['answers'] = list(restructuring.get('answers') or []) + [user_msg.strip()]
+        restructuring['q_index'] = q_index = restructuring.get('q_index', 0) + 1
+        new_state['restructuring'] = restructuring
+        if q_index < len(questions):
+            # Solo classificazione locale: nessuna chiamata LLM per le risposte alle domande
+            note = ""
+            result = distortion_classifier.classify(user_msg, allow_llm=False)
+            if result and result['source'] == 'local' and result['label'] != restructuring.get('distortion'):
+                note = (f"Nella tua risposta noto anche un po' di "
+                        f"**{distortion_classifier.get_labels()[result['label']]['name'].lower()}**. ")
+            return f"Grazie. {note}{questions[q_index]}", new_state
+        new_state['phase'] = 'RESTRUCTURING_ALTERNATIVE'
+        return (f"Hai fatto un buon lavoro. Ripensando al pensiero iniziale:\n\n\"{restructuring.get('hot_thought')}\"\n\n"
+                "come lo riformuleresti ora, in modo più realistico ed equilibrato?"), new_state
 
-    # Esempio di possibile transizione (da adattare)
-    # new_state['phase'] = 'NEXT_RESTRUCTURING_PHASE'
+    if current_phase == 'RESTRUCTURING_ALTERNATIVE':
+        restructuring['alternative'] = user_msg.strip()
+        new_state['restructuring'] = restructuring
+        new_state['phase'] = 'ERP_INTRO'
+        log_message("Restructuring Logic: Valutazione alternativa registrata. Transizione proposta a ERP_INTRO.")
+        return (f"Ottimo. La prossima volta che arriva l'ossessione prova a ricordarti questa valutazione:\n\n"
+                f"\"{restructuring['alternative']}\"\n\nIl passo successivo è mettere alla prova queste nuove "
+                "valutazioni nella pratica, con l'**Esposizione con Prevenzione della Risposta**. Ti andrebbe di iniziare?"), new_state
 
-    return bot_response, new_state
+    log_message(f"Restructuring Logic: WARN - Fase '{current_phase}' non gestita, ritorno a RESTRUCTURING_INTRO.")
+    new_state['phase'] = 'RESTRUCTURING_INTRO'
+    return "Riprendiamo la Ristrutturazione Cognitiva. Scrivimi \"sì\" quando sei pronto.", new_state
 
+
+# --- Precalcolo Speculativo del Turno Successivo (vedi speculation.py) ---
+def speculative_assets(state, bot_response):
+    """
+    Classificazione del pensiero caldo proposto (la SV2), pronta se l'utente lo conferma.
+
+    Returns:
+        tuple | None: (fase_prevista, [(chiave, funzione)]), o None se non c'è nulla da preparare.
+    """
+    if state.get('phase') != 'RESTRUCTURING_IDENTIFY_HOT':
+        return None
+    hot_thought = _default_hot_thought(state.get('schema') or {})
+    if not hot_thought:
+        return None
+    return 'RESTRUCTURING_CHALLENGE', [(_classification_key(hot_thought), lambda: distortion_classifier.classify(hot_thought))]
@@ -0,0 +1,156 @@
+# phrasing_pool.py (Struttura Modulare a Fasi)
+# Pool di formulazioni pre-generate (e revisionate) per le transizioni di fase scriptate.
+# Molti llm_task_prompt di assessment_logic sono domande fisse (es. l'invito a raccontare
+# un esempio): invece di una chiamata LLM con tutta la history solo per riformularle,
+# il turno risponde localmente scegliendo una variante da phrasing_pool.json e
+# riempiendo i segnaposto ({pv1}, {ts1}, ...) con i valori dello schema.
+# L'LLM resta il fallback quando il contesto lo richiede (l'utente ha fatto una domanda,
+# manca un valore, la transizione non è nel pool).
+#
+# Le varianti si generano offline e si revisionano a mano:
+#   python phrasing_pool.py generate [varianti_per_transizione]
+# aggiunge a phrasing_pool.json nuove varianti con "reviewed": false; solo quelle
+# segnate "reviewed": true vengono usate.
+
+import json
+import os
+import random
+import string
+import threading
+
+import metrics
+from utils import log_message
+from config import PHRASING_POOL_ENABLED, PHRASING_POOL_FILE, PHRASING_SLOT_MAX_CHARS
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _placeholders(text):
+    return {field for _, field, _, _ in string.Formatter().parse(text) if field}
+
+
+def _load_pool(path=PHRASING_POOL_FILE):
+    """Legge il pool e tiene, per ogni transizione, solo le varianti revisionate e coerenti con i suoi slot."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        log_message(f"Phrasing Pool: WARN - Pool '{path}' non disponibile ({e}). Userò sempre l'LLM.")
+        return {}
+    pool = {}
+    for key, transition in (data.get('transitions') or {}).items():
+        slots = set(transition.get('slots') or [])
+        variants = []
+        for variant in transition.get('variants') or []:
+            if not variant.get('reviewed'):
+                continue
+            try:
+                unknown = _placeholders(variant['text']) - slots
+            except (KeyError, ValueError) as e:
+                log_message(f"Phrasing Pool: WARN - Variante non valida per '{key}' ({e}), ignorata.")
+                continue
+            if unknown:
+                log_message(f"Phrasing Pool: WARN - Variante per '{key}' con segnaposto sconosciuti {sorted(unknown)}, ignorata.")
+                continue
+            variants.append(variant['text'])
+        if variants:
+            pool[key] = {'slots': slots, 'variants': variants}
+    log_message(f"Phrasing Pool: {sum(len(t['variants']) for t in pool.values())} varianti revisionate per {len(pool)} transizioni.")
+    return pool
+
+
+def get_pool():
+    """Pool caricato (una volta per processo)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _load_pool()
+        return _pool
+
+
+def _slot_value(value):
+    text = str(value).strip()
+    if len(text) > PHRASING_SLOT_MAX_CHARS:
+        text = text[:PHRASING_SLOT_MAX_CHARS].rstrip() + "..."
+    return text
+
+
+def pick_phrasing(key, slots=None, user_msg=""):
+    """
+    Restituisce una formulazione pronta per la transizione 'key', o None se serve l'LLM.
+
+    Args:
+        key (str): Chiave della transizione in phrasing_pool.json.
+        slots (dict, optional): Valori dei segnaposto (es. {'pv1': ...}).
+        user_msg (str, optional): Messaggio dell'utente del turno; se contiene una domanda
+            la risposta va contestualizzata e si usa l'LLM.
+
+    Returns:
+        str | None: Il testo con i segnaposto riempiti, oppure None.
+    """
+    if not PHRASING_POOL_ENABLED:
+        return None
+    if '?' in (user_msg or ''):
+        metrics.increment('phrasing_pool.llm_fallback.user_question')
+        return None
+    transition = get_pool().get(key)
+    if transition is None:
+        metrics.increment('phrasing_pool.llm_fallback.missing_transition')
+        return None
+    slots = slots or {}
+    if any(not slots.get(slot) for slot in transition['slots']):
+        metrics.increment('phrasing_pool.llm_fallback.missing_slot')
+        return None
+    text = random.choice(transition['variants']).format(
+        **{slot: _slot_value(slots[slot]) for slot in transition['slots']}
+    )
+    metrics.increment('phrasing_pool.hits')
+    log_message(f"Phrasing Pool: Risposta locale per la transizione '{key}' (nessuna chiamata LLM).")
+    return text
+
+
+def generate_variants(count=3, path=PHRASING_POOL_FILE):
+    """
+    Genera offline 'count' nuove varianti per ogni transizione (task 'user_reply') e le
+    aggiunge al pool con "reviewed": false, per la revisione manuale.
+    """
+    from llm_interface import generate_response
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    added = 0
+    for key, transition in data.get('transitions', {}).items():
+        slots = transition.get('slots') or []
+        for _ in range(count):
+            prompt = f"""Riformula il seguente messaggio di un assistente empatico per il supporto al DOC (TCC).
+Rispondi in ITALIANO con SOLO il messaggio riformulato: tono empatico, chiaro, conciso, UNA sola domanda.
+Non usare sigle (EC, PV1 ecc.). Mantieni ESATTAMENTE i segnaposto tra parentesi graffe ({', '.join('{' + s + '}' for s in slots) or 'nessuno'}).
+
+MESSAGGIO: {transition['script']}"""
+            text = generate_response(prompt=prompt, history=[], task='user_reply').strip()
+            try:
+                valid = _placeholders(text) == set(slots)
+            except ValueError:
+                valid = False
+            if not valid:
+                log_message(f"Phrasing Pool: Variante generata per '{key}' scartata (segnaposto non conformi): {text[:80]}...")
+                continue
+            transition.setdefault('variants', []).append({'text': text, 'reviewed': False})
+            added += 1
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    log_message(f"Phrasing Pool: {added} nuove varianti da revisionare aggiunte a '{path}'.")
+    return added
+
+
+if __name__ == "__main__":
+    # Uso: GOOGLE_API_KEY=... python phrasing_pool.py generate [varianti_per_transizione]
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "generate":
+        import google.generativeai as genai
+        genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+        generate_variants(int(sys.argv[2]) if len(sys.argv) > 2 else 3)
+    else:
+        print("Uso: python phrasing_pool.py generate [varianti_per_transizione]")
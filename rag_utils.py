@@ -1,169 +1,991 @@
 # rag_utils.py (Struttura Modulare a Fasi)
-# Questo file rimane invariato rispetto alla versione precedente (ibrida).
 # Gestisce il caricamento e la ricerca negli indici RAG (globale e per step).
+# Gli indici sono risorse condivise dal processo (non copiate in ogni sessione) e
+# vengono caricati in un thread di background, fuori dal percorso del primo rendering.
+# faiss, numpy e google.generativeai sono importati solo quando servono.
+#
+# Manifest e hot reload:
+# Il file RAG_MANIFEST_FILENAME descrive ogni coppia indice/mappa (modello di embedding,
+# dimensione, numero di chunk, hash SHA-256, data di build) ed è validato al caricamento.
+# Un watcher controlla periodicamente il manifest: quando cambia, costruisce in background
+# una nuova "generazione" di indici e la sostituisce in modo atomico a quella corrente.
+# Le ricerche già in corso mantengono il riferimento alla generazione precedente.
+# Per aggiornare i contenuti: scrivere i nuovi file indice/mappa e POI il nuovo manifest.
+#
+# Indice gerarchico (opzionale, HIERARCHY_INDEX_KEY nel manifest):
+# i riassunti dei capitoli e delle sezioni del manuale, con i loro embedding, formano un
+# livello grossolano. search_hierarchical_rag() sceglie prima i capitoli e poi le sezioni
+# più vicini alla query e cerca i chunk solo in quelle sezioni, così costo della ricerca e
+# dimensione del contesto restano quasi costanti al crescere del corpus.
+# Si genera offline con: python rag_utils.py build-hierarchy (riscrive anche il manifest).
+#
+# Knowledge base per namespace (multi-tenant, config.RAG_NAMESPACES):
+# ogni namespace (clinica, edizione del manuale) ha la propria cartella con indici, mappe e
+# manifest ed è scelto per sessione; il turno lo attiva con knowledge_base_scope() (come la
+# deadline, è visibile anche nei thread avviati con copy_context()) e tutte le ricerche e la
+# mappa fase -> capitolo (phase_chapter_key) usano quel namespace.
+# - I namespace sono caricati al primo uso (ognuno con il proprio watcher del manifest).
+# - Memoria condivisa: gli indici assenti dalla cartella del namespace sono presi dal
+#   namespace 'base' (stessi oggetti, non copie) e le coppie indice/mappa identiche (stessi
+#   hash nel manifest) già caricate da un altro namespace vengono riusate.
+# - Quota per namespace: una generazione i cui indici propri superano la quota non viene
+#   caricata. Oltre RAG_NAMESPACES_MAX_MEMORY_MB in totale i namespace meno usati di recente
+#   vengono scaricati (e ricaricati al primo uso successivo).
 
-import streamlit as st
-import faiss
-import numpy as np
-import pickle
+import contextvars
+import datetime
 import glob
+import hashlib
+import json
 import os
-import re
+import threading
 import time
-import google.generativeai as genai
 import traceback
-from utils import log_message
+from contextlib import contextmanager
+import metrics
+import client_pool
+import speculation
+from batching import MicroBatcher
+from utils import log_message, get_session_value, show_ui_message
+from deadline import call_timeout, budget_exhausted, record_degradation
+from config import (
+    EMBEDDING_MODEL_NAME, RAG_LOAD_WAIT_SECONDS, RAG_DATA_DIR, RAG_DEFAULT_NAMESPACE, RAG_NAMESPACES,
+    RAG_NAMESPACE_MEMORY_QUOTA_MB, RAG_NAMESPACES_MAX_MEMORY_MB,
+    RAG_MANIFEST_FILENAME, RAG_RELOAD_POLL_SECONDS, RAG_ROUTE_CHAPTERS, RAG_ROUTE_SECTIONS,
+    RAG_CHUNK_TOP_K, RAG_CONTEXT_CHUNK_MAX_CHARS, RAG_SUMMARY_INPUT_MAX_CHARS, PHASE_TO_CHAPTER_KEY_MAP,
+    RAG_BATCHING_ENABLED, EMBED_BATCH_WINDOW_MS, EMBED_BATCH_MAX_SIZE, SEARCH_BATCH_WINDOW_MS, SEARCH_BATCH_MAX_SIZE
+)
 
-def load_rag_indexes():
-    """Carica tutti gli indici FAISS (step e globale) e le mappe Pickle."""
-    log_message("5. Caricamento Indici e Mappe RAG...")
+GLOBAL_INDEX_KEY = "global_workbook"
+HIERARCHY_INDEX_KEY = "rag_hierarchy"
+MANIFEST_VERSION = 1
+
+# --- Risorse RAG condivise dal processo (una knowledge base per namespace) ---
+_rag_lock = threading.Lock()
+_rag_watcher_thread = None
+_current_namespace = contextvars.ContextVar('rag_namespace', default=None)
+
+class _KnowledgeBase:
+    """Caricamento e generazione corrente degli indici di un namespace."""
+
+    def __init__(self, namespace, settings):
+        self.namespace = namespace
+        self.data_dir = settings.get('data_dir', RAG_DATA_DIR)
+        self.base = settings.get('base')
+        self.memory_quota_bytes = int(settings.get('memory_quota_mb', RAG_NAMESPACE_MEMORY_QUOTA_MB) * 1024 * 1024)
+        self.ready = threading.Event()
+        self.loader_thread = None
+        self.rejected_manifest_signature = None # Manifest già scartato dal watcher (non si ritenta)
+        self.last_used = time.monotonic()
+        # Generazione corrente (dict): global_index, global_map, step_indexes, step_maps,
+        # success, warnings, generation, manifest_signature, ... Sostituita sempre per intero.
+        self.resources = None
+
+_knowledge_bases = {} # namespace -> _KnowledgeBase (creata al primo uso)
+
+@contextmanager
+def knowledge_base_scope(namespace):
+    """Attiva il namespace (None = RAG_DEFAULT_NAMESPACE) per le ricerche eseguite nel blocco."""
+    token = _current_namespace.set(namespace)
+    try:
+        yield namespace
+    finally:
+        _current_namespace.reset(token)
+
+def current_namespace():
+    """Il namespace della knowledge base attivo (quello del turno in corso o il default)."""
+    return _current_namespace.get() or RAG_DEFAULT_NAMESPACE
+
+def is_known_namespace(namespace):
+    return namespace in RAG_NAMESPACES
+
+def phase_chapter_key(phase, namespace=None):
+    """Chiave dell'indice del capitolo della fase: PHASE_TO_CHAPTER_KEY_MAP con le sostituzioni del namespace."""
+    overrides = (RAG_NAMESPACES.get(namespace or current_namespace()) or {}).get('phase_chapter_map') or {}
+    if phase in overrides:
+        return overrides[phase]
+    return PHASE_TO_CHAPTER_KEY_MAP.get(phase)
+
+def _get_knowledge_base(namespace=None):
+    """La knowledge base del namespace (None se il namespace non è configurato)."""
+    namespace = namespace or current_namespace()
+    settings = RAG_NAMESPACES.get(namespace)
+    if settings is None:
+        log_message(f"WARN: Namespace RAG '{namespace}' non configurato (vedi config.RAG_NAMESPACES).")
+        return None
+    with _rag_lock:
+        knowledge_base = _knowledge_bases.get(namespace)
+        if knowledge_base is None:
+            knowledge_base = _knowledge_bases[namespace] = _KnowledgeBase(namespace, settings)
+        knowledge_base.last_used = time.monotonic()
+    return knowledge_base
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _manifest_path(data_dir):
+    return os.path.join(data_dir, RAG_MANIFEST_FILENAME)
+
+def _manifest_signature(data_dir):
+    """Firma (mtime, dimensione) del manifest, usata dal watcher per rilevare modifiche."""
+    try:
+        stat = os.stat(_manifest_path(data_dir))
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def _discover_legacy_entries(data_dir):
+    """Coppie indice/mappa trovate per nome file (comportamento senza manifest)."""
+    entries = {GLOBAL_INDEX_KEY: {'index_file': f"{GLOBAL_INDEX_KEY}.index", 'map_file': f"{GLOBAL_INDEX_KEY}_map.pkl"}}
+    for index_filepath in sorted(glob.glob(os.path.join(data_dir, "step_*.index"))):
+        step_key = os.path.basename(index_filepath).replace(".index", "")
+        entries[step_key] = {'index_file': f"{step_key}.index", 'map_file': f"{step_key}_map.pkl"}
+    if os.path.exists(os.path.join(data_dir, f"{HIERARCHY_INDEX_KEY}.index")):
+        entries[HIERARCHY_INDEX_KEY] = {'index_file': f"{HIERARCHY_INDEX_KEY}.index", 'map_file': f"{HIERARCHY_INDEX_KEY}_map.pkl"}
+    return entries
+
+def build_manifest(data_dir=RAG_DATA_DIR, embedding_model=EMBEDDING_MODEL_NAME):
+    """
+    Genera (e scrive in modo atomico) il manifest per le coppie indice/mappa presenti in data_dir.
+    Da eseguire offline dopo aver (ri)costruito gli indici.
+
+    Returns:
+        dict: Il manifest scritto.
+    """
+    import faiss
+    import pickle
+
+    build_time = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    indexes = {}
+    for key, entry in _discover_legacy_entries(data_dir).items():
+        index_path = os.path.join(data_dir, entry['index_file'])
+        map_path = os.path.join(data_dir, entry['map_file'])
+        if not (os.path.exists(index_path) and os.path.exists(map_path)):
+            log_message(f"WARN: build_manifest - file mancanti per '{key}', voce esclusa.")
+            continue
+        index = faiss.read_index(index_path)
+        with open(map_path, 'rb') as f:
+            id_map = pickle.load(f)
+        indexes[key] = {
+            'index_file': entry['index_file'],
+            'map_file': entry['map_file'],
+            'embedding_model': embedding_model,
+            'dimension': int(index.d),
+            'count': int(index.ntotal),
+            'map_count': len(id_map),
+            'index_sha256': _file_sha256(index_path),
+            'map_sha256': _file_sha256(map_path),
+            'build_time': datetime.datetime.fromtimestamp(os.path.getmtime(index_path), datetime.timezone.utc).isoformat(timespec='seconds'),
+        }
+    manifest = {'manifest_version': MANIFEST_VERSION, 'generation': build_time, 'indexes': indexes}
+    tmp_path = _manifest_path(data_dir) + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, _manifest_path(data_dir)) # Scrittura atomica
+    log_message(f"Manifest RAG scritto: {len(indexes)} indici, generazione '{build_time}'.")
+    return manifest
+
+def _load_manifest(data_dir):
+    """Legge il manifest; restituisce None se assente, solleva ValueError se non valido."""
+    path = _manifest_path(data_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('indexes'), dict):
+        raise ValueError(f"Manifest RAG '{path}' non valido (manca 'indexes').")
+    if manifest.get('manifest_version') != MANIFEST_VERSION:
+        raise ValueError(f"Versione manifest RAG non supportata: {manifest.get('manifest_version')}.")
+    return manifest
+
+def _load_index_pair(data_dir, key, entry, faiss, pickle, shared_pairs=None):
+    """
+    Carica e valida una coppia indice/mappa. Se una coppia con gli stessi hash è già caricata
+    (shared_pairs, da altri namespace) restituisce quella invece di leggerne una copia.
+
+    Returns:
+        tuple: (indice, mappa, condivisa). Solleva ValueError se la coppia non rispetta il manifest.
+    """
+    index_path = os.path.join(data_dir, entry['index_file'])
+    map_path = os.path.join(data_dir, entry['map_file'])
+    if not (os.path.exists(index_path) and os.path.exists(map_path)):
+        raise ValueError(f"File indice ({index_path}) o mappa ({map_path}) mancanti")
+
+    is_manifest_entry = 'index_sha256' in entry
+    if is_manifest_entry:
+        if entry.get('embedding_model') != EMBEDDING_MODEL_NAME:
+            raise ValueError(f"modello embedding '{entry.get('embedding_model')}' diverso da quello configurato '{EMBEDDING_MODEL_NAME}'")
+        if _file_sha256(index_path) != entry['index_sha256'] or _file_sha256(map_path) != entry['map_sha256']:
+            raise ValueError("hash SHA-256 dei file diverso da quello del manifest (file aggiornati senza manifest?)")
+        shared = (shared_pairs or {}).get((entry['index_sha256'], entry['map_sha256']))
+        if shared is not None:
+            return shared[0], shared[1], True
+
+    index = faiss.read_index(index_path)
+    with open(map_path, 'rb') as f:
+        id_map = pickle.load(f)
+
+    if is_manifest_entry:
+        if int(index.d) != int(entry['dimension']):
+            raise ValueError(f"dimensione indice {index.d} diversa dal manifest ({entry['dimension']})")
+        if int(index.ntotal) != int(entry['count']) or len(id_map) != int(entry.get('map_count', entry['count'])):
+            raise ValueError(f"numero di chunk (indice {index.ntotal}, mappa {len(id_map)}) diverso dal manifest ({entry['count']})")
+    if index.ntotal == 0:
+        log_message(f"   WARN: Indice '{key}' caricato ma è vuoto.")
+    return index, id_map, False
+
+def _index_vectors(index, faiss):
+    """(id, vettori) di un indice flat, anche se avvolto in un IndexIDMap."""
+    import numpy as np
+
+    if hasattr(index, 'id_map'):
+        inner = faiss.downcast_index(index.index)
+        return faiss.vector_to_array(index.id_map).astype(np.int64), inner.reconstruct_n(0, inner.ntotal)
+    return np.arange(index.ntotal, dtype=np.int64), index.reconstruct_n(0, index.ntotal)
+
+def _build_hierarchy_routing(hierarchy_index, hierarchy_map, global_index, faiss):
+    """
+    Strutture di instradamento dell'indice gerarchico: vettori dei riassunti, sezioni di
+    ogni capitolo e chunk (id dell'indice globale) di ogni sezione.
+    Solleva ValueError se l'indice gerarchico non corrisponde all'indice globale.
+    """
+    import numpy as np
+
+    if global_index is None:
+        raise ValueError("indice globale non disponibile")
+    if int(hierarchy_index.d) != int(global_index.d):
+        raise ValueError(f"dimensione {hierarchy_index.d} diversa da quella dell'indice globale ({global_index.d})")
+    summary_ids, summary_vectors = _index_vectors(hierarchy_index, faiss)
+    entries = [hierarchy_map[int(i)] for i in summary_ids]
+    chapter_rows = [i for i, entry in enumerate(entries) if entry.get('level') == 'chapter']
+    section_rows = [i for i, entry in enumerate(entries) if entry.get('level') == 'section']
+    chapter_position = {entries[row]['key']: position for position, row in enumerate(chapter_rows)}
+
+    # I chunk delle sezioni sono id dell'indice globale: li converto in righe della matrice dei vettori
+    chunk_ids, chunk_vectors = _index_vectors(global_index, faiss)
+    id_order = np.argsort(chunk_ids)
+    section_chunks = []
+    for row in section_rows:
+        ids = np.asarray(entries[row]['chunk_ids'], dtype=np.int64)
+        positions = np.searchsorted(chunk_ids[id_order], ids)
+        if len(ids) and (positions.max() >= len(chunk_ids) or (chunk_ids[id_order][positions] != ids).any()):
+            raise ValueError("chunk delle sezioni assenti dall'indice globale (indice gerarchico da rigenerare)")
+        section_chunks.append(id_order[positions])
+    return {
+        'entries': entries,
+        'inner_product': hierarchy_index.metric_type == faiss.METRIC_INNER_PRODUCT,
+        'summary_vectors': summary_vectors,
+        'chunk_ids': chunk_ids,
+        'chunk_vectors': chunk_vectors,
+        'chapter_rows': np.asarray(chapter_rows, dtype=np.int64),
+        'section_rows': np.asarray(section_rows, dtype=np.int64),
+        'section_chapter': np.asarray([chapter_position[entries[row]['chapter_key']] for row in section_rows], dtype=np.int64),
+        'section_chunks': section_chunks,
+    }
+
+def _pair_objects(resources, key):
+    """(indice, mappa) della chiave in una generazione, o (None, None)."""
+    if key == GLOBAL_INDEX_KEY:
+        return resources.get('global_index'), resources.get('global_map')
+    if key == HIERARCHY_INDEX_KEY:
+        return resources.get('hierarchy_index'), resources.get('hierarchy_map')
+    return (resources.get('step_indexes') or {}).get(key), (resources.get('step_maps') or {}).get(key)
+
+def _pair_memory(index, id_map, hierarchy=None):
+    """(byte vettori, byte mappa) stimati di una coppia: d * 4 byte + 8 byte di id per vettore, più la mappa."""
+    from session_memory import estimate_size
+    index_bytes = int(index.ntotal) * (int(index.d) * 4 + 8)
+    if hierarchy:
+        index_bytes += hierarchy['summary_vectors'].nbytes + hierarchy['chunk_vectors'].nbytes
+    return index_bytes, estimate_size(id_map)
+
+def _shared_pairs():
+    """Coppie indice/mappa (con hash nel manifest) già caricate dai namespace, per riusarle."""
+    pairs = {}
+    with _rag_lock:
+        generations = [kb.resources for kb in _knowledge_bases.values() if kb.resources]
+    for resources in generations:
+        for key, identity in (resources.get('pair_ids') or {}).items():
+            index, id_map = _pair_objects(resources, key)
+            if identity and index is not None:
+                pairs.setdefault(identity, (index, id_map, resources))
+    return pairs
+
+def _build_generation(data_dir=RAG_DATA_DIR, base_resources=None, memory_quota_bytes=None, shared_pairs=None):
+    """
+    Costruisce una nuova generazione completa di indici e mappe, senza pubblicarla.
+    Non usa st.* (gli avvisi sono registrati nel log e in resources['warnings']).
+
+    Args:
+        data_dir (str): Cartella del namespace.
+        base_resources (dict, optional): Generazione del namespace base: gli indici assenti
+            da data_dir vengono presi da lì (condivisi, non copiati).
+        memory_quota_bytes (int, optional): Memoria massima degli indici propri del namespace.
+        shared_pairs (dict, optional): Coppie già caricate da altri namespace (vedi _shared_pairs).
+    """
+    import faiss
+    import pickle
+
+    warnings = []
     rag_load_success = True
-    st.session_state.global_index = None
-    st.session_state.global_map = {}
-    st.session_state.step_indexes = {}
-    st.session_state.step_maps = {}
+    global_index = None
+    global_map = {}
+    step_indexes = {}
+    step_maps = {}
+    hierarchy_index = None
+    hierarchy_map = {}
+    hierarchy = None
+    pair_ids = {}         # chiave -> (hash indice, hash mappa), per il riuso tra namespace
+    shared_keys = []      # Chiavi riusate da un altro namespace (memoria non a carico del namespace)
+    manifest_signature = _manifest_signature(data_dir)
+
+    try:
+        manifest = _load_manifest(data_dir)
+    except Exception as e:
+        manifest = None
+        warnings.append(f"Manifest RAG non leggibile: {e}"); log_message(f"ERRORE Manifest RAG: {e}"); rag_load_success = False
+
+    if manifest is not None:
+        entries = manifest['indexes']
+        generation = manifest.get('generation', 'N/D')
+        log_message(f"   Manifest RAG trovato: generazione '{generation}', {len(entries)} indici.")
+    else:
+        entries = _discover_legacy_entries(data_dir)
+        generation = 'legacy'
+        log_message(f"WARN: Manifest RAG '{RAG_MANIFEST_FILENAME}' assente: carico i file per nome senza validazione.")
 
-    global_index_filename = "global_workbook.index"
-    global_map_filename = "global_workbook_map.pkl"
+    step_keys = [key for key in entries if key.startswith("step_")]
+    log_message(f"   Trovati {len(step_keys)} indici per gli step.")
+    if not step_keys and base_resources is None:
+         log_message("ATTENZIONE: Nessun indice 'step_*' trovato! La ricerca RAG per step non sarà disponibile.");
 
-    # Carica Globale
-    if os.path.exists(global_index_filename) and os.path.exists(global_map_filename):
+    own_keys = set()
+    for key, entry in entries.items():
+        if base_resources is not None and manifest is None and \
+           not os.path.exists(os.path.join(data_dir, entry['index_file'])):
+            continue # Voce legacy senza file (es. il globale): vale quella del namespace base
+        own_keys.add(key)
         try:
-            st.session_state.global_index = faiss.read_index(global_index_filename)
-            with open(global_map_filename, 'rb') as f:
-                st.session_state.global_map = pickle.load(f)
-            if st.session_state.global_index is not None and st.session_state.global_index.ntotal > 0:
-                 log_message(f"   Indice Globale ({st.session_state.global_index.ntotal} vettori) e Mappa Globale ({len(st.session_state.global_map)} elem.) caricati.")
-            else:
-                 log_message(f"WARN: Indice globale '{global_index_filename}' caricato ma vuoto o corrotto.")
+            index, id_map, shared = _load_index_pair(data_dir, key, entry, faiss, pickle, shared_pairs)
         except Exception as e:
-            st.error(f"Errore durante il caricamento RAG globale: {e}"); log_message(f"ERRORE RAG globale: {e}"); rag_load_success = False
-    else:
-        st.warning(f"File RAG globale non trovato ('{global_index_filename}' o '{global_map_filename}'). La ricerca globale non sarà disponibile."); log_message(f"WARN: File RAG globale non trovato.");
+            if key == GLOBAL_INDEX_KEY:
+                warnings.append(f"RAG globale non disponibile: {e}"); log_message(f"ERRORE RAG globale: {e}")
+            elif key == HIERARCHY_INDEX_KEY:
+                warnings.append(f"RAG gerarchico non disponibile: {e}"); log_message(f"ERRORE RAG gerarchico: {e}")
+            else:
+                warnings.append(f"RAG step '{key}' non disponibile: {e}"); log_message(f"ERRORE caricamento RAG step '{key}': {e}")
+            rag_load_success = False
+            continue
+        if 'index_sha256' in entry:
+            pair_ids[key] = (entry['index_sha256'], entry['map_sha256'])
+        if shared:
+            shared_keys.append(key)
+            log_message(f"     - '{key}' già caricato da un altro namespace: condiviso.")
+        if key == GLOBAL_INDEX_KEY:
+            global_index, global_map = index, id_map
+            log_message(f"   Indice Globale ({index.ntotal} vettori) e Mappa Globale ({len(id_map)} elem.) caricati.")
+        elif key == HIERARCHY_INDEX_KEY:
+            hierarchy_index, hierarchy_map = index, id_map
+        else:
+            step_indexes[key] = index
+            step_maps[key] = id_map
+            log_message(f"     - OK: '{key}' caricato (Indice: {index.ntotal} vettori, Mappa: {len(id_map)} elementi).")
 
-    # Carica Step
-    step_index_files = glob.glob("step_*.index")
-    log_message(f"   Trovati {len(step_index_files)} file indice per gli step.")
-    if not step_index_files:
-         log_message("ATTENZIONE: Nessun file indice 'step_*.index' trovato! La ricerca RAG per step non sarà disponibile.");
+    # Indici non presenti nella cartella del namespace: condivisi con il namespace base
+    if base_resources is not None:
+        inherited = []
+        if global_index is None and GLOBAL_INDEX_KEY not in own_keys and base_resources.get('global_index') is not None:
+            global_index, global_map = base_resources['global_index'], base_resources['global_map']
+            inherited.append(GLOBAL_INDEX_KEY)
+            if hierarchy_index is None and HIERARCHY_INDEX_KEY not in own_keys and base_resources.get('hierarchy'):
+                hierarchy_index, hierarchy_map = base_resources['hierarchy_index'], base_resources['hierarchy_map']
+                hierarchy = base_resources['hierarchy'] # Stesso indice globale: anche l'instradamento è condiviso
+                inherited.append(HIERARCHY_INDEX_KEY)
+        for key, index in (base_resources.get('step_indexes') or {}).items():
+            if key not in own_keys:
+                step_indexes[key] = index
+                step_maps[key] = base_resources['step_maps'][key]
+                inherited.append(key)
+        for key in inherited:
+            if key in (base_resources.get('pair_ids') or {}):
+                pair_ids[key] = base_resources['pair_ids'][key]
+        shared_keys.extend(inherited)
+        log_message(f"   Indici condivisi con il namespace base: {len(inherited)}.")
 
-    for index_filepath in step_index_files:
-        base_name = os.path.basename(index_filepath)
-        step_key = base_name.replace(".index", "")
-        map_filename = f"{step_key}_map.pkl"
-        log_message(f"   Tentativo caricamento RAG step: '{step_key}'")
+    if hierarchy_index is not None and hierarchy is None:
+        try:
+            reusable = (shared_pairs or {}).get(pair_ids.get(HIERARCHY_INDEX_KEY))
+            if reusable and reusable[0] is hierarchy_index and reusable[2].get('global_index') is global_index:
+                hierarchy = reusable[2]['hierarchy'] # Stessa coppia indice gerarchico/globale di un altro namespace
+            else:
+                hierarchy = _build_hierarchy_routing(hierarchy_index, hierarchy_map, global_index, faiss)
+            log_message(f"   Indice gerarchico caricato: {len(hierarchy['chapter_rows'])} capitoli, {len(hierarchy['section_rows'])} sezioni.")
+        except Exception as e:
+            warnings.append(f"RAG gerarchico non disponibile: {e}"); log_message(f"ERRORE RAG gerarchico: {e}")
+            rag_load_success = False
 
-        if os.path.exists(index_filepath) and os.path.exists(map_filename):
-            try:
-                step_index = faiss.read_index(index_filepath)
-                if step_index.ntotal == 0:
-                    log_message(f"   WARN: Indice step '{step_key}' caricato ma è vuoto.")
-                with open(map_filename, 'rb') as f:
-                    step_map = pickle.load(f)
-                st.session_state.step_indexes[step_key] = step_index
-                st.session_state.step_maps[step_key] = step_map
-                log_message(f"     - OK: '{step_key}' caricato (Indice: {step_index.ntotal} vettori, Mappa: {len(step_map)} elementi).")
-            except Exception as e:
-                 st.error(f"Errore caricamento RAG step '{step_key}': {e}"); log_message(f"ERRORE caricamento RAG step '{step_key}': {e}"); rag_load_success = False;
-        else:
-            st.warning(f"File indice ({index_filepath}) o mappa ({map_filename}) mancanti per step '{step_key}'. Questo step RAG non sarà disponibile."); log_message(f"WARN: File mancanti RAG step '{step_key}'.");
+    # Memoria per coppia (id dell'indice, byte vettori, byte mappa) e quota degli indici propri
+    resources = {
+        'global_index': global_index, 'global_map': global_map,
+        'step_indexes': step_indexes, 'step_maps': step_maps,
+        'hierarchy_index': hierarchy_index, 'hierarchy_map': hierarchy_map, 'hierarchy': hierarchy,
+    }
+    pair_memory = {}
+    for key in [GLOBAL_INDEX_KEY, HIERARCHY_INDEX_KEY] + list(step_indexes):
+        index, id_map = _pair_objects(resources, key)
+        if index is not None:
+            pair_memory[key] = (id(index),) + _pair_memory(index, id_map, hierarchy if key == HIERARCHY_INDEX_KEY else None)
+    own_bytes = sum(index_bytes + map_bytes for key, (_, index_bytes, map_bytes) in pair_memory.items() if key not in shared_keys)
+    if memory_quota_bytes is not None and own_bytes > memory_quota_bytes:
+        warnings.append(f"Quota di memoria superata: indici propri {own_bytes / (1024 * 1024):.0f} MB, "
+                        f"quota {memory_quota_bytes / (1024 * 1024):.0f} MB. Indici non caricati.")
+        log_message(f"ERRORE RAG: {warnings[-1]}")
+        global_index, global_map, step_indexes, step_maps = None, {}, {}, {}
+        hierarchy_index, hierarchy_map, hierarchy = None, {}, None
+        pair_ids, shared_keys, pair_memory, own_bytes = {}, [], {}, 0
+        rag_load_success = False
 
     # Verifica finale
-    if not st.session_state.get('global_index') and not st.session_state.get('step_indexes'):
+    if global_index is None and not step_indexes:
         log_message("ERRORE: Nessun indice RAG (né globale né step) caricato con successo.")
-        st.error("Caricamento RAG fallito completamente. La ricerca contesto non funzionerà.")
+        warnings.append("Caricamento RAG fallito completamente. La ricerca contesto non funzionerà.")
         rag_load_success = False
     elif rag_load_success:
-        log_message("   Caricamento RAG completato (almeno parzialmente).")
+        log_message("   Caricamento RAG completato.")
     else:
-        log_message("ERRORE: Caricamento RAG fallito/incompleto a causa di errori critici.")
-        st.warning("Funzionalità RAG potrebbero essere limitate a causa di errori di caricamento.")
+        log_message("ERRORE: Caricamento RAG incompleto: alcuni indici sono stati esclusi.")
+
+    return {
+        'global_index': global_index,
+        'global_map': global_map,
+        'step_indexes': step_indexes,
+        'step_maps': step_maps,
+        'hierarchy_index': hierarchy_index,
+        'hierarchy_map': hierarchy_map,
+        'hierarchy': hierarchy,
+        'success': rag_load_success,
+        'warnings': warnings,
+        'generation': generation,
+        'manifest_signature': manifest_signature,
+        'pair_ids': pair_ids,
+        'shared_keys': shared_keys,
+        'pair_memory': pair_memory,
+        'own_bytes': own_bytes,
+    }
+
+def _base_resources(knowledge_base):
+    """Generazione del namespace base (caricato se serve); None senza base o con basi cicliche."""
+    chain = [knowledge_base.namespace]
+    namespace = knowledge_base.base
+    while namespace:
+        if namespace in chain:
+            log_message(f"ERRORE RAG: Catena di namespace base ciclica per '{knowledge_base.namespace}': {chain + [namespace]}. Base ignorata.")
+            return None
+        chain.append(namespace)
+        namespace = (RAG_NAMESPACES.get(namespace) or {}).get('base')
+    if not knowledge_base.base:
+        return None
+    return wait_for_rag(None, knowledge_base.base)
+
+def _build_namespace_generation(knowledge_base):
+    return _build_generation(knowledge_base.data_dir, _base_resources(knowledge_base),
+                             knowledge_base.memory_quota_bytes, _shared_pairs())
+
+def _publish_generation(knowledge_base, resources):
+    """Sostituisce in modo atomico la generazione corrente del namespace."""
+    with _rag_lock:
+        knowledge_base.resources = resources
+    knowledge_base.ready.set()
+    metrics.increment('rag.generations_published')
+    _enforce_memory_limit(keep=knowledge_base.namespace)
+
+def _unload(knowledge_base):
+    """Scarica il namespace (chiamare con _rag_lock): le ricerche in corso conservano la loro generazione."""
+    knowledge_base.resources = None
+    knowledge_base.ready.clear()
+    knowledge_base.loader_thread = None
+    metrics.increment('rag.namespaces_unloaded')
+    log_message(f"RAG: Namespace '{knowledge_base.namespace}' scaricato (limite di memoria), verrà ricaricato al primo uso.")
+
+def _enforce_memory_limit(keep=None):
+    """Scarica i namespace usati meno di recente finché la memoria RAG totale supera il limite."""
+    limit_bytes = RAG_NAMESPACES_MAX_MEMORY_MB * 1024 * 1024
+    while estimate_rag_memory_bytes()['total_bytes'] > limit_bytes:
+        with _rag_lock:
+            bases = {kb.base for kb in _knowledge_bases.values() if kb.resources is not None}
+            candidates = [kb for kb in _knowledge_bases.values()
+                          if kb.resources is not None and kb.namespace not in (keep, RAG_DEFAULT_NAMESPACE)
+                          and kb.namespace not in bases]
+            if not candidates:
+                return
+            _unload(min(candidates, key=lambda kb: kb.last_used))
 
-    return rag_load_success
+def load_rag_indexes(namespace=None):
+    """
+    Carica tutti gli indici FAISS (step e globale) e le mappe Pickle del namespace e li
+    pubblica come risorse condivise del processo. Può essere eseguita in un thread di background.
+    """
+    knowledge_base = _get_knowledge_base(namespace)
+    if knowledge_base is None:
+        return False
+    log_message(f"5. Caricamento Indici e Mappe RAG (namespace '{knowledge_base.namespace}')...")
+    resources = _build_namespace_generation(knowledge_base)
+    _publish_generation(knowledge_base, resources)
+    return resources['success']
+
+def reload_rag_indexes_if_changed(namespace=None, force=False):
+    """
+    Se il manifest del namespace è cambiato (o force, es. dopo un cambio del namespace base),
+    costruisce la nuova generazione e la pubblica solo se TUTTE le sue coppie indice/mappa
+    sono valide (altrimenti resta quella corrente).
+
+    Returns:
+        bool: True se è stata pubblicata una nuova generazione.
+    """
+    knowledge_base = _get_knowledge_base(namespace)
+    if knowledge_base is None:
+        return False
+    with _rag_lock:
+        current = knowledge_base.resources
+    if current is None:
+        return False # Non caricato (o scaricato): verrà costruito al primo uso
+    signature = _manifest_signature(knowledge_base.data_dir)
+    if not force and (signature is None or signature == knowledge_base.rejected_manifest_signature or
+                      current.get('manifest_signature') == signature):
+        return False
+    log_message(f"RAG Watcher: Manifest del namespace '{knowledge_base.namespace}' modificato, costruisco la nuova generazione in background...")
+    started = time.perf_counter()
+    resources = _build_namespace_generation(knowledge_base)
+    if not resources['success']:
+        metrics.increment('rag.reloads_rejected')
+        log_message(f"RAG Watcher: Nuova generazione '{resources['generation']}' scartata (non valida): {resources['warnings']}. Resta attiva quella corrente.")
+        knowledge_base.rejected_manifest_signature = signature # Non ritenta finché il manifest non cambia di nuovo
+        return False
+    _publish_generation(knowledge_base, resources)
+    log_message(f"RAG Watcher: Generazione '{resources['generation']}' attiva per '{knowledge_base.namespace}' (costruita in {(time.perf_counter() - started) * 1000:.0f} ms).")
+    return True
+
+def _watch_manifest():
+    while True:
+        time.sleep(RAG_RELOAD_POLL_SECONDS)
+        with _rag_lock:
+            loaded = [kb for kb in _knowledge_bases.values() if kb.resources is not None]
+        # Prima i namespace base: chi li usa viene ricostruito sulla nuova generazione
+        reloaded = set()
+        for knowledge_base in sorted(loaded, key=lambda kb: kb.base is not None):
+            try:
+                if reload_rag_indexes_if_changed(knowledge_base.namespace, force=knowledge_base.base in reloaded):
+                    reloaded.add(knowledge_base.namespace)
+            except Exception as e:
+                log_message(f"ERRORE RAG Watcher: {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
+
+def _load_rag_indexes_safely(knowledge_base):
+    started = time.perf_counter()
+    try:
+        load_rag_indexes(knowledge_base.namespace)
+        load_seconds = time.perf_counter() - started
+        metrics.set_gauge(f'rag.load_seconds.{knowledge_base.namespace}', load_seconds)
+        log_message(f"   Caricamento RAG in background del namespace '{knowledge_base.namespace}' completato in {load_seconds * 1000:.0f} ms.")
+    except Exception as e:
+        log_message(f"ERRORE imprevisto nel caricamento RAG in background: {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
+        knowledge_base.ready.set() # Sblocca chi attende: le ricerche restituiranno risultati vuoti
+
+def start_rag_loading(namespace=None):
+    """
+    Avvia (una sola volta per processo e namespace, o di nuovo dopo che il namespace è stato
+    scaricato) il caricamento RAG in un thread di background, più il watcher del manifest.
+    """
+    global _rag_watcher_thread
+    knowledge_base = _get_knowledge_base(namespace)
+    if knowledge_base is None:
+        return False
+    with _rag_lock:
+        if knowledge_base.loader_thread is not None:
+            return False
+        knowledge_base.loader_thread = threading.Thread(target=_load_rag_indexes_safely, args=(knowledge_base,),
+                                                        name=f"rag-loader-{knowledge_base.namespace}", daemon=True)
+        knowledge_base.loader_thread.start()
+        if _rag_watcher_thread is None and RAG_RELOAD_POLL_SECONDS and RAG_RELOAD_POLL_SECONDS > 0:
+            _rag_watcher_thread = threading.Thread(target=_watch_manifest, name="rag-manifest-watcher", daemon=True)
+            _rag_watcher_thread.start()
+    log_message(f"5. Caricamento Indici e Mappe RAG (namespace '{knowledge_base.namespace}') avviato in background.")
+    return True
+
+def wait_for_rag(timeout=None, namespace=None):
+    """
+    Attende (al massimo 'timeout' secondi) che le risorse RAG del namespace (default: quello
+    attivo, vedi knowledge_base_scope) siano caricate, avviandone il caricamento al primo uso.
+    Il dict restituito è una generazione completa e non viene mai modificato:
+    chi lo usa può completare la ricerca anche se nel frattempo ne viene pubblicata una nuova.
+
+    Returns:
+        dict | None: Le risorse RAG condivise, o None se non ancora disponibili.
+    """
+    knowledge_base = _get_knowledge_base(namespace)
+    if knowledge_base is None:
+        return None
+    start_rag_loading(knowledge_base.namespace) # No-op se già caricato o in caricamento
+    if not knowledge_base.ready.wait(timeout):
+        return None
+    with _rag_lock:
+        return knowledge_base.resources
+
+def get_rag_status(namespace=None):
+    """Stato del caricamento RAG del namespace: 'not_started', 'loading', 'ready' o 'failed'."""
+    knowledge_base = _get_knowledge_base(namespace)
+    if knowledge_base is None:
+        return 'failed'
+    with _rag_lock:
+        if knowledge_base.resources is not None:
+            return 'ready' if knowledge_base.resources.get('success') else 'failed'
+        return 'loading' if knowledge_base.loader_thread is not None else 'not_started'
+
+def estimate_rag_memory_bytes():
+    """
+    Stima la memoria occupata dagli indici RAG caricati (condivisi da tutte le sessioni):
+    vettori FAISS (d * 4 byte + 8 byte di id per vettore) più le mappe dei chunk. Gli indici
+    condivisi tra namespace sono contati una volta sola. La stima di ogni coppia è calcolata
+    al caricamento della generazione.
+
+    Returns:
+        dict: {'generation', 'index_bytes', 'map_bytes', 'total_bytes', 'namespaces': [{'namespace',
+               'generation', 'own_bytes', 'quota_bytes', 'shared_indexes'}]} (valori a 0 se nulla è caricato).
+    """
+    with _rag_lock:
+        loaded = [(kb, kb.resources) for kb in _knowledge_bases.values() if kb.resources is not None]
+    seen = set()
+    index_bytes = map_bytes = 0
+    namespaces = []
+    for knowledge_base, resources in loaded:
+        for object_id, pair_index_bytes, pair_map_bytes in (resources.get('pair_memory') or {}).values():
+            if object_id in seen:
+                continue
+            seen.add(object_id)
+            index_bytes += pair_index_bytes
+            map_bytes += pair_map_bytes
+        namespaces.append({'namespace': knowledge_base.namespace, 'generation': resources.get('generation'),
+                           'own_bytes': resources.get('own_bytes', 0), 'quota_bytes': knowledge_base.memory_quota_bytes,
+                           'shared_indexes': len(resources.get('shared_keys') or [])})
+    default = next((resources for kb, resources in loaded if kb.namespace == RAG_DEFAULT_NAMESPACE), None)
+    return {'generation': default.get('generation') if default else None, 'index_bytes': index_bytes,
+            'map_bytes': map_bytes, 'total_bytes': index_bytes + map_bytes, 'namespaces': namespaces}
 
 # --- Funzioni di Ricerca RAG ---
 
+def _embed_batch(model_name, texts, task_type):
+    """
+    Embedding di più testi in una sola richiesta (sostituibile, es. dal backend finto di fake_llm.py).
+
+    Returns:
+        list: Un vettore per testo, nello stesso ordine.
+    """
+    import google.generativeai as genai
+    result = client_pool.call(
+        lambda client: genai.embed_content(model=model_name, content=list(texts), task_type=task_type,
+                                           client=client.generative_client, request_options={'timeout': call_timeout()}),
+        'embed', sum(client_pool.estimate_request_tokens(text) for text in texts))
+    return result['embedding']
+
+def _faiss_search_batch(index_local, queries):
+    """Una ricerca matriciale per più query sullo stesso indice: queries è una lista di (vettore, top_k)."""
+    import numpy as np
+
+    max_k = max(top_k for _, top_k in queries)
+    distances, indices = index_local.search(np.stack([vector for vector, _ in queries]).astype('float32'), max_k)
+    return [(distances[row:row + 1, :top_k], indices[row:row + 1, :top_k]) for row, (_, top_k) in enumerate(queries)]
+
+# Batcher condivisi dalle sessioni: embedding raggruppati per (modello, tipo di task),
+# ricerche raggruppate per indice (vedi batching.py)
+_embed_batcher = MicroBatcher(
+    'embed', lambda group, texts: _embed_batch(group[0], texts, group[1]),
+    EMBED_BATCH_WINDOW_MS / 1000, EMBED_BATCH_MAX_SIZE)
+_search_batcher = MicroBatcher(
+    'faiss_search', lambda group, items: _faiss_search_batch(items[0][0], [(vector, top_k) for _, vector, top_k in items]),
+    SEARCH_BATCH_WINDOW_MS / 1000, SEARCH_BATCH_MAX_SIZE)
+
+def _embed_query(model_name, query_text, task_type="RETRIEVAL_QUERY"):
+    """Embedding della query, raccolto con quelle delle altre sessioni in un'unica richiesta batch."""
+    if not RAG_BATCHING_ENABLED:
+        return {'embedding': _embed_batch(model_name, [query_text], task_type)[0]}
+    return {'embedding': _embed_batcher.submit((model_name, task_type), query_text)}
+
+def _faiss_search(index_local, query_vector, top_k):
+    """index.search di un solo vettore (1, d), eseguita insieme alle altre ricerche sullo stesso indice."""
+    if not RAG_BATCHING_ENABLED:
+        return index_local.search(query_vector, top_k)
+    return _search_batcher.submit(id(index_local), (index_local, query_vector[0], top_k))
+
+def _search_index(index_local, id_map_local, query_text, top_k, label):
+    """Calcola l'embedding della query e cerca nell'indice FAISS indicato."""
+    import numpy as np
+
+    embedding_model_name_local = get_session_value('embedding_model_name', EMBEDDING_MODEL_NAME)
+    query_embedding_result = _embed_query(embedding_model_name_local, query_text)
+    query_embedding = np.array([query_embedding_result['embedding']], dtype='float32')
+    distances, indices = _faiss_search(index_local, query_embedding, top_k)
+    results = []
+    if indices.size > 0:
+         for i, idx in enumerate(indices[0]):
+            if idx != -1:
+                chunk_data = id_map_local.get(int(idx))
+                if chunk_data and isinstance(chunk_data, dict):
+                    results.append({
+                        "id": int(idx),
+                        "content": chunk_data.get("content", ""),
+                        "metadata": chunk_data.get("metadata", {}),
+                        "distance": float(distances[0][i])
+                    })
+                else:
+                     log_message(f"WARN: Dati non trovati o formato non valido per indice {idx} nella mappa {label}.")
+    return results
+
 def search_global_rag(query_text, top_k=3):
     """Cerca nell'indice FAISS globale."""
     log_message(f"Richiesta ricerca RAG Globale (k={top_k}) per: '{query_text[:50]}...'")
-    if 'global_index' not in st.session_state or 'global_map' not in st.session_state or \
-       'embedding_model_name' not in st.session_state or st.session_state.global_index is None or \
-       st.session_state.global_index.ntotal == 0:
-        log_message("WARN: Risorse RAG globale non disponibili o indice vuoto per search_global_rag.")
+    if budget_exhausted():
+        record_degradation('rag_skipped')
+        return []
+    resources = wait_for_rag(call_timeout(RAG_LOAD_WAIT_SECONDS))
+    if not resources or resources.get('global_index') is None or resources['global_index'].ntotal == 0:
+        log_message("WARN: Risorse RAG globale non disponibili (non ancora caricate?) o indice vuoto per search_global_rag.")
         return []
-
-    index_local = st.session_state.global_index
-    id_map_local = st.session_state.global_map
-    embedding_model_name_local = st.session_state.embedding_model_name
 
     try:
-        query_embedding_result = genai.embed_content(
-            model=embedding_model_name_local,
-            content=query_text,
-            task_type="RETRIEVAL_QUERY"
-        )
-        query_embedding = np.array([query_embedding_result['embedding']], dtype='float32')
-        distances, indices = index_local.search(query_embedding, top_k)
-        results = []
-        if indices.size > 0:
-             for i, idx in enumerate(indices[0]):
-                if idx != -1:
-                    chunk_data = id_map_local.get(int(idx))
-                    if chunk_data and isinstance(chunk_data, dict):
-                        results.append({
-                            "id": int(idx),
-                            "content": chunk_data.get("content", ""),
-                            "metadata": chunk_data.get("metadata", {}),
-                            "distance": float(distances[0][i])
-                        })
-                    else:
-                         log_message(f"WARN: Dati non trovati o formato non valido per indice globale {idx} nella mappa.")
+        results = _search_index(resources['global_index'], resources['global_map'], query_text, top_k, "globale")
         log_message(f"Ricerca RAG Globale ha trovato {len(results)} risultati.")
         return results
     except Exception as e:
-        st.error(f"Errore durante la ricerca RAG globale: {e}")
+        show_ui_message('error', f"Errore durante la ricerca RAG globale: {e}")
         log_message(f"ERRORE Ricerca RAG Globale: {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
         return []
 
 def search_step_rag(query_text, step_key, top_k=3):
     """Cerca nell'indice FAISS specifico dello step."""
     log_message(f"Richiesta ricerca RAG Step '{step_key}' (k={top_k}) per: '{query_text[:50]}...'")
-    if 'step_indexes' not in st.session_state or 'step_maps' not in st.session_state or \
-       'embedding_model_name' not in st.session_state or \
-       step_key not in st.session_state.step_indexes or step_key not in st.session_state.step_maps or \
-       st.session_state.step_indexes[step_key].ntotal == 0:
-        log_message(f"WARN: Risorse RAG per step '{step_key}' non disponibili, non trovate o indice vuoto.")
+    if budget_exhausted():
+        record_degradation('rag_skipped')
+        return []
+    resources = wait_for_rag(call_timeout(RAG_LOAD_WAIT_SECONDS))
+    if not resources or step_key not in resources['step_indexes'] or step_key not in resources['step_maps'] or \
+       resources['step_indexes'][step_key].ntotal == 0:
+        log_message(f"WARN: Risorse RAG per step '{step_key}' non disponibili (non ancora caricate?), non trovate o indice vuoto.")
         return []
-
-    index_local = st.session_state.step_indexes[step_key]
-    id_map_local = st.session_state.step_maps[step_key]
-    embedding_model_name_local = st.session_state.embedding_model_name
 
     try:
-        query_embedding_result = genai.embed_content(
-            model=embedding_model_name_local,
-            content=query_text,
-            task_type="RETRIEVAL_QUERY"
-        )
-        query_embedding = np.array([query_embedding_result['embedding']], dtype='float32')
-        distances, indices = index_local.search(query_embedding, top_k)
-        results = []
-        if indices.size > 0:
-             for i, idx in enumerate(indices[0]):
-                if idx != -1:
-                    chunk_data = id_map_local.get(int(idx))
-                    if chunk_data and isinstance(chunk_data, dict):
-                        results.append({
-                            "id": int(idx),
-                            "content": chunk_data.get("content", ""),
-                            "metadata": chunk_data.get("metadata", {}),
-                            "distance": float(distances[0][i])
-                        })
-                    else:
-                         log_message(f"WARN: Dati non trovati o formato non valido per indice step {idx} nella mappa '{step_key}'.")
+        results = _search_index(resources['step_indexes'][step_key], resources['step_maps'][step_key], query_text, top_k, f"'{step_key}'")
         log_message(f"Ricerca RAG Step '{step_key}' ha trovato {len(results)} risultati.")
         return results
     except Exception as e:
-        st.error(f"Errore durante la ricerca RAG step '{step_key}': {e}")
+        show_ui_message('error', f"Errore durante la ricerca RAG step '{step_key}': {e}")
         log_message(f"ERRORE Ricerca RAG Step '{step_key}': {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
         return []
+
+def _rank(vectors, query, inner_product):
+    """Distanze (come FAISS: L2 al quadrato o prodotto scalare) e ordine dal più vicino."""
+    import numpy as np
+
+    if inner_product:
+        scores = vectors @ query
+        return scores, np.argsort(-scores, kind='stable')
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    return distances, np.argsort(distances, kind='stable')
+
+def search_hierarchical_rag(query_text, top_k=RAG_CHUNK_TOP_K):
+    """
+    Ricerca a due livelli: capitoli e sezioni più vicini alla query (sui riassunti), poi
+    i chunk solo dentro le sezioni scelte. Senza indice gerarchico usa la ricerca globale.
+
+    Returns:
+        dict: 'sections' (lista di {'chapter', 'title', 'summary'}) e 'chunks' (risultati
+              nel formato di search_global_rag).
+    """
+    import numpy as np
+
+    log_message(f"Richiesta ricerca RAG Gerarchica (k={top_k}) per: '{query_text[:50]}...'")
+    if budget_exhausted():
+        record_degradation('rag_skipped')
+        return {'sections': [], 'chunks': []}
+    resources = wait_for_rag(call_timeout(RAG_LOAD_WAIT_SECONDS))
+    hierarchy = (resources or {}).get('hierarchy')
+    if not hierarchy:
+        log_message("WARN: Indice RAG gerarchico non disponibile, uso la ricerca globale.")
+        return {'sections': [], 'chunks': search_global_rag(query_text, top_k)}
+
+    try:
+        embedding_model_name_local = get_session_value('embedding_model_name', EMBEDDING_MODEL_NAME)
+        query = np.asarray(_embed_query(embedding_model_name_local, query_text)['embedding'], dtype='float32')
+        inner_product = hierarchy['inner_product']
+        summary_vectors = hierarchy['summary_vectors']
+
+        _, chapter_order = _rank(summary_vectors[hierarchy['chapter_rows']], query, inner_product)
+        candidates = np.flatnonzero(np.isin(hierarchy['section_chapter'], chapter_order[:RAG_ROUTE_CHAPTERS]))
+        _, section_order = _rank(summary_vectors[hierarchy['section_rows'][candidates]], query, inner_product)
+        chosen_sections = candidates[section_order[:RAG_ROUTE_SECTIONS]]
+        if not len(chosen_sections):
+            return {'sections': [], 'chunks': search_global_rag(query_text, top_k)}
+
+        chunk_rows = np.unique(np.concatenate([hierarchy['section_chunks'][s] for s in chosen_sections]))
+        chunk_scores, chunk_order = _rank(hierarchy['chunk_vectors'][chunk_rows], query, inner_product)
+        metrics.observe('rag.hierarchical_candidate_chunks', len(chunk_rows))
+
+        chunks = []
+        for position in chunk_order[:top_k]:
+            chunk_id = int(hierarchy['chunk_ids'][chunk_rows[position]])
+            chunk_data = resources['global_map'].get(chunk_id)
+            if chunk_data and isinstance(chunk_data, dict):
+                chunks.append({
+                    "id": chunk_id,
+                    "content": chunk_data.get("content", ""),
+                    "metadata": chunk_data.get("metadata", {}),
+                    "distance": float(chunk_scores[position]),
+                })
+        sections = []
+        for s in chosen_sections:
+            entry = hierarchy['entries'][hierarchy['section_rows'][s]]
+            sections.append({'chapter': entry.get('chapter'), 'title': entry.get('title'), 'summary': entry.get('summary', '')})
+        log_message(f"Ricerca RAG Gerarchica: {len(sections)} sezioni, {len(chunk_rows)} chunk candidati, {len(chunks)} risultati.")
+        return {'sections': sections, 'chunks': chunks}
+    except Exception as e:
+        log_message(f"ERRORE Ricerca RAG Gerarchica: {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
+        return {'sections': [], 'chunks': []}
+
+def format_rag_context(result, max_chunk_chars=RAG_CONTEXT_CHUNK_MAX_CHARS):
+    """Contesto compatto per il prompt: riassunto delle sezioni pertinenti più i chunk più rilevanti."""
+    lines = []
+    if result.get('sections'):
+        lines.append("SEZIONI PERTINENTI DEL MANUALE:")
+        lines.extend(f"- {section['chapter']} / {section['title']}: {section['summary']}" for section in result['sections'])
+    if result.get('chunks'):
+        lines.append("ESTRATTI PIÙ RILEVANTI:")
+        for chunk in result['chunks']:
+            content = chunk['content'].strip()
+            if len(content) > max_chunk_chars:
+                content = content[:max_chunk_chars].rstrip() + "..."
+            lines.append(f"- {content}")
+    return "\n".join(lines)
+
+def chapter_search_asset(phase, query_text, top_k=RAG_CHUNK_TOP_K):
+    """
+    Ricerca nel capitolo della fase (phase_chapter_key) come risorsa speculativa, nel
+    namespace attivo (la chiave e la ricerca restano legate a quel namespace).
+
+    Returns:
+        tuple | None: (chiave, funzione) per speculation.speculate; None se la fase non ha capitolo.
+    """
+    namespace = current_namespace()
+    chapter_key = phase_chapter_key(phase, namespace)
+    if not chapter_key or not query_text:
+        return None
+    key = speculation.asset_key('chapter', namespace, chapter_key, query_text, top_k)
+
+    def search():
+        with knowledge_base_scope(namespace):
+            return search_step_rag(query_text, chapter_key, top_k)
+    return key, search
+
+def chapter_context(phase, query_text, top_k=RAG_CHUNK_TOP_K):
+    """
+    Estratti del capitolo della fase pertinenti alla query, formattati per il prompt.
+    Usa il risultato precalcolato dal turno precedente (speculation.py) se disponibile;
+    altrimenti cerca solo se gli indici sono già caricati (non attende il caricamento).
+    """
+    asset = chapter_search_asset(phase, query_text, top_k)
+    if asset is None:
+        return ""
+    chunks = speculation.take(asset[0])
+    if chunks is None:
+        if wait_for_rag(0) is None:
+            return ""
+        chunks = asset[1]()
+    return format_rag_context({'chunks': chunks})
+
+# --- Costruzione Offline dell'Indice Gerarchico ---
+
+def _summarize_for_hierarchy(title, text):
+    """Riassunto (2-3 frasi) di una sezione o di un capitolo; in caso di errore l'inizio del testo."""
+    from llm_interface import generate_response, is_failed_response
+    prompt = f"""Riassumi in ITALIANO, in 2-3 frasi (massimo 60 parole), il contenuto della seguente parte di un manuale di auto-aiuto per il DOC.
+Indica gli argomenti trattati e le parole chiave, senza introduzioni.
+
+TITOLO: {title}
+TESTO:
+{text[:RAG_SUMMARY_INPUT_MAX_CHARS]}"""
+    summary = generate_response(prompt=prompt, history=[], task='section_summary')
+    if is_failed_response(summary):
+        # Un messaggio di errore come riassunto porterebbe tutte le sezioni fallite sullo stesso vettore
+        metrics.increment('rag.hierarchy_summary_failed')
+        log_message(f"Indice gerarchico: WARN - Riassunto di '{title}' non generato, uso l'inizio del testo.")
+        return text[:400]
+    return summary.strip()
+
+def _embed_document(text):
+    return _embed_batch(EMBEDDING_MODEL_NAME, [text], "RETRIEVAL_DOCUMENT")[0]
+
+def build_hierarchy(data_dir=RAG_DATA_DIR):
+    """
+    Genera l'indice gerarchico dall'indice globale: raggruppa i chunk per capitolo e sezione
+    (metadata), ne scrive i riassunti con l'LLM, calcola gli embedding dei riassunti e
+    aggiorna il manifest (il watcher pubblica la nuova generazione).
+
+    Returns:
+        int: Numero di voci (capitoli + sezioni) dell'indice gerarchico.
+    """
+    import faiss
+    import pickle
+    import numpy as np
+
+    global_index = faiss.read_index(os.path.join(data_dir, f"{GLOBAL_INDEX_KEY}.index"))
+    with open(os.path.join(data_dir, f"{GLOBAL_INDEX_KEY}_map.pkl"), 'rb') as f:
+        global_map = pickle.load(f)
+
+    chapters = {}
+    for chunk_id in sorted(global_map):
+        metadata = global_map[chunk_id].get('metadata') or {}
+        chapter = metadata.get('chapter') or "Senza capitolo"
+        section = metadata.get('section') or "Introduzione al capitolo"
+        chapters.setdefault(chapter, {}).setdefault(section, []).append(int(chunk_id))
+
+    entries = []
+    for chapter_number, (chapter, sections) in enumerate(chapters.items()):
+        chapter_key = f"chapter_{chapter_number}"
+        section_summaries = []
+        for section, chunk_ids in sections.items():
+            text = "\n\n".join(global_map[chunk_id].get('content', '') for chunk_id in chunk_ids)
+            summary = _summarize_for_hierarchy(f"{chapter} / {section}", text)
+            section_summaries.append(f"{section}: {summary}")
+            entries.append({'level': 'section', 'key': f"{chapter_key}.section_{len(section_summaries)}", 'chapter_key': chapter_key,
+                            'chapter': chapter, 'title': section, 'summary': summary, 'chunk_ids': chunk_ids})
+        entries.append({'level': 'chapter', 'key': chapter_key, 'chapter_key': chapter_key, 'chapter': chapter,
+                        'title': chapter, 'summary': _summarize_for_hierarchy(chapter, "\n".join(section_summaries))})
+        log_message(f"Indice gerarchico: capitolo '{chapter}' ({len(sections)} sezioni) riassunto.")
+
+    vectors = np.asarray([_embed_document(f"{entry['title']}\n{entry['summary']}") for entry in entries], dtype='float32')
+    if global_index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        hierarchy_index = faiss.IndexFlatIP(vectors.shape[1])
+    else:
+        hierarchy_index = faiss.IndexFlatL2(vectors.shape[1])
+    hierarchy_index.add(vectors)
+    faiss.write_index(hierarchy_index, os.path.join(data_dir, f"{HIERARCHY_INDEX_KEY}.index"))
+    with open(os.path.join(data_dir, f"{HIERARCHY_INDEX_KEY}_map.pkl"), 'wb') as f:
+        pickle.dump(dict(enumerate(entries)), f)
+    build_manifest(data_dir)
+    log_message(f"Indice gerarchico scritto: {len(chapters)} capitoli, {len(entries) - len(chapters)} sezioni.")
+    return len(entries)
+
+
+if __name__ == "__main__":
+    # Uso: python rag_utils.py build-manifest [cartella_dati]
+    #      GOOGLE_API_KEY=... python rag_utils.py build-hierarchy [cartella_dati]
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "build-manifest":
+        build_manifest(sys.argv[2] if len(sys.argv) > 2 else RAG_DATA_DIR)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "build-hierarchy":
+        import google.generativeai as genai
+        genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+        build_hierarchy(sys.argv[2] if len(sys.argv) > 2 else RAG_DATA_DIR)
+    else:
+        print("Uso: python rag_utils.py build-manifest | build-hierarchy [cartella_dati]")
@@ -0,0 +1,303 @@
+# session_memory.py (Struttura Modulare a Fasi)
+# Memoria limitata per sessione e contabilità della memoria del processo.
+# - MessageHistory: la chat history della sessione (st.session_state.messages) tiene in
+#   memoria solo gli ultimi SESSION_HISTORY_MAX_IN_MEMORY messaggi; i precedenti vengono
+#   scaricati su disco (JSONL) e restano consultabili tramite page().
+# - SessionRegistry: registro delle sessioni del processo. Le sessioni inattive da più di
+#   SESSION_IDLE_TIMEOUT_SECONDS vengono scaricate su disco (messaggi e journal) e
+#   ripristinate in modo trasparente se l'utente ritorna; i file vengono eliminati dopo
+#   SESSION_OFFLOAD_RETENTION_SECONDS.
+# - memory_report(): byte per sessione e per componente (messaggi, stato, journal) più le
+#   risorse RAG condivise, per stimare quante sessioni può servire una replica.
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import metrics
+from utils import log_message
+from config import (
+    SESSION_HISTORY_MAX_IN_MEMORY, SESSION_IDLE_TIMEOUT_SECONDS, SESSION_OFFLOAD_RETENTION_SECONDS,
+    SESSION_SWEEP_INTERVAL_SECONDS, SESSION_OFFLOAD_DIR
+)
+
+
+def estimate_size(obj, _seen=None):
+    """Stima (in byte) della memoria occupata da obj e dagli oggetti che contiene."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in list(obj.items()))
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(estimate_size(item, _seen) for item in list(obj))
+    elif hasattr(obj, '__dict__'):
+        size += estimate_size(vars(obj), _seen)
+    return size
+
+
+def _offload_path(session_id, kind):
+    return os.path.join(SESSION_OFFLOAD_DIR, f"{session_id}.{kind}")
+
+
+class MessageHistory(list):
+    """
+    Chat history con al massimo max_in_memory messaggi in memoria (resta una list:
+    append, slicing e len funzionano come prima). I messaggi più vecchi sono accodati
+    nel file <session_id>.messages.jsonl.
+    """
+
+    def __init__(self, session_id, messages=(), max_in_memory=SESSION_HISTORY_MAX_IN_MEMORY):
+        super().__init__(messages)
+        self.session_id = session_id
+        self.max_in_memory = max(1, int(max_in_memory))
+        self.offloaded_count = 0
+        self.evicted = False
+        self._lock = threading.RLock()
+
+    @property
+    def path(self):
+        return _offload_path(self.session_id, 'messages.jsonl')
+
+    @property
+    def total_count(self):
+        """Numero totale di messaggi della conversazione (su disco + in memoria)."""
+        return self.offloaded_count + len(self)
+
+    def append(self, message):
+        with self._lock:
+            # Sessione scaricata durante un turno in corso: prima si ripristinano i messaggi,
+            # altrimenti il nuovo messaggio finirebbe prima di quelli riletti dal disco
+            if self.evicted:
+                self.restore()
+            super().append(message)
+            if len(self) > self.max_in_memory:
+                self._offload(len(self) - self.max_in_memory)
+
+    def _offload(self, count):
+        """Sposta su disco i primi 'count' messaggi in memoria."""
+        if count <= 0:
+            return
+        os.makedirs(SESSION_OFFLOAD_DIR, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for message in self[:count]:
+                f.write(json.dumps(message, ensure_ascii=False) + "\n")
+        del self[:count]
+        self.offloaded_count += count
+        metrics.increment('sessions.messages_offloaded', count)
+
+    def page(self, start, count):
+        """Messaggi [start, start + count) della conversazione completa (disco + memoria)."""
+        with self._lock:
+            result = []
+            end = start + count
+            if start < self.offloaded_count and os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for position, line in enumerate(f):
+                        if position >= min(end, self.offloaded_count):
+                            break
+                        if position >= start:
+                            result.append(json.loads(line))
+            memory_start = max(0, start - self.offloaded_count)
+            memory_end = max(0, end - self.offloaded_count)
+            result.extend(self[memory_start:memory_end])
+            return result
+
+    def offload_all(self):
+        """Scarica su disco tutti i messaggi (sessione inattiva)."""
+        with self._lock:
+            if not self.evicted:
+                self._offload(len(self))
+                self.evicted = True
+
+    def restore(self):
+        """Riporta in memoria gli ultimi max_in_memory messaggi dopo uno scarico completo."""
+        with self._lock:
+            if not self.evicted:
+                return
+            lines = []
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    lines = f.readlines()
+            keep_on_disk = max(0, len(lines) - self.max_in_memory)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.writelines(lines[:keep_on_disk])
+            super().extend(json.loads(line) for line in lines[keep_on_disk:])
+            self.offloaded_count = keep_on_disk
+            self.evicted = False
+
+    def discard_offloaded(self):
+        """Elimina i messaggi su disco (es. reset della chat)."""
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.offloaded_count = 0
+
+
+class SessionRegistry:
+    """Registro delle sessioni del processo, con scarico su disco di quelle inattive."""
+
+    def __init__(self, idle_timeout_seconds=SESSION_IDLE_TIMEOUT_SECONDS,
+                 retention_seconds=SESSION_OFFLOAD_RETENTION_SECONDS,
+                 sweep_interval_seconds=SESSION_SWEEP_INTERVAL_SECONDS):
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.retention_seconds = retention_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._lock = threading.Lock()
+        self._sessions = {}  # session_id -> {'last_seen', 'messages', 'state', 'journal', 'evicted'}
+        self._sweeper_thread = None
+
+    def touch(self, session_id, messages, state, journal):
+        """
+        Registra l'attività della sessione e i suoi componenti in memoria.
+        Se la sessione era stata scaricata per inattività, messaggi e journal vengono ripristinati.
+
+        Returns:
+            bool: True se la sessione è stata ripristinata dal disco.
+        """
+        restored = False
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            was_evicted = entry is not None and entry['evicted']
+        # I messaggi possono essere già stati ripristinati da MessageHistory.append (turno in corso)
+        if was_evicted or (isinstance(messages, MessageHistory) and messages.evicted):
+            if isinstance(messages, MessageHistory):
+                messages.restore()
+            self._restore_journal(session_id, journal)
+            metrics.increment('sessions.restored')
+            log_message(f"Session Memory: Sessione '{session_id}' ripristinata dal disco.")
+            restored = True
+        with self._lock:
+            self._sessions[session_id] = {
+                'last_seen': time.time(), 'messages': messages, 'state': state, 'journal': journal, 'evicted': False
+            }
+            metrics.set_gauge('sessions.active', sum(1 for entry in self._sessions.values() if not entry['evicted']))
+        self._start_sweeper()
+        return restored
+
+    def forget(self, session_id):
+        """Elimina la sessione dal registro e i suoi file su disco."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        for kind in ('messages.jsonl', 'journal.json'):
+            path = _offload_path(session_id, kind)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _restore_journal(self, session_id, journal):
+        path = _offload_path(session_id, 'journal.json')
+        if journal is None or not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            journal.load_list(json.load(f))
+        os.remove(path)
+
+    def _evict(self, session_id, entry):
+        """Scarica su disco messaggi e journal della sessione e rilascia i riferimenti."""
+        messages, journal = entry['messages'], entry['journal']
+        if isinstance(messages, MessageHistory):
+            messages.offload_all()
+        if journal is not None and journal.entries:
+            os.makedirs(SESSION_OFFLOAD_DIR, exist_ok=True)
+            with open(_offload_path(session_id, 'journal.json'), 'w', encoding='utf-8') as f:
+                json.dump(journal.to_list(), f, ensure_ascii=False, default=str)
+            journal.entries.clear()
+        entry.update(messages=None, state=None, journal=None, evicted=True)
+        metrics.increment('sessions.evicted')
+        log_message(f"Session Memory: Sessione '{session_id}' inattiva, scaricata su disco.")
+
+    def sweep(self, now=None):
+        """Scarica le sessioni inattive ed elimina i file oltre il periodo di conservazione."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            entries = list(self._sessions.items())
+        for session_id, entry in entries:
+            idle_seconds = now - entry['last_seen']
+            try:
+                if not entry['evicted'] and idle_seconds > self.idle_timeout_seconds:
+                    self._evict(session_id, entry)
+                elif entry['evicted'] and idle_seconds > self.retention_seconds:
+                    self.forget(session_id)
+            except Exception as e:
+                log_message(f"Session Memory: ERRORE scarico sessione '{session_id}': {type(e).__name__}: {e}")
+        self._remove_orphan_files(now)
+        with self._lock:
+            metrics.set_gauge('sessions.active', sum(1 for entry in self._sessions.values() if not entry['evicted']))
+
+    def _remove_orphan_files(self, now):
+        """Elimina i file di sessioni non più registrate (es. processo riavviato) oltre la conservazione."""
+        if not os.path.isdir(SESSION_OFFLOAD_DIR):
+            return
+        with self._lock:
+            known = set(self._sessions)
+        for filename in os.listdir(SESSION_OFFLOAD_DIR):
+            path = os.path.join(SESSION_OFFLOAD_DIR, filename)
+            if filename.split('.', 1)[0] not in known and now - os.path.getmtime(path) > self.retention_seconds:
+                os.remove(path)
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval_seconds)
+            self.sweep()
+
+    def _start_sweeper(self):
+        with self._lock:
+            if self._sweeper_thread is not None or self.sweep_interval_seconds <= 0:
+                return
+            self._sweeper_thread = threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True)
+            self._sweeper_thread.start()
+
+    def memory_report(self):
+        """
+        Memoria stimata per sessione e per componente, più le risorse RAG condivise.
+
+        Returns:
+            dict: {'sessions': [{'session_id', 'idle_seconds', 'evicted', 'messages_in_memory',
+                   'messages_offloaded', 'messages_bytes', 'state_bytes', 'journal_bytes',
+                   'total_bytes'}], 'sessions_total_bytes', 'avg_session_bytes', 'rag': {...}}
+        """
+        from rag_utils import estimate_rag_memory_bytes
+        now = time.time()
+        with self._lock:
+            entries = list(self._sessions.items())
+        sessions = []
+        for session_id, entry in entries:
+            messages = entry['messages']
+            row = {
+                'session_id': session_id,
+                'idle_seconds': round(now - entry['last_seen'], 1),
+                'evicted': entry['evicted'],
+                'messages_in_memory': len(messages) if messages is not None else 0,
+                'messages_offloaded': getattr(messages, 'offloaded_count', 0) if messages is not None else None,
+                'messages_bytes': estimate_size(messages) if messages is not None else 0,
+                'state_bytes': estimate_size(entry['state']) if entry['state'] is not None else 0,
+                'journal_bytes': estimate_size(entry['journal']) if entry['journal'] is not None else 0,
+            }
+            row['total_bytes'] = row['messages_bytes'] + row['state_bytes'] + row['journal_bytes']
+            sessions.append(row)
+        sessions.sort(key=lambda row: row['total_bytes'], reverse=True)
+        active = [row for row in sessions if not row['evicted']]
+        sessions_total = sum(row['total_bytes'] for row in sessions)
+        return {
+            'sessions': sessions,
+            'sessions_total_bytes': sessions_total,
+            'avg_session_bytes': sessions_total / len(active) if active else None,
+            'rag': estimate_rag_memory_bytes(),
+        }
+
+
+# Istanza condivisa da tutte le sessioni del processo
+_registry = SessionRegistry()
+
+
+def get_session_registry():
+    """Restituisce il registro delle sessioni del processo."""
+    return _registry
@@ -0,0 +1,74 @@
+# singleflight.py (Struttura Modulare a Fasi)
+# Coalescenza "single-flight" delle richieste identiche in corso.
+# Se arriva una richiesta con la stessa chiave di una già in esecuzione (doppio invio,
+# rerun di Streamlit durante un turno, stessa chiamata LLM da più sessioni), non
+# viene eseguita una seconda volta: attende la prima e ne condivide il risultato.
+
+import threading
+
+import metrics
+
+
+class WaitTimeoutError(TimeoutError):
+    """Scaduta l'attesa di una richiesta accodata a una chiamata identica in corso."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Gruppo di chiamate coalescenti identificate da una chiave (hashable)."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, wait_timeout=None, **kwargs):
+        """
+        Esegue func(*args, **kwargs), oppure attende la chiamata identica già in corso.
+
+        Args:
+            key: Chiave della richiesta.
+            wait_timeout (float, optional): Attesa massima (secondi) di chi si accoda
+                a una chiamata in corso; scaduta viene sollevato WaitTimeoutError.
+
+        Returns:
+            tuple: (risultato, condiviso) -> condiviso è True se il risultato è stato
+                   prodotto dalla chiamata di un'altra richiesta.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            metrics.increment(f'singleflight.{self.name}.coalesced')
+            if not call.done.wait(wait_timeout):
+                raise WaitTimeoutError(f"Attesa della richiesta in corso '{self.name}' scaduta")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        metrics.increment(f'singleflight.{self.name}.executed')
+        return call.result, False
+
+    def in_flight(self):
+        """Numero di chiamate attualmente in esecuzione."""
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,162 @@
+# speculation.py (Struttura Modulare a Fasi)
+# Precalcolo speculativo del lavoro costoso del turno successivo.
+# Il grafo delle fasi è in gran parte prevedibile (dopo la conferma dello schema viene
+# RESTRUCTURING_INTRO, dopo la conferma della prima parte la domanda sulla SV2): mentre
+# l'utente legge e scrive, il modulo della fase indica la fase probabile e le risorse da
+# preparare (speculative_assets), che vengono calcolate in background:
+# - solo con capacità libera (nessun turno in coda e turni attivi sotto soglia);
+# - con una deadline propria (SPECULATION_BUDGET_SECONDS), come un turno;
+# - annullate (e scartate) se la risposta dell'utente porta a un'altra fase.
+# Le risorse sono indicizzate per contenuto (es. capitolo + digest della query): il turno
+# successivo le ritira con take() e, se mancano, le calcola come sempre.
+# Le metriche speculation.* riportano previsioni, hit, risorse usate e sprecate.
+
+import contextvars
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, CancelledError
+
+import metrics
+from utils import log_message
+from deadline import TurnDeadline, turn_deadline, call_timeout
+from config import (
+    SPECULATION_ENABLED, SPECULATION_WORKERS, SPECULATION_MAX_PENDING, SPECULATION_MAX_LOAD,
+    SPECULATION_BUDGET_SECONDS, SPECULATION_MAX_SESSIONS, TURN_MAX_CONCURRENCY
+)
+
+_executor = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix='speculation')
+_lock = threading.Lock()
+_assets = {}    # chiave_risorsa -> Future
+_sessions = OrderedDict()  # session_id -> {'phase': fase_prevista, 'keys': [chiavi_risorse]}
+
+
+def asset_key(kind, *parts):
+    """Chiave di una risorsa speculativa: tipo ('warm' per le cache scaldate) più digest del contenuto da cui dipende."""
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False).encode('utf-8'))
+    return f"{kind}:{digest.hexdigest()[:24]}"
+
+
+def has_idle_capacity():
+    """True se nessun turno è in coda e i turni attivi sono sotto SPECULATION_MAX_LOAD della concorrenza."""
+    gauges = metrics.snapshot(prefix='turns.')['gauges']
+    return (gauges.get('turns.queue_depth', 0) == 0
+            and gauges.get('turns.active', 0) < TURN_MAX_CONCURRENCY * SPECULATION_MAX_LOAD)
+
+
+def _discard(keys, hit=False):
+    """
+    Rimuove le risorse indicate, annullando quelle non ancora avviate (chiamare con _lock).
+    Le risorse 'warm' (cache scaldate, es. context cache) non vengono ritirate con take():
+    su una previsione corretta contano come usate.
+    """
+    for key in keys:
+        future = _assets.pop(key, None)
+        if future is None:
+            continue
+        if hit and key.startswith('warm:') and future.done() and future.exception() is None:
+            metrics.increment('speculation.assets_used')
+        elif future.cancel():
+            metrics.increment('speculation.cancelled')
+        else:
+            metrics.increment('speculation.assets_wasted')
+
+
+def _run_asset(func):
+    with turn_deadline(TurnDeadline(SPECULATION_BUDGET_SECONDS)):
+        result = func()
+    metrics.increment('speculation.assets_computed')
+    return result
+
+
+def speculate(session_id, predicted_phase, assets):
+    """
+    Avvia in background il calcolo delle risorse per la fase prevista della sessione.
+
+    Args:
+        session_id (str): La sessione.
+        predicted_phase (str): Fase in cui porterà, con ogni probabilità, il prossimo turno.
+        assets (list): Lista di (chiave, funzione senza argomenti) (vedi asset_key).
+    """
+    if not SPECULATION_ENABLED or not assets:
+        return
+    if not has_idle_capacity():
+        metrics.increment('speculation.skipped_busy')
+        return
+    with _lock:
+        pending = sum(1 for future in _assets.values() if not future.done())
+        if pending + len(assets) > SPECULATION_MAX_PENDING:
+            metrics.increment('speculation.skipped_busy')
+            return
+        keys = []
+        for key, func in assets:
+            if key not in _assets:
+                # Il contesto viene copiato come per i thread del turno (deadline, variabili di contesto)
+                _assets[key] = _executor.submit(contextvars.copy_context().run, _run_asset, func)
+            keys.append(key)
+        _sessions[session_id] = {'phase': predicted_phase, 'keys': keys}
+        _sessions.move_to_end(session_id)
+        while len(_sessions) > SPECULATION_MAX_SESSIONS:
+            # Sessioni abbandonate: la previsione non verrà mai verificata
+            _, stale = _sessions.popitem(last=False)
+            _discard(stale['keys'])
+    metrics.increment('speculation.predictions')
+    log_message(f"Speculation: Fase prevista '{predicted_phase}' per la sessione '{session_id}', {len(keys)} risorse in preparazione.")
+
+
+def resolve(session_id, actual_phase):
+    """
+    Chiude la previsione della sessione dopo il turno: hit se la fase raggiunta è quella
+    prevista, altrimenti le risorse ancora in coda vengono annullate e tutte scartate.
+    """
+    with _lock:
+        prediction = _sessions.pop(session_id, None)
+        if prediction is None:
+            return
+        hit = prediction['phase'] == actual_phase
+        _discard(prediction['keys'], hit)  # Su hit restano solo le risorse non ritirate dal turno
+    metrics.increment('speculation.hits' if hit else 'speculation.misses')
+    if not hit:
+        log_message(f"Speculation: Previsione '{prediction['phase']}' mancata (fase '{actual_phase}'), risorse scartate.")
+
+
+def take(key):
+    """
+    Risorsa speculativa pronta (o in calcolo: attende al massimo il budget della chiamata).
+
+    Returns:
+        Il risultato, o None se la risorsa non è stata preparata o il calcolo è fallito.
+    """
+    with _lock:
+        future = _assets.pop(key, None)
+    if future is None:
+        return None
+    try:
+        result = future.result(timeout=call_timeout())
+    except (FutureTimeoutError, CancelledError):
+        metrics.increment('speculation.assets_wasted')
+        return None
+    except Exception as e:
+        metrics.increment('speculation.errors')
+        log_message(f"Speculation: WARN - Risorsa '{key}' non calcolata ({type(e).__name__}: {e}).")
+        return None
+    metrics.increment('speculation.assets_used')
+    return result
+
+
+def stats():
+    """Previsioni, hit rate e risorse usate/sprecate (per la sidebar)."""
+    counters = metrics.snapshot(prefix='speculation.')['counters']
+    hits = counters.get('speculation.hits', 0)
+    misses = counters.get('speculation.misses', 0)
+    return {
+        'predictions': counters.get('speculation.predictions', 0),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if (hits + misses) else None,
+        'assets_computed': counters.get('speculation.assets_computed', 0),
+        'assets_used': counters.get('speculation.assets_used', 0),
+        'assets_wasted': counters.get('speculation.assets_wasted', 0) + counters.get('speculation.cancelled', 0),
+        'skipped_busy': counters.get('speculation.skipped_busy', 0),
+    }
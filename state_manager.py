@@ -2,9 +2,12 @@
 # Questo modulo agisce da router: riceve l'input, determina la fase
 # e delega l'elaborazione al modulo logico specifico per quella fase.
 
-import streamlit as st
+import traceback
 from utils import log_message
-from config import INITIAL_STATE # Importa stato iniziale per fallback
+from config import INITIAL_STATE, TURN_DEADLINE_SECONDS # Importa stato iniziale per fallback
+from state_store import freeze_state, thaw_state
+from deadline import TurnDeadline, turn_deadline
+from turn_events import record_error
 
 # Importa i moduli logici specifici per ogni fase
 # Metti un try-except per gestire casi in cui i file potrebbero mancare
@@ -42,49 +45,82 @@ except ImportError:
 # Aggiungi import per altri moduli di fase qui...
 
 
-def process_user_message(user_msg, current_state):
+def _route(phase):
+    """Modulo logico che gestisce la fase (None se la fase non è riconosciuta)."""
+    # Mappa le fasi ai moduli logici importati
+    if phase.startswith('ASSESSMENT_') or phase == 'START':
+        return assessment_logic
+    elif phase.startswith('RESTRUCTURING_'):
+        return restructuring_logic
+    elif phase.startswith('ERP_'):
+        return erp_logic
+    elif phase.startswith('ACT_'):
+         return act_logic
+    elif phase.startswith('DISGUST_'):
+         return disgust_logic
+    elif phase.startswith('RELAPSE_'):
+         return relapse_logic
+    # Aggiungi altri elif per nuove fasi qui...
+    return None
+
+
+def plan_speculation(state, bot_response):
+    """
+    Fase prevista dopo il turno e risorse da precalcolare (vedi speculation.py), chiedendole
+    al modulo della fase (funzione opzionale 'speculative_assets').
+
+    Returns:
+        tuple | None: (fase_prevista, [(chiave, funzione), ...]) o None.
+    """
+    handler_module = _route(state.get('phase', 'START'))
+    if handler_module is None or not hasattr(handler_module, 'speculative_assets'):
+        return None
+    try:
+        return handler_module.speculative_assets(state, bot_response)
+    except Exception as e:
+        log_message(f"WARN: Pianificazione speculativa fallita per la fase '{state.get('phase')}': {type(e).__name__}: {e}")
+        return None
+
+
+def process_user_message(user_msg, current_state, journal=None, deadline=None):
     """
     Funzione principale per processare il messaggio utente.
     Determina la fase corrente e delega al modulo logico appropriato.
 
+    Il modulo delegato lavora su una copia mutabile e completamente isolata dello stato;
+    lo stato restituito è immutabile (FrozenDict) e condivide con quello precedente
+    le parti non modificate.
+
     Args:
         user_msg (str): Il messaggio dell'utente.
         current_state (dict): Lo stato attuale della conversazione.
+        journal (StateJournal, optional): Se fornito, vi viene registrato il delta del turno.
+        deadline (TurnDeadline, optional): Scadenza del turno, propagata a tutte le chiamate
+            LLM/embedding/RAG. Se None ne viene creata una di TURN_DEADLINE_SECONDS.
 
     Returns:
         tuple: (str, dict) -> (risposta_del_bot, nuovo_stato)
     """
     if not isinstance(current_state, dict):
         log_message(f"ERRORE CRITICO in state_manager: current_state non è un dizionario! Ricevuto: {type(current_state)}. Ripristino.")
-        current_state = INITIAL_STATE.copy() # Fallback a stato iniziale
+        current_state = freeze_state(INITIAL_STATE) # Fallback a stato iniziale
         bot_response = "Si è verificato un errore interno nello stato della conversazione. Riavvio la sessione."
         return bot_response, current_state
 
+    current_state = freeze_state(current_state) # No-op se già congelato
+    if deadline is None:
+        deadline = TurnDeadline(TURN_DEADLINE_SECONDS)
     current_phase = current_state.get('phase', 'START') # Ottieni la fase corrente
     log_message(f"State Manager: Ricevuto messaggio per fase '{current_phase}'")
 
-    new_state = current_state.copy() # Lavora su una copia per evitare side effects
+    new_state = thaw_state(current_state) # Copia profonda: il rollback in caso di errore è isolato
     bot_response = "Mi dispiace, non so come gestire questa fase." # Fallback
 
-    handler_module = None
     handler_function_name = 'handle' # Nome convenzione per la funzione handler in ogni modulo fase
 
     # --- Routing basato sulla Fase ---
-    # Mappa le fasi ai moduli logici importati
-    if current_phase.startswith('ASSESSMENT_') or current_phase == 'START':
-        handler_module = assessment_logic
-    elif current_phase.startswith('RESTRUCTURING_'):
-        handler_module = restructuring_logic
-    elif current_phase.startswith('ERP_'):
-        handler_module = erp_logic
-    elif current_phase.startswith('ACT_'):
-         handler_module = act_logic
-    elif current_phase.startswith('DISGUST_'):
-         handler_module = disgust_logic
-    elif current_phase.startswith('RELAPSE_'):
-         handler_module = relapse_logic
-    # Aggiungi altri elif per nuove fasi qui...
-    else:
+    handler_module = _route(current_phase)
+    if handler_module is None:
         log_message(f"WARN: Fase '{current_phase}' non riconosciuta dallo state_manager.")
         # Potrebbe gestire un fallback generico qui o lasciare la risposta di default
 
@@ -94,11 +130,13 @@ def process_user_message(user_msg, current_state):
             log_message(f"State Manager: Delega alla funzione '{handler_function_name}' del modulo {handler_module.__name__}")
             # Chiama la funzione handle del modulo specifico
             handler_func = getattr(handler_module, handler_function_name)
-            bot_response, new_state = handler_func(user_msg, new_state)
+            with turn_deadline(deadline):
+                bot_response, new_state = handler_func(user_msg, new_state)
             log_message(f"State Manager: Ricevuto nuovo stato con fase '{new_state.get('phase')}' da {handler_module.__name__}")
 
         except Exception as e:
             log_message(f"ERRORE durante l'esecuzione di {handler_module.__name__}.{handler_function_name}: {type(e).__name__}: {e}\nTraceback: {traceback.format_exc()}")
+            record_error(type(e).__name__)
             bot_response = "Mi dispiace, si è verificato un errore interno durante l'elaborazione della tua richiesta in questa fase."
             # Mantiene lo stato precedente in caso di errore nel modulo delegato
             new_state = current_state
@@ -118,5 +156,15 @@ def process_user_message(user_msg, current_state):
         new_state = current_state # Ripristina stato precedente
         bot_response = "Errore interno nello stato restituito dalla logica della fase."
 
+    new_state = freeze_state(new_state, previous=current_state)
+    if deadline.degradations:
+        log_message(f"State Manager: Turno degradato per deadline ({deadline.budget_seconds:.0f}s), fallback attivati: {deadline.degradations}")
+    if journal is not None:
+        entry = journal.record(current_state, new_state)
+        if entry:
+            if deadline.degradations:
+                entry['degradations'] = list(deadline.degradations)
+            log_message(f"State Manager: Delta turno #{entry['seq']}: {entry['phase_from']} -> {entry['phase_to']}, campi schema modificati: {list(entry['schema_changes'])}")
+
     return bot_response, new_state
 
@@ -0,0 +1,178 @@
+# state_store.py (Struttura Modulare a Fasi)
+# Rappresentazione immutabile dello stato della conversazione e journal delle modifiche.
+# - Lo stato "committato" (st.session_state.state) è un FrozenDict: nessuno può
+#   modificarlo per errore in place (es. lo schema condiviso tra copie superficiali).
+# - Ogni turno lavora su una copia mutabile (thaw_state) e il risultato viene
+#   ricongelato (freeze_state) riutilizzando le parti invariate dello stato precedente.
+# - Per ogni turno il StateJournal registra un delta compatto (transizione di fase +
+#   campi modificati), utile per snapshot, rollback e persistenza.
+
+import time
+from collections import deque
+
+from config import STATE_JOURNAL_MAX_ENTRIES
+
+_READONLY_ERROR = "Lo stato della conversazione è immutabile: usare thaw_state() per ottenerne una copia modificabile."
+
+
+class FrozenDict(dict):
+    """dict di sola lettura (resta un dict: json, st.json e isinstance(x, dict) funzionano)."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError(_READONLY_ERROR)
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    """list di sola lettura, usata per i valori lista contenuti nello stato."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError(_READONLY_ERROR)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+def _freeze_value(value, previous=None):
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    # Condivisione strutturale: se il valore non è cambiato si riusa l'oggetto già congelato
+    if previous is not None and isinstance(previous, (FrozenDict, FrozenList)) and previous == value:
+        return previous
+    if isinstance(value, dict):
+        prev_dict = previous if isinstance(previous, dict) else {}
+        return FrozenDict({k: _freeze_value(v, prev_dict.get(k)) for k, v in value.items()})
+    if isinstance(value, list):
+        return FrozenList(_freeze_value(v) for v in value)
+    return value
+
+
+def freeze_state(state, previous=None):
+    """
+    Restituisce una versione immutabile dello stato.
+
+    Args:
+        state (dict): Lo stato (mutabile o già congelato).
+        previous (FrozenDict, optional): Lo stato congelato precedente; le parti
+            invariate vengono riutilizzate invece di essere ricopiate.
+
+    Returns:
+        FrozenDict: Lo stato congelato.
+    """
+    return _freeze_value(state, previous)
+
+
+def thaw_state(state):
+    """Restituisce una copia completamente mutabile (dict/list annidati inclusi) dello stato."""
+    if isinstance(state, dict):
+        return {k: thaw_state(v) for k, v in state.items()}
+    if isinstance(state, list):
+        return [thaw_state(v) for v in state]
+    return state
+
+
+def diff_states(before, after):
+    """
+    Calcola il delta compatto tra due stati.
+
+    Returns:
+        dict: {'phase_from', 'phase_to', 'schema_changes': {campo: [vecchio, nuovo]},
+               'other_changes': {chiave: [vecchio, nuovo]}, 'added': [chiavi assenti prima],
+               'removed': {chiave: vecchio}}
+    """
+    before = before or {}
+    after = after or {}
+    before_schema = before.get('schema') or {}
+    after_schema = after.get('schema') or {}
+    schema_changes = {
+        field: [before_schema.get(field), after_schema.get(field)]
+        for field in set(before_schema) | set(after_schema)
+        if before_schema.get(field) != after_schema.get(field)
+    }
+    other_changes = {
+        key: [thaw_state(before.get(key)), thaw_state(after[key])]
+        for key in after
+        if key not in ('phase', 'schema') and before.get(key) != after[key]
+    }
+    added = sorted(key for key in other_changes if key not in before)
+    removed = {key: thaw_state(before[key]) for key in before if key not in after}
+    return {
+        'phase_from': before.get('phase'),
+        'phase_to': after.get('phase'),
+        'schema_changes': schema_changes,
+        'other_changes': other_changes,
+        'added': added,
+        'removed': removed,
+    }
+
+
+class StateJournal:
+    """
+    Journal per sessione dei delta di stato, uno per turno.
+    Conserva al massimo STATE_JOURNAL_MAX_ENTRIES voci (le più vecchie vengono scartate).
+    """
+
+    def __init__(self, max_entries=STATE_JOURNAL_MAX_ENTRIES):
+        self.entries = deque(maxlen=max_entries)
+        self.next_seq = 1
+
+    def record(self, before, after):
+        """Registra il delta del turno; restituisce la voce (None se lo stato non è cambiato)."""
+        delta = diff_states(before, after)
+        if delta['phase_from'] == delta['phase_to'] and not delta['schema_changes'] and \
+           not delta['other_changes'] and not delta['removed']:
+            return None
+        entry = {'seq': self.next_seq, 'ts': time.time(), **delta}
+        self.next_seq += 1
+        self.entries.append(entry)
+        return entry
+
+    def rollback(self, state):
+        """
+        Annulla l'ultimo delta registrato applicandone l'inverso a 'state'.
+
+        Returns:
+            FrozenDict | None: Lo stato precedente, o None se il journal è vuoto.
+        """
+        if not self.entries:
+            return None
+        entry = self.entries.pop()
+        restored = thaw_state(state)
+        restored['phase'] = entry['phase_from']
+        schema = restored.setdefault('schema', {})
+        for field, (old_value, _new_value) in entry['schema_changes'].items():
+            schema[field] = old_value
+        # Le voci salvate prima di 'added' non distinguono chiave assente e valore None
+        added = set(entry['added'] if 'added' in entry else
+                    (key for key, (old_value, _new_value) in entry['other_changes'].items() if old_value is None))
+        for key, (old_value, _new_value) in entry['other_changes'].items():
+            if key in added:
+                restored.pop(key, None)
+            else:
+                restored[key] = old_value
+        restored.update(entry['removed'])
+        return freeze_state(restored, previous=state)
+
+    def to_list(self):
+        """Voci del journal in forma serializzabile (JSON) per la persistenza."""
+        return [dict(entry) for entry in self.entries]
+
+    def load_list(self, entries):
+        """
+        Ripristina le voci prodotte da to_list() (es. dopo lo scarico su disco della sessione).
+        Le voci registrate nel frattempo (turno in corso durante lo scarico) restano in coda.
+        """
+        recorded_since = list(self.entries)
+        self.entries.clear()
+        self.entries.extend(dict(entry) for entry in entries)
+        self.entries.extend(recorded_since)
+        if self.entries:
+            self.next_seq = max(self.next_seq, self.entries[-1]['seq'] + 1)
@@ -0,0 +1,151 @@
+# streaming_json.py (Struttura Modulare a Fasi)
+# Parser JSON incrementale per le risposte LLM in streaming.
+# Riceve il testo a frammenti e restituisce ogni campo di primo livello dell'oggetto
+# JSON (es. 'ec', 'pv1', 'ts1') appena il suo valore è completo, senza attendere
+# la fine della risposta. Come _clean_llm_json_response, tollera i blocchi
+# ```json ... ``` e il testo prima/dopo l'oggetto (ignorati).
+
+import json
+
+# Stati del parser
+_SEEK_OBJECT = 'seek_object'
+_SEEK_KEY = 'seek_key'
+_IN_KEY = 'in_key'
+_SEEK_COLON = 'seek_colon'
+_SEEK_VALUE = 'seek_value'
+_IN_STRING_VALUE = 'in_string_value'
+_IN_SCALAR_VALUE = 'in_scalar_value'
+_IN_NESTED_VALUE = 'in_nested_value'
+_DONE = 'done'
+
+
+class IncrementalJsonFieldParser:
+    """
+    Parser a stati per un oggetto JSON di primo livello ricevuto a frammenti.
+
+    Uso:
+        parser = IncrementalJsonFieldParser()
+        for chunk in stream:
+            for key, value in parser.feed(chunk):
+                ...  # il campo 'key' è completo
+    """
+
+    def __init__(self, fields=None):
+        self.fields = set(fields) if fields else None # Se indicato, emette solo questi campi
+        self.values = {}
+        self._buffer = ""
+        self._pos = 0
+        self._state = _SEEK_OBJECT
+        self._token_start = 0
+        self._current_key = None
+        self._nested_depth = 0
+        self._nested_in_string = False
+
+    @property
+    def completed(self):
+        """True quando l'oggetto JSON di primo livello è stato chiuso."""
+        return self._state == _DONE
+
+    def feed(self, chunk):
+        """
+        Aggiunge un frammento di testo.
+
+        Returns:
+            list: Coppie (chiave, valore) dei campi completati in questo frammento.
+        """
+        if self._state == _DONE or not chunk:
+            return []
+        self._buffer += chunk
+        emitted = []
+        buffer = self._buffer
+        while self._pos < len(buffer) and self._state != _DONE:
+            char = buffer[self._pos]
+            state = self._state
+
+            if state == _SEEK_OBJECT:
+                if char == '{':
+                    self._state = _SEEK_KEY
+            elif state == _SEEK_KEY:
+                if char == '"':
+                    self._state = _IN_KEY
+                    self._token_start = self._pos
+                elif char == '}':
+                    self._state = _DONE
+            elif state in (_IN_KEY, _IN_STRING_VALUE):
+                if char == '\\':
+                    if self._pos + 1 >= len(buffer):
+                        break # Sequenza di escape spezzata tra due frammenti: attende il prossimo
+                    self._pos += 1
+                elif char == '"':
+                    raw = buffer[self._token_start:self._pos + 1]
+                    if state == _IN_KEY:
+                        self._current_key = self._parse_string(raw)
+                        self._state = _SEEK_COLON
+                    else:
+                        self._emit(self._parse_string(raw), emitted)
+            elif state == _SEEK_COLON:
+                if char == ':':
+                    self._state = _SEEK_VALUE
+            elif state == _SEEK_VALUE:
+                if char == '"':
+                    self._state = _IN_STRING_VALUE
+                    self._token_start = self._pos
+                elif char in '{[':
+                    self._state = _IN_NESTED_VALUE
+                    self._token_start = self._pos
+                    self._nested_depth = 1
+                    self._nested_in_string = False
+                elif not char.isspace():
+                    self._state = _IN_SCALAR_VALUE
+                    self._token_start = self._pos
+            elif state == _IN_SCALAR_VALUE:
+                if char in ',}' or char.isspace():
+                    raw = buffer[self._token_start:self._pos].strip()
+                    self._emit(self._parse_scalar(raw), emitted)
+                    if char == '}':
+                        self._state = _DONE
+            elif state == _IN_NESTED_VALUE:
+                if self._nested_in_string:
+                    if char == '\\':
+                        if self._pos + 1 >= len(buffer):
+                            break
+                        self._pos += 1
+                    elif char == '"':
+                        self._nested_in_string = False
+                elif char == '"':
+                    self._nested_in_string = True
+                elif char in '{[':
+                    self._nested_depth += 1
+                elif char in '}]':
+                    self._nested_depth -= 1
+                    if self._nested_depth == 0:
+                        raw = buffer[self._token_start:self._pos + 1]
+                        try:
+                            value = json.loads(raw, strict=False)
+                        except json.JSONDecodeError:
+                            value = raw
+                        self._emit(value, emitted)
+            self._pos += 1
+        return emitted
+
+    def _parse_string(self, raw):
+        try:
+            # strict=False: accetta gli a capo non escapati che gli LLM a volte producono
+            return json.loads(raw, strict=False)
+        except json.JSONDecodeError:
+            return raw[1:-1] # Escape non valido: restituisce il testo tra virgolette così com'è
+
+    def _parse_scalar(self, raw):
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            return raw # Valore non standard (es. None non quotato): restituito come testo
+
+    def _emit(self, value, emitted):
+        key = self._current_key
+        self._state = _SEEK_KEY
+        self._current_key = None
+        if self.fields is not None and key not in self.fields:
+            return
+        self.values[key] = value
+        emitted.append((key, value))
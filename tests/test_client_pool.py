@@ -0,0 +1,64 @@
+# tests/test_client_pool.py
+# Risposte in streaming: la chiave del pool resta occupata fino alla fine della lettura.
+
+import pytest
+
+import client_pool
+from client_pool import ClientPool, PooledClient
+
+LIMITS = {'generate': {'rpm': 60, 'tpm': 10_000}}
+
+
+class _Usage:
+    total_token_count = 700
+
+
+class _Stream:
+    """Risposta in streaming del provider: usage_metadata disponibile a fine lettura."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.usage_metadata = None
+
+    def __iter__(self):
+        yield from self.chunks
+        self.usage_metadata = _Usage()
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = ClientPool([PooledClient('chiave-1', limits=LIMITS)])
+    monkeypatch.setattr(client_pool, '_pool', pool)
+    return pool
+
+
+def test_stream_holds_slot_until_consumed(pool):
+    client = pool.clients[0]
+    stream = client_pool.call(lambda c: _Stream(["a", "b"]), 'generate', 100, stream=True)
+    assert client.in_flight == 1
+    chunks = []
+    for chunk in stream:
+        assert client.in_flight == 1
+        chunks.append(chunk)
+    assert chunks == ["a", "b"]
+    assert client.in_flight == 0
+
+
+def test_stream_corrects_tokens_with_actual_usage(pool):
+    tokens_bucket = pool.clients[0].buckets['generate'][1]
+    list(client_pool.call(lambda c: _Stream(["a"]), 'generate', 100, stream=True))
+    assert tokens_bucket.level == pytest.approx(10_000 - 700, abs=5)
+
+
+def test_abandoned_stream_is_released_by_close(pool):
+    client = pool.clients[0]
+    stream = client_pool.call(lambda c: _Stream(["a", "b", "c"]), 'generate', 100, stream=True)
+    next(iter(stream))
+    stream.close()
+    stream.close()
+    assert client.in_flight == 0
+
+
+def test_non_stream_call_releases_immediately(pool):
+    client_pool.call(lambda c: "risposta", 'generate', 100)
+    assert pool.clients[0].in_flight == 0
@@ -0,0 +1,76 @@
+# tests/test_context_cache.py
+# Percorso di caching con il backend locale (emulazione in processo) e ripiego inline.
+
+import pytest
+
+import context_cache
+from context_cache import ContextCache, LocalContextCacheBackend, compose_inline
+
+PREFIX = "Istruzioni di sistema stabili della fase."
+
+
+class _Model:
+    model_name = "models/test-model"
+
+
+class _FailingBackend(LocalContextCacheBackend):
+    def __init__(self):
+        super().__init__()
+        self.attempts = 0
+
+    def register(self, key, model_name, prefix_text, ttl_seconds):
+        self.attempts += 1
+        raise RuntimeError("registrazione non disponibile")
+
+
+@pytest.fixture
+def cache():
+    return ContextCache(LocalContextCacheBackend(), min_tokens=0)
+
+
+def test_local_backend_reinserts_prefix(cache):
+    model = _Model()
+    bound_model, prompt = cache.prepare('fase.task', model, PREFIX, "domanda")
+    assert bound_model is model
+    assert prompt == compose_inline(PREFIX, "domanda")
+
+
+def test_local_backend_registers_once(cache):
+    model = _Model()
+    cache.prepare('fase.task', model, PREFIX, "primo")
+    handle = cache._entries[('fase.task', model.model_name)]['handle']
+    cache.prepare('fase.task', model, PREFIX, "secondo")
+    assert cache._entries[('fase.task', model.model_name)]['handle'] == handle
+    assert len(cache.backend._prefixes) == 1
+
+
+def test_changed_prefix_is_registered_again(cache):
+    model = _Model()
+    cache.prepare('fase.task', model, PREFIX, "primo")
+    _, prompt = cache.prepare('fase.task', model, PREFIX + " Aggiornate.", "secondo")
+    assert prompt == compose_inline(PREFIX + " Aggiornate.", "secondo")
+    assert len(cache.backend._prefixes) == 2
+
+
+def test_prefix_below_min_tokens_is_inline():
+    cache = ContextCache(LocalContextCacheBackend(), min_tokens=10_000)
+    _, prompt = cache.prepare('fase.task', _Model(), PREFIX, "domanda")
+    assert prompt == compose_inline(PREFIX, "domanda")
+    assert not cache.backend._prefixes
+
+
+def test_failed_registration_goes_inline_and_backs_off():
+    backend = _FailingBackend()
+    cache = ContextCache(backend, min_tokens=0, retry_seconds=300)
+    for _ in range(3):
+        _, prompt = cache.prepare('fase.task', _Model(), PREFIX, "domanda")
+        assert prompt == compose_inline(PREFIX, "domanda")
+    assert backend.attempts == 1
+
+
+def test_prepare_call_without_cache_is_inline(monkeypatch):
+    monkeypatch.setattr(context_cache, '_context_cache', None)
+    model = _Model()
+    bound_model, prompt = context_cache.prepare_call('fase.task', model, PREFIX, "domanda")
+    assert bound_model is model
+    assert prompt == compose_inline(PREFIX, "domanda")
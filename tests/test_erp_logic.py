@@ -0,0 +1,36 @@
+# tests/test_erp_logic.py
+# Esito della prevenzione della risposta nelle prove ERP (phases/erp_logic._resisted).
+
+import pytest
+
+from phases.erp_logic import _resisted
+
+
+@pytest.mark.parametrize("user_msg", [
+    "non l'ho fatta",
+    "No, non l’ho fatta",
+    "non ho controllato",
+    "picco 70, fine 30, non ho controllato",
+    "non ho ceduto",
+    "ho resistito",
+    "ce l'ho fatta",
+    "sono riuscita a non farla",
+    "sì",
+    "picco 70 fine 30",
+])
+def test_resisted(user_msg):
+    assert _resisted(user_msg) is True
+
+
+@pytest.mark.parametrize("user_msg", [
+    "l'ho fatta",
+    "ho controllato",
+    "no",
+    "picco 60 fine 20, no",
+    "non ho resistito",
+    "ho ceduto",
+    "non ce l'ho fatta",
+    "non sono riuscito",
+])
+def test_not_resisted(user_msg):
+    assert _resisted(user_msg) is False
@@ -0,0 +1,42 @@
+# tests/test_session_memory.py
+# Scarico su disco di una sessione con un turno in corso (ordine di messaggi e journal).
+
+import pytest
+
+import session_memory
+from session_memory import MessageHistory, SessionRegistry
+from state_store import StateJournal
+
+
+@pytest.fixture(autouse=True)
+def offload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(session_memory, 'SESSION_OFFLOAD_DIR', str(tmp_path))
+
+
+def _message(i):
+    return {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"messaggio {i}"}
+
+
+def test_append_after_offload_keeps_order():
+    history = MessageHistory('sessione', [_message(i) for i in range(4)], max_in_memory=3)
+    history.offload_all()
+    history.append(_message(4))
+    assert not history.evicted
+    assert history.page(0, history.total_count) == [_message(i) for i in range(5)]
+    assert list(history) == [_message(i) for i in range(2, 5)]
+
+
+def test_eviction_during_turn_keeps_messages_and_journal():
+    registry = SessionRegistry(idle_timeout_seconds=0, sweep_interval_seconds=0)
+    history = MessageHistory('sessione', [_message(0)], max_in_memory=10)
+    journal = StateJournal()
+    journal.record({'phase': 'A'}, {'phase': 'B'})
+    registry.touch('sessione', history, {'phase': 'B'}, journal)
+
+    registry.sweep(now=registry._sessions['sessione']['last_seen'] + 1)  # Turno ancora in corso
+    history.append(_message(1))
+    journal.record({'phase': 'B'}, {'phase': 'C'})
+    registry.touch('sessione', history, {'phase': 'C'}, journal)
+
+    assert list(history) == [_message(0), _message(1)]
+    assert [entry['phase_to'] for entry in journal.entries] == ['B', 'C']
@@ -0,0 +1,66 @@
+# tests/test_turn_scheduler.py
+# Coalescenza dei turni duplicati: deadline propria del duplicato ed evento coalesced=True.
+
+import threading
+import time
+
+import pytest
+
+import turn_scheduler
+from config import BUSY_MESSAGE
+
+
+@pytest.fixture
+def turn(monkeypatch):
+    """Turno che resta in esecuzione finché il test non lo rilascia; raccoglie gli eventi emessi."""
+    started, release, events = threading.Event(), threading.Event(), []
+
+    def process_user_message(user_msg, current_state, journal=None, deadline=None):
+        started.set()
+        release.wait(5)
+        return "risposta", {**current_state, 'phase': 'DOPO'}
+
+    def emit(recorder, outcome, state_before, state_after, user_msg, bot_response, degradations=(), coalesced=False):
+        events.append({'outcome': outcome, 'coalesced': coalesced, 'response': bot_response})
+
+    monkeypatch.setattr(turn_scheduler, 'process_user_message', process_user_message)
+    monkeypatch.setattr(turn_scheduler, 'plan_speculation', lambda state, response: None)
+    monkeypatch.setattr(turn_scheduler.turn_events, 'emit', emit)
+    return started, release, events
+
+
+def _leader(session_id, results):
+    thread = threading.Thread(target=lambda: results.append(
+        turn_scheduler.schedule_turn(session_id, "ciao", {'phase': 'PRIMA'}, turn_seq=1)))
+    thread.start()
+    return thread
+
+
+def test_duplicate_shares_result_and_records_coalesced_event(turn):
+    started, release, events = turn
+    results = []
+    leader = _leader('sessione-condivisa', results)
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(
+        turn_scheduler.schedule_turn('sessione-condivisa', "ciao", {'phase': 'PRIMA'}, turn_seq=1)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert [response for response, _state in results] == ["risposta", "risposta"]
+    assert sorted(event['coalesced'] for event in events) == [False, True]
+    assert all(event['outcome'] == 'ok' for event in events)
+
+
+def test_duplicate_waits_only_for_its_own_deadline(turn, monkeypatch):
+    started, release, events = turn
+    results = []
+    leader = _leader('sessione-lenta', results)
+    started.wait(5)
+    monkeypatch.setattr(turn_scheduler, 'TURN_DEADLINE_SECONDS', 0.05)
+    response, state = turn_scheduler.schedule_turn('sessione-lenta', "ciao", {'phase': 'PRIMA'}, turn_seq=1)
+    assert (response, state) == (BUSY_MESSAGE, {'phase': 'PRIMA'})
+    assert events == [{'outcome': turn_scheduler.REJECT_WAIT_TIMEOUT, 'coalesced': True, 'response': BUSY_MESSAGE}]
+    release.set()
+    leader.join(5)
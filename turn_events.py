@@ -0,0 +1,360 @@
+# turn_events.py (Struttura Modulare a Fasi)
+# Eventi analitici per turno, scritti in formato colonnare (Parquet) per le analisi
+# aggregate ("dove si bloccano gli utenti?", "quante volte viene richiesta la SV2?",
+# "quale fase ha i turni più lenti?") senza dover leggere i log.
+# Ogni turno passato dallo scheduler produce un evento: sessione, fase prima/dopo, esito
+# (eseguito o rifiutato per carico), se era un duplicato servito da un altro turno
+# ('coalesced'), attesa in coda e durata, chiamate LLM (task, modello,
+# latenza, token, errori), fallback attivati per la deadline e campi dello schema modificati.
+# I testi dei messaggi e i valori dello schema NON vengono registrati (solo lunghezze e nomi).
+# Gli eventi sono accumulati in memoria e scritti a blocchi da un thread in background
+# (ogni TURN_EVENTS_FLUSH_EVENTS eventi o TURN_EVENTS_FLUSH_SECONDS secondi), in file
+# partizionati per giorno: <TURN_EVENTS_DIR>/date=AAAA-MM-GG/part-*.parquet
+# (leggibili come un unico dataset con load_events(), che applica lo schema fisso dei file).
+# pyarrow è una dipendenza richiesta: i file CSV sono solo un percorso degradato esplicito
+# (TURN_EVENTS_CSV_FALLBACK), altrimenti senza pyarrow gli eventi restano in buffer.
+#
+# Uso: python turn_events.py report [cartella]   -> riepilogo per fase
+
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import metrics
+from utils import log_message
+from state_store import diff_states
+from config import (
+    TURN_EVENTS_ENABLED, TURN_EVENTS_DIR, TURN_EVENTS_FLUSH_EVENTS, TURN_EVENTS_FLUSH_SECONDS,
+    TURN_EVENTS_MAX_BUFFERED, TURN_EVENTS_CSV_FALLBACK
+)
+
+# Colonne del dataset (ordine stabile tra i file delle partizioni)
+EVENT_COLUMNS = [
+    'ts', 'date', 'session_id', 'turn_seq', 'outcome', 'coalesced', 'phase_before', 'phase_after', 'phase_changed',
+    'queue_wait_seconds', 'duration_seconds', 'user_msg_chars', 'response_chars',
+    'llm_calls', 'llm_errors', 'llm_seconds', 'llm_input_tokens', 'llm_output_tokens',
+    'llm_tasks', 'llm_models', 'llm_latencies',
+    'fallbacks', 'fallback_count', 'schema_fields_changed', 'error',
+]
+# Colonne con liste (nel percorso degradato CSV vengono scritte come JSON)
+LIST_COLUMNS = ('llm_tasks', 'llm_models', 'llm_latencies', 'fallbacks', 'schema_fields_changed')
+
+
+def _file_schema():
+    """
+    Schema Parquet fisso (tutte le colonne nullable) dei file del dataset, senza 'date' (è nel
+    nome della partizione). Senza uno schema esplicito pyarrow dedurrebbe i tipi da ogni blocco:
+    una colonna tutta None (es. 'error', o 'turn_seq' senza sequenza) diventerebbe di tipo null
+    e i file non sarebbero più leggibili insieme a quelli con valori.
+    """
+    import pyarrow as pa
+    types = {
+        'ts': pa.timestamp('us', tz='UTC'), 'session_id': pa.string(), 'turn_seq': pa.int64(),
+        'outcome': pa.string(), 'coalesced': pa.bool_(), 'phase_before': pa.string(), 'phase_after': pa.string(), 'phase_changed': pa.bool_(),
+        'queue_wait_seconds': pa.float64(), 'duration_seconds': pa.float64(),
+        'user_msg_chars': pa.int64(), 'response_chars': pa.int64(),
+        'llm_calls': pa.int64(), 'llm_errors': pa.int64(), 'llm_seconds': pa.float64(),
+        'llm_input_tokens': pa.int64(), 'llm_output_tokens': pa.int64(),
+        'llm_tasks': pa.list_(pa.string()), 'llm_models': pa.list_(pa.string()), 'llm_latencies': pa.list_(pa.float64()),
+        'fallbacks': pa.list_(pa.string()), 'fallback_count': pa.int64(),
+        'schema_fields_changed': pa.list_(pa.string()), 'error': pa.string(),
+    }
+    return pa.schema([pa.field(column, types[column]) for column in EVENT_COLUMNS if column != 'date'])
+
+_current_recorder = contextvars.ContextVar('turn_recorder', default=None)
+
+
+class TurnRecorder:
+    """Raccoglie i dati di un turno; le chiamate LLM possono arrivare da più thread del turno."""
+
+    def __init__(self, session_id, turn_seq=None):
+        self.session_id = session_id
+        self.turn_seq = turn_seq
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.llm_calls = []  # (task, modello, latenza, token_input, token_output, ok)
+        self.error = None
+        self._lock = threading.Lock()
+
+    def run(self, func, *args, **kwargs):
+        """Esegue func segnando l'inizio effettivo del turno (la differenza con la creazione è l'attesa in coda)."""
+        self.started_at = time.monotonic()
+        return func(*args, **kwargs)
+
+    def add_llm_call(self, task, model_name, latency_seconds, input_tokens=0, output_tokens=0, ok=True):
+        with self._lock:
+            self.llm_calls.append((task, model_name, latency_seconds, input_tokens, output_tokens, ok))
+
+    def to_event(self, outcome, state_before, state_after, user_msg, bot_response, degradations=(), coalesced=False):
+        """Evento del turno (una riga del dataset); coalesced indica un duplicato che non ha eseguito il turno."""
+        finished_at = time.monotonic()
+        now = datetime.now(timezone.utc)
+        delta = diff_states(state_before, state_after)
+        with self._lock:
+            calls = list(self.llm_calls)
+        return {
+            'ts': now,
+            'date': now.strftime('%Y-%m-%d'),
+            'session_id': self.session_id,
+            'turn_seq': self.turn_seq,
+            'outcome': outcome,
+            'coalesced': coalesced,
+            'phase_before': delta['phase_from'] or 'START',
+            'phase_after': delta['phase_to'] or 'START',
+            'phase_changed': delta['phase_from'] != delta['phase_to'],
+            'queue_wait_seconds': (self.started_at or finished_at) - self.created_at,
+            'duration_seconds': finished_at - self.started_at if self.started_at is not None else 0.0,
+            'user_msg_chars': len(user_msg or ''),
+            'response_chars': len(bot_response or ''),
+            'llm_calls': len(calls),
+            'llm_errors': sum(1 for call in calls if not call[5]),
+            'llm_seconds': sum(call[2] for call in calls),
+            'llm_input_tokens': sum(call[3] for call in calls),
+            'llm_output_tokens': sum(call[4] for call in calls),
+            'llm_tasks': [call[0] for call in calls],
+            'llm_models': [call[1] or '' for call in calls],
+            'llm_latencies': [call[2] for call in calls],
+            'fallbacks': list(degradations),
+            'fallback_count': len(degradations),
+            'schema_fields_changed': sorted(delta['schema_changes']),
+            'error': self.error,
+        }
+
+
+@contextmanager
+def recording(recorder):
+    """Attiva 'recorder' per il codice del turno eseguito nel blocco (e nei thread con copy_context())."""
+    token = _current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_recorder.reset(token)
+
+
+def record_llm_call(task, model_name, latency_seconds, input_tokens=0, output_tokens=0, ok=True):
+    """Registra una chiamata LLM nel turno in corso (nessun effetto fuori da un turno, es. batch e script)."""
+    recorder = _current_recorder.get()
+    if recorder is not None:
+        recorder.add_llm_call(task, model_name, latency_seconds, input_tokens, output_tokens, ok)
+
+
+def record_error(error):
+    """Registra l'errore (tipo di eccezione) che ha fatto ripiegare il turno sulla risposta di errore."""
+    recorder = _current_recorder.get()
+    if recorder is not None:
+        recorder.error = error
+
+
+class TurnEventWriter:
+    """
+    Buffer degli eventi del processo, scritto a blocchi in file Parquet partizionati per giorno.
+    Se la scrittura fallisce gli eventi restano nel buffer (al massimo max_buffered, poi i più
+    vecchi vengono scartati) e vengono riscritti al blocco successivo.
+    """
+
+    def __init__(self, output_dir, flush_events, flush_seconds, max_buffered):
+        self.output_dir = output_dir
+        self.flush_events = max(1, int(flush_events))
+        self.flush_seconds = flush_seconds
+        self.max_buffered = max_buffered
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()  # Un solo blocco alla volta (thread di flush e atexit)
+        self._flusher = None
+        self._file_prefix = f"part-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._file_seq = 0
+        self._warned_csv = False
+
+    def append(self, event):
+        with self._cond:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="turn-events-writer", daemon=True)
+                self._flusher.start()
+            self._buffer.append(event)
+            dropped = len(self._buffer) - self.max_buffered
+            if dropped > 0:
+                del self._buffer[:dropped]
+                metrics.increment('turn_events.dropped', dropped)
+            if len(self._buffer) >= self.flush_events:
+                self._cond.notify_all()
+        metrics.increment('turn_events.recorded')
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buffer) >= self.flush_events, timeout=self.flush_seconds)
+            if self.flush() is None:
+                time.sleep(self.flush_seconds)  # Scrittura fallita: niente tentativi a vuoto a buffer pieno
+
+    def flush(self):
+        """Scrive gli eventi in buffer (un file per partizione). Restituisce gli eventi scritti (None se fallisce)."""
+        with self._write_lock:
+            with self._cond:
+                events, self._buffer = self._buffer, []
+            if not events:
+                return 0
+            try:
+                by_date = {}
+                for event in events:
+                    by_date.setdefault(event['date'], []).append(event)
+                for date, rows in by_date.items():
+                    self._write_partition(date, rows)
+            except Exception as e:
+                metrics.increment('turn_events.write_errors')
+                log_message(f"Turn Events: ERRORE nella scrittura di {len(events)} eventi ({type(e).__name__}: {e}). Riprovo al prossimo blocco.")
+                with self._cond:
+                    self._buffer[:0] = events
+                    dropped = len(self._buffer) - self.max_buffered
+                    if dropped > 0:
+                        del self._buffer[:dropped]
+                        metrics.increment('turn_events.dropped', dropped)
+                return None
+            metrics.increment('turn_events.written', len(events))
+            log_message(f"Turn Events: Scritti {len(events)} eventi in {self.output_dir}.")
+            return len(events)
+
+    def _write_partition(self, date, rows):
+        partition_dir = os.path.join(self.output_dir, f"date={date}")
+        os.makedirs(partition_dir, exist_ok=True)
+        self._file_seq += 1
+        base_path = os.path.join(partition_dir, f"{self._file_prefix}-{self._file_seq:06d}")
+        # La data è nel nome della partizione: come nei dataset Hive non è ripetuta nel file
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            if not TURN_EVENTS_CSV_FALLBACK:
+                raise ImportError(f"pyarrow non disponibile ({e}): installalo (requirements.txt) "
+                                  "o abilita TURN_EVENTS_CSV_FALLBACK") from e
+            self._write_csv(base_path, rows, e)
+            return
+        schema = _file_schema()
+        pq.write_table(pa.Table.from_pylist([{column: row.get(column) for column in schema.names} for row in rows],
+                                            schema=schema),
+                       base_path + '.parquet')
+
+    def _write_csv(self, base_path, rows, reason):
+        """Percorso degradato senza pyarrow: CSV con le colonne lista serializzate in JSON (tipi non garantiti)."""
+        if not self._warned_csv:
+            log_message(f"Turn Events: WARN - pyarrow non disponibile ({reason}). Percorso degradato "
+                        "(TURN_EVENTS_CSV_FALLBACK): scrivo file CSV.")
+            self._warned_csv = True
+        import pandas as pd
+        df = pd.DataFrame(rows, columns=EVENT_COLUMNS).drop(columns=['date'])
+        for column in LIST_COLUMNS:
+            df[column] = df[column].map(json.dumps)
+        df.to_csv(base_path + '.csv', index=False)
+        metrics.increment('turn_events.csv_files')
+
+    def stats(self):
+        with self._cond:
+            buffered = len(self._buffer)
+        counters = metrics.snapshot(prefix='turn_events.')['counters']
+        return {
+            'buffered': buffered,
+            'recorded': counters.get('turn_events.recorded', 0),
+            'written': counters.get('turn_events.written', 0),
+            'dropped': counters.get('turn_events.dropped', 0),
+            'write_errors': counters.get('turn_events.write_errors', 0),
+        }
+
+
+# Writer condiviso da tutte le sessioni del processo; gli eventi in buffer sono scritti all'uscita
+_writer = TurnEventWriter(TURN_EVENTS_DIR, TURN_EVENTS_FLUSH_EVENTS, TURN_EVENTS_FLUSH_SECONDS, TURN_EVENTS_MAX_BUFFERED)
+atexit.register(_writer.flush)
+
+
+def get_writer():
+    """Restituisce il writer degli eventi condiviso del processo."""
+    return _writer
+
+
+def emit(recorder, outcome, state_before, state_after, user_msg, bot_response, degradations=(), coalesced=False):
+    """
+    Costruisce l'evento del turno e lo accoda per la scrittura (nessun effetto se disattivato).
+    outcome è 'ok' per i turni eseguiti, altrimenti il motivo del rifiuto dello scheduler;
+    coalesced è True per i duplicati che hanno atteso (o riusato) il risultato di un altro turno.
+    """
+    if not TURN_EVENTS_ENABLED:
+        return
+    try:
+        _writer.append(recorder.to_event(outcome, state_before, state_after, user_msg, bot_response, degradations, coalesced))
+    except Exception as e:
+        # L'analisi non deve mai far fallire un turno
+        log_message(f"Turn Events: WARN - Evento del turno non registrato ({type(e).__name__}: {e}).")
+
+
+def load_events(events_dir=TURN_EVENTS_DIR):
+    """Carica il dataset degli eventi (tutte le partizioni) in un DataFrame pandas."""
+    import pandas as pd
+    parquet_files, csv_files = [], []
+    for root, _dirs, files in os.walk(events_dir):
+        for name in files:
+            if name.endswith('.parquet'):
+                parquet_files.append(os.path.join(root, name))
+            elif name.endswith('.csv'):
+                csv_files.append(os.path.join(root, name))
+    frames = []
+    if parquet_files:
+        # Ogni file letto con lo schema fisso (anche quelli scritti prima dello schema esplicito,
+        # con colonne di tipo null): i tipi restano coerenti tra le partizioni
+        import pyarrow.parquet as pq
+        schema = _file_schema()
+        for path in parquet_files:
+            frame = pq.read_table(path, schema=schema).to_pandas()
+            frame['date'] = os.path.basename(os.path.dirname(path)).split('=', 1)[-1]
+            frames.append(frame)
+    for path in csv_files:
+        frame = pd.read_csv(path)
+        frame['date'] = os.path.basename(os.path.dirname(path)).split('=', 1)[-1]
+        for column in LIST_COLUMNS:
+            frame[column] = frame[column].map(json.loads)
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    # I CSV scritti prima di una nuova colonna (es. 'coalesced') la ricevono vuota
+    return pd.concat(frames, ignore_index=True).reindex(columns=EVENT_COLUMNS)
+
+
+def phase_report(events):
+    """
+    Riepilogo per fase dei turni eseguiti: turni, turni senza avanzamento (la stessa domanda
+    viene riproposta), sessioni che si sono fermate nella fase, durata e chiamate LLM.
+    I duplicati coalescenti sono contati a parte (non hanno eseguito un turno).
+    """
+    is_coalesced = events['coalesced'].fillna(False).astype(bool)
+    coalesced, events = events[is_coalesced], events[~is_coalesced]
+    executed = events[events['outcome'] == 'ok']
+    last_phase = executed.sort_values('ts').groupby('session_id')['phase_after'].last()
+    report = executed.groupby('phase_before').agg(
+        turns=('session_id', 'size'),
+        repeated=('phase_changed', lambda changed: int((~changed.astype(bool)).sum())),
+        duration_p50=('duration_seconds', 'median'),
+        duration_p95=('duration_seconds', lambda values: values.quantile(0.95)),
+        llm_calls_mean=('llm_calls', 'mean'),
+        fallback_turns=('fallback_count', lambda counts: int((counts > 0).sum())),
+    )
+    report['repeated_rate'] = report['repeated'] / report['turns']
+    report['stalled_sessions'] = last_phase.value_counts().reindex(report.index, fill_value=0)
+    report['rejected'] = events[events['outcome'] != 'ok'].groupby('phase_before').size().reindex(report.index, fill_value=0)
+    report['coalesced'] = coalesced.groupby('phase_before').size().reindex(report.index, fill_value=0)
+    return report.sort_values('duration_p95', ascending=False)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "report":
+        all_events = load_events(sys.argv[2] if len(sys.argv) > 2 else TURN_EVENTS_DIR)
+        if all_events.empty:
+            print("Nessun evento registrato.")
+        else:
+            print(f"{len(all_events)} turni, {all_events['session_id'].nunique()} sessioni.")
+            print(phase_report(all_events).to_string())
+    else:
+        print("Uso: python turn_events.py report [cartella]")
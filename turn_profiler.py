@@ -0,0 +1,170 @@
+# turn_profiler.py (Struttura Modulare a Fasi)
+# Profilatura opzionale (cProfile) dei turni e dei rerun dell'app: mostra dove va il tempo
+# CPU dentro il codice Python (costruzione dei prompt, history, pulizia del JSON, rendering
+# Streamlit), che gli span di durata delle chiamate non rendono visibile.
+# - Per processo: variabile d'ambiente DOCBOT_PROFILE_TURNS=N profila un turno di
+#   process_user_message ogni N (1 = tutti), vedi config.TURN_PROFILER_EVERY_N_TURNS.
+# - Per sessione: il toggle nella sidebar profila ogni rerun della chat (turno compreso).
+# Ogni profilo viene salvato in TURN_PROFILER_DIR (file .prof, leggibile con pstats o
+# snakeviz) e riassunto nelle TURN_PROFILER_TOP_N funzioni per tempo proprio e cumulativo.
+# Disattivata non ha costi: il turno chiama direttamente process_user_message.
+#
+# cProfile misura solo il thread che lo attiva: il lavoro dei thread di supporto (estrazione
+# in parallelo, batcher, precalcolo speculativo) compare come attesa del thread del turno.
+# Report di un profilo salvato: python turn_profiler.py report <file.prof> [N]
+
+import os
+import cProfile
+import pstats
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import nullcontext
+from itertools import count
+
+import metrics
+from utils import log_message
+from config import TURN_PROFILER_EVERY_N_TURNS, TURN_PROFILER_DIR, TURN_PROFILER_TOP_N, TURN_PROFILER_MAX_FILES
+
+RECENT_REPORTS = 20  # Report tenuti in memoria per la sidebar
+
+_recent = deque(maxlen=RECENT_REPORTS)
+_recent_lock = threading.Lock()
+_active = threading.local()  # Profilo attivo nel thread (i profili annidati non partono)
+_turn_counter = count()
+
+
+def sample_turn():
+    """True se questo turno va profilato secondo TURN_PROFILER_EVERY_N_TURNS (0 = mai)."""
+    return TURN_PROFILER_EVERY_N_TURNS > 0 and next(_turn_counter) % TURN_PROFILER_EVERY_N_TURNS == 0
+
+
+def _function_label(key):
+    filename, line, name = key
+    if filename == '~':  # Funzioni built-in
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+def top_functions(stats, top_n=TURN_PROFILER_TOP_N):
+    """
+    Funzioni più costose di un profilo.
+
+    Args:
+        stats (pstats.Stats): Il profilo.
+        top_n (int): Funzioni per classifica.
+
+    Returns:
+        dict: {'self': [...], 'cumulative': [...]}, righe {'funzione', 'chiamate', 'proprio_ms', 'cumulativo_ms'}.
+    """
+    rows = [{'funzione': _function_label(key), 'chiamate': calls,
+             'proprio_ms': round(self_seconds * 1000, 2), 'cumulativo_ms': round(cumulative_seconds * 1000, 2)}
+            for key, (_, calls, self_seconds, cumulative_seconds, _) in stats.stats.items()]
+    return {
+        'self': sorted(rows, key=lambda row: row['proprio_ms'], reverse=True)[:top_n],
+        'cumulative': sorted(rows, key=lambda row: row['cumulativo_ms'], reverse=True)[:top_n],
+    }
+
+
+def _save(profile, label):
+    """Salva il profilo in TURN_PROFILER_DIR (mantenendo gli ultimi TURN_PROFILER_MAX_FILES); None se fallisce."""
+    try:
+        os.makedirs(TURN_PROFILER_DIR, exist_ok=True)
+        path = os.path.join(TURN_PROFILER_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{uuid.uuid4().hex[:6]}.prof")
+        profile.dump_stats(path)
+        saved = sorted(name for name in os.listdir(TURN_PROFILER_DIR) if name.endswith('.prof'))
+        for name in saved[:max(0, len(saved) - TURN_PROFILER_MAX_FILES)]:
+            os.remove(os.path.join(TURN_PROFILER_DIR, name))
+        return path
+    except OSError as e:
+        log_message(f"Turn Profiler: WARN - Profilo '{label}' non salvato ({e}).")
+        return None
+
+
+class _Profiling:
+    """Context manager: profila il blocco nel thread corrente e ne registra il report."""
+
+    def __init__(self, label, session_id):
+        self.label = label
+        self.session_id = session_id
+        self._profile = None
+
+    def __enter__(self):
+        if getattr(_active, 'profile', None) is not None:
+            metrics.increment('profiler.skipped_nested')  # Il profilo esterno include già questo blocco
+            return self
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Un altro profiler è attivo nel processo
+            metrics.increment('profiler.skipped_busy')
+            return self
+        self._profile = _active.profile = profile
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        profile = self._profile
+        if profile is None:
+            return False
+        profile.disable()
+        _active.profile = None
+        seconds = time.perf_counter() - self._started
+        try:
+            functions = top_functions(pstats.Stats(profile))
+        except Exception as e:  # Il report non deve mai far fallire il turno
+            log_message(f"Turn Profiler: ERRORE nel report del profilo '{self.label}' ({type(e).__name__}: {e}).")
+            return False
+        report = {'label': self.label, 'session_id': self.session_id, 'ts': time.time(),
+                  'seconds': seconds, 'path': _save(profile, self.label), **functions}
+        with _recent_lock:
+            _recent.append(report)
+        metrics.increment('profiler.profiles')
+        metrics.observe(f'profiler.{self.label}_seconds', seconds)
+        hottest = report['self'][0]['funzione'] if report['self'] else "N/D"
+        log_message(f"Turn Profiler: Profilo '{self.label}' ({seconds * 1000:.0f} ms), funzione più costosa: {hottest}. File: {report['path']}")
+        return False
+
+
+def profiling(label, session_id=None, enabled=True):
+    """
+    Context manager che profila il blocco (un nullcontext se enabled è False).
+
+    Args:
+        label (str): Nome del profilo ('turn', 'rerun', ...), usato anche nel nome del file.
+        session_id (str | None): Sessione a cui mostrare il report nella sidebar.
+        enabled (bool): Se False il blocco non viene profilato.
+    """
+    return _Profiling(label, session_id) if enabled else nullcontext()
+
+
+def profiled(func, label, session_id=None, enabled=True):
+    """func stessa se enabled è False, altrimenti una funzione che la esegue dentro profiling(label)."""
+    if not enabled:
+        return func
+    def run(*args, **kwargs):
+        with profiling(label, session_id):
+            return func(*args, **kwargs)
+    return run
+
+
+def recent_reports(session_id=None):
+    """Report più recenti per primi (solo quelli della sessione, se indicata)."""
+    with _recent_lock:
+        reports = list(_recent)
+    return [report for report in reversed(reports) if session_id is None or report['session_id'] == session_id]
+
+
+if __name__ == "__main__":
+    # Uso: python turn_profiler.py report profiles/<file>.prof [N]
+    import sys
+    if len(sys.argv) >= 3 and sys.argv[1] == "report":
+        top_n = int(sys.argv[3]) if len(sys.argv) >= 4 else TURN_PROFILER_TOP_N
+        functions = top_functions(pstats.Stats(sys.argv[2]), top_n)
+        for ranking, title in (('self', "tempo proprio"), ('cumulative', "tempo cumulativo")):
+            print(f"--- Top {top_n} per {title} ---")
+            for row in functions[ranking]:
+                print(f"{row['proprio_ms']:10.2f} {row['cumulativo_ms']:10.2f} {row['chiamate']:8d}  {row['funzione']}")
+    else:
+        print("Uso: python turn_profiler.py report <file.prof> [N]")
@@ -0,0 +1,232 @@
+# turn_scheduler.py (Struttura Modulare a Fasi)
+# Scheduler dei turni posto davanti a state_manager.process_user_message.
+# Limita il numero di turni (chiamate LLM) eseguiti contemporaneamente nel processo,
+# mette in coda gli altri con profondità massima e tempo di attesa massimo (SLO)
+# e risponde subito con un messaggio "occupato" quando il sistema è saturo.
+# Ogni sessione può avere al massimo un turno in coda o in esecuzione.
+# I turni duplicati (stessa sessione, stesso numero di sequenza, stesso messaggio) non
+# vengono rieseguiti: si accodano a quello in corso o ne riusano il risultato.
+# Dopo ogni turno viene verificata la previsione speculativa precedente della sessione e
+# avviata quella per il turno successivo (vedi speculation.py).
+# Ogni turno (eseguito o rifiutato) produce un evento analitico (vedi turn_events.py).
+# Il turno e il precalcolo speculativo usano la knowledge base (namespace RAG) della sessione.
+# Con DOCBOT_PROFILE_TURNS un turno ogni N viene profilato (vedi turn_profiler.py).
+
+import hashlib
+import threading
+import time
+from collections import deque, OrderedDict
+
+import metrics
+import speculation
+import turn_events
+import turn_profiler
+from utils import log_message
+from state_manager import process_user_message, plan_speculation
+from rag_utils import knowledge_base_scope
+from deadline import TurnDeadline
+from singleflight import SingleFlight, WaitTimeoutError
+from config import (
+    TURN_MAX_CONCURRENCY, TURN_QUEUE_MAX_DEPTH, TURN_QUEUE_MAX_WAIT_SECONDS, BUSY_MESSAGE,
+    TURN_DEADLINE_SECONDS, TURN_RESULT_CACHE_MAX_SESSIONS
+)
+
+# Motivi di rifiuto (usati anche come suffisso delle metriche)
+REJECT_SESSION_BUSY = 'session_busy'
+REJECT_QUEUE_FULL = 'queue_full'
+REJECT_WAIT_TIMEOUT = 'wait_timeout'
+REJECT_PREDICTED_WAIT = 'predicted_wait'
+
+
+class TurnScheduler:
+    """
+    Admission control per i turni di conversazione.
+
+    Il turno viene eseguito nel thread chiamante (quello della sessione Streamlit,
+    che mantiene così l'accesso a st.session_state): lo scheduler decide solo
+    QUANDO può partire, rispettando il limite di concorrenza e l'ordine FIFO.
+    """
+
+    def __init__(self, max_concurrency, max_queue_depth, max_wait_seconds):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue_depth = max(0, int(max_queue_depth))
+        self.max_wait_seconds = float(max_wait_seconds)
+        self._cond = threading.Condition()
+        self._active = 0
+        self._queue = deque()
+        self._sessions = set()  # Sessioni con un turno in coda o in esecuzione
+        self._avg_turn_seconds = None  # Media mobile esponenziale della durata dei turni
+
+    def _publish_gauges(self):
+        metrics.set_gauge('turns.queue_depth', len(self._queue))
+        metrics.set_gauge('turns.active', self._active)
+
+    def _predicted_wait(self, queue_position):
+        """Stima dell'attesa per chi entra in coda alla posizione indicata (0 = primo)."""
+        if self._avg_turn_seconds is None:
+            return 0.0
+        return (queue_position + 1) * self._avg_turn_seconds / self.max_concurrency
+
+    def _reject(self, session_id, reason):
+        metrics.increment(f'turns.rejected.{reason}')
+        log_message(f"Turn Scheduler: Turno rifiutato per sessione '{session_id}' ({reason}). "
+                    f"Attivi: {self._active}/{self.max_concurrency}, In coda: {len(self._queue)}")
+        return False, reason
+
+    def run(self, session_id, func, *args, **kwargs):
+        """
+        Esegue func(*args, **kwargs) appena c'è capacità disponibile.
+
+        Returns:
+            tuple: (True, risultato_di_func) se eseguito,
+                   (False, motivo_rifiuto) se rifiutato.
+        """
+        enqueued_at = time.monotonic()
+        ticket = object()
+        with self._cond:
+            if session_id in self._sessions:
+                return self._reject(session_id, REJECT_SESSION_BUSY)
+            if self._active >= self.max_concurrency or self._queue:
+                if len(self._queue) >= self.max_queue_depth:
+                    return self._reject(session_id, REJECT_QUEUE_FULL)
+                if self._predicted_wait(len(self._queue)) > self.max_wait_seconds:
+                    return self._reject(session_id, REJECT_PREDICTED_WAIT)
+                self._queue.append(ticket)
+                self._sessions.add(session_id)
+                self._publish_gauges()
+                wait_deadline = enqueued_at + self.max_wait_seconds
+                while not (self._queue[0] is ticket and self._active < self.max_concurrency):
+                    remaining = wait_deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._queue.remove(ticket)
+                        self._sessions.discard(session_id)
+                        self._publish_gauges()
+                        self._cond.notify_all()  # Il prossimo in coda potrebbe ora essere in testa
+                        metrics.observe('turns.queue_wait_seconds', time.monotonic() - enqueued_at)
+                        return self._reject(session_id, REJECT_WAIT_TIMEOUT)
+                    self._cond.wait(remaining)
+                self._queue.popleft()
+            else:
+                self._sessions.add(session_id)
+            self._active += 1
+            self._publish_gauges()
+            self._cond.notify_all()
+
+        started_at = time.monotonic()
+        metrics.observe('turns.queue_wait_seconds', started_at - enqueued_at)
+        metrics.increment('turns.accepted')
+        try:
+            return True, func(*args, **kwargs)
+        finally:
+            duration = time.monotonic() - started_at
+            metrics.observe('turns.duration_seconds', duration)
+            with self._cond:
+                self._active -= 1
+                self._sessions.discard(session_id)
+                if self._avg_turn_seconds is None:
+                    self._avg_turn_seconds = duration
+                else:
+                    self._avg_turn_seconds = 0.8 * self._avg_turn_seconds + 0.2 * duration
+                self._publish_gauges()
+                self._cond.notify_all()
+
+    def stats(self):
+        """Stato istantaneo dello scheduler (per debug/sidebar)."""
+        with self._cond:
+            return {
+                'active': self._active,
+                'max_concurrency': self.max_concurrency,
+                'queue_depth': len(self._queue),
+                'max_queue_depth': self.max_queue_depth,
+                'avg_turn_seconds': self._avg_turn_seconds,
+            }
+
+
+# Istanza condivisa da tutte le sessioni del processo
+_scheduler = TurnScheduler(TURN_MAX_CONCURRENCY, TURN_QUEUE_MAX_DEPTH, TURN_QUEUE_MAX_WAIT_SECONDS)
+
+
+def get_scheduler():
+    """Restituisce lo scheduler condiviso del processo."""
+    return _scheduler
+
+
+# Turni in corso (coalescenza dei duplicati) e ultimo turno completato per sessione
+_turn_flights = SingleFlight('turns')
+_completed_turns = OrderedDict()  # session_id -> (chiave_turno, risultato)
+_completed_turns_lock = threading.Lock()
+
+
+def _run_turn(session_id, user_msg, current_state, journal, turn_seq=None, namespace=None):
+    """Esegue il turno; restituisce (esito, (risposta, stato)) con esito 'ok' o il motivo del rifiuto."""
+    deadline = TurnDeadline(TURN_DEADLINE_SECONDS)
+    recorder = turn_events.TurnRecorder(session_id, turn_seq)
+    with knowledge_base_scope(namespace):
+        with turn_events.recording(recorder):
+            turn_func = turn_profiler.profiled(process_user_message, 'turn', session_id, enabled=turn_profiler.sample_turn())
+            accepted, result = _scheduler.run(session_id, recorder.run, turn_func, user_msg, current_state,
+                                              journal=journal, deadline=deadline)
+        if not accepted:
+            turn_events.emit(recorder, result, current_state, current_state, user_msg, BUSY_MESSAGE)
+            return result, (BUSY_MESSAGE, current_state)
+        bot_response, new_state = result
+        turn_events.emit(recorder, 'ok', current_state, new_state, user_msg, bot_response, deadline.degradations)
+        speculation.resolve(session_id, new_state.get('phase'))
+        plan = plan_speculation(new_state, bot_response)
+        if plan:
+            speculation.speculate(session_id, *plan)
+    return 'ok', result
+
+
+def schedule_turn(session_id, user_msg, current_state, journal=None, turn_seq=None, namespace=None):
+    """
+    Esegue process_user_message passando dallo scheduler condiviso.
+
+    Se il turno viene rifiutato restituisce BUSY_MESSAGE e lo stato invariato,
+    così l'utente può semplicemente riprovare. La deadline del turno parte all'arrivo
+    del messaggio: il tempo passato in coda riduce il budget delle chiamate.
+
+    Se turn_seq è indicato (numero di turni già completati dalla sessione) il turno è
+    idempotente: un duplicato con la stessa sessione, sequenza e messaggio condivide il
+    turno in corso oppure riceve il risultato già calcolato, senza una seconda transizione.
+    Il duplicato attende al massimo la propria deadline (dal suo arrivo), poi riceve
+    BUSY_MESSAGE; ne viene registrato un evento con coalesced=True.
+
+    namespace è la knowledge base RAG della sessione (None = RAG_DEFAULT_NAMESPACE).
+
+    Returns:
+        tuple: (str, dict) -> (risposta_del_bot, nuovo_stato)
+    """
+    if turn_seq is None:
+        return _run_turn(session_id, user_msg, current_state, journal, namespace=namespace)[1]
+
+    turn_key = (session_id, turn_seq, hashlib.sha256(user_msg.encode('utf-8')).hexdigest())
+    with _completed_turns_lock:
+        completed = _completed_turns.get(session_id)
+    recorder = turn_events.TurnRecorder(session_id, turn_seq)  # Evento del duplicato (se lo è)
+    if completed and completed[0] == turn_key:
+        metrics.increment('turns.deduplicated')
+        log_message(f"Turn Scheduler: Turno #{turn_seq} della sessione '{session_id}' già elaborato, riuso il risultato.")
+        turn_events.emit(recorder, 'ok', current_state, completed[1][1], user_msg, completed[1][0], coalesced=True)
+        return completed[1]
+
+    # Deadline propria del duplicato: non attende il turno in corso oltre il proprio budget
+    deadline = TurnDeadline(TURN_DEADLINE_SECONDS)
+    try:
+        (outcome, result), shared = _turn_flights.do(turn_key, _run_turn, session_id, user_msg, current_state, journal,
+                                                     turn_seq, namespace, wait_timeout=deadline.remaining())
+    except WaitTimeoutError:
+        metrics.increment(f'turns.rejected.coalesced_{REJECT_WAIT_TIMEOUT}')
+        log_message(f"Turn Scheduler: Turno #{turn_seq} duplicato per sessione '{session_id}', attesa del turno in corso scaduta.")
+        turn_events.emit(recorder, REJECT_WAIT_TIMEOUT, current_state, current_state, user_msg, BUSY_MESSAGE, coalesced=True)
+        return BUSY_MESSAGE, current_state
+    if shared:
+        log_message(f"Turn Scheduler: Turno #{turn_seq} duplicato per sessione '{session_id}', risultato condiviso.")
+        turn_events.emit(recorder, outcome, current_state, result[1], user_msg, result[0], coalesced=True)
+    elif outcome == 'ok':
+        with _completed_turns_lock:
+            _completed_turns[session_id] = (turn_key, result)
+            _completed_turns.move_to_end(session_id)
+            while len(_completed_turns) > TURN_RESULT_CACHE_MAX_SESSIONS:
+                _completed_turns.popitem(last=False)
+    return result
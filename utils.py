@@ -1,9 +1,12 @@
 # utils.py (Struttura Modulare a Fasi)
 # Questo file rimane invariato rispetto alla versione precedente (ibrida).
 # Contiene funzioni di utilità come il logging.
+# Streamlit viene importato solo quando serve (accesso a session_state / messaggi UI),
+# così i moduli logici restano importabili rapidamente e anche senza Streamlit.
 
 import datetime
-import streamlit as st
+import time
+from contextlib import contextmanager
 
 def log_message(message):
     """Funzione semplice per stampare messaggi di log con timestamp sulla console."""
@@ -13,4 +16,57 @@ def log_message(message):
     except Exception as e:
         print(f"LOGGING ERROR: {e} - Original message: {message}")
 
+def get_session_value(key, default=None):
+    """
+    Legge un valore da st.session_state, importando Streamlit solo al primo uso.
+    Restituisce 'default' se Streamlit non è disponibile o se non c'è una sessione attiva
+    (es. esecuzione headless o thread di background).
+    """
+    try:
+        import streamlit as st
+        return st.session_state.get(key, default)
+    except Exception:
+        return default
+
+def show_ui_message(kind, text):
+    """
+    Mostra un messaggio nella UI Streamlit (kind: 'warning', 'error', 'info').
+    Fuori da una sessione Streamlit il messaggio viene solo registrato nel log.
+    """
+    try:
+        import streamlit as st
+        getattr(st, kind)(text)
+    except Exception:
+        log_message(f"UI ({kind}): {text}")
+
+class StartupProfiler:
+    """
+    Misura la durata delle fasi di avvio (import e step di inizializzazione)
+    e ne produce un report, per rendere visibili le regressioni del cold start.
+    """
+
+    def __init__(self):
+        self.created_at = time.perf_counter()
+        self.stages = [] # Lista di (nome_fase, secondi)
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager che registra la durata del blocco come fase 'name'."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - started))
+
+    def total_seconds(self):
+        return time.perf_counter() - self.created_at
+
+    def report(self, title="Profilo di avvio"):
+        """Registra nel log il tempo per fase e restituisce le fasi come lista di dict."""
+        lines = [f"--- {title} (totale {self.total_seconds() * 1000:.0f} ms) ---"]
+        for name, seconds in self.stages:
+            lines.append(f"   {name:<45} {seconds * 1000:8.1f} ms")
+        log_message("\n".join(lines))
+        return [{'fase': name, 'ms': round(seconds * 1000, 1)} for name, seconds in self.stages]
+
 # Aggiungi qui altre funzioni di utilità se necessario